@@ -0,0 +1,97 @@
+"""Планы запросов к smuggle_runs до и после перевода end_time из TEXT в TIMESTAMPTZ.
+
+    DATABASE_URL=postgresql://... python benchmarks/bench_smuggle_runs.py [строк]
+
+Нужна настоящая PostgreSQL. Во временных таблицах (исчезают вместе с соединением)
+создаются две копии smuggle_runs на 5 млн строк по умолчанию: старая схема с TEXT-датой
+и индексом по ней и новая – TIMESTAMPTZ с idx_smuggle_runs_end и частичным
+idx_smuggle_runs_due. Почти все рейсы завершены, в пути – доля IN_PROGRESS_SHARE.
+Для каждого запроса печатается EXPLAIN (ANALYZE, BUFFERS) обеих версий.
+"""
+import asyncio
+import os
+import sys
+
+import asyncpg
+
+IN_PROGRESS_SHARE = 0.001
+
+FILL_SQL = """
+    INSERT INTO {table} (user_id, start_time, end_time, status, notified)
+    SELECT g % 100000,
+           (NOW() - make_interval(mins => g % 525600))::timestamp::text,
+           {end_time},
+           CASE WHEN random() < {share} THEN 'in_progress' ELSE 'completed' END,
+           FALSE
+    FROM generate_series(1, $1) AS g
+"""
+
+# (название, запрос по старой схеме, запрос по новой) – как их выполнял бот
+QUERIES = [
+    (
+        "наступившие рейсы (расчёт контрабанды)",
+        "SELECT id FROM runs_text WHERE status = 'in_progress' AND notified = FALSE "
+        "AND end_time::timestamp <= NOW()",
+        "SELECT id FROM runs_tz WHERE status = 'in_progress' AND notified = FALSE AND end_time <= NOW()",
+    ),
+    (
+        "загрузка таймеров при старте",
+        "SELECT id, end_time FROM runs_text WHERE status = 'in_progress' AND notified = FALSE",
+        "SELECT id, end_time FROM runs_tz WHERE status = 'in_progress' AND notified = FALSE",
+    ),
+    (
+        "очистка старых рейсов",
+        "SELECT count(*) FROM runs_text WHERE status IN ('completed', 'failed') "
+        "AND end_time::timestamp < NOW() - interval '360 days'",
+        "SELECT count(*) FROM runs_tz WHERE status IN ('completed', 'failed') "
+        "AND end_time < NOW() - interval '360 days'",
+    ),
+]
+
+
+async def create_tables(conn, rows: int):
+    for table, end_type, end_time in (
+        ('runs_text', 'TEXT', "(NOW() - make_interval(mins => g % 525600 - 60))::timestamp::text"),
+        ('runs_tz', 'TIMESTAMPTZ', "NOW() - make_interval(mins => g % 525600 - 60)"),
+    ):
+        await conn.execute(f"""
+            CREATE TEMP TABLE {table} (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                start_time TEXT NOT NULL,
+                end_time {end_type} NOT NULL,
+                status TEXT DEFAULT 'in_progress',
+                notified BOOLEAN DEFAULT FALSE
+            )
+        """)
+        await conn.execute(FILL_SQL.format(table=table, end_time=end_time, share=IN_PROGRESS_SHARE), rows)
+        await conn.execute(f"CREATE INDEX ON {table}(end_time)")
+    await conn.execute(
+        "CREATE INDEX ON runs_tz(end_time) WHERE status = 'in_progress' AND notified = FALSE"
+    )
+    await conn.execute("ANALYZE runs_text")
+    await conn.execute("ANALYZE runs_tz")
+
+
+async def explain(conn, query: str) -> str:
+    rows = await conn.fetch("EXPLAIN (ANALYZE, BUFFERS) " + query)
+    return "\n".join("    " + r[0] for r in rows)
+
+
+async def main(rows: int = 5_000_000):
+    conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    try:
+        print(f"заполняем две таблицы по {rows:,} строк...")
+        await create_tables(conn, rows)
+        for title, before, after in QUERIES:
+            print(f"\n=== {title} ===")
+            print("  до (TEXT):")
+            print(await explain(conn, before))
+            print("  после (TIMESTAMPTZ):")
+            print(await explain(conn, after))
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000))
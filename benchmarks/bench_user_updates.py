@@ -0,0 +1,126 @@
+"""Пропускная способность горячих UPDATE: широкая таблица users против узкой user_wallet.
+
+    DATABASE_URL=postgresql://... python benchmarks/bench_user_updates.py [пользователей] [секунд] [соединений]
+
+Нужна настоящая PostgreSQL. В отдельной схеме bench_user_updates (удаляется в конце)
+создаются две таблицы с одинаковыми пользователями:
+  * до – прежняя широкая users: все колонки в одной строке, индексы по balance,
+    total_spent и exp, fillfactor по умолчанию;
+  * после – user_wallet из миграции 9: только деньги, fillfactor 50, без индексов
+    по часто меняющимся колонкам.
+Несколько соединений параллельно списывают и зачисляют баланс случайным пользователям
+(тот же UPDATE, что WALLET_BALANCE_SQL). Печатаются UPDATE/с, доля HOT-обновлений
+и размер таблицы с индексами после прогона.
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+import asyncpg
+
+SCHEMA = "bench_user_updates"
+
+WIDE_TABLE = f"""
+    CREATE TABLE {SCHEMA}.users_wide (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT, first_name TEXT, joined_date TIMESTAMPTZ DEFAULT NOW(),
+        balance BIGINT DEFAULT 0, negative_balance BIGINT DEFAULT 0,
+        total_spent BIGINT DEFAULT 0, bitcoin_balance BIGINT DEFAULT 0,
+        exp INTEGER DEFAULT 0, level INTEGER DEFAULT 1, strength INTEGER DEFAULT 1,
+        agility INTEGER DEFAULT 1, defense INTEGER DEFAULT 1, reputation INTEGER DEFAULT 0,
+        authority_balance INTEGER DEFAULT 0, bot_blocked BOOLEAN DEFAULT FALSE,
+        last_bonus TIMESTAMPTZ, last_theft_time TIMESTAMPTZ, last_gift_time TIMESTAMPTZ,
+        casino_wins INTEGER DEFAULT 0, casino_losses INTEGER DEFAULT 0,
+        dice_wins INTEGER DEFAULT 0, dice_losses INTEGER DEFAULT 0,
+        theft_attempts INTEGER DEFAULT 0, theft_success INTEGER DEFAULT 0,
+        smuggle_success INTEGER DEFAULT 0, smuggle_fail INTEGER DEFAULT 0
+    )
+"""
+WIDE_INDEXES = [
+    f"CREATE INDEX ON {SCHEMA}.users_wide(balance)",
+    f"CREATE INDEX ON {SCHEMA}.users_wide(total_spent)",
+    f"CREATE INDEX ON {SCHEMA}.users_wide(exp)",
+]
+NARROW_TABLE = f"""
+    CREATE TABLE {SCHEMA}.user_wallet (
+        user_id BIGINT PRIMARY KEY,
+        balance BIGINT NOT NULL DEFAULT 0,
+        negative_balance BIGINT NOT NULL DEFAULT 0,
+        total_spent BIGINT NOT NULL DEFAULT 0,
+        bitcoin_balance BIGINT NOT NULL DEFAULT 0
+    ) WITH (fillfactor = 50)
+"""
+
+UPDATE_SQL = """
+    UPDATE {table} SET
+        balance = GREATEST(balance + $1::bigint, 0),
+        negative_balance = negative_balance + GREATEST(-(balance + $1::bigint), 0)
+    WHERE user_id = $2
+"""
+
+
+async def prepare(pool, users: int):
+    async with pool.acquire() as conn:
+        await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+        await conn.execute(WIDE_TABLE)
+        await conn.execute(NARROW_TABLE)
+        for table in ("users_wide", "user_wallet"):
+            await conn.execute(
+                f"INSERT INTO {SCHEMA}.{table} (user_id, balance) "
+                "SELECT g, 100000 FROM generate_series(1, $1) AS g", users
+            )
+        for sql in WIDE_INDEXES:
+            await conn.execute(sql)
+        await conn.execute(f"VACUUM ANALYZE {SCHEMA}.users_wide")
+        await conn.execute(f"VACUUM ANALYZE {SCHEMA}.user_wallet")
+
+
+async def hammer(pool, table: str, users: int, seconds: float, workers: int) -> int:
+    query = UPDATE_SQL.format(table=f"{SCHEMA}.{table}")
+    deadline = time.monotonic() + seconds
+
+    async def worker(seed: int) -> int:
+        rng = random.Random(seed)
+        done = 0
+        async with pool.acquire() as conn:
+            while time.monotonic() < deadline:
+                await conn.execute(query, rng.randint(-500, 500), rng.randint(1, users))
+                done += 1
+        return done
+
+    return sum(await asyncio.gather(*(worker(i) for i in range(workers))))
+
+
+async def table_stats(pool, table: str):
+    async with pool.acquire() as conn:
+        # статистика уходит в pg_stat с задержкой – ждём, пока счётчики обновлений догонят
+        await asyncio.sleep(1)
+        return await conn.fetchrow(
+            "SELECT n_tup_upd, n_tup_hot_upd, pg_total_relation_size(relid) AS size "
+            "FROM pg_stat_user_tables WHERE schemaname = $1 AND relname = $2",
+            SCHEMA, table
+        )
+
+
+async def main(users: int = 100_000, seconds: float = 20, workers: int = 8):
+    pool = await asyncpg.create_pool(os.environ["DATABASE_URL"], min_size=workers, max_size=workers)
+    try:
+        await prepare(pool, users)
+        for title, table in (("до (широкая users)", "users_wide"), ("после (user_wallet)", "user_wallet")):
+            count = await hammer(pool, table, users, seconds, workers)
+            stats = await table_stats(pool, table)
+            hot = stats['n_tup_hot_upd'] / stats['n_tup_upd'] * 100 if stats['n_tup_upd'] else 0
+            print(f"{title}: {count / seconds:,.0f} UPDATE/с, HOT {hot:.1f}%, "
+                  f"размер с индексами {stats['size'] / 1024 / 1024:.1f} МБ")
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await pool.close()
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:4]]
+    asyncio.run(main(*args))
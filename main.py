@@ -9,10 +9,19 @@ import string
 import csv
 import io
 import json
+import math
 import html
-from datetime import datetime, timedelta, date
+import inspect
+import hashlib
+import heapq
+import itertools
+from datetime import datetime, timedelta, date, timezone
+from decimal import Decimal, ROUND_HALF_UP
 from typing import Dict, List, Optional, Tuple, Any, Union
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, fields
 
 import asyncpg
 from aiogram import Bot, Dispatcher, types
@@ -26,10 +35,10 @@ from aiogram.types import (
 from aiogram.utils.exceptions import (
     BotBlocked, UserDeactivated, ChatNotFound, RetryAfter,
     TelegramAPIError, MessageNotModified, TerminatedByOtherGetUpdates,
-    MessageToDeleteNotFound, MessageCantBeDeleted
+    MessageToDeleteNotFound, MessageCantBeDeleted, NetworkError
 )
 from aiogram.dispatcher.middlewares import BaseMiddleware
-from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.handler import CancelHandler, current_handler
 from aiogram.utils import executor
 
 # ==================== НАСТРОЙКИ ====================
@@ -242,6 +251,20 @@ MIN_PLAYERS = 2
 MAX_PLAYERS = 5
 MIN_BET = 3
 MAX_COMPLETED_GIVEAWAYS = 10
+MEMBERSHIP_CACHE_TTL = 600        # сколько секунд доверяем положительному ответу о подписке
+MEMBERSHIP_NEGATIVE_TTL = 30      # отрицательный ответ живёт меньше, чтобы быстро увидеть подписку
+MEMBERSHIP_CACHE_MAX = 100000
+# Лимиты Telegram на исходящие сообщения
+OUTBOUND_GLOBAL_RATE = 30            # сообщений в секунду на бота
+OUTBOUND_PRIVATE_RATE = 1            # в секунду на личный чат
+OUTBOUND_GROUP_RATE = 20 / 60        # 20 в минуту на группу
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_MAX_ATTEMPTS = 3
+PRIORITY_INTERACTIVE = 0   # ответы и уведомления о действиях пользователя
+PRIORITY_NOTIFY = 1        # уведомления из фоновых задач и outbox
+PRIORITY_BULK = 2          # рассылки, реклама, notify_chats
+BROADCAST_PAGE_SIZE = 500          # получателей на одну страницу курсора
+BROADCAST_PROGRESS_INTERVAL = 5    # секунд между обновлениями статуса рассылки
 
 PERMISSIONS_LIST = [
     "manage_users",
@@ -266,6 +289,11 @@ PERMISSIONS_LIST = [
     "manage_media",
 ]
 
+# Права храним битовой маской: позиция бита = индекс в PERMISSIONS_LIST
+PERMISSION_BITS = {perm: 1 << i for i, perm in enumerate(PERMISSIONS_LIST)}
+ALL_PERMISSIONS_MASK = (1 << len(PERMISSIONS_LIST)) - 1
+ACCESS_NOTIFY_CHANNEL = "access_changed"
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
@@ -273,9 +301,12 @@ logging.basicConfig(
 
 # Глобальные переменные и блокировки для кэшей
 db_pool = None
-settings_cache = {}
-settings_cache_lock = asyncio.Lock()
-last_settings_update = 0
+# Соединение, которое держит текущая задача: (conn, task). См. db_conn()
+current_db_conn: ContextVar = ContextVar('current_db_conn', default=None)
+# Буфер сообщений открытой транзакции: (список, task). См. db_transaction() и outbox_send()
+current_outbox: ContextVar = ContextVar('current_outbox', default=None)
+settings_snapshot = None  # SettingsSnapshot, подменяется целиком при обновлении
+settings_reload_lock = asyncio.Lock()
 
 channels_cache = []
 channels_cache_lock = asyncio.Lock()
@@ -285,6 +316,18 @@ confirmed_chats_cache = {}
 confirmed_chats_lock = asyncio.Lock()
 last_confirmed_chats_update = 0
 
+# Реестр доступа: заблокированные и права младших админов (user_id -> маска)
+banned_users_set = frozenset()
+admin_permission_masks: Dict[int, int] = {}
+access_registry_loaded = False
+access_registry_lock = asyncio.Lock()
+access_listener_conn = None
+ACCESS_NOTIFY_SOURCE = f"{os.getpid()}-{random.getrandbits(32)}"
+
+# Индекс подписок: (user_id, chat_id канала) -> (подписан, время истечения).
+# Порядок – от давно использованных к недавним: при переполнении вытесняются самые старые
+membership_cache: 'OrderedDict[Tuple[int, int], Tuple[bool, float]]' = OrderedDict()
+
 bot = Bot(token=BOT_TOKEN, parse_mode="HTML")
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
@@ -572,14 +615,86 @@ class ThrottlingMiddleware(BaseMiddleware):
             raise CancelHandler()
         self.user_last_time[user_id] = now
 
+class UserContextMiddleware(BaseMiddleware):
+    """Один раз за апдейт загружает строку пользователя для хендлеров с параметром user_ctx."""
+    def __init__(self):
+        self.wants_ctx = {}
+        super().__init__()
+
+    def _handler_wants_ctx(self, data: dict) -> bool:
+        # для кнопок, разобранных через router, смотрим на конечный хендлер
+        handler = data.get('routed_handler') or current_handler.get(None)
+        if handler is None:
+            return False
+        wants = self.wants_ctx.get(handler)
+        if wants is None:
+            wants = 'user_ctx' in inspect.signature(handler).parameters
+            self.wants_ctx[handler] = wants
+        return wants
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if message.chat.type != 'private' or not message.from_user or not self._handler_wants_ctx(data):
+            return
+        data['user_ctx'] = await load_user_context(message.from_user)
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        if not self._handler_wants_ctx(data):
+            return
+        data['user_ctx'] = await load_user_context(callback.from_user)
+
+# ==================== РЕЕСТР ДОСТУПА ====================
+def permissions_to_mask(permissions: List[str]) -> int:
+    mask = 0
+    for perm in permissions:
+        mask |= PERMISSION_BITS.get(perm, 0)
+    return mask
+
+def mask_to_permissions(mask: int) -> List[str]:
+    return [perm for perm in PERMISSIONS_LIST if mask & PERMISSION_BITS[perm]]
+
+async def reload_access_registry():
+    """Перечитывает заблокированных и админов из БД и атомарно подменяет реестр."""
+    global banned_users_set, admin_permission_masks, access_registry_loaded
+    async with access_registry_lock:
+        async with db_conn() as conn:
+            banned_rows = await conn.fetch("SELECT user_id FROM banned_users")
+            admin_rows = await conn.fetch("SELECT user_id, permissions FROM admins")
+        masks = {}
+        for row in admin_rows:
+            try:
+                perms = json.loads(row['permissions']) if row['permissions'] else []
+            except:
+                perms = []
+            masks[row['user_id']] = permissions_to_mask(perms)
+        banned_users_set = frozenset(r['user_id'] for r in banned_rows)
+        admin_permission_masks = masks
+        access_registry_loaded = True
+
+async def ensure_access_registry():
+    if not access_registry_loaded:
+        await reload_access_registry()
+
+async def notify_access_changed():
+    """Обновляет реестр в этом процессе и рассылает NOTIFY остальным экземплярам бота."""
+    await reload_access_registry()
+    try:
+        async with db_conn() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", ACCESS_NOTIFY_CHANNEL, ACCESS_NOTIFY_SOURCE)
+    except Exception as e:
+        logging.error(f"Access notify error: {e}", exc_info=True)
+
+def on_access_notify(connection, pid, channel, payload):
+    if payload == ACCESS_NOTIFY_SOURCE:
+        return
+    asyncio.create_task(reload_access_registry())
+
 # ==================== ФУНКЦИИ ПРОВЕРКИ ПРАВ ====================
 async def is_super_admin(user_id: int) -> bool:
     return user_id in SUPER_ADMINS
 
 async def is_junior_admin(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM admins WHERE user_id=$1", user_id)
-    return row is not None
+    await ensure_access_registry()
+    return user_id in admin_permission_masks
 
 async def is_admin(user_id: int) -> bool:
     return await is_super_admin(user_id) or await is_junior_admin(user_id)
@@ -587,57 +702,198 @@ async def is_admin(user_id: int) -> bool:
 async def has_permission(user_id: int, permission: str) -> bool:
     if await is_super_admin(user_id):
         return True
-    async with db_pool.acquire() as conn:
-        perms_json = await conn.fetchval("SELECT permissions FROM admins WHERE user_id=$1", user_id)
-    if not perms_json:
-        return False
-    try:
-        perms = json.loads(perms_json)
-        return permission in perms
-    except:
-        return False
+    await ensure_access_registry()
+    return bool(admin_permission_masks.get(user_id, 0) & PERMISSION_BITS.get(permission, 0))
 
 async def get_admin_permissions(user_id: int) -> List[str]:
     if await is_super_admin(user_id):
         return PERMISSIONS_LIST.copy()
-    async with db_pool.acquire() as conn:
-        perms_json = await conn.fetchval("SELECT permissions FROM admins WHERE user_id=$1", user_id)
-    if not perms_json:
-        return []
-    try:
-        return json.loads(perms_json)
-    except:
-        return []
+    await ensure_access_registry()
+    return mask_to_permissions(admin_permission_masks.get(user_id, 0))
 
 async def update_admin_permissions(user_id: int, permissions: List[str]):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
             "UPDATE admins SET permissions=$1 WHERE user_id=$2",
             json.dumps(permissions), user_id
         )
+    await notify_access_changed()
 
 dp.middleware.setup(ThrottlingMiddleware(rate_limit=0.5))
+dp.middleware.setup(UserContextMiddleware())
+
+# ==================== ПЛАНИРОВЩИК ИСХОДЯЩИХ СООБЩЕНИЙ ====================
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundLane:
+    """Очередь одного чата: свой токен-бакет и своё ожидание после RetryAfter."""
+    __slots__ = ('queue', 'bucket', 'blocked_until', 'state')
+
+    def __init__(self, chat_id: int):
+        rate = OUTBOUND_GROUP_RATE if chat_id < 0 else OUTBOUND_PRIVATE_RATE
+        self.queue = []
+        self.bucket = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+        self.blocked_until = 0.0
+        self.state = 'idle'   # idle / ready / delayed / inflight
+
+class OutboundScheduler:
+    """Единая точка отправки в Telegram.
+
+    Сообщения раскладываются по чатам; внутри чата идут по (приоритет, порядок постановки),
+    между чатами – по приоритету головы очереди. Соблюдаются общий лимит бота и лимит на чат;
+    RetryAfter откладывает только тот чат, в котором случился.
+    """
+    def __init__(self):
+        self.lanes: Dict[int, OutboundLane] = {}
+        self.ready = []     # (priority, seq, chat_id)
+        self.delayed = []   # (время, seq, chat_id)
+        self.global_bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.inflight = set()
+
+    def submit(self, chat_id: int, method: str, *args, priority: int = PRIORITY_NOTIFY, wait: bool = False, **kwargs):
+        """Ставит вызов bot.<method>(chat_id, *args, **kwargs) в очередь.
+        При wait=True возвращает future с результатом отправки."""
+        future = asyncio.get_event_loop().create_future() if wait else None
+        lane = self.lanes.get(chat_id)
+        if lane is None:
+            lane = self.lanes[chat_id] = OutboundLane(chat_id)
+        seq = next(self.counter)
+        heapq.heappush(lane.queue, (priority, seq, method, args, kwargs, future, 0))
+        if lane.state == 'idle':
+            self._schedule(chat_id, lane)
+        elif lane.state == 'ready' and lane.queue[0][1] == seq:
+            # новое сообщение обогнало голову очереди – старая запись в ready станет неактуальной
+            heapq.heappush(self.ready, (priority, seq, chat_id))
+        return future
+
+    async def send(self, chat_id: int, method: str, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        return await self.submit(chat_id, method, *args, priority=priority, wait=True, **kwargs)
+
+    def _schedule(self, chat_id: int, lane: OutboundLane):
+        now = time.monotonic()
+        if not lane.queue:
+            lane.state = 'idle'
+            if lane.blocked_until <= now and lane.bucket.is_full(now):
+                self.lanes.pop(chat_id, None)
+            return
+        at = max(lane.blocked_until, now + lane.bucket.wait_time(now))
+        if at > now:
+            lane.state = 'delayed'
+            heapq.heappush(self.delayed, (at, next(self.counter), chat_id))
+        else:
+            lane.state = 'ready'
+            head = lane.queue[0]
+            heapq.heappush(self.ready, (head[0], head[1], chat_id))
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.delayed)
+                    lane = self.lanes.get(chat_id)
+                    if lane is not None and lane.state == 'delayed':
+                        self._schedule(chat_id, lane)
+                if not self.ready:
+                    timeout = self.delayed[0][0] - now if self.delayed else None
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                wait = self.global_bucket.wait_time(now)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                priority, seq, chat_id = heapq.heappop(self.ready)
+                lane = self.lanes.get(chat_id)
+                if lane is None or lane.state != 'ready' or not lane.queue or lane.queue[0][1] != seq:
+                    continue
+                self.global_bucket.consume(now)
+                lane.bucket.consume(now)
+                lane.state = 'inflight'
+                item = heapq.heappop(lane.queue)
+                task = asyncio.create_task(self._deliver(chat_id, lane, item))
+                self.inflight.add(task)
+                task.add_done_callback(self.inflight.discard)
+            except Exception as e:
+                logging.error(f"Error in outbound scheduler: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def _deliver(self, chat_id: int, lane: OutboundLane, item: tuple):
+        priority, seq, method, args, kwargs, future, attempts = item
+        try:
+            result = await getattr(bot, method)(chat_id, *args, **kwargs)
+            if future is not None and not future.done():
+                future.set_result(result)
+        except RetryAfter as e:
+            logging.warning(f"Flood limit in chat {chat_id}, lane paused for {e.timeout} seconds")
+            lane.blocked_until = time.monotonic() + e.timeout
+            heapq.heappush(lane.queue, item)
+        except (NetworkError, asyncio.TimeoutError) as e:
+            if attempts + 1 < OUTBOUND_MAX_ATTEMPTS:
+                heapq.heappush(lane.queue, (priority, seq, method, args, kwargs, future, attempts + 1))
+            else:
+                self._fail(chat_id, future, e)
+        except Exception as e:
+            self._fail(chat_id, future, e)
+        finally:
+            self._schedule(chat_id, lane)
+
+    def _fail(self, chat_id: int, future, error: Exception):
+        if future is not None and not future.done():
+            future.set_exception(error)
+        else:
+            logging.warning(f"Failed to send to {chat_id}: {error}")
+
+    async def drain(self, timeout: float = 5):
+        """Ждёт, пока очереди опустеют (при остановке бота)."""
+        deadline = time.monotonic() + timeout
+        while (self.ready or self.delayed or self.inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+outbound = OutboundScheduler()
 
 # ==================== БЕЗОПАСНАЯ ОТПРАВКА ====================
-async def safe_send_message(user_id: int, text: str, **kwargs):
+async def safe_send_message(user_id: int, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs):
     # Экранируем HTML-теги в пользовательском тексте, если parse_mode=HTML
     if kwargs.get('parse_mode') == 'HTML':
         text = html.escape(text)
     try:
-        await bot.send_message(user_id, text, **kwargs)
+        await outbound.send(user_id, 'send_message', text, priority=priority, **kwargs)
     except BotBlocked:
         logging.warning(f"Bot blocked by user {user_id}")
     except UserDeactivated:
         logging.warning(f"User {user_id} deactivated")
     except ChatNotFound:
         logging.warning(f"Chat {user_id} not found")
-    except RetryAfter as e:
-        logging.warning(f"Flood limit exceeded. Retry after {e.timeout} seconds")
-        await asyncio.sleep(e.timeout)
-        try:
-            await bot.send_message(user_id, text, **kwargs)
-        except Exception as ex:
-            logging.warning(f"Still failed after retry: {ex}")
     except TelegramAPIError as e:
         logging.warning(f"Telegram API error for user {user_id}: {e}")
     except Exception as e:
@@ -646,12 +902,29 @@ async def safe_send_message(user_id: int, text: str, **kwargs):
 def safe_send_message_task(user_id: int, text: str, **kwargs):
     asyncio.create_task(safe_send_message(user_id, text, **kwargs))
 
-async def safe_send_chat(chat_id: int, text: str, **kwargs):
+async def safe_send_chat(chat_id: int, text: str, priority: int = PRIORITY_NOTIFY, **kwargs):
     try:
-        await bot.send_message(chat_id, text, **kwargs)
+        await outbound.send(chat_id, 'send_message', text, priority=priority, **kwargs)
     except Exception as e:
         logging.error(f"Failed to send to chat {chat_id}: {e}")
 
+# ==================== ОТЛОЖЕННАЯ ОТПРАВКА (OUTBOX) ====================
+def outbox_send(chat_id: int, text: str, **kwargs):
+    """Ставит сообщение в outbox. Внутри db_transaction() – до коммита, иначе сразу в очередь отправки."""
+    held = current_outbox.get()
+    if held is not None and held[1] is asyncio.current_task():
+        held[0].append((chat_id, text, kwargs))
+    else:
+        outbound.submit(chat_id, 'send_message', text, priority=PRIORITY_NOTIFY, **kwargs)
+
+def after_commit(callback):
+    """Внутри db_transaction() откладывает callback до коммита (при откате он отбрасывается), иначе вызывает сразу."""
+    held = current_outbox.get()
+    if held is not None and held[1] is asyncio.current_task():
+        held[0].append(callback)
+    else:
+        callback()
+
 # ==================== АВТОУДАЛЕНИЕ ====================
 async def can_delete_message(chat_id: int, message: types.Message) -> bool:
     try:
@@ -674,8 +947,9 @@ async def delete_after(message: types.Message, seconds: int):
             pass
 
 async def auto_delete_reply(message: types.Message, text: str, delete_seconds: int = None, **kwargs):
+    cfg = await get_settings_snapshot()
     if delete_seconds is None:
-        delete_seconds = int(await get_setting("auto_delete_commands_seconds"))
+        delete_seconds = cfg.auto_delete_commands_seconds
     sent = await message.reply(text, **kwargs)
     if message.chat.type != 'private':
         confirmed = await get_confirmed_chats()
@@ -685,10 +959,11 @@ async def auto_delete_reply(message: types.Message, text: str, delete_seconds: i
     asyncio.create_task(delete_after(sent, delete_seconds))
 
 async def auto_delete_message(message: types.Message, delete_seconds: int = None):
+    cfg = await get_settings_snapshot()
     if message.chat.type == 'private':
         return
     if delete_seconds is None:
-        delete_seconds = int(await get_setting("auto_delete_commands_seconds"))
+        delete_seconds = cfg.auto_delete_commands_seconds
     confirmed = await get_confirmed_chats()
     chat_data = confirmed.get(message.chat.id)
     if chat_data and not chat_data.get('auto_delete_enabled', True):
@@ -696,6 +971,143 @@ async def auto_delete_message(message: types.Message, delete_seconds: int = None
     asyncio.create_task(delete_after(message, delete_seconds))
 
 # ==================== ПОДКЛЮЧЕНИЕ К БД ====================
+# ==================== ВРЕМЯ ЗАПУСКА ====================
+startup_timings: List[Tuple[str, float]] = []
+
+@contextmanager
+def startup_step(name: str):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_timings.append((name, time.monotonic() - started))
+
+def log_startup_report():
+    total = sum(duration for _, duration in startup_timings)
+    steps = ", ".join(f"{name} {duration:.2f} с" for name, duration in startup_timings)
+    logging.info(f"⏱ Запуск за {total:.2f} с: {steps}")
+
+# Даты в БД хранятся как TIMESTAMPTZ, а бот работает с «наивным» локальным временем (datetime.now()).
+# Кодек переводит одно в другое на границе с БД, поэтому остальной код сравнивает даты как раньше.
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+def encode_timestamptz(value: datetime) -> tuple:
+    if value.tzinfo is None:
+        value = value.astimezone()
+    return ((value - PG_EPOCH) // MICROSECOND,)
+
+def decode_timestamptz(value: tuple) -> datetime:
+    return (PG_EPOCH + value[0] * MICROSECOND).astimezone().replace(tzinfo=None)
+
+def db_now() -> datetime:
+    """Текущее время для записи в БД – с точностью до секунды, как раньше хранилось в TEXT."""
+    return datetime.now().replace(microsecond=0)
+
+def local_timezone_name() -> Optional[str]:
+    """IANA-имя часового пояса процесса (TZ или /etc/localtime), если его можно определить."""
+    name = os.getenv("TZ", "").lstrip(":")
+    if not name:
+        path = os.path.realpath("/etc/localtime")
+        if "zoneinfo/" in path:
+            name = path.split("zoneinfo/", 1)[1]
+    return name or None
+
+async def local_timezone_sql(conn) -> str:
+    """Выражение для AT TIME ZONE, переводящее локальное время бота в TIMESTAMPTZ.
+
+    Зона по имени даёт каждой дате её собственное смещение (летнее/зимнее время). Если имя
+    не определить или PostgreSQL его не знает, остаётся текущее смещение процесса.
+    """
+    name = local_timezone_name()
+    if name and await conn.fetchval("SELECT EXISTS (SELECT 1 FROM pg_timezone_names WHERE name = $1)", name):
+        return "'" + name.replace("'", "''") + "'"
+    offset = int(datetime.now().astimezone().utcoffset().total_seconds())
+    logging.warning(f"Часовой пояс процесса ({name or 'не задан'}) неизвестен PostgreSQL, "
+                    f"старые даты переводятся по текущему смещению {offset} с")
+    return f"INTERVAL '{offset} seconds'"
+
+# ==================== ДЕНЬГИ В МИНИМАЛЬНЫХ ЕДИНИЦАХ ====================
+class Money(int):
+    """Сумма в минимальных единицах. В БД – BIGINT, который asyncpg отдаёт готовым int,
+    без Decimal. В основные единицы (float) переводим только на границе со старым кодом
+    (.major) и при выводе: f"{m:.2f}" форматирует основные единицы."""
+    __slots__ = ()
+    SCALE = 1
+    DIGITS = 0
+
+    @classmethod
+    def from_major(cls, value) -> 'Money':
+        if isinstance(value, cls):
+            return value
+        return cls(int((Decimal(str(value)) * cls.SCALE).to_integral_value(ROUND_HALF_UP)))
+
+    @property
+    def major(self) -> float:
+        return int(self) / self.SCALE
+
+    def __format__(self, spec: str) -> str:
+        return format(self.major, spec or f".{self.DIGITS}f")
+
+    def __str__(self) -> str:
+        return format(self)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({int(self)})"
+
+class Cents(Money):
+    """Баксы в центах."""
+    __slots__ = ()
+    SCALE = 100
+    DIGITS = 2
+
+class BtcUnits(Money):
+    """Биткоины в единицах 1/10000 BTC – точность, с которой они всегда хранились."""
+    __slots__ = ()
+    SCALE = 10_000
+    DIGITS = 4
+
+# денежные колонки пользователя (user_wallet) и их единицы
+MONEY_COLUMNS = {
+    'balance': Cents,
+    'negative_balance': Cents,
+    'total_spent': Cents,
+    'bitcoin_balance': BtcUnits,
+}
+
+# ==================== РАЗБИЕНИЕ USERS ====================
+# В users остаются имя, даты и редко меняющиеся поля. Часто обновляемые колонки живут в узких
+# таблицах: user_wallet (деньги), user_progress (опыт, уровень, статы, репутация) и
+# user_game_stats (счётчики COUNTER_COLUMNS). Полная строка, как раньше, – представление users_full.
+USER_WALLET_COLUMNS = tuple(MONEY_COLUMNS)
+USER_PROGRESS_COLUMNS = ('exp', 'level', 'strength', 'agility', 'defense', 'reputation')
+
+def user_column_table(column: str) -> str:
+    """Таблица, в которой хранится колонка пользователя."""
+    if column in USER_WALLET_COLUMNS:
+        return 'user_wallet'
+    if column in USER_PROGRESS_COLUMNS:
+        return 'user_progress'
+    if column in COUNTER_COLUMNS:
+        return 'user_game_stats'
+    return 'users'
+
+# новый пользователь – строки во всех четырёх таблицах одним запросом; $5 – стартовый баланс в центах
+NEW_USER_CTE = (
+    "WITH ins AS ("
+    " INSERT INTO users (user_id, username, first_name, joined_date) VALUES ($1, $2, $3, $4)"
+    " ON CONFLICT (user_id) DO NOTHING RETURNING *"
+    "), w AS (INSERT INTO user_wallet (user_id, balance) SELECT user_id, $5::bigint FROM ins RETURNING *)"
+    ", p AS (INSERT INTO user_progress (user_id) SELECT user_id FROM ins RETURNING *)"
+    ", s AS (INSERT INTO user_game_stats (user_id) SELECT user_id FROM ins RETURNING *) "
+)
+
+async def init_db_connection(conn):
+    await conn.set_type_codec(
+        'timestamptz', schema='pg_catalog',
+        encoder=encode_timestamptz, decoder=decode_timestamptz, format='tuple'
+    )
+
 async def create_db_pool(retries: int = 5, delay: int = 3):
     global db_pool
     for attempt in range(1, retries + 1):
@@ -706,7 +1118,8 @@ async def create_db_pool(retries: int = 5, delay: int = 3):
                 max_size=20,
                 command_timeout=60,
                 max_queries=50000,
-                max_inactive_connection_lifetime=300
+                max_inactive_connection_lifetime=300,
+                init=init_db_connection
             )
             logging.info(f"✅ Подключение к PostgreSQL установлено (попытка {attempt})")
             return
@@ -717,618 +1130,1240 @@ async def create_db_pool(retries: int = 5, delay: int = 3):
             else:
                 raise
 
-# ==================== ИНИЦИАЛИЗАЦИЯ ТАБЛИЦ ====================
-async def init_db():
-    async with db_pool.acquire() as conn:
-        # ---- Таблица users ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                joined_date TEXT,
-                balance NUMERIC(12,2) DEFAULT 0,
-                reputation INTEGER DEFAULT 0,
-                total_spent NUMERIC(12,2) DEFAULT 0,
-                negative_balance NUMERIC(12,2) DEFAULT 0,
-                last_bonus TEXT,
-                last_theft_time TEXT,
-                theft_attempts INTEGER DEFAULT 0,
-                theft_success INTEGER DEFAULT 0,
-                theft_failed INTEGER DEFAULT 0,
-                theft_protected INTEGER DEFAULT 0,
-                casino_wins INTEGER DEFAULT 0,
-                casino_losses INTEGER DEFAULT 0,
-                dice_wins INTEGER DEFAULT 0,
-                dice_losses INTEGER DEFAULT 0,
-                guess_wins INTEGER DEFAULT 0,
-                guess_losses INTEGER DEFAULT 0,
-                slots_wins INTEGER DEFAULT 0,
-                slots_losses INTEGER DEFAULT 0,
-                roulette_wins INTEGER DEFAULT 0,
-                roulette_losses INTEGER DEFAULT 0,
-                multiplayer_wins INTEGER DEFAULT 0,
-                multiplayer_losses INTEGER DEFAULT 0,
-                exp INTEGER DEFAULT 0,
-                level INTEGER DEFAULT 1,
-                strength INTEGER DEFAULT 1,
-                agility INTEGER DEFAULT 1,
-                defense INTEGER DEFAULT 1,
-                last_gift_time TEXT,
-                gift_count_today INTEGER DEFAULT 0,
-                global_authority INTEGER DEFAULT 0,
-                smuggle_success INTEGER DEFAULT 0,
-                smuggle_fail INTEGER DEFAULT 0,
-                bitcoin_balance NUMERIC(12,4) DEFAULT 0,
-                authority_balance INTEGER DEFAULT 0
-            )
-        ''')
+@asynccontextmanager
+async def db_conn():
+    """Соединение для текущей задачи.
 
-        # ---- Таблица бизнесов пользователей ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_businesses (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                business_type_id INTEGER NOT NULL,
-                level INTEGER DEFAULT 1,
-                last_collection TEXT,
-                accumulated INTEGER DEFAULT 0,
-                UNIQUE(user_id, business_type_id)
-            )
-        ''')
+    Если задача уже держит соединение (или транзакцию), вложенные хелперы получают его же
+    и не занимают второй слот пула. Владелец проверяется по задаче: контекст копируется
+    в create_task/gather, а одно соединение asyncpg нельзя использовать параллельно.
+    """
+    held = current_db_conn.get()
+    if held is not None and held[1] is asyncio.current_task():
+        yield held[0]
+        return
+    if db_pool.get_idle_size() == 0 and db_pool.get_size() >= db_pool.get_max_size():
+        logging.warning(f"Пул соединений исчерпан ({db_pool.get_size()}/{db_pool.get_max_size()}), ожидаем освобождения")
+    async with db_pool.acquire() as conn:
+        token = current_db_conn.set((conn, asyncio.current_task()))
+        try:
+            yield conn
+        finally:
+            current_db_conn.reset(token)
+
+@asynccontextmanager
+async def db_transaction():
+    """Транзакция на соединении задачи. Сообщения, поставленные через outbox_send()
+    внутри неё, уходят только после коммита; при откате они отбрасываются."""
+    buffer = []
+    async with db_conn() as conn:
+        token = current_outbox.set((buffer, asyncio.current_task()))
+        try:
+            async with conn.transaction():
+                yield conn
+        finally:
+            current_outbox.reset(token)
+    parent = current_outbox.get()
+    if parent is not None and parent[1] is asyncio.current_task():
+        # вложенная транзакция – ждём коммита внешней
+        parent[0].extend(buffer)
+    else:
+        for item in buffer:
+            if callable(item):
+                item()  # отложенное до коммита действие (приращения счётчиков)
+                continue
+            chat_id, text, kwargs = item
+            outbound.submit(chat_id, 'send_message', text, priority=PRIORITY_NOTIFY, **kwargs)
+
+# ==================== МИГРАЦИИ СХЕМЫ ====================
+# Каждая миграция выполняется один раз; номер последней применённой хранится в schema_version.
+MIGRATIONS: List[Tuple[int, str, Any]] = []
+MIGRATION_LOCK_ID = 7770001        # pg_advisory_lock: две копии бота не мигрируют одновременно
+MIGRATION_BATCH_SIZE = 5000
+
+def migration(version: int, description: str):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return register
+
+def schema_fingerprint() -> str:
+    """Хэш списка миграций вместе с их кодом: совпал с записанным в БД – схема актуальна."""
+    digest = hashlib.sha1()
+    for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        digest.update(f"{version}:{description}\n".encode())
+        digest.update(inspect.getsource(func).encode())
+    return digest.hexdigest()
+
+async def run_migrations():
+    fingerprint = schema_fingerprint()
+    async with db_conn() as conn:
+        # быстрый путь: один запрос вместо DDL на каждом запуске
+        try:
+            stored = await conn.fetchval("SELECT fingerprint FROM schema_version ORDER BY version DESC LIMIT 1")
+        except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+            stored = None
+        if stored == fingerprint:
+            logging.info("Схема БД актуальна, миграции пропущены")
+            return
 
-        # ---- Таблица типов бизнесов ----
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS business_types (
-                id SERIAL PRIMARY KEY,
-                name TEXT UNIQUE NOT NULL,
-                emoji TEXT NOT NULL,
-                base_price_btc NUMERIC(10,2) NOT NULL,
-                base_income_cents INTEGER NOT NULL,
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
                 description TEXT,
-                max_level INTEGER DEFAULT 10,
-                available BOOLEAN DEFAULT TRUE
+                applied_at TIMESTAMPTZ DEFAULT NOW()
             )
         ''')
-
-        # ---- Таблица последних ставок ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_last_bets (
-                user_id BIGINT,
-                game TEXT,
-                bet_amount NUMERIC(12,2),
-                bet_data JSONB,
-                updated_at TIMESTAMP DEFAULT NOW(),
-                PRIMARY KEY (user_id, game)
+        await conn.execute("ALTER TABLE schema_version ADD COLUMN IF NOT EXISTS fingerprint TEXT")
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            for version, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+                if version <= current:
+                    continue
+                logging.info(f"Применяю миграцию {version}: {description}")
+                started = time.monotonic()
+                await func(conn)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                    version, description
+                )
+                logging.info(f"✅ Миграция {version} применена за {time.monotonic() - started:.1f} с")
+            await conn.execute(
+                "UPDATE schema_version SET fingerprint = $1 WHERE version = (SELECT MAX(version) FROM schema_version)",
+                fingerprint
             )
-        ''')
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+
+@migration(1, "базовая схема")
+async def migration_001_base_schema(conn):
+    # ---- Таблица users ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            joined_date TEXT,
+            balance NUMERIC(12,2) DEFAULT 0,
+            reputation INTEGER DEFAULT 0,
+            total_spent NUMERIC(12,2) DEFAULT 0,
+            negative_balance NUMERIC(12,2) DEFAULT 0,
+            last_bonus TEXT,
+            last_theft_time TEXT,
+            theft_attempts INTEGER DEFAULT 0,
+            theft_success INTEGER DEFAULT 0,
+            theft_failed INTEGER DEFAULT 0,
+            theft_protected INTEGER DEFAULT 0,
+            casino_wins INTEGER DEFAULT 0,
+            casino_losses INTEGER DEFAULT 0,
+            dice_wins INTEGER DEFAULT 0,
+            dice_losses INTEGER DEFAULT 0,
+            guess_wins INTEGER DEFAULT 0,
+            guess_losses INTEGER DEFAULT 0,
+            slots_wins INTEGER DEFAULT 0,
+            slots_losses INTEGER DEFAULT 0,
+            roulette_wins INTEGER DEFAULT 0,
+            roulette_losses INTEGER DEFAULT 0,
+            multiplayer_wins INTEGER DEFAULT 0,
+            multiplayer_losses INTEGER DEFAULT 0,
+            exp INTEGER DEFAULT 0,
+            level INTEGER DEFAULT 1,
+            strength INTEGER DEFAULT 1,
+            agility INTEGER DEFAULT 1,
+            defense INTEGER DEFAULT 1,
+            last_gift_time TEXT,
+            gift_count_today INTEGER DEFAULT 0,
+            global_authority INTEGER DEFAULT 0,
+            smuggle_success INTEGER DEFAULT 0,
+            smuggle_fail INTEGER DEFAULT 0,
+            bitcoin_balance NUMERIC(12,4) DEFAULT 0,
+            authority_balance INTEGER DEFAULT 0,
+            bot_blocked BOOLEAN DEFAULT FALSE
+        )
+    ''')
+    await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS bot_blocked BOOLEAN DEFAULT FALSE")
+
+    # ---- Таблица бизнесов пользователей ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_businesses (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            business_type_id INTEGER NOT NULL,
+            level INTEGER DEFAULT 1,
+            last_collection TEXT,
+            accumulated INTEGER DEFAULT 0,
+            UNIQUE(user_id, business_type_id)
+        )
+    ''')
+
+    # ---- Таблица типов бизнесов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS business_types (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            emoji TEXT NOT NULL,
+            base_price_btc NUMERIC(10,2) NOT NULL,
+            base_income_cents INTEGER NOT NULL,
+            description TEXT,
+            max_level INTEGER DEFAULT 10,
+            available BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+    # ---- Таблица последних ставок ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_last_bets (
+            user_id BIGINT,
+            game TEXT,
+            bet_amount NUMERIC(12,2),
+            bet_data JSONB,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (user_id, game)
+        )
+    ''')
+
+    # ---- Таблица подтверждённых чатов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS confirmed_chats (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            type TEXT,
+            joined_date TEXT,
+            confirmed_by BIGINT,
+            confirmed_date TEXT,
+            notify_enabled BOOLEAN DEFAULT TRUE,
+            last_gift_date DATE,
+            gift_count_today INTEGER DEFAULT 0,
+            boss_last_spawn TEXT,
+            boss_spawn_count INTEGER DEFAULT 0,
+            auto_delete_enabled BOOLEAN DEFAULT TRUE,
+            last_boss_status_time TEXT
+        )
+    ''')
+
+    # ---- Запросы на подтверждение чатов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_confirmation_requests (
+            chat_id BIGINT PRIMARY KEY,
+            title TEXT,
+            type TEXT,
+            requested_by BIGINT,
+            request_date TEXT,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+
+    # ---- Боссы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bosses (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            name TEXT,
+            level INTEGER,
+            hp INTEGER,
+            max_hp INTEGER,
+            spawned_at TEXT,
+            expires_at TEXT,
+            reward_coins INTEGER,
+            reward_bitcoin INTEGER,
+            participants BIGINT[] DEFAULT '{}',
+            status TEXT DEFAULT 'active',
+            image_file_id TEXT,
+            description TEXT
+        )
+    ''')
+
+    # ---- Атаки на босса ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS boss_attacks (
+            boss_id INTEGER,
+            user_id BIGINT,
+            damage INTEGER,
+            attack_time TEXT,
+            PRIMARY KEY (boss_id, user_id)
+        )
+    ''')
+
+    # ---- Каналы для подписки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS channels (
+            id SERIAL PRIMARY KEY,
+            chat_id TEXT UNIQUE,
+            title TEXT,
+            invite_link TEXT
+        )
+    ''')
+
+    # ---- Рефералы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            id SERIAL PRIMARY KEY,
+            referrer_id BIGINT,
+            referred_id BIGINT UNIQUE,
+            referred_date TEXT,
+            reward_given BOOLEAN DEFAULT FALSE,
+            clicks INTEGER DEFAULT 0,
+            active BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    # ---- Товары магазина ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS shop_items (
+            id SERIAL PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            price NUMERIC(12,2),
+            stock INTEGER DEFAULT -1,
+            photo_file_id TEXT
+        )
+    ''')
+
+    # ---- Покупки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS purchases (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            item_id INTEGER,
+            purchase_date TEXT,
+            status TEXT DEFAULT 'pending',
+            admin_comment TEXT
+        )
+    ''')
+
+    # ---- Промокоды ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS promocodes (
+            code TEXT PRIMARY KEY,
+            reward NUMERIC(12,2),
+            max_uses INTEGER,
+            used_count INTEGER DEFAULT 0,
+            created_at TEXT
+        )
+    ''')
+
+    # ---- Активации промокодов ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS promo_activations (
+            user_id BIGINT,
+            promo_code TEXT,
+            activated_at TEXT,
+            PRIMARY KEY (user_id, promo_code)
+        )
+    ''')
+
+    # ---- Розыгрыши ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS giveaways (
+            id SERIAL PRIMARY KEY,
+            prize TEXT,
+            description TEXT,
+            end_date TEXT,
+            media_file_id TEXT,
+            media_type TEXT,
+            status TEXT DEFAULT 'active',
+            winner_id BIGINT,
+            winners_count INTEGER DEFAULT 1,
+            winners_list TEXT,
+            notified BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    # ---- Участники розыгрышей ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS participants (
+            user_id BIGINT,
+            giveaway_id INTEGER,
+            PRIMARY KEY (user_id, giveaway_id)
+        )
+    ''')
+
+    # ---- Админы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id BIGINT PRIMARY KEY,
+            added_by BIGINT,
+            added_date TEXT,
+            permissions TEXT DEFAULT '[]'
+        )
+    ''')
+
+    # ---- Забаненные ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS banned_users (
+            user_id BIGINT PRIMARY KEY,
+            banned_by BIGINT,
+            banned_date TEXT,
+            reason TEXT
+        )
+    ''')
 
-        # ---- Таблица подтверждённых чатов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS confirmed_chats (
-                chat_id BIGINT PRIMARY KEY,
-                title TEXT,
-                type TEXT,
-                joined_date TEXT,
-                confirmed_by BIGINT,
-                confirmed_date TEXT,
-                notify_enabled BOOLEAN DEFAULT TRUE,
-                last_gift_date DATE,
-                gift_count_today INTEGER DEFAULT 0,
-                boss_last_spawn TEXT,
-                boss_spawn_count INTEGER DEFAULT 0,
-                auto_delete_enabled BOOLEAN DEFAULT TRUE,
-                last_boss_status_time TEXT
-            )
-        ''')
+    # ---- Настройки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    # ---- Задания ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id SERIAL PRIMARY KEY,
+            name TEXT,
+            description TEXT,
+            task_type TEXT,
+            target_id TEXT,
+            reward_coins NUMERIC(12,2) DEFAULT 0,
+            reward_reputation INTEGER DEFAULT 0,
+            required_days INTEGER DEFAULT 0,
+            penalty_days INTEGER DEFAULT 0,
+            created_by BIGINT,
+            created_at TEXT,
+            active BOOLEAN DEFAULT TRUE,
+            max_completions INTEGER DEFAULT 1,
+            completed_count INTEGER DEFAULT 0
+        )
+    ''')
+
+    # ---- Выполненные задания ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_tasks (
+            user_id BIGINT,
+            task_id INTEGER,
+            completed_at TEXT,
+            expires_at TEXT,
+            status TEXT DEFAULT 'completed',
+            PRIMARY KEY (user_id, task_id)
+        )
+    ''')
+
+    # ---- Мультиплеерные игры ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS multiplayer_games (
+            game_id TEXT PRIMARY KEY,
+            host_id BIGINT,
+            max_players INTEGER,
+            bet_amount NUMERIC(12,2),
+            status TEXT DEFAULT 'waiting',
+            deck TEXT,
+            created_at TEXT,
+            current_player_index INTEGER DEFAULT 0
+        )
+    ''')
+
+    # ---- Игроки в мультиплеере ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id TEXT,
+            user_id BIGINT,
+            username TEXT,
+            cards TEXT,
+            value INTEGER DEFAULT 0,
+            stopped BOOLEAN DEFAULT FALSE,
+            joined_at TEXT,
+            doubled BOOLEAN DEFAULT FALSE,
+            surrendered BOOLEAN DEFAULT FALSE,
+            PRIMARY KEY (game_id, user_id)
+        )
+    ''')
+
+    # ---- Награды за уровень ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS level_rewards (
+            level INTEGER PRIMARY KEY,
+            coins NUMERIC(12,2),
+            reputation INTEGER
+        )
+    ''')
+
+    # ---- Аукционы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS auctions (
+            id SERIAL PRIMARY KEY,
+            item_name TEXT NOT NULL,
+            description TEXT,
+            start_price NUMERIC(12,2) NOT NULL,
+            current_price NUMERIC(12,2) NOT NULL,
+            start_time TIMESTAMP NOT NULL DEFAULT NOW(),
+            end_time TIMESTAMP,
+            target_price NUMERIC(12,2),
+            status TEXT DEFAULT 'active',
+            winner_id BIGINT,
+            created_by BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            photo_file_id TEXT
+        )
+    ''')
+
+    # ---- Ставки на аукционе ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS auction_bids (
+            id SERIAL PRIMARY KEY,
+            auction_id INTEGER REFERENCES auctions(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            bid_amount NUMERIC(12,2) NOT NULL,
+            bid_time TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+    # ---- Авторитет в чатах ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_authority (
+            chat_id BIGINT,
+            user_id BIGINT,
+            authority INTEGER DEFAULT 0,
+            total_damage INTEGER DEFAULT 0,
+            fights INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+
+    # ---- Кулдауны боёв ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS fight_cooldowns (
+            chat_id BIGINT,
+            user_id BIGINT,
+            last_fight TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+
+    # ---- Глобальные кулдауны ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS global_cooldowns (
+            user_id BIGINT,
+            command TEXT,
+            last_used TIMESTAMP,
+            PRIMARY KEY (user_id, command)
+        )
+    ''')
+
+    # ---- Логи боёв ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS fight_logs (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            user_id BIGINT,
+            timestamp TIMESTAMP DEFAULT NOW(),
+            damage INTEGER,
+            authority_gained INTEGER,
+            outcome TEXT
+        )
+    ''')
+
+    # ---- Реклама ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS ads (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            interval_minutes INTEGER DEFAULT 60,
+            last_sent TIMESTAMP,
+            enabled BOOLEAN DEFAULT TRUE,
+            target TEXT DEFAULT 'chats'
+        )
+    ''')
+
+    # ---- Заявки на биткоин-бирже ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bitcoin_orders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            type TEXT NOT NULL CHECK (type IN ('buy', 'sell')),
+            amount NUMERIC(12,4) NOT NULL CHECK (amount > 0),
+            price INTEGER NOT NULL CHECK (price >= 1),
+            total_locked NUMERIC(12,4) NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            status TEXT DEFAULT 'active' CHECK (status IN ('active', 'completed', 'cancelled'))
+        )
+    ''')
+
+    # ---- Сделки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bitcoin_trades (
+            id SERIAL PRIMARY KEY,
+            buy_order_id INTEGER REFERENCES bitcoin_orders(id),
+            sell_order_id INTEGER REFERENCES bitcoin_orders(id),
+            amount NUMERIC(12,4) NOT NULL,
+            price INTEGER NOT NULL,
+            buyer_id BIGINT NOT NULL,
+            seller_id BIGINT NOT NULL,
+            traded_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+    # ---- Контрабандные рейсы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS smuggle_runs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            start_time TEXT NOT NULL,
+            end_time TIMESTAMPTZ NOT NULL,
+            status TEXT DEFAULT 'in_progress',
+            result TEXT,
+            smuggle_amount NUMERIC(12,4) DEFAULT 0,
+            notified BOOLEAN DEFAULT FALSE
+        )
+    ''')
+    # в старых базах end_time был TEXT – из-за приведения типа индекс не использовался;
+    # его пакетно переводит миграция 2 вместе с остальными TEXT-датами
+
+    # ---- Кулдауны контрабанды ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS smuggle_cooldowns (
+            user_id BIGINT PRIMARY KEY,
+            cooldown_until TIMESTAMP
+        )
+    ''')
+
+    # ---- Медиафайлы ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            id SERIAL PRIMARY KEY,
+            key TEXT UNIQUE NOT NULL,
+            file_id TEXT NOT NULL,
+            description TEXT
+        )
+    ''')
+
+    # ---- Задания рассылки ----
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            created_by BIGINT,
+            created_at TEXT,
+            content TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            last_user_id BIGINT DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            status_chat_id BIGINT,
+            status_message_id BIGINT,
+            finished_at TEXT
+        )
+    ''')
+
+    # ---- Индексы ----
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reputation ON users(reputation DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users(total_spent DESC)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status ON purchases(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_status ON giveaways(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_activations_user ON promo_activations(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tasks_expires ON user_tasks(expires_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_active ON tasks(active)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_multiplayer_games_status ON multiplayer_games(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_level ON users(level)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_exp ON users(exp)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_chat_status ON bosses(chat_id, status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_boss ON boss_attacks(boss_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_user ON boss_attacks(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_confirmed_chats_chat ON confirmed_chats(chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_requests_status ON chat_confirmation_requests(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_status ON auctions(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_end_time ON auctions(end_time)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_auction_bids_auction ON auction_bids(auction_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_authority_chat ON chat_authority(chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_cooldowns_chat ON fight_cooldowns(chat_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_logs_timestamp ON fight_logs(timestamp)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_enabled ON ads(enabled)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_user ON bitcoin_orders(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_status ON bitcoin_orders(status)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_type ON bitcoin_orders(type)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_user ON smuggle_runs(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_end ON smuggle_runs(end_time)")
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_smuggle_runs_due ON smuggle_runs(end_time) "
+        "WHERE status = 'in_progress' AND notified = FALSE"
+    )
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_businesses_user ON user_businesses(user_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+
+# (таблица, колонка для пакетной обработки, TEXT-колонки с датами)
+TEXT_DATE_COLUMNS = [
+    ('users', 'user_id', ['joined_date', 'last_bonus', 'last_theft_time', 'last_gift_time']),
+    ('user_businesses', 'id', ['last_collection']),
+    ('confirmed_chats', 'chat_id', ['joined_date', 'confirmed_date', 'boss_last_spawn', 'last_boss_status_time']),
+    ('chat_confirmation_requests', 'chat_id', ['request_date']),
+    ('bosses', 'id', ['spawned_at', 'expires_at']),
+    ('boss_attacks', 'boss_id', ['attack_time']),
+    ('referrals', 'id', ['referred_date']),
+    ('purchases', 'id', ['purchase_date']),
+    ('promocodes', 'code', ['created_at']),
+    ('promo_activations', 'user_id', ['activated_at']),
+    ('giveaways', 'id', ['end_date']),
+    ('admins', 'user_id', ['added_date']),
+    ('banned_users', 'user_id', ['banned_date']),
+    ('tasks', 'id', ['created_at']),
+    ('user_tasks', 'user_id', ['completed_at', 'expires_at']),
+    ('multiplayer_games', 'game_id', ['created_at']),
+    ('game_players', 'game_id', ['joined_at']),
+    ('smuggle_runs', 'id', ['start_time', 'end_time']),
+    ('broadcast_jobs', 'id', ['created_at', 'finished_at']),
+]
 
-        # ---- Запросы на подтверждение чатов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_confirmation_requests (
-                chat_id BIGINT PRIMARY KEY,
-                title TEXT,
-                type TEXT,
-                requested_by BIGINT,
-                request_date TEXT,
-                status TEXT DEFAULT 'pending'
-            )
-        ''')
+async def convert_text_date_column(conn, table: str, key: str, column: str):
+    """TEXT -> TIMESTAMPTZ без долгой блокировки таблицы.
 
-        # ---- Боссы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bosses (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT,
-                name TEXT,
-                level INTEGER,
-                hp INTEGER,
-                max_hp INTEGER,
-                spawned_at TEXT,
-                expires_at TEXT,
-                reward_coins INTEGER,
-                reward_bitcoin INTEGER,
-                participants BIGINT[] DEFAULT '{}',
-                status TEXT DEFAULT 'active',
-                image_file_id TEXT,
-                description TEXT
+    Новая колонка заполняется пакетами по MIGRATION_BATCH_SIZE значений ключа (каждый пакет –
+    отдельный короткий UPDATE), затем в одной короткой транзакции дозаполняется остаток,
+    старая колонка удаляется, а новая получает её имя. Повторный запуск после сбоя безопасен.
+    """
+    info = await conn.fetchrow(
+        "SELECT data_type, is_nullable FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name=$1 AND column_name=$2",
+        table, column
+    )
+    if not info or info['data_type'] != 'text':
+        return
+    tmp = f"{column}_tz"
+    # старые значения записаны в локальном времени бота; неразборчивые становятся NULL
+    expr = f"pg_temp.text_to_timestamp(t.{column}) AT TIME ZONE {await local_timezone_sql(conn)}"
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION pg_temp.text_to_timestamp(value TEXT) RETURNS TIMESTAMP
+        LANGUAGE plpgsql IMMUTABLE AS $$
+        BEGIN
+            RETURN value::timestamp;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$
+    ''')
+    await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {tmp} TIMESTAMPTZ")
+
+    last = None
+    while True:
+        where = f"WHERE {key} > $1" if last is not None else ""
+        args = [last] if last is not None else []
+        last = await conn.fetchval(f"""
+            WITH batch AS (
+                SELECT DISTINCT {key} FROM {table} {where} ORDER BY {key} LIMIT {MIGRATION_BATCH_SIZE}
+            ), upd AS (
+                UPDATE {table} t SET {tmp} = {expr} FROM batch WHERE t.{key} = batch.{key}
             )
-        ''')
+            SELECT MAX({key}) FROM batch
+        """, *args)
+        if last is None:
+            break
 
-        # ---- Атаки на босса ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS boss_attacks (
-                boss_id INTEGER,
-                user_id BIGINT,
-                damage INTEGER,
-                attack_time TEXT,
-                PRIMARY KEY (boss_id, user_id)
-            )
-        ''')
+    bad = await conn.fetch(
+        f"SELECT {key} AS key, {column} AS value FROM {table} WHERE {tmp} IS NULL AND {column} IS NOT NULL LIMIT 10"
+    )
+    if bad:
+        samples = ", ".join(f"{r['key']}={r['value']!r}" for r in bad)
+        logging.warning(f"{table}.{column}: нераспознанные даты заменены на "
+                        f"{'NULL' if info['is_nullable'] == 'YES' else 'NOW()'} (например: {samples})")
+
+    fill = expr if info['is_nullable'] == 'YES' else f"COALESCE({expr}, NOW())"
+    async with conn.transaction():
+        await conn.execute("SET LOCAL lock_timeout = '10s'")
+        await conn.execute(f"UPDATE {table} t SET {tmp} = {fill} WHERE t.{tmp} IS NULL AND t.{column} IS NOT NULL")
+        await conn.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+        await conn.execute(f"ALTER TABLE {table} RENAME COLUMN {tmp} TO {column}")
+        if info['is_nullable'] != 'YES':
+            await conn.execute(f"UPDATE {table} SET {column} = NOW() WHERE {column} IS NULL")
+            await conn.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")
+    logging.info(f"Колонка {table}.{column} переведена в TIMESTAMPTZ")
+
+@migration(2, "TEXT-даты -> TIMESTAMPTZ")
+async def migration_002_text_dates_to_timestamptz(conn):
+    for table, key, columns in TEXT_DATE_COLUMNS:
+        for column in columns:
+            await convert_text_date_column(conn, table, key, column)
+    # индексы на удалённых колонках пропали вместе с ними
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tasks_expires ON user_tasks(expires_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_end ON smuggle_runs(end_time)")
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_smuggle_runs_due ON smuggle_runs(end_time) "
+        "WHERE status = 'in_progress' AND notified = FALSE"
+    )
 
-        # ---- Каналы для подписки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS channels (
-                id SERIAL PRIMARY KEY,
-                chat_id TEXT UNIQUE,
-                title TEXT,
-                invite_link TEXT
-            )
-        ''')
+@migration(3, "исполненные заявки биржи с нулевым остатком")
+async def migration_003_order_amount_check(conn):
+    # завершённая заявка хранит amount=0, старый CHECK (amount > 0) такое не пропускал
+    await conn.execute("ALTER TABLE bitcoin_orders DROP CONSTRAINT IF EXISTS bitcoin_orders_amount_check")
+    await conn.execute("ALTER TABLE bitcoin_orders ADD CONSTRAINT bitcoin_orders_amount_check CHECK (amount >= 0)")
+
+@migration(4, "частичный индекс активных заявок биржи")
+async def migration_004_active_orders_index(conn):
+    # загрузка стакана и списки заявок читают только активные строки в порядке цена-время
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_active_book
+        ON bitcoin_orders(type, price, created_at) WHERE status='active'
+    ''')
+
+@migration(5, "свечи OHLCV по сделкам биржи")
+async def migration_005_bitcoin_candles(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bitcoin_candles (
+            period TEXT NOT NULL,
+            bucket TIMESTAMPTZ NOT NULL,
+            open INTEGER NOT NULL,
+            high INTEGER NOT NULL,
+            low INTEGER NOT NULL,
+            close INTEGER NOT NULL,
+            volume NUMERIC(16,4) NOT NULL DEFAULT 0,
+            trades INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket)
+        )
+    ''')
+    # уже совершённые сделки сворачиваем один раз, дальше свечи растут вместе со сделками
+    await conn.execute('''
+        INSERT INTO bitcoin_candles (period, bucket, open, high, low, close, volume, trades)
+        SELECT p.period, date_trunc(p.unit, t.traded_at),
+               (array_agg(t.price ORDER BY t.id))[1], MAX(t.price), MIN(t.price),
+               (array_agg(t.price ORDER BY t.id DESC))[1], SUM(t.amount), COUNT(*)
+        FROM bitcoin_trades t
+        CROSS JOIN (VALUES ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) AS p(period, unit)
+        GROUP BY p.period, date_trunc(p.unit, t.traded_at)
+        ON CONFLICT DO NOTHING
+    ''')
+
+@migration(6, "архив закрытых заявок биржи")
+async def migration_006_bitcoin_orders_history(conn):
+    # сделки ссылаются и на архивные заявки, внешний ключ на живую таблицу мешает переносу
+    await conn.execute("ALTER TABLE bitcoin_trades DROP CONSTRAINT IF EXISTS bitcoin_trades_buy_order_id_fkey")
+    await conn.execute("ALTER TABLE bitcoin_trades DROP CONSTRAINT IF EXISTS bitcoin_trades_sell_order_id_fkey")
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS bitcoin_orders_history (
+            id INTEGER PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            type TEXT NOT NULL,
+            amount NUMERIC(12,4) NOT NULL,
+            price INTEGER NOT NULL,
+            created_at TIMESTAMP,
+            status TEXT NOT NULL CHECK (status IN ('completed', 'cancelled')),
+            closed_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_history_user ON bitcoin_orders_history(user_id, id DESC)")
+    # в живой таблице остаются только активные заявки – индекс по статусу больше ничего не отсекает
+    await conn.execute("DROP INDEX IF EXISTS idx_bitcoin_orders_status")
+    await conn.execute('''
+        WITH moved AS (DELETE FROM bitcoin_orders WHERE status <> 'active' RETURNING *)
+        INSERT INTO bitcoin_orders_history (id, user_id, type, amount, price, created_at, status, closed_at)
+        SELECT id, user_id, type, amount, price, created_at, status, created_at FROM moved
+    ''')
+
+@migration(7, "журнал движения денег")
+async def migration_007_wallet_ledger(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS wallet_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            currency TEXT NOT NULL CHECK (currency IN ('balance', 'bitcoin')),
+            delta NUMERIC(16,4) NOT NULL,
+            balance_after NUMERIC(16,4),
+            reason TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user ON wallet_ledger(user_id, id)")
+
+@migration(8, "деньги пользователей в BIGINT (центы и 1/10000 BTC)")
+async def migration_008_money_minor_units(conn):
+    async with conn.transaction():
+        # одним ALTER TABLE – таблица переписывается один раз
+        clauses = []
+        for column, unit in MONEY_COLUMNS.items():
+            clauses += [
+                f"ALTER COLUMN {column} DROP DEFAULT",
+                f"ALTER COLUMN {column} TYPE BIGINT USING ROUND(COALESCE({column}, 0) * {unit.SCALE})::bigint",
+                f"ALTER COLUMN {column} SET DEFAULT 0",
+            ]
+        await conn.execute("ALTER TABLE users " + ", ".join(clauses))
+        scale = f"CASE WHEN currency = 'bitcoin' THEN {BtcUnits.SCALE} ELSE {Cents.SCALE} END"
+        await conn.execute(f"""
+            ALTER TABLE wallet_ledger
+                ALTER COLUMN delta TYPE BIGINT USING ROUND(delta * {scale})::bigint,
+                ALTER COLUMN balance_after TYPE BIGINT USING ROUND(balance_after * {scale})::bigint
+        """)
 
-        # ---- Рефералы ----
+@migration(9, "разбиение users на user_wallet, user_progress, user_game_stats")
+async def migration_009_split_users(conn):
+    async with conn.transaction():
+        # fillfactor оставляет место в странице: обновление ложится рядом (HOT) без правки индексов.
+        # Поэтому индексов по balance/total_spent/exp больше нет – они меняются на каждой операции,
+        # а топы по ним сортируют узкую таблицу.
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_id BIGINT,
-                referred_id BIGINT UNIQUE,
-                referred_date TEXT,
-                reward_given BOOLEAN DEFAULT FALSE,
-                clicks INTEGER DEFAULT 0,
-                active BOOLEAN DEFAULT FALSE
-            )
+            CREATE TABLE IF NOT EXISTS user_wallet (
+                user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                balance BIGINT NOT NULL DEFAULT 0,
+                negative_balance BIGINT NOT NULL DEFAULT 0,
+                total_spent BIGINT NOT NULL DEFAULT 0,
+                bitcoin_balance BIGINT NOT NULL DEFAULT 0
+            ) WITH (fillfactor = 50)
         ''')
-
-        # ---- Товары магазина ----
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS shop_items (
-                id SERIAL PRIMARY KEY,
-                name TEXT,
-                description TEXT,
-                price NUMERIC(12,2),
-                stock INTEGER DEFAULT -1,
-                photo_file_id TEXT
-            )
+            CREATE TABLE IF NOT EXISTS user_progress (
+                user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+                exp INTEGER NOT NULL DEFAULT 0,
+                level INTEGER NOT NULL DEFAULT 1,
+                strength INTEGER NOT NULL DEFAULT 1,
+                agility INTEGER NOT NULL DEFAULT 1,
+                defense INTEGER NOT NULL DEFAULT 1,
+                reputation INTEGER NOT NULL DEFAULT 0
+            ) WITH (fillfactor = 70)
         ''')
-
-        # ---- Покупки ----
+        await conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_game_stats ("
+            "user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE, "
+            + ", ".join(f"{c} INTEGER NOT NULL DEFAULT 0" for c in COUNTER_COLUMNS)
+            + ") WITH (fillfactor = 80)"
+        )
+        await conn.execute(
+            "INSERT INTO user_wallet (user_id, balance, negative_balance, total_spent, bitcoin_balance) "
+            "SELECT user_id, COALESCE(balance, 0), COALESCE(negative_balance, 0), "
+            "COALESCE(total_spent, 0), COALESCE(bitcoin_balance, 0) FROM users ON CONFLICT DO NOTHING"
+        )
+        await conn.execute(
+            "INSERT INTO user_progress (user_id, exp, level, strength, agility, defense, reputation) "
+            "SELECT user_id, COALESCE(exp, 0), COALESCE(level, 1), COALESCE(strength, 1), "
+            "COALESCE(agility, 1), COALESCE(defense, 1), COALESCE(reputation, 0) FROM users ON CONFLICT DO NOTHING"
+        )
+        await conn.execute(
+            "INSERT INTO user_game_stats (user_id, " + ", ".join(COUNTER_COLUMNS) + ") "
+            "SELECT user_id, " + ", ".join(f"COALESCE({c}, 0)" for c in COUNTER_COLUMNS)
+            + " FROM users ON CONFLICT DO NOTHING"
+        )
+        moved = USER_WALLET_COLUMNS + USER_PROGRESS_COLUMNS + COUNTER_COLUMNS
+        # индексы по этим колонкам уходят вместе с ними
+        await conn.execute("ALTER TABLE users " + ", ".join(f"DROP COLUMN {c}" for c in moved))
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_progress_reputation ON user_progress(reputation DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_progress_level ON user_progress(level)")
+        # совместимость: SELECT * и выгрузки видят прежнюю широкую строку.
+        # * раскрывается при создании – новые колонки users требуют пересоздать представление.
         await conn.execute('''
-            CREATE TABLE IF NOT EXISTS purchases (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                item_id INTEGER,
-                purchase_date TEXT,
-                status TEXT DEFAULT 'pending',
-                admin_comment TEXT
-            )
+            CREATE OR REPLACE VIEW users_full AS
+            SELECT * FROM users
+            JOIN user_wallet USING (user_id)
+            JOIN user_progress USING (user_id)
+            JOIN user_game_stats USING (user_id)
         ''')
 
-        # ---- Промокоды ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS promocodes (
-                code TEXT PRIMARY KEY,
-                reward NUMERIC(12,2),
-                max_uses INTEGER,
-                used_count INTEGER DEFAULT 0,
-                created_at TEXT
-            )
-        ''')
+# ==================== ИНИЦИАЛИЗАЦИЯ ТАБЛИЦ ====================
+async def init_db():
+    with startup_step("миграции"):
+        await run_migrations()
 
-        # ---- Активации промокодов ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS promo_activations (
-                user_id BIGINT,
-                promo_code TEXT,
-                activated_at TEXT,
-                PRIMARY KEY (user_id, promo_code)
-            )
-        ''')
+    # Заполняем настройки
+    with startup_step("начальные данные"):
+        await init_settings()
+        await init_level_rewards()
+        await init_business_types()
 
-        # ---- Розыгрыши ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS giveaways (
-                id SERIAL PRIMARY KEY,
-                prize TEXT,
-                description TEXT,
-                end_date TEXT,
-                media_file_id TEXT,
-                media_type TEXT,
-                status TEXT DEFAULT 'active',
-                winner_id BIGINT,
-                winners_count INTEGER DEFAULT 1,
-                winners_list TEXT,
-                notified BOOLEAN DEFAULT FALSE
-            )
-        ''')
+    logging.info("✅ Таблицы в PostgreSQL проверены/обновлены")
 
-        # ---- Участники розыгрышей ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS participants (
-                user_id BIGINT,
-                giveaway_id INTEGER,
-                PRIMARY KEY (user_id, giveaway_id)
-            )
-        ''')
+async def init_settings():
+    async with db_conn() as conn:
+        await conn.execute(
+            "INSERT INTO settings (key, value) SELECT * FROM unnest($1::text[], $2::text[]) ON CONFLICT (key) DO NOTHING",
+            list(DEFAULT_SETTINGS.keys()), list(DEFAULT_SETTINGS.values())
+        )
 
-        # ---- Админы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id BIGINT PRIMARY KEY,
-                added_by BIGINT,
-                added_date TEXT,
-                permissions TEXT DEFAULT '[]'
-            )
-        ''')
+async def init_level_rewards():
+    levels = list(range(1, 101))
+    coins_base = int(DEFAULT_SETTINGS["level_reward_coins"])
+    coins_inc = int(DEFAULT_SETTINGS["level_reward_coins_increment"])
+    rep_base = int(DEFAULT_SETTINGS["level_reward_reputation"])
+    rep_inc = int(DEFAULT_SETTINGS["level_reward_reputation_increment"])
+    async with db_conn() as conn:
+        await conn.execute(
+            "INSERT INTO level_rewards (level, coins, reputation) "
+            "SELECT * FROM unnest($1::int[], $2::numeric[], $3::int[]) ON CONFLICT (level) DO NOTHING",
+            levels,
+            [float(coins_base + (lvl - 1) * coins_inc) for lvl in levels],
+            [rep_base + (lvl - 1) * rep_inc for lvl in levels]
+        )
 
-        # ---- Забаненные ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS banned_users (
-                user_id BIGINT PRIMARY KEY,
-                banned_by BIGINT,
-                banned_date TEXT,
-                reason TEXT
-            )
-        ''')
+DEFAULT_BUSINESS_TYPES = [
+    ("🥙 Ларёк с шаурмой", "🥙", 5.0, 60, "Уличная точка быстрого питания. Приносит стабильный, но небольшой доход.", 10),
+    ("🏪 Магазин у дома", "🏪", 15.0, 120, "Небольшой продуктовый магазин. Доход выше, чем у ларька.", 10),
+    ("🚗 Автомойка", "🚗", 30.0, 180, "Мойка самообслуживания. Требует вложений, но окупается.", 10),
+    ("☕ Кафе", "☕", 50.0, 220, "Уютное кафе в центре. Хороший пассивный доход.", 10),
+    ("🏨 Мини-отель", "🏨", 80.0, 260, "Небольшая гостиница. Доход позволяет не работать.", 10),
+    ("🏬 Торговый центр", "🏬", 150.0, 298, "Крупный торговый комплекс. Максимальный доход (до 500 баксов/неделю).", 10),
+]
 
-        # ---- Настройки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
+async def init_business_types():
+    names, emojis, prices, incomes, descriptions, max_levels = map(list, zip(*DEFAULT_BUSINESS_TYPES))
+    async with db_conn() as conn:
+        # только в пустую таблицу: удалённые админом типы не должны возвращаться
+        await conn.execute(
+            "INSERT INTO business_types (name, emoji, base_price_btc, base_income_cents, description, max_level, available) "
+            "SELECT n, e, p, i, d, m, TRUE FROM unnest($1::text[], $2::text[], $3::numeric[], $4::int[], $5::text[], $6::int[]) AS t(n, e, p, i, d, m) "
+            "WHERE NOT EXISTS (SELECT 1 FROM business_types)",
+            names, emojis, prices, incomes, descriptions, max_levels
+        )
 
-        # ---- Задания ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                id SERIAL PRIMARY KEY,
-                name TEXT,
-                description TEXT,
-                task_type TEXT,
-                target_id TEXT,
-                reward_coins NUMERIC(12,2) DEFAULT 0,
-                reward_reputation INTEGER DEFAULT 0,
-                required_days INTEGER DEFAULT 0,
-                penalty_days INTEGER DEFAULT 0,
-                created_by BIGINT,
-                created_at TEXT,
-                active BOOLEAN DEFAULT TRUE,
-                max_completions INTEGER DEFAULT 1,
-                completed_count INTEGER DEFAULT 0
-            )
-        ''')
+# ==================== РАБОТА С НАСТРОЙКАМИ ====================
+def parse_setting(kind: type, value: Optional[str]):
+    """Значение настройки из строки settings; неразборчивое – нулевое значение типа."""
+    value = (value or "").strip()
+    if kind is bool:
+        return value == "1"
+    if kind is str:
+        return value
+    try:
+        return kind(float(value)) if kind is int else kind(value)
+    except (ValueError, OverflowError):
+        return kind()
+
+def validate_setting(key: str, value: str):
+    """ValueError, если значение не подходит к типу настройки – до записи в БД."""
+    kind = SETTING_TYPES.get(key)
+    if kind in (int, float):
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError("Нужно число")
+        if not math.isfinite(number):
+            raise ValueError("Нужно конечное число")
+        if kind is int and number != int(number):
+            raise ValueError("Нужно целое число")
+    elif kind is bool and value.strip() not in ("0", "1"):
+        raise ValueError("Нужно 0 или 1")
+
+@dataclass(frozen=True, slots=True)
+class SettingsSnapshot:
+    """Неизменяемый снимок настроек: каждая настройка – типизированный атрибут.
+    Ключи и значения по умолчанию – DEFAULT_SETTINGS, строки из БД разбираются один раз при загрузке."""
+    # ----- КРАЖА -----
+    random_attack_cost: float
+    targeted_attack_cost: float
+    theft_cooldown_minutes: int
+    theft_success_chance: float
+    theft_defense_chance: float
+    theft_defense_penalty: int
+    min_theft_amount: float
+    max_theft_amount: float
 
-        # ---- Выполненные задания ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_tasks (
-                user_id BIGINT,
-                task_id INTEGER,
-                completed_at TEXT,
-                expires_at TEXT,
-                status TEXT DEFAULT 'completed',
-                PRIMARY KEY (user_id, task_id)
-            )
-        ''')
+    # ----- КАЗИНО И ИГРЫ -----
+    casino_win_chance: float
+    casino_min_bet: float
+    casino_max_bet: float
+    casino_multiplier: float
+    dice_multiplier: float
+    dice_win_threshold: int
+    guess_multiplier: float
+    guess_reputation: int
+    slots_multiplier_three: float
+    slots_multiplier_diamond: float
+    slots_multiplier_seven: float
+    slots_win_probability: float
+    slots_min_bet: float
+    slots_max_bet: float
+    roulette_color_multiplier: float
+    roulette_green_multiplier: float
+    roulette_number_multiplier: float
+    roulette_min_bet: float
+    roulette_max_bet: float
+    multiplayer_min_bet: float
+    multiplayer_max_bet: float
 
-        # ---- Мультиплеерные игры ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS multiplayer_games (
-                game_id TEXT PRIMARY KEY,
-                host_id BIGINT,
-                max_players INTEGER,
-                bet_amount NUMERIC(12,2),
-                status TEXT DEFAULT 'waiting',
-                deck TEXT,
-                created_at TEXT,
-                current_player_index INTEGER DEFAULT 0
-            )
-        ''')
+    # ----- ОГРАНИЧЕНИЯ ПО УРОВНЮ ДЛЯ ИГР -----
+    min_level_casino: int
+    min_level_dice: int
+    min_level_guess: int
+    min_level_slots: int
+    min_level_roulette: int
+    min_level_multiplayer: int
 
-        # ---- Игроки в мультиплеере ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS game_players (
-                game_id TEXT,
-                user_id BIGINT,
-                username TEXT,
-                cards TEXT,
-                value INTEGER DEFAULT 0,
-                stopped BOOLEAN DEFAULT FALSE,
-                joined_at TEXT,
-                doubled BOOLEAN DEFAULT FALSE,
-                surrendered BOOLEAN DEFAULT FALSE,
-                PRIMARY KEY (game_id, user_id)
-            )
-        ''')
+    # ----- УВЕДОМЛЕНИЯ -----
+    chat_notify_big_win: bool
+    chat_notify_big_purchase: bool
+    chat_notify_giveaway: bool
 
-        # ---- Награды за уровень ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS level_rewards (
-                level INTEGER PRIMARY KEY,
-                coins NUMERIC(12,2),
-                reputation INTEGER
-            )
-        ''')
+    # ----- ПОДГОН -----
+    gift_amount: int
+    gift_limit_per_day: int
+    gift_global_limit_per_user: int
+    gift_cooldown: int
 
-        # ---- Аукционы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS auctions (
-                id SERIAL PRIMARY KEY,
-                item_name TEXT NOT NULL,
-                description TEXT,
-                start_price NUMERIC(12,2) NOT NULL,
-                current_price NUMERIC(12,2) NOT NULL,
-                start_time TIMESTAMP NOT NULL DEFAULT NOW(),
-                end_time TIMESTAMP,
-                target_price NUMERIC(12,2),
-                status TEXT DEFAULT 'active',
-                winner_id BIGINT,
-                created_by BIGINT NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
-                photo_file_id TEXT
-            )
-        ''')
+    # ----- РЕФЕРАЛЫ -----
+    referral_bonus: float
+    referral_reputation: int
+    referral_required_thefts: int
 
-        # ---- Ставки на аукционе ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS auction_bids (
-                id SERIAL PRIMARY KEY,
-                auction_id INTEGER REFERENCES auctions(id) ON DELETE CASCADE,
-                user_id BIGINT NOT NULL,
-                bid_amount NUMERIC(12,2) NOT NULL,
-                bid_time TIMESTAMP DEFAULT NOW()
-            )
-        ''')
+    # ----- ОПЫТ -----
+    exp_per_casino_win: int
+    exp_per_casino_lose: int
+    exp_per_dice_win: int
+    exp_per_dice_lose: int
+    exp_per_guess_win: int
+    exp_per_guess_lose: int
+    exp_per_slots_win: int
+    exp_per_slots_lose: int
+    exp_per_roulette_win: int
+    exp_per_roulette_lose: int
+    exp_per_theft_success: int
+    exp_per_theft_fail: int
+    exp_per_theft_defense: int
+    exp_per_game_win: int
+    exp_per_game_lose: int
+    exp_per_fight: int
+    exp_per_smuggle: int
 
-        # ---- Авторитет в чатах ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS chat_authority (
-                chat_id BIGINT,
-                user_id BIGINT,
-                authority INTEGER DEFAULT 0,
-                total_damage INTEGER DEFAULT 0,
-                fights INTEGER DEFAULT 0,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        ''')
+    # ----- УРОВНИ -----
+    level_multiplier: int
+    level_reward_coins: int
+    level_reward_reputation: int
+    level_reward_coins_increment: int
+    level_reward_reputation_increment: int
 
-        # ---- Кулдауны боёв ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS fight_cooldowns (
-                chat_id BIGINT,
-                user_id BIGINT,
-                last_fight TIMESTAMP,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        ''')
+    # ----- РЕПУТАЦИЯ -----
+    reputation_theft_bonus: float
+    reputation_defense_bonus: float
+    reputation_smuggle_bonus: float
+    reputation_smuggle_success_bonus: float
+    reputation_max_bonus_percent: float
 
-        # ---- Глобальные кулдауны ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS global_cooldowns (
-                user_id BIGINT,
-                command TEXT,
-                last_used TIMESTAMP,
-                PRIMARY KEY (user_id, command)
-            )
-        ''')
+    # ----- БОССЫ -----
+    boss_spawn_chance: int
+    boss_min_interval: int
+    boss_max_per_day: int
+    boss_hp_multiplier: int
+    boss_attack_cooldown: int
+    boss_base_damage: int
+    boss_reward_coins: int
+    boss_reward_coins_variance: int
+    boss_reward_bitcoin: int
+    boss_reward_bitcoin_variance: int
 
-        # ---- Логи боёв ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS fight_logs (
-                id SERIAL PRIMARY KEY,
-                chat_id BIGINT,
-                user_id BIGINT,
-                timestamp TIMESTAMP DEFAULT NOW(),
-                damage INTEGER,
-                authority_gained INTEGER,
-                outcome TEXT
-            )
-        ''')
+    # ----- СТАТЫ ЗА УРОВЕНЬ -----
+    stat_strength_per_level: int
+    stat_agility_per_level: int
+    stat_defense_per_level: int
 
-        # ---- Реклама ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS ads (
-                id SERIAL PRIMARY KEY,
-                text TEXT NOT NULL,
-                interval_minutes INTEGER DEFAULT 60,
-                last_sent TIMESTAMP,
-                enabled BOOLEAN DEFAULT TRUE,
-                target TEXT DEFAULT 'chats'
-            )
-        ''')
+    # ----- АУКЦИОН -----
+    auction_min_bid_step: int
+    auction_commission: int
+    auction_notify_chats: int
 
-        # ---- Заявки на биткоин-бирже ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bitcoin_orders (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                type TEXT NOT NULL CHECK (type IN ('buy', 'sell')),
-                amount NUMERIC(12,4) NOT NULL CHECK (amount > 0),
-                price INTEGER NOT NULL CHECK (price >= 1),
-                total_locked NUMERIC(12,4) NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
-                status TEXT DEFAULT 'active' CHECK (status IN ('active', 'completed', 'cancelled'))
-            )
-        ''')
+    # ----- БОЙ В ЧАТАХ -----
+    fight_cooldown_minutes: int
+    fight_base_damage: int
+    fight_damage_variance: int
+    fight_authority_min: int
+    fight_authority_max: int
+    fight_bitcoin_reward: int
 
-        # ---- Сделки ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS bitcoin_trades (
-                id SERIAL PRIMARY KEY,
-                buy_order_id INTEGER REFERENCES bitcoin_orders(id),
-                sell_order_id INTEGER REFERENCES bitcoin_orders(id),
-                amount NUMERIC(12,4) NOT NULL,
-                price INTEGER NOT NULL,
-                buyer_id BIGINT NOT NULL,
-                seller_id BIGINT NOT NULL,
-                traded_at TIMESTAMP DEFAULT NOW()
-            )
-        ''')
+    # ----- КАЧАЛКА (АВТОРИТЕТ) -----
+    gym_strength_cost: int
+    gym_agility_cost: int
+    gym_defense_cost: int
 
-        # ---- Контрабандные рейсы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS smuggle_runs (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                chat_id BIGINT,
-                start_time TEXT NOT NULL,
-                end_time TEXT NOT NULL,
-                status TEXT DEFAULT 'in_progress',
-                result TEXT,
-                smuggle_amount NUMERIC(12,4) DEFAULT 0,
-                notified BOOLEAN DEFAULT FALSE
-            )
-        ''')
+    # ----- БИЗНЕСЫ -----
+    business_upgrade_cost_per_level: float
 
-        # ---- Кулдауны контрабанды ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS smuggle_cooldowns (
-                user_id BIGINT PRIMARY KEY,
-                cooldown_until TIMESTAMP
-            )
-        ''')
+    # ----- КОНТРАБАНДА -----
+    smuggle_min_duration: int
+    smuggle_max_duration: int
+    smuggle_success_chance: float
+    smuggle_caught_chance: float
+    smuggle_lost_chance: float
+    smuggle_base_amount: float
+    smuggle_authority_multiplier: float
+    smuggle_cooldown_minutes: int
+    smuggle_fail_penalty_minutes: int
 
-        # ---- Медиафайлы ----
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS media (
-                id SERIAL PRIMARY KEY,
-                key TEXT UNIQUE NOT NULL,
-                file_id TEXT NOT NULL,
-                description TEXT
-            )
-        ''')
+    # ----- БИТКОИНЫ -----
+    bitcoin_per_theft: int
+    bitcoin_per_fight: int
+    bitcoin_per_casino_win: int
+    bitcoin_per_slots_win: int
+    bitcoin_per_roulette_win: int
+    bitcoin_per_dice_win: int
+    bitcoin_per_guess_win: int
+    bitcoin_per_boss_participation: int
 
-        # ---- Индексы ----
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reputation ON users(reputation DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_total_spent ON users(total_spent DESC)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_status ON purchases(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_giveaways_status ON giveaways(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_promo_activations_user ON promo_activations(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_tasks_expires ON user_tasks(expires_at)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_active ON tasks(active)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_multiplayer_games_status ON multiplayer_games(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_level ON users(level)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_exp ON users(exp)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bosses_chat_status ON bosses(chat_id, status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_boss ON boss_attacks(boss_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_boss_attacks_user ON boss_attacks(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_confirmed_chats_chat ON confirmed_chats(chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_requests_status ON chat_confirmation_requests(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_status ON auctions(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_auctions_end_time ON auctions(end_time)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_auction_bids_auction ON auction_bids(auction_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_authority_chat ON chat_authority(chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_cooldowns_chat ON fight_cooldowns(chat_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_fight_logs_timestamp ON fight_logs(timestamp)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_ads_enabled ON ads(enabled)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_user ON bitcoin_orders(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_status ON bitcoin_orders(status)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_type ON bitcoin_orders(type)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_user ON smuggle_runs(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_smuggle_runs_end ON smuggle_runs(end_time)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_businesses_user ON user_businesses(user_id)")
+    # ----- БИТКОИН-БИРЖА -----
+    exchange_min_price: int
+    exchange_max_price: int
+    exchange_commission_percent: int
+    exchange_commission_side: str
+    exchange_commission_destination: str
+    exchange_min_amount_btc: float
 
-    # Заполняем настройки
-    await init_settings()
-    await init_level_rewards()
-    await init_business_types()
+    # ----- ОЧИСТКА ЛОГОВ (ДНИ) -----
+    cleanup_days_fight_logs: int
+    cleanup_days_bosses: int
+    cleanup_days_auctions: int
+    cleanup_days_purchases: int
+    cleanup_days_giveaways: int
+    cleanup_days_user_tasks: int
+    cleanup_days_smuggle: int
+    cleanup_days_bitcoin_orders: int
 
-    logging.info("✅ Таблицы в PostgreSQL проверены/обновлены")
+    # ----- АВТОУДАЛЕНИЕ КОМАНД (СЕКУНД) -----
+    auto_delete_commands_seconds: int
 
-async def init_settings():
-    async with db_pool.acquire() as conn:
-        for key, value in DEFAULT_SETTINGS.items():
-            await conn.execute(
-                "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                key, value
-            )
+    # ----- СТАРТОВЫЙ БОНУС -----
+    new_user_bonus: float
 
-async def init_level_rewards():
-    async with db_pool.acquire() as conn:
-        for lvl in range(1, 101):
-            exists = await conn.fetchval("SELECT level FROM level_rewards WHERE level=$1", lvl)
-            if not exists:
-                coins = int(DEFAULT_SETTINGS["level_reward_coins"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_coins_increment"])
-                rep = int(DEFAULT_SETTINGS["level_reward_reputation"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_reputation_increment"])
-                await conn.execute(
-                    "INSERT INTO level_rewards (level, coins, reputation) VALUES ($1, $2, $3)",
-                    lvl, float(coins), rep
-                )
+    # ----- ГЛОБАЛЬНЫЙ КУЛДАУН (секунды) -----
+    global_cooldown_seconds: int
 
-async def init_business_types():
-    async with db_pool.acquire() as conn:
-        count = await conn.fetchval("SELECT COUNT(*) FROM business_types")
-        if count == 0:
-            businesses = [
-                ("🥙 Ларёк с шаурмой", "🥙", 5.0, 60, "Уличная точка быстрого питания. Приносит стабильный, но небольшой доход.", 10),
-                ("🏪 Магазин у дома", "🏪", 15.0, 120, "Небольшой продуктовый магазин. Доход выше, чем у ларька.", 10),
-                ("🚗 Автомойка", "🚗", 30.0, 180, "Мойка самообслуживания. Требует вложений, но окупается.", 10),
-                ("☕ Кафе", "☕", 50.0, 220, "Уютное кафе в центре. Хороший пассивный доход.", 10),
-                ("🏨 Мини-отель", "🏨", 80.0, 260, "Небольшая гостиница. Доход позволяет не работать.", 10),
-                ("🏬 Торговый центр", "🏬", 150.0, 298, "Крупный торговый комплекс. Максимальный доход (до 500 баксов/неделю).", 10),
-            ]
-            for name, emoji, price, income, desc, max_lvl in businesses:
-                await conn.execute(
-                    "INSERT INTO business_types (name, emoji, base_price_btc, base_income_cents, description, max_level, available) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                    name, emoji, price, income, desc, max_lvl, True
-                )
+    # ----- ЛИМИТ НА ВВОД ЧИСЕЛ -----
+    max_input_number: float
+
+    raw: Dict[str, str]
+    loaded_at: float
+
+    @classmethod
+    def from_raw(cls, raw: Dict[str, str]) -> 'SettingsSnapshot':
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update(raw)
+        values = {
+            f.name: parse_setting(f.type, merged.get(f.name))
+            for f in fields(cls) if f.name not in ('raw', 'loaded_at')
+        }
+        return cls(raw=merged, loaded_at=time.time(), **values)
+
+    def get(self, key: str) -> str:
+        """Строковое значение по ключу – для админки, где ключ выбирают из списка."""
+        return self.raw.get(key, "")
+
+    def replace(self, key: str, value: str) -> 'SettingsSnapshot':
+        raw = dict(self.raw)
+        raw[key] = value
+        return SettingsSnapshot.from_raw(raw)
+
+SETTING_TYPES = {f.name: f.type for f in fields(SettingsSnapshot) if f.name not in ('raw', 'loaded_at')}
+
+async def reload_settings() -> SettingsSnapshot:
+    global settings_snapshot
+    async with settings_reload_lock:
+        async with db_conn() as conn:
+            rows = await conn.fetch("SELECT key, value FROM settings")
+        settings_snapshot = SettingsSnapshot.from_raw({row['key']: row['value'] for row in rows})
+    return settings_snapshot
+
+async def get_settings_snapshot() -> SettingsSnapshot:
+    # Чтение без блокировок: снимок обновляет фоновая задача settings_refresher
+    snapshot = settings_snapshot
+    if snapshot is None:
+        snapshot = await reload_settings()
+    return snapshot
 
-# ==================== РАБОТА С НАСТРОЙКАМИ ====================
 async def get_setting(key: str) -> str:
-    global settings_cache, last_settings_update
-    async with settings_cache_lock:
-        now = time.time()
-        if now - last_settings_update > 60 or not settings_cache:
-            async with db_pool.acquire() as conn:
-                rows = await conn.fetch("SELECT key, value FROM settings")
-                settings_cache = {row['key']: row['value'] for row in rows}
-            last_settings_update = now
-        value = settings_cache.get(key)
-        if value is None:
-            value = DEFAULT_SETTINGS.get(key, "")
-            if value:
-                async with db_pool.acquire() as conn:
-                    await conn.execute(
-                        "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                        key, value
-                    )
-                settings_cache[key] = value
-        return value
-
-async def get_setting_float(key: str) -> float:
-    val = await get_setting(key)
-    try:
-        return float(val)
-    except:
-        return 0.0
-
-async def get_setting_int(key: str) -> int:
-    val = await get_setting(key)
-    try:
-        return int(val)
-    except:
-        return 0
+    return (await get_settings_snapshot()).get(key)
 
 async def set_setting(key: str, value: str):
-    async with db_pool.acquire() as conn:
+    global settings_snapshot
+    validate_setting(key, value)
+    async with db_conn() as conn:
         await conn.execute("UPDATE settings SET value=$1 WHERE key=$2", value, key)
-    async with settings_cache_lock:
-        settings_cache[key] = value
-        global last_settings_update
-        last_settings_update = 0
+    snapshot = await get_settings_snapshot()
+    settings_snapshot = snapshot.replace(key, value)
 
 # ==================== ФУНКЦИИ ДЛЯ ЧАТОВ И КАНАЛОВ ====================
 async def get_channels():
@@ -1336,18 +2371,25 @@ async def get_channels():
     async with channels_cache_lock:
         now = time.time()
         if now - last_channels_update > 300 or not channels_cache:
-            async with db_pool.acquire() as conn:
+            async with db_conn() as conn:
                 rows = await conn.fetch("SELECT chat_id, title, invite_link FROM channels")
                 channels_cache = [(r['chat_id'], r['title'], r['invite_link']) for r in rows]
             last_channels_update = now
         return channels_cache
 
+async def invalidate_channels_cache(chat_id: Optional[str] = None):
+    """Сбрасывает кэш каналов и индекс подписок (по одному каналу или целиком)."""
+    global last_channels_update
+    async with channels_cache_lock:
+        last_channels_update = 0
+    invalidate_membership_cache(chat_id)
+
 async def get_confirmed_chats(force_update=False) -> Dict[int, dict]:
     global confirmed_chats_cache, last_confirmed_chats_update
     async with confirmed_chats_lock:
         now = time.time()
         if force_update or now - last_confirmed_chats_update > 300 or not confirmed_chats_cache:
-            async with db_pool.acquire() as conn:
+            async with db_conn() as conn:
                 rows = await conn.fetch("SELECT * FROM confirmed_chats")
                 confirmed_chats_cache = {row['chat_id']: dict(row) for row in rows}
             last_confirmed_chats_update = now
@@ -1358,49 +2400,91 @@ async def is_chat_confirmed(chat_id: int) -> bool:
     return chat_id in confirmed
 
 async def add_confirmed_chat(chat_id: int, title: str, chat_type: str, confirmed_by: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
             "INSERT INTO confirmed_chats (chat_id, title, type, joined_date, confirmed_by, confirmed_date) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (chat_id) DO UPDATE SET confirmed_by=$5, confirmed_date=$6",
-            chat_id, title, chat_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), confirmed_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            chat_id, title, chat_type, db_now(), confirmed_by, db_now()
         )
     await get_confirmed_chats(force_update=True)
 
 async def remove_confirmed_chat(chat_id: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM confirmed_chats WHERE chat_id=$1", chat_id)
     await get_confirmed_chats(force_update=True)
 
 async def create_chat_confirmation_request(chat_id: int, title: str, chat_type: str, requested_by: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
             "INSERT INTO chat_confirmation_requests (chat_id, title, type, requested_by, request_date, status) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (chat_id) DO UPDATE SET status='pending', requested_by=$4, request_date=$5",
-            chat_id, title, chat_type, requested_by, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'pending'
+            chat_id, title, chat_type, requested_by, db_now(), 'pending'
         )
 
 async def get_pending_chat_requests() -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT * FROM chat_confirmation_requests WHERE status='pending' ORDER BY request_date")
         return [dict(r) for r in rows]
 
 async def update_chat_request_status(chat_id: int, status: str):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("UPDATE chat_confirmation_requests SET status=$1 WHERE chat_id=$2", status, chat_id)
 
 # ==================== ПРОВЕРКА ПОДПИСКИ ====================
-async def check_subscription(user_id: int):
+def set_channel_membership(user_id: int, chat_id: int, is_member: bool):
+    ttl = MEMBERSHIP_CACHE_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL
+    key = (user_id, chat_id)
+    membership_cache[key] = (is_member, time.time() + ttl)
+    membership_cache.move_to_end(key)
+    while len(membership_cache) > MEMBERSHIP_CACHE_MAX:
+        membership_cache.popitem(last=False)
+
+def invalidate_membership_cache(chat_id: Optional[str] = None):
+    if chat_id is None:
+        membership_cache.clear()
+        return
+    try:
+        chat_id_int = int(chat_id)
+    except (TypeError, ValueError):
+        membership_cache.clear()
+        return
+    for key in [k for k in membership_cache if k[1] == chat_id_int]:
+        del membership_cache[key]
+
+async def fetch_channel_membership(user_id: int, chat_id: int) -> bool:
+    try:
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+    except Exception:
+        # ошибку не кэшируем – при следующей проверке спросим Telegram снова
+        return False
+    is_member = member.status not in ['left', 'kicked']
+    set_channel_membership(user_id, chat_id, is_member)
+    return is_member
+
+async def check_subscription(user_id: int, force: bool = False):
     channels = await get_channels()
     if not channels:
         return True, []
+    now = time.time()
     not_subscribed = []
+    to_fetch = []
     for chat_id, title, link in channels:
         try:
             # chat_id может быть строкой, преобразуем в int
             chat_id_int = int(chat_id)
-            member = await bot.get_chat_member(chat_id=chat_id_int, user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append((title, link))
-        except Exception:
+        except (TypeError, ValueError):
             not_subscribed.append((title, link))
+            continue
+        cached = None if force else membership_cache.get((user_id, chat_id_int))
+        if cached and cached[1] > now:
+            membership_cache.move_to_end((user_id, chat_id_int))
+            if not cached[0]:
+                not_subscribed.append((title, link))
+        else:
+            to_fetch.append((chat_id_int, title, link))
+    if to_fetch:
+        results = await asyncio.gather(*[fetch_channel_membership(user_id, c[0]) for c in to_fetch])
+        for (chat_id_int, title, link), is_member in zip(to_fetch, results):
+            if not is_member:
+                not_subscribed.append((title, link))
     return len(not_subscribed) == 0, not_subscribed
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
@@ -1431,110 +2515,262 @@ async def notify_chats(message_text: str):
     for chat_id, data in confirmed.items():
         if not data.get('notify_enabled', True):
             continue
-        await safe_send_chat(chat_id, message_text)
+        outbound.submit(chat_id, 'send_message', message_text, priority=PRIORITY_BULK)
 
 async def is_banned(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchval("SELECT user_id FROM banned_users WHERE user_id=$1", user_id)
-    return row is not None
+    await ensure_access_registry()
+    return user_id in banned_users_set
 
 async def find_user_by_input(input_str: str) -> Optional[Dict]:
     input_str = input_str.strip()
     try:
         uid = int(input_str)
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", uid)
+        async with db_conn() as conn:
+            row = await conn.fetchrow("SELECT * FROM users_full WHERE user_id=$1", uid)
             return dict(row) if row else None
     except ValueError:
         username = input_str.lower()
         if username.startswith('@'):
             username = username[1:]
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT * FROM users WHERE LOWER(username)=$1", username)
+        async with db_conn() as conn:
+            row = await conn.fetchrow("SELECT * FROM users_full WHERE LOWER(username)=$1", username)
             return dict(row) if row else None
 
 # ----- НОВАЯ ФУНКЦИЯ ДЛЯ ПОЛУЧЕНИЯ МЕДИАФАЙЛОВ -----
 async def get_media_file_id(key: str) -> Optional[str]:
     """Возвращает file_id из таблицы media по ключу, или None, если не найдено."""
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         file_id = await conn.fetchval("SELECT file_id FROM media WHERE key=$1", key)
         return file_id
 
 # ==================== ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ====================
 async def ensure_user_exists(user_id: int, username: str = None, first_name: str = None):
-    async with db_pool.acquire() as conn:
+    cfg = await get_settings_snapshot()
+    async with db_conn() as conn:
         exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", user_id)
         if not exists:
-            bonus = await get_setting_float("new_user_bonus")
-            await conn.execute(
-                "INSERT INTO users (user_id, username, first_name, joined_date, balance, reputation, total_spent, negative_balance, exp, level, strength, agility, defense, bitcoin_balance, authority_balance) "
-                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)",
-                user_id, username, first_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                bonus, 0, 0, 0, 0, 1, 1, 1, 1, 0.0, 0
+            bonus = cfg.new_user_bonus
+            created = await conn.fetchval(
+                NEW_USER_CTE + "SELECT EXISTS (SELECT 1 FROM ins)",
+                user_id, username, first_name, db_now(), Cents.from_major(bonus)
             )
-            return True, bonus
+            return created, bonus if created else 0
     return False, 0
 
+# колонки строки контекста; к ним добавляются счётчики COUNTER_COLUMNS (для профиля)
+USER_CONTEXT_COLUMNS = (
+    ('user_id', 'username', 'first_name', 'joined_date', 'bot_blocked', 'authority_balance')
+    + USER_WALLET_COLUMNS + USER_PROGRESS_COLUMNS
+)
+
+class UserContext:
+    """Строка users_full, загруженная один раз за апдейт, плюс флаги бана и админки."""
+    __slots__ = ('user_id', 'row', 'created', 'bonus', 'is_banned', 'is_admin')
+
+    def __init__(self, row, created: bool, bonus: float, banned: bool, admin: bool):
+        self.user_id = row['user_id']
+        self.row = row
+        self.created = created
+        self.bonus = bonus
+        self.is_banned = banned
+        self.is_admin = admin
+
+    def __getitem__(self, key):
+        return self.row[key]
+
+    @property
+    def balance(self) -> float:
+        return Cents(self.row['balance'] or 0).major
+
+    @property
+    def bitcoin(self) -> float:
+        return BtcUnits(self.row['bitcoin_balance'] or 0).major
+
+    @property
+    def reputation(self) -> int:
+        return self.row['reputation'] or 0
+
+    @property
+    def level(self) -> int:
+        return self.row['level'] or 1
+
+    @property
+    def exp(self) -> int:
+        return self.row['exp'] or 0
+
+async def mark_user_reachable(user_id: int):
+    """Пользователь сам написал боту – значит, разблокировал: снова получает рассылки."""
+    async with db_conn() as conn:
+        await conn.execute("UPDATE users SET bot_blocked=FALSE WHERE user_id=$1 AND bot_blocked", user_id)
+
+async def load_user_context(user: types.User) -> UserContext:
+    cfg = await get_settings_snapshot()
+    bonus = cfg.new_user_bonus
+    columns = ", ".join(USER_CONTEXT_COLUMNS + COUNTER_COLUMNS)
+    async with db_conn() as conn:
+        # INSERT ... RETURNING и SELECT в одном запросе: новая строка собирается из RETURNING
+        # вставок, существующая – из users_full; колонки перечислены явно в обеих ветках
+        row = await conn.fetchrow(
+            NEW_USER_CTE
+            + f"SELECT {columns}, TRUE AS created FROM ins "
+            "JOIN w USING (user_id) JOIN p USING (user_id) JOIN s USING (user_id) "
+            "UNION ALL "
+            f"SELECT {columns}, FALSE AS created FROM users_full WHERE user_id=$1",
+            user.id, user.username, user.first_name, db_now(), Cents.from_major(bonus)
+        )
+        if row is None:
+            # пользователя одновременно создал другой апдейт: наш INSERT дождался его коммита
+            # и ничего не вставил, а снимок SELECT был взят раньше – перечитываем
+            row = await conn.fetchrow(
+                f"SELECT {columns}, FALSE AS created FROM users_full WHERE user_id=$1", user.id
+            )
+    created = row['created']
+    if row['bot_blocked']:
+        await mark_user_reachable(user.id)
+    return UserContext(row, created, bonus if created else 0, await is_banned(user.id), await is_admin(user.id))
+
 async def get_user_balance(user_id: int) -> float:
-    async with db_pool.acquire() as conn:
-        balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
-        return float(balance) if balance is not None else 0.0
+    async with db_conn() as conn:
+        balance = await conn.fetchval("SELECT balance FROM user_wallet WHERE user_id=$1", user_id)
+        return Cents(balance or 0).major
+
+# ==================== КОШЕЛЁК ====================
+# Каждая операция – один UPDATE ... RETURNING: арифметика, округление и перенос ухода в минус
+# в negative_balance считаются в БД, без чтения строки и гонок между чтением и записью.
+LEDGER_FLUSH_INTERVAL = 5.0      # секунд между записями журнала
+LEDGER_FLUSH_THRESHOLD = 1000    # записей в буфере – пишем досрочно
+LEDGER_COLUMNS = ('user_id', 'currency', 'delta', 'balance_after', 'reason', 'created_at')
+
+WALLET_BALANCE_SQL = """
+    UPDATE user_wallet SET
+        balance = GREATEST(balance + $1::bigint, 0),
+        negative_balance = negative_balance + GREATEST(-(balance + $1::bigint), 0)
+    WHERE user_id = $2
+    RETURNING balance
+"""
+WALLET_BITCOIN_SQL = """
+    UPDATE user_wallet SET bitcoin_balance = bitcoin_balance + $1::bigint
+    WHERE user_id = $2 AND bitcoin_balance + $1::bigint >= 0
+    RETURNING bitcoin_balance
+"""
+# списание с переносом долга и зачисление одним запросом; если нет одного из пользователей – ничего
+WALLET_TRANSFER_SQL = """
+    WITH src AS (
+        UPDATE user_wallet SET
+            balance = GREATEST(balance - $3::bigint, 0),
+            negative_balance = negative_balance + GREATEST($3::bigint - balance, 0)
+        WHERE user_id = $1 AND EXISTS (SELECT 1 FROM user_wallet WHERE user_id = $2)
+        RETURNING balance
+    ), dst AS (
+        UPDATE user_wallet SET balance = balance + $3::bigint
+        WHERE user_id = $2 AND EXISTS (SELECT 1 FROM src)
+        RETURNING balance
+    )
+    SELECT (SELECT balance FROM src) AS from_balance, (SELECT balance FROM dst) AS to_balance
+"""
+
+class LedgerWriter:
+    """Append-only журнал wallet_ledger. Записи копятся в памяти (внутри db_transaction –
+    только после коммита) и уходят пачкой через COPY, а не INSERT на каждую операцию."""
+    def __init__(self):
+        self.pending = []
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+
+    def record(self, user_id: int, currency: str, delta: int, balance_after: Optional[int], reason: str = None):
+        """delta и balance_after – в минимальных единицах валюты."""
+        entry = (user_id, currency, int(delta), None if balance_after is None else int(balance_after), reason, db_now())
+        after_commit(lambda: self._append(entry))
+
+    def _append(self, entry: tuple):
+        self.pending.append(entry)
+        if len(self.pending) >= LEDGER_FLUSH_THRESHOLD:
+            self.wakeup.set()
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            try:
+                async with db_conn() as conn:
+                    await conn.copy_records_to_table('wallet_ledger', records=batch, columns=LEDGER_COLUMNS)
+            except Exception:
+                self.pending[:0] = batch
+                raise
+
+    async def run(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), LEDGER_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing wallet ledger: {e}", exc_info=True)
+                await asyncio.sleep(1)
 
-async def update_user_balance(user_id: int, delta: float, conn=None):
-    delta = float(delta)  # преобразуем на всякий случай
+ledger = LedgerWriter()
+
+async def update_user_balance(user_id: int, delta: Union[float, Cents], conn=None, reason: str = None) -> Cents:
+    """Изменяет баланс на delta (баксы или Cents); уход в минус переносится в negative_balance."""
+    delta = Cents.from_major(delta)
     async def _update(conn):
-        row = await conn.fetchrow("SELECT balance, negative_balance FROM users WHERE user_id=$1", user_id)
-        if not row:
+        balance = await conn.fetchval(WALLET_BALANCE_SQL, delta, user_id)
+        if balance is None:
             await ensure_user_exists(user_id)
-            row = {'balance': 0.0, 'negative_balance': 0.0}
-        balance = float(row['balance'])
-        negative = float(row['negative_balance']) if row['negative_balance'] else 0.0
-
-        new_balance = balance + delta
-        if new_balance < 0:
-            negative += abs(new_balance)
-            new_balance = 0.0
-        new_balance = round(new_balance, 2)
-        negative = round(negative, 2)
-        await conn.execute(
-            "UPDATE users SET balance=$1, negative_balance=$2 WHERE user_id=$3",
-            new_balance, negative, user_id
-        )
+            balance = await conn.fetchval(WALLET_BALANCE_SQL, delta, user_id)
+        ledger.record(user_id, 'balance', delta, balance, reason)
+        return Cents(balance)
     if conn:
-        await _update(conn)
-    else:
-        async with db_pool.acquire() as new_conn:
-            await _update(new_conn)
+        return await _update(conn)
+    async with db_conn() as new_conn:
+        return await _update(new_conn)
+
+async def wallet_transfer(from_id: int, to_id: int, amount: Union[float, Cents], conn=None,
+                          reason: str = None) -> Tuple[Cents, Cents]:
+    """Переводит баксы одним запросом. Недостача у отправителя уходит в его negative_balance."""
+    if from_id == to_id:
+        raise ValueError("Перевод самому себе")
+    amount = Cents.from_major(amount)
+    async def _transfer(conn):
+        row = await conn.fetchrow(WALLET_TRANSFER_SQL, from_id, to_id, amount)
+        if row['from_balance'] is None or row['to_balance'] is None:
+            raise ValueError("Пользователь не найден")
+        ledger.record(from_id, 'balance', -amount, row['from_balance'], reason)
+        ledger.record(to_id, 'balance', amount, row['to_balance'], reason)
+        return Cents(row['from_balance']), Cents(row['to_balance'])
+    if conn:
+        return await _transfer(conn)
+    async with db_conn() as new_conn:
+        return await _transfer(new_conn)
 
 async def get_user_bitcoin(user_id: int) -> float:
-    async with db_pool.acquire() as conn:
-        btc = await conn.fetchval("SELECT bitcoin_balance FROM users WHERE user_id=$1", user_id)
-        return float(btc) if btc is not None else 0.0
+    async with db_conn() as conn:
+        btc = await conn.fetchval("SELECT bitcoin_balance FROM user_wallet WHERE user_id=$1", user_id)
+        return BtcUnits(btc or 0).major
 
-async def update_user_bitcoin(user_id: int, delta: float, conn=None):
-    delta = float(delta)
+async def update_user_bitcoin(user_id: int, delta: Union[float, BtcUnits], conn=None, reason: str = None) -> BtcUnits:
+    """Изменяет BTC-баланс на delta (BTC или BtcUnits); в минус не уходит – ValueError."""
+    delta = BtcUnits.from_major(delta)
     async def _update(conn):
-        row = await conn.fetchrow("SELECT bitcoin_balance FROM users WHERE user_id=$1", user_id)
-        if not row:
+        btc = await conn.fetchval(WALLET_BITCOIN_SQL, delta, user_id)
+        if btc is None:
             await ensure_user_exists(user_id)
-            row = {'bitcoin_balance': 0.0}
-        current = float(row['bitcoin_balance'])
-        new_balance = current + delta
-        if new_balance < 0:
-            raise ValueError("Недостаточно биткоинов")
-        new_balance = round(new_balance, 4)
-        await conn.execute(
-            "UPDATE users SET bitcoin_balance=$1 WHERE user_id=$2",
-            new_balance, user_id
-        )
+            btc = await conn.fetchval(WALLET_BITCOIN_SQL, delta, user_id)
+            if btc is None:
+                raise ValueError("Недостаточно биткоинов")
+        ledger.record(user_id, 'bitcoin', delta, btc, reason)
+        return BtcUnits(btc)
     if conn:
-        await _update(conn)
-    else:
-        async with db_pool.acquire() as new_conn:
-            await _update(new_conn)
+        return await _update(conn)
+    async with db_conn() as new_conn:
+        return await _update(new_conn)
 
 async def get_user_authority(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         auth = await conn.fetchval("SELECT authority_balance FROM users WHERE user_id=$1", user_id)
         return auth if auth is not None else 0
 
@@ -1547,135 +2783,233 @@ async def update_user_authority(user_id: int, delta: int, conn=None):
     if conn:
         await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
+        async with db_conn() as new_conn:
             await _update(new_conn)
 
 async def get_user_reputation(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        rep = await conn.fetchval("SELECT reputation FROM users WHERE user_id=$1", user_id)
+    async with db_conn() as conn:
+        rep = await conn.fetchval("SELECT reputation FROM user_progress WHERE user_id=$1", user_id)
         return rep if rep is not None else 0
 
 async def update_user_reputation(user_id: int, delta: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET reputation = reputation + $1 WHERE user_id=$2", delta, user_id)
+    async with db_conn() as conn:
+        await conn.execute("UPDATE user_progress SET reputation = reputation + $1 WHERE user_id=$2", delta, user_id)
 
 async def get_user_stats(user_id: int) -> dict:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT level, strength, agility, defense FROM users WHERE user_id=$1", user_id)
+    async with db_conn() as conn:
+        row = await conn.fetchrow("SELECT level, strength, agility, defense FROM user_progress WHERE user_id=$1", user_id)
         if row:
             return dict(row)
         return {'level': 1, 'strength': 1, 'agility': 1, 'defense': 1}
 
 async def update_user_stats(user_id: int, strength_delta=0, agility_delta=0, defense_delta=0):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
-            "UPDATE users SET strength = strength + $1, agility = agility + $2, defense = defense + $3 WHERE user_id=$4",
+            "UPDATE user_progress SET strength = strength + $1, agility = agility + $2, defense = defense + $3 WHERE user_id=$4",
             strength_delta, agility_delta, defense_delta, user_id
         )
 
-async def update_user_game_stats(user_id: int, game: str, win: bool, conn=None):
-    async def _update(conn):
-        if win:
-            if game == 'casino':
-                await conn.execute("UPDATE users SET casino_wins = casino_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'dice':
-                await conn.execute("UPDATE users SET dice_wins = dice_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'guess':
-                await conn.execute("UPDATE users SET guess_wins = guess_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'slots':
-                await conn.execute("UPDATE users SET slots_wins = slots_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'roulette':
-                await conn.execute("UPDATE users SET roulette_wins = roulette_wins + 1 WHERE user_id=$1", user_id)
-            elif game == 'multiplayer':
-                await conn.execute("UPDATE users SET multiplayer_wins = multiplayer_wins + 1 WHERE user_id=$1", user_id)
-        else:
-            if game == 'casino':
-                await conn.execute("UPDATE users SET casino_losses = casino_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'dice':
-                await conn.execute("UPDATE users SET dice_losses = dice_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'guess':
-                await conn.execute("UPDATE users SET guess_losses = guess_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'slots':
-                await conn.execute("UPDATE users SET slots_losses = slots_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'roulette':
-                await conn.execute("UPDATE users SET roulette_losses = roulette_losses + 1 WHERE user_id=$1", user_id)
-            elif game == 'multiplayer':
-                await conn.execute("UPDATE users SET multiplayer_losses = multiplayer_losses + 1 WHERE user_id=$1", user_id)
-    if conn:
-        await _update(conn)
-    else:
-        async with db_pool.acquire() as new_conn:
-            await _update(new_conn)
+# ==================== ОТЛОЖЕННАЯ ЗАПИСЬ СЧЁТЧИКОВ ====================
+COUNTER_FLUSH_INTERVAL = 2.0     # секунд между сбросами
+COUNTER_FLUSH_THRESHOLD = 500    # ключей в буфере – сбрасываем досрочно
+COUNTER_COLUMNS = (
+    'casino_wins', 'casino_losses', 'dice_wins', 'dice_losses', 'guess_wins', 'guess_losses',
+    'slots_wins', 'slots_losses', 'roulette_wins', 'roulette_losses',
+    'multiplayer_wins', 'multiplayer_losses',
+    'theft_attempts', 'theft_success', 'theft_failed', 'theft_protected',
+    'smuggle_success', 'smuggle_fail',
+)
+COUNTER_FLUSH_SQL = (
+    "UPDATE user_game_stats u SET "
+    + ", ".join(f"{c} = u.{c} + v.{c}" for c in COUNTER_COLUMNS)
+    + " FROM unnest($1::bigint[], "
+    + ", ".join(f"${i}::int[]" for i in range(2, len(COUNTER_COLUMNS) + 2))
+    + ") AS v(user_id, " + ", ".join(COUNTER_COLUMNS) + ") WHERE u.user_id = v.user_id"
+)
+
+class CounterBuffer:
+    """Приращения монотонных счётчиков user_game_stats (игры, кражи, контрабанда) с отложенной записью.
+
+    Приращения копятся по ключу (user_id, колонка) и уходят одним UPDATE ... FROM unnest
+    раз в COUNTER_FLUSH_INTERVAL или при COUNTER_FLUSH_THRESHOLD ключах, а не отдельным
+    UPDATE горячей строки на каждую игру. Внутри db_transaction приращение попадает в буфер
+    только после коммита. Профили подмешивают несброшенное через merge().
+    """
+    def __init__(self):
+        self.pending = defaultdict(int)
+        self.flushing = {}
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+
+    def add(self, user_id: int, column: str, delta: int = 1):
+        if column not in COUNTER_COLUMNS:
+            raise ValueError(f"Неизвестный счётчик {column}")
+        after_commit(lambda: self._add(user_id, column, delta))
+
+    def _add(self, user_id: int, column: str, delta: int):
+        self.pending[(user_id, column)] += delta
+        if len(self.pending) >= COUNTER_FLUSH_THRESHOLD:
+            self.wakeup.set()
+
+    def get(self, user_id: int, column: str) -> int:
+        key = (user_id, column)
+        return self.pending.get(key, 0) + self.flushing.get(key, 0)
+
+    def merge(self, row) -> dict:
+        """Строка users с учётом ещё не записанных приращений."""
+        data = dict(row)
+        for column in COUNTER_COLUMNS:
+            delta = self.get(data['user_id'], column)
+            if delta:
+                data[column] = (data.get(column) or 0) + delta
+        return data
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, defaultdict(int)
+            try:
+                user_ids = sorted({user_id for user_id, _ in self.flushing})
+                arrays = [[self.flushing.get((user_id, column), 0) for user_id in user_ids]
+                          for column in COUNTER_COLUMNS]
+                async with db_conn() as conn:
+                    await conn.execute(COUNTER_FLUSH_SQL, user_ids, *arrays)
+            except Exception:
+                # не теряем приращения – вернём в буфер до следующего сброса
+                for key, delta in self.flushing.items():
+                    self.pending[key] += delta
+                raise
+            finally:
+                self.flushing = {}
+
+    async def run(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), COUNTER_FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing counters: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+counters = CounterBuffer()
+
+def update_user_game_stats(user_id: int, game: str, win: bool):
+    counters.add(user_id, f"{game}_wins" if win else f"{game}_losses")
+
+# ----- Уровни и награды -----
+# Префиксные суммы наград: [n] – сумма за уровни 1..n. Таблица level_rewards меняется только
+# при инициализации, поэтому читаем её один раз при старте.
+level_reward_coins: List[float] = [0.0]
+level_reward_rep: List[int] = [0]
+
+async def reload_level_rewards():
+    global level_reward_coins, level_reward_rep
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT level, coins, reputation FROM level_rewards WHERE level >= 1 ORDER BY level")
+    top = rows[-1]['level'] if rows else 0
+    coins = [0.0] * (top + 1)
+    reps = [0] * (top + 1)
+    for r in rows:
+        coins[r['level']] = float(r['coins'] or 0)
+        reps[r['level']] = r['reputation'] or 0
+    level_reward_coins = list(itertools.accumulate(coins))
+    level_reward_rep = list(itertools.accumulate(reps))
+
+def level_rewards_between(first: int, last: int) -> Tuple[float, int]:
+    """Суммарная награда за уровни first..last включительно."""
+    top = len(level_reward_coins) - 1
+    last = min(last, top)
+    if first > last:
+        return 0.0, 0
+    return (level_reward_coins[last] - level_reward_coins[first - 1],
+            level_reward_rep[last] - level_reward_rep[first - 1])
+
+def levels_gained_for(level: int, exp: int, level_mult: int) -> Tuple[int, int]:
+    """Сколько уровней даёт опыт exp на уровне level и сколько опыта останется.
+
+    Переход с уровня i стоит i * level_mult, поэтому k уровней подряд стоят
+    level_mult * (k*level + k*(k-1)/2) – решаем квадратное неравенство относительно k."""
+    if exp < level * level_mult:
+        return 0, exp
+    b = 2 * level - 1
+    k = (math.isqrt(b * b + 8 * exp // level_mult) - b) // 2
+
+    def cost(k):
+        return level_mult * (k * level + k * (k - 1) // 2)
+
+    # isqrt по целой части exp // level_mult может ошибиться на единицу
+    while cost(k + 1) <= exp:
+        k += 1
+    while k > 0 and cost(k) > exp:
+        k -= 1
+    return k, exp - cost(k)
 
 async def add_exp(user_id: int, exp: int, conn=None):
-    async def _add(conn):
-        user = await conn.fetchrow("SELECT exp, level FROM users WHERE user_id=$1", user_id)
+    """Начисляет опыт. Все полученные уровни, статы и награды – одним запросом и одним сообщением.
+
+    Уровень считается в Python по прочитанной строке, поэтому строка прогресса блокируется
+    (FOR UPDATE) до конца транзакции: параллельное начисление ждёт и читает уже новый опыт.
+    Транзакция идёт на соединении задачи – это и есть conn, если его передали."""
+    cfg = await get_settings_snapshot()
+    async with db_transaction() as conn:
+        user = await conn.fetchrow("SELECT exp, level FROM user_progress WHERE user_id=$1 FOR UPDATE", user_id)
         if not user:
             return
-        new_exp = user['exp'] + exp
         level = user['level']
-        level_mult = await get_setting_int("level_multiplier")
+        level_mult = cfg.level_multiplier
         if level_mult <= 0:
-            level_mult = 1  # защита от бесконечного цикла
-        levels_gained = 0
-        while new_exp >= level * level_mult:
-            new_exp -= level * level_mult
-            level += 1
-            levels_gained += 1
-        await conn.execute(
-            "UPDATE users SET exp=$1, level=$2 WHERE user_id=$3",
-            new_exp, level, user_id
+            level_mult = 1
+        levels_gained, new_exp = levels_gained_for(level, user['exp'] + exp, level_mult)
+        if levels_gained == 0:
+            await conn.execute("UPDATE user_progress SET exp=$1 WHERE user_id=$2", new_exp, user_id)
+            return
+        new_level = level + levels_gained
+        str_per = cfg.stat_strength_per_level
+        agi_per = cfg.stat_agility_per_level
+        def_per = cfg.stat_defense_per_level
+        coins, reputation = level_rewards_between(level + 1, new_level)
+        balance = await conn.fetchval(
+            "WITH p AS (UPDATE user_progress SET exp=$1, level=$2, strength = strength + $3, "
+            "agility = agility + $4, defense = defense + $5, reputation = reputation + $7 WHERE user_id=$8) "
+            "UPDATE user_wallet SET balance = balance + $6 WHERE user_id=$8 RETURNING balance",
+            new_exp, new_level, str_per * levels_gained, agi_per * levels_gained, def_per * levels_gained,
+            Cents.from_major(coins), reputation, user_id
         )
-        if levels_gained > 0:
-            str_inc = await get_setting_int("stat_strength_per_level") * levels_gained
-            agi_inc = await get_setting_int("stat_agility_per_level") * levels_gained
-            def_inc = await get_setting_int("stat_defense_per_level") * levels_gained
-            await update_user_stats(user_id, str_inc, agi_inc, def_inc)
-            for lvl in range(level - levels_gained + 1, level + 1):
-                await reward_level_up(user_id, lvl, conn)
-    if conn:
-        await _add(conn)
-    else:
-        async with db_pool.acquire() as conn2:
-            await _add(conn2)
-
-async def reward_level_up(user_id: int, new_level: int, conn=None):
-    async def _reward(conn):
-        reward = await conn.fetchrow(
-            "SELECT coins, reputation FROM level_rewards WHERE level=$1",
-            new_level
+        if coins:
+            ledger.record(user_id, 'balance', Cents.from_major(coins), balance, 'level_reward')
+        if levels_gained == 1:
+            text = f"🎉 Поздравляем! Ты достиг {new_level} уровня!\n"
+        else:
+            text = f"🎉 Поздравляем! Ты поднялся на {levels_gained} уровней сразу – теперь у тебя {new_level} уровень!\n"
+        if coins or reputation:
+            text += f"Награда: +{coins:.2f} баксов, +{reputation} репутации!\n"
+        text += (
+            f"Твои статы увеличены: сила +{str_per * levels_gained}, "
+            f"ловкость +{agi_per * levels_gained}, защита +{def_per * levels_gained}."
         )
-        if reward:
-            await update_user_balance(user_id, float(reward['coins']), conn=conn)
-            await update_user_reputation(user_id, reward['reputation'])
-            await safe_send_message(
-                user_id,
-                f"🎉 Поздравляем! Ты достиг {new_level} уровня!\n"
-                f"Награда: +{reward['coins']} баксов, +{reward['reputation']} репутации!\n"
-                f"Твои статы увеличены: сила +{await get_setting_int('stat_strength_per_level')}, ловкость +{await get_setting_int('stat_agility_per_level')}, защита +{await get_setting_int('stat_defense_per_level')}."
-            )
-    if conn:
-        await _reward(conn)
-    else:
-        async with db_pool.acquire() as conn2:
-            await _reward(conn2)
+        outbox_send(user_id, text)
 
 async def get_user_level(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        level = await conn.fetchval("SELECT level FROM users WHERE user_id=$1", user_id)
+    async with db_conn() as conn:
+        level = await conn.fetchval("SELECT level FROM user_progress WHERE user_id=$1", user_id)
         return level if level is not None else 1
 
 async def get_user_exp(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        exp = await conn.fetchval("SELECT exp FROM users WHERE user_id=$1", user_id)
+    async with db_conn() as conn:
+        exp = await conn.fetchval("SELECT exp FROM user_progress WHERE user_id=$1", user_id)
         return exp if exp is not None else 0
 
 async def update_user_total_spent(user_id: int, amount: float):
-    async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET total_spent = total_spent + $1 WHERE user_id=$2", amount, user_id)
+    async with db_conn() as conn:
+        await conn.execute("UPDATE user_wallet SET total_spent = total_spent + $1 WHERE user_id=$2", Cents.from_major(amount), user_id)
 
 async def get_random_user(exclude_id: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         row = await conn.fetchrow("""
             SELECT user_id FROM users 
             WHERE user_id != $1 AND user_id NOT IN (SELECT user_id FROM banned_users)
@@ -1685,8 +3019,9 @@ async def get_random_user(exclude_id: int):
 
 # ==================== ФУНКЦИИ ДЛЯ ГЛОБАЛЬНОГО КУЛДАУНА ====================
 async def check_global_cooldown(user_id: int, command: str) -> Tuple[bool, int]:
-    cooldown = await get_setting_int("global_cooldown_seconds")
-    async with db_pool.acquire() as conn:
+    cfg = await get_settings_snapshot()
+    cooldown = cfg.global_cooldown_seconds
+    async with db_conn() as conn:
         row = await conn.fetchrow("SELECT last_used FROM global_cooldowns WHERE user_id=$1 AND command=$2", user_id, command)
         if row and row['last_used']:
             diff = datetime.now() - row['last_used']
@@ -1696,7 +3031,7 @@ async def check_global_cooldown(user_id: int, command: str) -> Tuple[bool, int]:
     return True, 0
 
 async def set_global_cooldown(user_id: int, command: str):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute('''
             INSERT INTO global_cooldowns (user_id, command, last_used)
             VALUES ($1, $2, $3)
@@ -1705,126 +3040,142 @@ async def set_global_cooldown(user_id: int, command: str):
 
 # ==================== ФУНКЦИИ ДЛЯ БИЗНЕСОВ ====================
 async def get_business_type_list(only_available: bool = True) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         if only_available:
             rows = await conn.fetch("SELECT * FROM business_types WHERE available = TRUE ORDER BY base_price_btc")
         else:
             rows = await conn.fetch("SELECT * FROM business_types ORDER BY base_price_btc")
-        # Преобразуем Decimal в float
         result = []
         for r in rows:
             d = dict(r)
-            d['base_price_btc'] = float(d['base_price_btc'])
+            d['base_price_btc'] = BtcUnits.from_major(d['base_price_btc'])
             result.append(d)
         return result
 
 async def get_business_type(business_type_id: int) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         row = await conn.fetchrow("SELECT * FROM business_types WHERE id=$1", business_type_id)
         if row:
             d = dict(row)
-            d['base_price_btc'] = float(d['base_price_btc'])
+            d['base_price_btc'] = BtcUnits.from_major(d['base_price_btc'])
             return d
         return None
 
+# Доход бизнеса начисляется лениво: накопленное = accumulated + полные часы с last_collection * доход в час.
+# Выражения ниже подставляются в запросы, {now} – номер параметра с текущим временем.
+BUSINESS_HOURS_SQL = (
+    "GREATEST(COALESCE(FLOOR(EXTRACT(EPOCH FROM ({now}::timestamptz - ub.last_collection)) / 3600)::int, 0), 0)"
+)
+BUSINESS_ACCRUED_SQL = "(ub.accumulated + " + BUSINESS_HOURS_SQL + " * bt.base_income_cents * ub.level)"
+# last_collection сдвигается на целое число часов, чтобы не терять начатый час
+BUSINESS_ADVANCED_SQL = (
+    "COALESCE(ub.last_collection, {now}::timestamptz) + " + BUSINESS_HOURS_SQL + " * INTERVAL '1 hour'"
+)
+BUSINESS_COLUMNS_SQL = (
+    "ub.id, ub.user_id, ub.business_type_id, ub.level, ub.last_collection, "
+    + BUSINESS_ACCRUED_SQL + " AS accumulated, "
+    "bt.name, bt.emoji, bt.base_price_btc, bt.base_income_cents, bt.max_level"
+)
+
 async def get_user_businesses(user_id: int) -> List[dict]:
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT ub.*, bt.name, bt.emoji, bt.base_price_btc, bt.base_income_cents, bt.max_level
+    async with db_conn() as conn:
+        rows = await conn.fetch(f"""
+            SELECT {BUSINESS_COLUMNS_SQL.format(now='$2')}
             FROM user_businesses ub
             JOIN business_types bt ON ub.business_type_id = bt.id
             WHERE ub.user_id = $1
             ORDER BY bt.base_price_btc
-        """, user_id)
+        """, user_id, datetime.now())
         result = []
         for r in rows:
             d = dict(r)
-            d['base_price_btc'] = float(d['base_price_btc'])
+            d['base_price_btc'] = BtcUnits.from_major(d['base_price_btc'])
             result.append(d)
         return result
 
 async def get_user_business(user_id: int, business_type_id: int) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT ub.*, bt.name, bt.emoji, bt.base_price_btc, bt.base_income_cents, bt.max_level
+    async with db_conn() as conn:
+        row = await conn.fetchrow(f"""
+            SELECT {BUSINESS_COLUMNS_SQL.format(now='$3')}
             FROM user_businesses ub
             JOIN business_types bt ON ub.business_type_id = bt.id
             WHERE ub.user_id = $1 AND ub.business_type_id = $2
-        """, user_id, business_type_id)
+        """, user_id, business_type_id, datetime.now())
         if row:
             d = dict(row)
-            d['base_price_btc'] = float(d['base_price_btc'])
+            d['base_price_btc'] = BtcUnits.from_major(d['base_price_btc'])
             return d
         return None
 
-async def get_business_price(business_type: dict, level: int) -> float:
-    base_price = business_type['base_price_btc']  # уже float
+async def get_business_price(business_type: dict, level: int) -> BtcUnits:
+    cfg = await get_settings_snapshot()
     if level == 1:
-        return base_price
+        return BtcUnits.from_major(business_type['base_price_btc'])
     else:
-        upgrade_base = await get_setting_float("business_upgrade_cost_per_level")
+        upgrade_base = cfg.business_upgrade_cost_per_level
         cost = upgrade_base * (level ** 1.5)
-        return round(cost, 2)
+        return BtcUnits.from_major(round(cost, 2))
 
 async def get_business_income(business_type: dict, level: int) -> int:
     return business_type['base_income_cents'] * level
 
 async def create_user_business(user_id: int, business_type_id: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
             "INSERT INTO user_businesses (user_id, business_type_id, level, last_collection, accumulated) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (user_id, business_type_id) DO NOTHING",
-            user_id, business_type_id, 1, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
+            user_id, business_type_id, 1, db_now(), 0
         )
 
-async def update_business_income(user_id: int, conn=None):
+async def settle_business_income(user_id: int = None, conn=None) -> int:
+    """Переносит начисленный доход в accumulated одним UPDATE ... FROM (для всех или для одного игрока).
+    Нужен перед сменой уровня и для отчётов; обычное чтение считает доход на лету."""
     async def _update(conn):
-        now = datetime.now()
-        businesses = await conn.fetch(
-            "SELECT ub.*, bt.base_income_cents FROM user_businesses ub JOIN business_types bt ON ub.business_type_id = bt.id WHERE ub.user_id=$1",
-            user_id
-        )
-        for biz in businesses:
-            if biz['last_collection']:
-                try:
-                    last_col = datetime.strptime(biz['last_collection'], "%Y-%m-%d %H:%M:%S")
-                    hours_passed = int((now - last_col).total_seconds() // 3600)
-                    if hours_passed > 0:
-                        income_per_hour = biz['base_income_cents'] * biz['level']
-                        new_accum = biz['accumulated'] + hours_passed * income_per_hour
-                        await conn.execute(
-                            "UPDATE user_businesses SET accumulated=$1, last_collection=$2 WHERE id=$3",
-                            new_accum, now.strftime("%Y-%m-%d %H:%M:%S"), biz['id']
-                        )
-                except:
-                    pass
+        where = "AND ub.user_id = $2" if user_id is not None else ""
+        args = [datetime.now()] + ([user_id] if user_id is not None else [])
+        result = await conn.execute(f"""
+            UPDATE user_businesses ub
+            SET accumulated = {BUSINESS_ACCRUED_SQL.format(now='$1')},
+                last_collection = {BUSINESS_ADVANCED_SQL.format(now='$1')}
+            FROM business_types bt
+            WHERE bt.id = ub.business_type_id {where}
+              AND {BUSINESS_HOURS_SQL.format(now='$1')} > 0
+        """, *args)
+        return int(result.split()[-1])
     if conn:
-        await _update(conn)
+        return await _update(conn)
     else:
-        async with db_pool.acquire() as new_conn:
-            await _update(new_conn)
+        async with db_conn() as new_conn:
+            return await _update(new_conn)
 
 async def collect_business_income(user_id: int, business_id: int) -> Tuple[bool, str]:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            biz = await conn.fetchrow("SELECT * FROM user_businesses WHERE id=$1 AND user_id=$2", business_id, user_id)
-            if not biz:
-                return False, "Бизнес не найден."
-            if biz['accumulated'] == 0:
-                return False, "Нет дохода для сбора."
-            amount_cents = biz['accumulated']
-            coins = amount_cents // 100
-            remainder = amount_cents % 100
-            if coins > 0:
-                await update_user_balance(user_id, float(coins), conn=conn)
-            await conn.execute(
-                "UPDATE user_businesses SET accumulated=$1, last_collection=$2 WHERE id=$3",
-                remainder, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), business_id
+    async with db_transaction() as conn:
+        # начисление, сбор целых баксов и сдвиг last_collection – одним запросом
+        amount_cents = await conn.fetchval(f"""
+            WITH cur AS (
+                SELECT ub.id, {BUSINESS_ACCRUED_SQL.format(now='$3')} AS total,
+                       {BUSINESS_ADVANCED_SQL.format(now='$3')} AS advanced
+                FROM user_businesses ub
+                JOIN business_types bt ON ub.business_type_id = bt.id
+                WHERE ub.id = $1 AND ub.user_id = $2
+                FOR UPDATE OF ub
             )
-            return True, f"Собрано {coins} баксов и {remainder} центов."
+            UPDATE user_businesses ub
+            SET accumulated = cur.total % 100, last_collection = cur.advanced
+            FROM cur WHERE ub.id = cur.id
+            RETURNING cur.total
+        """, business_id, user_id, datetime.now())
+        if amount_cents is None:
+            return False, "Бизнес не найден."
+        coins = amount_cents // 100
+        remainder = amount_cents % 100
+        if coins == 0:
+            return False, "Нет дохода для сбора."
+        await update_user_balance(user_id, float(coins), conn=conn, reason='business')
+        return True, f"Собрано {coins} баксов и {remainder} центов."
 
 async def upgrade_business(user_id: int, business_id: int) -> Tuple[bool, str]:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
+    async with db_conn() as conn:
+        async with db_transaction():
             biz = await conn.fetchrow("""
                 SELECT ub.*, bt.base_price_btc, bt.base_income_cents, bt.max_level 
                 FROM user_businesses ub 
@@ -1835,12 +3186,13 @@ async def upgrade_business(user_id: int, business_id: int) -> Tuple[bool, str]:
                 return False, "Бизнес не найден."
             if biz['level'] >= biz['max_level']:
                 return False, f"Бизнес уже максимального уровня ({biz['max_level']})."
-            base_price = float(biz['base_price_btc'])
-            cost = await get_business_price({'base_price_btc': base_price}, biz['level'] + 1)
-            btc_balance = await get_user_bitcoin(user_id)
-            if btc_balance < cost - 0.0001:
+            cost = await get_business_price(biz, biz['level'] + 1)
+            btc_balance = BtcUnits.from_major(await get_user_bitcoin(user_id))
+            if btc_balance < cost:
                 return False, f"Недостаточно биткоинов. Нужно {cost:.2f} BTC, у вас {btc_balance:.4f}."
-            await update_user_bitcoin(user_id, -cost, conn=conn)
+            await update_user_bitcoin(user_id, BtcUnits(-cost), conn=conn)
+            # прошедшие часы считаются по старому уровню
+            await settle_business_income(user_id, conn=conn)
             await conn.execute(
                 "UPDATE user_businesses SET level = level + 1 WHERE id=$1",
                 business_id
@@ -1849,12 +3201,12 @@ async def upgrade_business(user_id: int, business_id: int) -> Tuple[bool, str]:
 
 # ==================== ФУНКЦИИ ДЛЯ ЧАТОВОГО АВТОРИТЕТА ====================
 async def get_chat_authority(chat_id: int, user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         val = await conn.fetchval("SELECT authority FROM chat_authority WHERE chat_id=$1 AND user_id=$2", chat_id, user_id)
         return val if val is not None else 0
 
 async def add_chat_authority(chat_id: int, user_id: int, amount: int, damage: int = 0):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute('''
             INSERT INTO chat_authority (chat_id, user_id, authority, total_damage, fights)
             VALUES ($1, $2, $3, $4, 1)
@@ -1865,36 +3217,46 @@ async def add_chat_authority(chat_id: int, user_id: int, amount: int, damage: in
         ''', chat_id, user_id, amount, damage)
 
 async def get_total_user_authority(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         total = await conn.fetchval("SELECT SUM(authority) FROM chat_authority WHERE user_id=$1", user_id)
         return total or 0
 
 async def get_total_user_fights(user_id: int) -> Tuple[int, int]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         row = await conn.fetchrow(
             "SELECT SUM(fights) as total_fights, SUM(total_damage) as total_damage FROM chat_authority WHERE user_id=$1",
             user_id
         )
         return (row['total_fights'] or 0, row['total_damage'] or 0)
 
+async def get_total_user_chat_stats(user_id: int) -> Tuple[int, int, int]:
+    """Авторитет, бои и урон по всем чатам одним запросом."""
+    async with db_conn() as conn:
+        row = await conn.fetchrow(
+            "SELECT SUM(authority) as total_authority, SUM(fights) as total_fights, SUM(total_damage) as total_damage FROM chat_authority WHERE user_id=$1",
+            user_id
+        )
+        return (row['total_authority'] or 0, row['total_fights'] or 0, row['total_damage'] or 0)
+
 async def spend_chat_authority(chat_id: int, user_id: int, amount: int) -> bool:
     current = await get_chat_authority(chat_id, user_id)
     if current < amount:
         return False
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("UPDATE chat_authority SET authority = authority - $1 WHERE chat_id=$2 AND user_id=$3", amount, chat_id, user_id)
     return True
 
 async def log_fight(chat_id: int, user_id: int, damage: int, authority: int, outcome: str):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
             "INSERT INTO fight_logs (chat_id, user_id, timestamp, damage, authority_gained, outcome) VALUES ($1, $2, $3, $4, $5, $6)",
             chat_id, user_id, datetime.now(), damage, authority, outcome
         )
 
 async def can_fight(chat_id: int, user_id: int) -> Tuple[bool, int]:
-    cooldown = await get_setting_int("fight_cooldown_minutes")
-    async with db_pool.acquire() as conn:
+    cfg = await get_settings_snapshot()
+    cooldown = cfg.fight_cooldown_minutes
+    async with db_conn() as conn:
         row = await conn.fetchrow("SELECT last_fight FROM fight_cooldowns WHERE chat_id=$1 AND user_id=$2", chat_id, user_id)
         if row and row['last_fight']:
             diff = datetime.now() - row['last_fight']
@@ -1904,7 +3266,7 @@ async def can_fight(chat_id: int, user_id: int) -> Tuple[bool, int]:
         return True, 0
 
 async def set_fight_cooldown(chat_id: int, user_id: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute('''
             INSERT INTO fight_cooldowns (chat_id, user_id, last_fight)
             VALUES ($1, $2, $3)
@@ -1933,39 +3295,44 @@ BOSS_DESCRIPTIONS = [
 ]
 
 async def spawn_boss(chat_id: int, level: int = None, image_file_id: str = None):
+    cfg = await get_settings_snapshot()
     if level is None:
         level = random.randint(1, 5)
     name = random.choice(BOSS_NAMES)
     description = random.choice(BOSS_DESCRIPTIONS)
-    hp_mult = await get_setting_int("boss_hp_multiplier")
+    hp_mult = cfg.boss_hp_multiplier
     hp = level * hp_mult * random.randint(5, 10)
-    base_reward_coins = await get_setting_int("boss_reward_coins")
-    variance_coins = await get_setting_int("boss_reward_coins_variance")
+    base_reward_coins = cfg.boss_reward_coins
+    variance_coins = cfg.boss_reward_coins_variance
     reward_coins = base_reward_coins + random.randint(-variance_coins, variance_coins)
-    base_reward_btc = await get_setting_int("boss_reward_bitcoin")
-    variance_btc = await get_setting_int("boss_reward_bitcoin_variance")
+    base_reward_btc = cfg.boss_reward_bitcoin
+    variance_btc = cfg.boss_reward_bitcoin_variance
     reward_btc = base_reward_btc + random.randint(-variance_btc, variance_btc)
-    now = datetime.now()
+    now = db_now()
     expires_at = now + timedelta(hours=2)
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         boss_id = await conn.fetchval(
             "INSERT INTO bosses (chat_id, name, level, hp, max_hp, spawned_at, expires_at, reward_coins, reward_bitcoin, participants, status, image_file_id, description) "
             "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13) RETURNING id",
-            chat_id, name, level, hp, hp, now.strftime("%Y-%m-%d %H:%M:%S"),
-            expires_at.strftime("%Y-%m-%d %H:%M:%S"), reward_coins, reward_btc, [], 'active', image_file_id, description
+            chat_id, name, level, hp, hp, now,
+            expires_at, reward_coins, reward_btc, [], 'active', image_file_id, description
         )
         await conn.execute(
             "UPDATE confirmed_chats SET boss_last_spawn=$1, boss_spawn_count = boss_spawn_count + 1 WHERE chat_id=$2",
-            now.strftime("%Y-%m-%d %H:%M:%S"), chat_id
+            now, chat_id
         )
     caption = f"⚠️ ВНИМАНИЕ! В чате появился {name} (Уровень {level})!\n📖 {description}\n❤️ Здоровье: {hp}"
     if image_file_id:
-        await bot.send_photo(chat_id, image_file_id, caption=caption)
+        try:
+            await outbound.send(chat_id, 'send_photo', image_file_id, caption=caption, priority=PRIORITY_NOTIFY)
+        except Exception as e:
+            logging.error(f"Failed to send boss photo to chat {chat_id}: {e}")
     else:
         await safe_send_chat(chat_id, caption)
 
 async def finish_boss_fight(boss_id: int):
-    async with db_pool.acquire() as conn:
+    cfg = await get_settings_snapshot()
+    async with db_transaction() as conn:
         boss = await conn.fetchrow("SELECT * FROM bosses WHERE id=$1", boss_id)
         if not boss or boss['status'] != 'active':
             return
@@ -1984,22 +3351,24 @@ async def finish_boss_fight(boss_id: int):
             btc = btc_per_player + (1 if i < remainder_btc else 0)
             await update_user_balance(uid, float(coins), conn=conn)
             await update_user_bitcoin(uid, float(btc), conn=conn)
-            exp = await get_setting_int("exp_per_game_win")
+            exp = cfg.exp_per_game_win
             await add_exp(uid, exp, conn=conn)
         await conn.execute("UPDATE bosses SET status='defeated' WHERE id=$1", boss_id)
         phrase = random.choice(BOSS_DEATH_PHRASES)
-        await safe_send_chat(boss['chat_id'], f"{phrase}\nУчастники получили по {coins_per_player} баксов и {btc_per_player} BTC!")
+        outbox_send(boss['chat_id'], f"{phrase}\nУчастники получили по {coins_per_player} баксов и {btc_per_player} BTC!")
 
 # ==================== ФУНКЦИИ ДЛЯ РАСЧЁТА УРОНА ====================
 async def calculate_fight_damage(strength: int) -> int:
-    base = await get_setting_int("fight_base_damage")
-    variance = await get_setting_int("fight_damage_variance")
+    cfg = await get_settings_snapshot()
+    base = cfg.fight_base_damage
+    variance = cfg.fight_damage_variance
     damage = base + strength // 2 + random.randint(-variance, variance)
     return max(1, damage)
 
 async def calculate_fight_authority() -> int:
-    min_auth = await get_setting_int("fight_authority_min")
-    max_auth = await get_setting_int("fight_authority_max")
+    cfg = await get_settings_snapshot()
+    min_auth = cfg.fight_authority_min
+    max_auth = cfg.fight_authority_max
     return random.randint(min_auth, max_auth)
 
 def is_critical(strength: int, agility: int) -> bool:
@@ -2016,9 +3385,10 @@ def is_counter(defense: int) -> bool:
 
 # ==================== ФУНКЦИИ ДЛЯ ИГР ====================
 async def slots_spin() -> Tuple[List[str], float, bool]:
+    cfg = await get_settings_snapshot()
     symbols = ['🍒', '🍋', '🍊', '7️⃣', '💎']
     result = [random.choice(symbols) for _ in range(3)]
-    win_prob = await get_setting_float("slots_win_probability")
+    win_prob = cfg.slots_win_probability
     win = random.random() * 100 <= win_prob
     if not win:
         while result[0] == result[1] or result[1] == result[2] or result[0] == result[2]:
@@ -2036,11 +3406,11 @@ async def slots_spin() -> Tuple[List[str], float, bool]:
             result[(pos+1)%3] = sym
         if result[0] == result[1] == result[2]:
             if result[0] == '7️⃣':
-                multiplier = await get_setting_float("slots_multiplier_seven")
+                multiplier = cfg.slots_multiplier_seven
             elif result[0] == '💎':
-                multiplier = await get_setting_float("slots_multiplier_diamond")
+                multiplier = cfg.slots_multiplier_diamond
             else:
-                multiplier = await get_setting_float("slots_multiplier_three")
+                multiplier = cfg.slots_multiplier_three
             return result, multiplier, True
         else:
             return result, 2.0, True
@@ -2076,7 +3446,7 @@ async def roulette_spin(bet_type: str, bet_number: int = None) -> Tuple[int, str
 
 # ==================== ФУНКЦИИ ДЛЯ КОНТРАБАНДЫ ====================
 async def check_smuggle_cooldown(user_id: int) -> Tuple[bool, int]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         row = await conn.fetchrow("SELECT cooldown_until FROM smuggle_cooldowns WHERE user_id=$1", user_id)
         if row and row['cooldown_until']:
             cooldown_until = row['cooldown_until']
@@ -2088,9 +3458,10 @@ async def check_smuggle_cooldown(user_id: int) -> Tuple[bool, int]:
     return True, 0
 
 async def set_smuggle_cooldown(user_id: int, penalty: int = 0):
-    base = await get_setting_int("smuggle_cooldown_minutes")
+    cfg = await get_settings_snapshot()
+    base = cfg.smuggle_cooldown_minutes
     cooldown_until = datetime.now() + timedelta(minutes=base + penalty)
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute('''
             INSERT INTO smuggle_cooldowns (user_id, cooldown_until)
             VALUES ($1, $2)
@@ -2127,26 +3498,27 @@ def create_deck():
 
 # ==================== ФУНКЦИИ ДЛЯ ОЧИСТКИ ====================
 async def perform_cleanup(manual=False):
-    days_bosses = await get_setting_int("cleanup_days_bosses")
-    days_auctions = await get_setting_int("cleanup_days_auctions")
-    days_purchases = await get_setting_int("cleanup_days_purchases")
-    days_giveaways = await get_setting_int("cleanup_days_giveaways")
-    days_tasks = await get_setting_int("cleanup_days_user_tasks")
-    days_fight = await get_setting_int("cleanup_days_fight_logs")
-    days_smuggle = await get_setting_int("cleanup_days_smuggle")
-    days_orders = await get_setting_int("cleanup_days_bitcoin_orders")
+    cfg = await get_settings_snapshot()
+    days_bosses = cfg.cleanup_days_bosses
+    days_auctions = cfg.cleanup_days_auctions
+    days_purchases = cfg.cleanup_days_purchases
+    days_giveaways = cfg.cleanup_days_giveaways
+    days_tasks = cfg.cleanup_days_user_tasks
+    days_fight = cfg.cleanup_days_fight_logs
+    days_smuggle = cfg.cleanup_days_smuggle
+    days_orders = cfg.cleanup_days_bitcoin_orders
 
     now = datetime.now()
-    cutoff_bosses = (now - timedelta(days=days_bosses)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_purchases = (now - timedelta(days=days_purchases)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_giveaways = (now - timedelta(days=days_giveaways)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_tasks = (now - timedelta(days=days_tasks)).strftime("%Y-%m-%d %H:%M:%S")
-    cutoff_smuggle = (now - timedelta(days=days_smuggle)).strftime("%Y-%m-%d %H:%M:%S")
+    cutoff_bosses = now - timedelta(days=days_bosses)
+    cutoff_purchases = now - timedelta(days=days_purchases)
+    cutoff_giveaways = now - timedelta(days=days_giveaways)
+    cutoff_tasks = now - timedelta(days=days_tasks)
+    cutoff_smuggle = now - timedelta(days=days_smuggle)
     cutoff_auctions = now - timedelta(days=days_auctions)
     cutoff_fight = now - timedelta(days=days_fight)
     cutoff_orders = now - timedelta(days=days_orders)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM bosses WHERE status IN ('defeated', 'expired') AND spawned_at < $1", cutoff_bosses)
         await conn.execute("DELETE FROM boss_attacks WHERE attack_time < $1", cutoff_bosses)
         await conn.execute("DELETE FROM purchases WHERE status IN ('completed','rejected') AND purchase_date < $1", cutoff_purchases)
@@ -2155,9 +3527,13 @@ async def perform_cleanup(manual=False):
         await conn.execute("DELETE FROM smuggle_runs WHERE status IN ('completed', 'failed') AND end_time < $1", cutoff_smuggle)
         await conn.execute("DELETE FROM auctions WHERE status='ended' AND end_time < $1", cutoff_auctions)
         await conn.execute("DELETE FROM fight_logs WHERE timestamp < $1", cutoff_fight)
-        await conn.execute("DELETE FROM bitcoin_orders WHERE status IN ('completed', 'cancelled') AND created_at < $1", cutoff_orders)
+        await conn.execute("DELETE FROM bitcoin_orders_history WHERE closed_at < $1", cutoff_orders)
+        await conn.execute(
+            "DELETE FROM bitcoin_candles WHERE period='1m' AND bucket < $1",
+            now - timedelta(days=CANDLE_MINUTE_RETENTION_DAYS)
+        )
 
-        cooldown_minutes = await get_setting_int("fight_cooldown_minutes")
+        cooldown_minutes = cfg.fight_cooldown_minutes
         cutoff_cooldown = now - timedelta(minutes=cooldown_minutes * 2)
         await conn.execute("DELETE FROM global_cooldowns WHERE last_used < $1", cutoff_cooldown)
 
@@ -2168,27 +3544,34 @@ async def perform_cleanup(manual=False):
 
 # ==================== ФУНКЦИИ ДЛЯ ЭКСПОРТА ====================
 async def export_users_to_csv() -> bytes:
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM users ORDER BY user_id")
+    # счётчики игр копятся в памяти – сначала сбрасываем их, остаток подмешиваем через merge()
+    try:
+        await counters.flush()
+    except Exception as e:
+        logging.warning(f"Export: не удалось сбросить счётчики перед выгрузкой: {e}")
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT * FROM users_full ORDER BY user_id")
     if not rows:
         return b""
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(dict(rows[0]).keys())
     for row in rows:
-        # Преобразуем Decimal в float для записи
-        row_dict = dict(row)
+        # Деньги – в основных единицах, Decimal – в float
+        row_dict = counters.merge(row)
         for k, v in row_dict.items():
-            if isinstance(v, (asyncpg.pgproto.pgdecimal.Decimal, float)):
+            if k in MONEY_COLUMNS and v is not None:
+                row_dict[k] = str(MONEY_COLUMNS[k](v))
+            elif isinstance(v, (Decimal, float)):
                 row_dict[k] = float(v)
         writer.writerow(row_dict.values())
     return output.getvalue().encode('utf-8')
 
-ALLOWED_TABLES = ['users', 'purchases', 'bosses', 'auctions', 'giveaways', 'tasks', 'chat_authority', 'fight_logs', 'bitcoin_orders']
+ALLOWED_TABLES = ['users', 'purchases', 'bosses', 'auctions', 'giveaways', 'tasks', 'chat_authority', 'fight_logs', 'bitcoin_orders', 'bitcoin_orders_history']
 async def export_table_to_csv(table: str) -> Optional[bytes]:
     if table not in ALLOWED_TABLES:
         return None
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         try:
             exists = await conn.fetchval(
                 "SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = $1)",
@@ -2207,163 +3590,477 @@ async def export_table_to_csv(table: str) -> Optional[bytes]:
         for row in rows:
             row_dict = dict(row)
             for k, v in row_dict.items():
-                if isinstance(v, (asyncpg.pgproto.pgdecimal.Decimal, float)):
+                if isinstance(v, (Decimal, float)):
                     row_dict[k] = float(v)
             writer.writerow(row_dict.values())
         return output.getvalue().encode('utf-8')
 
 # ==================== ФУНКЦИИ ДЛЯ БИТКОИН-БИРЖИ (ПОЛНОЦЕННЫЙ СТАКАН) ====================
-async def get_order_book() -> Dict[str, List[Dict]]:
-    async with db_pool.acquire() as conn:
-        buy_orders = await conn.fetch("""
-            SELECT price, SUM(amount) as total_amount, COUNT(*) as count
-            FROM bitcoin_orders
-            WHERE type='buy' AND status='active'
-            GROUP BY price
-            ORDER BY price DESC
-        """)
-        sell_orders = await conn.fetch("""
-            SELECT price, SUM(amount) as total_amount, COUNT(*) as count
-            FROM bitcoin_orders
-            WHERE type='sell' AND status='active'
-            GROUP BY price
-            ORDER BY price ASC
-        """)
-        bids = []
-        for r in buy_orders:
-            bids.append({
-                'price': r['price'],
-                'total_amount': float(r['total_amount']),
-                'count': r['count']
-            })
-        asks = []
-        for r in sell_orders:
-            asks.append({
-                'price': r['price'],
-                'total_amount': float(r['total_amount']),
-                'count': r['count']
-            })
-        return {
-            'bids': bids,
-            'asks': asks
-        }
+def get_order_book() -> Dict[str, Any]:
+    """Агрегированный стакан из памяти движка; пересобирается только при смене версии."""
+    return exchange.depth_snapshot()
 
 async def get_active_orders(order_type: str = None) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         if order_type == 'buy':
             rows = await conn.fetch("SELECT * FROM bitcoin_orders WHERE type='buy' AND status='active' ORDER BY price DESC, created_at ASC")
         elif order_type == 'sell':
             rows = await conn.fetch("SELECT * FROM bitcoin_orders WHERE type='sell' AND status='active' ORDER BY price ASC, created_at ASC")
         else:
             rows = await conn.fetch("SELECT * FROM bitcoin_orders WHERE status='active' ORDER BY created_at DESC")
-        result = []
+        return [order_row(r) for r in rows]
+
+def locked_unit(side: str) -> type:
+    """Единицы блокировки заявки: покупка держит баксы, продажа – биткоины."""
+    return Cents if side == 'buy' else BtcUnits
+
+def order_row(row) -> dict:
+    """Строка bitcoin_orders с amount в BtcUnits и total_locked в единицах своей стороны."""
+    d = dict(row)
+    d['amount'] = BtcUnits.from_major(d['amount'])
+    d['total_locked'] = locked_unit(d['type']).from_major(d['total_locked'])
+    return d
+
+def trade_cost(amount: BtcUnits, price: int) -> Cents:
+    """Стоимость amount по цене price $/BTC в центах, с округлением вниз. Сумма стоимостей
+    частей никогда не больше стоимости целого, поэтому блокировки покупки всегда хватает."""
+    return Cents(amount * price * Cents.SCALE // BtcUnits.SCALE)
+
+# ==================== МАТЧИНГ-ДВИЖОК БИРЖИ ====================
+class BookOrder:
+    """Заявка в стакане: amount – BtcUnits, total_locked – Cents у покупки и BtcUnits у продажи."""
+    __slots__ = ('id', 'user_id', 'side', 'price', 'amount', 'total_locked')
+
+    def __init__(self, id, user_id: int, side: str, price: int, amount: BtcUnits, total_locked: Money):
+        self.id = id
+        self.user_id = user_id
+        self.side = side
+        self.price = price
+        self.amount = amount
+        self.total_locked = total_locked
+
+class MatchingEngine:
+    """Стакан биржи в памяти с приоритетом цена-время.
+
+    На каждой стороне – куча цен (у покупок цена хранится со знаком минус) и FIFO-очередь
+    заявок на каждом уровне. Стакан никогда не остаётся пересечённым, поэтому сводить
+    нужно только входящую заявку с противоположной стороной. Источник истины – БД:
+    стакан меняется только под self.lock вместе с транзакцией, а при её откате
+    перечитывается заново. Если и перечитать не удалось (задачу отменили), стакан
+    помечается stale и перечитывается следующей операцией под тем же lock.
+
+    Объёмы и блокировки – целые BtcUnits/Cents, поэтому исполненная заявка – ровно ноль.
+    Глубина по уровням (объём и число заявок) поддерживается на каждое изменение,
+    а version растёт с каждым изменением – по ней клавиатуры понимают, что стакан сдвинулся.
+    """
+    def __init__(self):
+        self.orders: Dict[int, BookOrder] = {}
+        self.levels = {'buy': {}, 'sell': {}}   # цена -> deque заявок
+        self.heaps = {'buy': [], 'sell': []}
+        self.depth = {'buy': {}, 'sell': {}}    # цена -> [объём BtcUnits, число заявок]
+        self.version = 0
+        self.snapshot = None
+        self.stale = False
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        async with db_conn() as conn:
+            rows = await conn.fetch(
+                "SELECT id, user_id, type, price, amount, total_locked FROM bitcoin_orders "
+                "WHERE status='active' ORDER BY created_at, id"
+            )
+        self.orders.clear()
+        for side in ('buy', 'sell'):
+            self.levels[side].clear()
+            self.heaps[side].clear()
+            self.depth[side].clear()
+        self.version += 1
         for r in rows:
-            d = dict(r)
-            d['amount'] = float(d['amount'])
-            d['total_locked'] = float(d['total_locked'])
-            result.append(d)
-        return result
+            r = order_row(r)
+            self.add(BookOrder(r['id'], r['user_id'], r['type'], r['price'], r['amount'], r['total_locked']))
+        self.stale = False
+        logging.info(f"Стакан биржи загружен: {len(rows)} активных заявок")
+
+    def add(self, order: BookOrder):
+        levels = self.levels[order.side]
+        level = levels.get(order.price)
+        if level is None:
+            level = levels[order.price] = deque()
+            heapq.heappush(self.heaps[order.side], -order.price if order.side == 'buy' else order.price)
+        level.append(order)
+        self.orders[order.id] = order
+        self._update_depth(order.side, order.price, order.amount, 1)
+
+    def remove(self, order_id: int) -> Optional[BookOrder]:
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        level = self.levels[order.side].get(order.price)
+        if level is not None:
+            level.remove(order)
+            if not level:
+                # цена из кучи уйдёт лениво в best_price
+                del self.levels[order.side][order.price]
+        self._update_depth(order.side, order.price, -order.amount, -1)
+        return order
+
+    def _update_depth(self, side: str, price: int, amount: int, count: int):
+        depth = self.depth[side]
+        entry = depth.setdefault(price, [BtcUnits(0), 0])
+        entry[0] = BtcUnits(entry[0] + amount)
+        entry[1] += count
+        if entry[1] <= 0:
+            del depth[price]
+        self.version += 1
+
+    def depth_snapshot(self) -> Dict[str, Any]:
+        if self.snapshot is None or self.snapshot['version'] != self.version:
+            def side_levels(side, reverse):
+                return [{'price': price, 'total_amount': total, 'count': count}
+                        for price, (total, count) in sorted(self.depth[side].items(), reverse=reverse)]
+            self.snapshot = {
+                'version': self.version,
+                'bids': side_levels('buy', True),
+                'asks': side_levels('sell', False),
+            }
+        return self.snapshot
+
+    def best_price(self, side: str) -> Optional[int]:
+        heap = self.heaps[side]
+        levels = self.levels[side]
+        while heap:
+            price = -heap[0] if side == 'buy' else heap[0]
+            if price in levels:
+                return price
+            heapq.heappop(heap)
+        return None
 
-async def create_bitcoin_order(user_id: int, order_type: str, amount: float, price: int) -> int:
-    try:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
+    def _crossing_levels(self, side: str, limit: Optional[int]):
+        """Уровни стороны side, доступные заявке с лимитом limit (None – без лимита), от лучшего."""
+        for price in sorted(self.depth[side], reverse=(side == 'buy')):
+            if limit is not None and ((price > limit) if side == 'sell' else (price < limit)):
+                break
+            yield price, self.depth[side][price][0]
+
+    def available(self, side: str, limit: Optional[int] = None) -> BtcUnits:
+        return BtcUnits(sum(volume for _, volume in self._crossing_levels(side, limit)))
+
+    def quote(self, side: str, amount: BtcUnits, limit: Optional[int] = None) -> Tuple[BtcUnits, Cents]:
+        """Сколько BTC из amount можно забрать со стороны side и во сколько баксов это обойдётся.
+        Стоимость по уровню не меньше суммы стоимостей сделок по нему (trade_cost округляет вниз)."""
+        remaining = amount
+        cost = 0
+        for price, volume in self._crossing_levels(side, limit):
+            if remaining <= 0:
+                break
+            take = min(remaining, volume)
+            cost += trade_cost(take, price)
+            remaining -= take
+        return BtcUnits(amount - remaining), Cents(cost)
+
+    def match(self, taker: BookOrder) -> List[Tuple[BookOrder, BtcUnits, int]]:
+        """Сводит входящую заявку со стаканом по цене встречных заявок (price=None – по рынку).
+        Меняет стакан и taker, возвращает сделки (встречная заявка, объём, цена)."""
+        opposite = 'sell' if taker.side == 'buy' else 'buy'
+        fills = []
+        while taker.amount > 0:
+            price = self.best_price(opposite)
+            if price is None:
+                break
+            if taker.price is not None and ((price > taker.price) if taker.side == 'buy' else (price < taker.price)):
+                break
+            level = self.levels[opposite][price]
+            maker = level[0]
+            take = BtcUnits(min(taker.amount, maker.amount))
+            cost = trade_cost(take, price)
+            for order in (taker, maker):
+                order.amount = BtcUnits(order.amount - take)
+                if order.side == 'buy':
+                    order.total_locked = Cents(order.total_locked - cost)
+                else:
+                    order.total_locked = BtcUnits(order.total_locked - take)
+            done = maker.amount == 0
+            if done:
+                level.popleft()
+                del self.orders[maker.id]
+                if not level:
+                    del self.levels[opposite][price]
+            self._update_depth(opposite, price, -take, -1 if done else 0)
+            fills.append((maker, take, price))
+        return fills
+
+exchange = MatchingEngine()
+
+# ==================== СВЕЧИ И ТИКЕР БИРЖИ ====================
+CANDLE_PERIODS = {
+    '1m': dict(second=0, microsecond=0),
+    '1h': dict(minute=0, second=0, microsecond=0),
+    '1d': dict(hour=0, minute=0, second=0, microsecond=0),
+}
+CANDLE_MINUTE_RETENTION_DAYS = 7  # минутные свечи нужны только для свежей истории
+
+def candle_bucket(moment: datetime, period: str) -> datetime:
+    return moment.replace(**CANDLE_PERIODS[period])
+
+async def record_candles(conn, fills: List[Tuple[BookOrder, BtcUnits, int]], moment: datetime):
+    """Добавляет проход матчинга в свечи всех периодов одним upsert."""
+    prices = [price for _, _, price in fills]
+    volume = BtcUnits(sum(take for _, take, _ in fills)).major
+    periods = list(CANDLE_PERIODS)
+    n = len(periods)
+    await conn.execute('''
+        INSERT INTO bitcoin_candles AS c (period, bucket, open, high, low, close, volume, trades)
+        SELECT * FROM unnest($1::text[], $2::timestamptz[], $3::int[], $4::int[], $5::int[],
+                             $6::int[], $7::numeric[], $8::int[])
+        ON CONFLICT (period, bucket) DO UPDATE SET
+            high = GREATEST(c.high, EXCLUDED.high),
+            low = LEAST(c.low, EXCLUDED.low),
+            close = EXCLUDED.close,
+            volume = c.volume + EXCLUDED.volume,
+            trades = c.trades + EXCLUDED.trades
+    ''', periods, [candle_bucket(moment, p) for p in periods],
+        [prices[0]] * n, [max(prices)] * n, [min(prices)] * n, [prices[-1]] * n,
+        [volume] * n, [len(fills)] * n)
+
+class MarketTicker:
+    """Сводка рынка в памяти: последняя цена, лучшие bid/ask, изменение и объём за сутки.
+    Суточные цифры считаются по часовым свечам, поэтому окно сдвигается раз в час."""
+    def __init__(self):
+        self.last_price: Optional[int] = None
+        self.hours = deque()   # [начало часа, open, объём] за последние 24 часа
+
+    async def load(self):
+        since = candle_bucket(datetime.now(), '1h') - timedelta(hours=23)
+        async with db_conn() as conn:
+            rows = await conn.fetch(
+                "SELECT bucket, open, volume FROM bitcoin_candles WHERE period='1h' AND bucket >= $1 ORDER BY bucket",
+                since
+            )
+            self.last_price = await conn.fetchval("SELECT price FROM bitcoin_trades ORDER BY id DESC LIMIT 1")
+        self.hours = deque([r['bucket'], r['open'], float(r['volume'])] for r in rows)
+
+    def record(self, fills: List[Tuple[BookOrder, BtcUnits, int]], moment: datetime):
+        bucket = candle_bucket(moment, '1h')
+        if not self.hours or self.hours[-1][0] != bucket:
+            self.hours.append([bucket, fills[0][2], 0.0])
+        self.hours[-1][2] += BtcUnits(sum(take for _, take, _ in fills)).major
+        self.last_price = fills[-1][2]
+
+    def snapshot(self) -> Dict[str, Any]:
+        since = candle_bucket(datetime.now(), '1h') - timedelta(hours=23)
+        while self.hours and self.hours[0][0] < since:
+            self.hours.popleft()
+        change = None
+        if self.last_price is not None and self.hours:
+            base = self.hours[0][1]
+            change = (self.last_price - base) / base * 100
+        return {
+            'last': self.last_price,
+            'bid': exchange.best_price('buy'),
+            'ask': exchange.best_price('sell'),
+            'change': change,
+            'volume': round(sum(h[2] for h in self.hours), 4),
+        }
+
+ticker = MarketTicker()
+
+def ticker_text() -> str:
+    t = ticker.snapshot()
+    bid = f"{t['bid']} $" if t['bid'] is not None else "—"
+    ask = f"{t['ask']} $" if t['ask'] is not None else "—"
+    if t['last'] is None:
+        return f"📈 Сделок ещё не было. Bid: {bid} | Ask: {ask}"
+    change = f" ({t['change']:+.2f}% за 24ч)" if t['change'] is not None else ""
+    return (
+        f"📈 Курс: {t['last']} $/BTC{change}\n"
+        f"Bid: {bid} | Ask: {ask} | Объём 24ч: {t['volume']:.4f} BTC"
+    )
+
+async def archive_bitcoin_orders(conn, order_ids: List[int], status: str):
+    """Переносит закрытые заявки из живой таблицы в bitcoin_orders_history (в транзакции вызывающего)."""
+    await conn.execute('''
+        WITH moved AS (DELETE FROM bitcoin_orders WHERE id = ANY($1::int[]) RETURNING *)
+        INSERT INTO bitcoin_orders_history (id, user_id, type, amount, price, created_at, status)
+        SELECT id, user_id, type, CASE WHEN $2 = 'completed' THEN 0 ELSE amount END, price, created_at, $2
+        FROM moved
+    ''', order_ids, status)
+
+async def persist_fills(conn, taker: BookOrder, fills: List[Tuple[BookOrder, BtcUnits, int]], release_taker: bool):
+    """Записывает проход матчинга пачкой: заявки, сделки и зачисления – по запросу на таблицу.
+    С исполненных заявок (и с taker при release_taker) возвращается остаток блокировки:
+    покупка дешевле своего лимита оставляет лишние баксы."""
+    money = defaultdict(int)   # user_id -> центы
+    btc = defaultdict(int)     # user_id -> BtcUnits
+    trades = []
+    makers = {}
+    for maker, take, price in fills:
+        makers[maker.id] = maker
+        buy, sell = (taker, maker) if taker.side == 'buy' else (maker, taker)
+        trades.append((buy.id, sell.id, take.major, price, buy.user_id, sell.user_id))
+        money[sell.user_id] += trade_cost(take, price)
+        btc[buy.user_id] += take
+
+    def release(order: BookOrder):
+        if order.total_locked > 0:
+            (money if order.side == 'buy' else btc)[order.user_id] += order.total_locked
+        order.total_locked = locked_unit(order.side)(0)
+
+    for maker in makers.values():
+        if maker.amount == 0:
+            release(maker)
+    if release_taker:
+        release(taker)
+
+    partial = [o for o in makers.values() if o.amount > 0]
+    completed = [o.id for o in makers.values() if o.amount == 0]
+    if partial:
+        await conn.execute('''
+            UPDATE bitcoin_orders o
+            SET amount = v.amount, total_locked = v.locked
+            FROM unnest($1::int[], $2::numeric[], $3::numeric[]) AS v(id, amount, locked)
+            WHERE o.id = v.id
+        ''', [o.id for o in partial], [o.amount.major for o in partial],
+            [o.total_locked.major for o in partial]
+        )
+    if completed:
+        await archive_bitcoin_orders(conn, completed, 'completed')
+    if trades:
+        await conn.execute('''
+            INSERT INTO bitcoin_trades (buy_order_id, sell_order_id, amount, price, buyer_id, seller_id)
+            SELECT * FROM unnest($1::int[], $2::int[], $3::numeric[], $4::int[], $5::bigint[], $6::bigint[])
+        ''', *[list(col) for col in zip(*trades)])
+        await record_candles(conn, fills, db_now())
+    if money:
+        money = {user_id: Cents(d) for user_id, d in money.items()}
+        rows = await conn.fetch('''
+            UPDATE user_wallet u SET balance = u.balance + v.delta
+            FROM unnest($1::bigint[], $2::bigint[]) AS v(user_id, delta)
+            WHERE u.user_id = v.user_id
+            RETURNING u.user_id, u.balance
+        ''', list(money.keys()), list(money.values()))
+        for r in rows:
+            ledger.record(r['user_id'], 'balance', money[r['user_id']], r['balance'], 'exchange')
+    if btc:
+        btc = {user_id: BtcUnits(d) for user_id, d in btc.items()}
+        rows = await conn.fetch('''
+            UPDATE user_wallet u SET bitcoin_balance = u.bitcoin_balance + v.delta
+            FROM unnest($1::bigint[], $2::bigint[]) AS v(user_id, delta)
+            WHERE u.user_id = v.user_id
+            RETURNING u.user_id, u.bitcoin_balance
+        ''', list(btc.keys()), list(btc.values()))
+        for r in rows:
+            ledger.record(r['user_id'], 'bitcoin', btc[r['user_id']], r['bitcoin_balance'], 'exchange')
+
+async def place_bitcoin_order(user_id: int, order_type: str, amount: Union[float, BtcUnits], price: Optional[int],
+                              rest: bool = True) -> Tuple[Optional[int], List[Tuple[BookOrder, BtcUnits, int]]]:
+    """Блокирует средства, сводит заявку в памяти и сохраняет результат одной транзакцией.
+
+    rest=False – немедленное исполнение (IOC): проходит по всем подходящим уровням за один
+    проход, неисполненный остаток возвращается. price=None – рыночная заявка, только с rest=False.
+    Покупка IOC блокирует ровно стоимость прохода по стакану, а не amount * лимит."""
+    cfg = await get_settings_snapshot()
+    if price is None and rest:
+        raise ValueError("Рыночная заявка не может стоять в стакане")
+    max_input = Cents.from_major(cfg.max_input_number)
+    amount = BtcUnits.from_major(amount)
+    taker = BookOrder(None, user_id, order_type, price, amount, locked_unit(order_type)(0))
+    fills = None
+    async with exchange.lock:
+        if exchange.stale:
+            await exchange.load()
+        try:
+            async with db_transaction() as conn:
                 if order_type == 'sell':
-                    current_btc = await get_user_bitcoin(user_id)
-                    if current_btc < amount - 0.0001:
-                        raise ValueError("Недостаточно BTC")
-                    await update_user_bitcoin(user_id, -amount, conn=conn)
-                    total_locked = amount
-                else:  # buy
-                    total_cost = amount * price
-                    current_balance = await get_user_balance(user_id)
-                    if current_balance < total_cost - 0.01:
-                        raise ValueError("Недостаточно баксов")
-                    max_input = await get_setting_float("max_input_number")
-                    if total_cost > max_input:
+                    taker.total_locked = amount
+                    await update_user_bitcoin(user_id, BtcUnits(-amount), conn=conn, reason='exchange')
+                else:
+                    if rest:
+                        taker.total_locked = trade_cost(amount, price)
+                    else:
+                        _, taker.total_locked = exchange.quote('sell', amount, price)
+                    if taker.total_locked > max_input:
                         raise ValueError(f"Сумма слишком большая (максимум {max_input:.2f})")
-                    await update_user_balance(user_id, -total_cost, conn=conn)
-                    total_locked = total_cost
+                    balance = await conn.fetchval("SELECT balance FROM user_wallet WHERE user_id=$1 FOR UPDATE", user_id)
+                    if Cents(balance or 0) < taker.total_locked:
+                        raise ValueError(f"Недостаточно баксов. Нужно {taker.total_locked:.2f}")
+                    await update_user_balance(user_id, Cents(-taker.total_locked), conn=conn, reason='exchange')
+                fills = exchange.match(taker)
+                filled = taker.amount == 0
+                if rest and filled:
+                    # исполнилась сразу – в живую таблицу не попадает, id из той же последовательности
+                    taker.id = await conn.fetchval(
+                        "INSERT INTO bitcoin_orders_history (id, user_id, type, amount, price, created_at, status) "
+                        "VALUES (nextval(pg_get_serial_sequence('bitcoin_orders', 'id')), $1, $2, 0, $3, NOW(), 'completed') "
+                        "RETURNING id",
+                        user_id, order_type, price
+                    )
+                elif rest:
+                    taker.id = await conn.fetchval(
+                        "INSERT INTO bitcoin_orders (user_id, type, amount, price, total_locked) "
+                        "VALUES ($1, $2, $3, $4, $5) RETURNING id",
+                        user_id, order_type, taker.amount.major, price, taker.total_locked.major
+                    )
+                await persist_fills(conn, taker, fills, release_taker=filled or not rest)
+        except BaseException:
+            # и CancelledError: транзакция откатилась, а стакан уже изменён – берём состояние из БД
+            if fills:
+                exchange.stale = True
+                await exchange.load()
+            raise
+        if rest and taker.amount > 0:
+            exchange.add(taker)
+        if fills:
+            ticker.record(fills, db_now())
+    return taker.id, fills
+
+def fill_report_text(order_type: str, requested: Union[float, BtcUnits],
+                     fills: List[Tuple[BookOrder, BtcUnits, int]]) -> str:
+    """Отчёт об исполнении IOC/рыночной заявки: объём, средняя цена, пройденные уровни."""
+    filled = BtcUnits(sum(take for _, take, _ in fills))
+    if filled == 0:
+        return "❌ Подходящих встречных заявок нет – ничего не исполнено, средства возвращены."
+    total = Cents(sum(trade_cost(take, price) for _, take, price in fills))
+    levels = len({price for _, _, price in fills})
+    text = (
+        f"✅ {'Куплено' if order_type == 'buy' else 'Продано'} {filled:.4f} BTC "
+        f"за {total:.2f} баксов.\n"
+        f"Средняя цена: {total.major / filled.major:.2f} $/BTC (уровней: {levels}, сделок: {len(fills)})"
+    )
+    unfilled = BtcUnits(BtcUnits.from_major(requested) - filled)
+    if unfilled > 0:
+        text += f"\nНе исполнено: {unfilled:.4f} BTC – остаток возвращён."
+    return text
 
-                order_id = await conn.fetchval(
-                    "INSERT INTO bitcoin_orders (user_id, type, amount, price, total_locked) VALUES ($1, $2, $3, $4, $5) RETURNING id",
-                    user_id, order_type, amount, price, total_locked
-                )
-                await match_orders(conn)
-                return order_id
+async def create_bitcoin_order(user_id: int, order_type: str, amount: Union[float, BtcUnits], price: int) -> int:
+    try:
+        order_id, _ = await place_bitcoin_order(user_id, order_type, amount, price)
+        return order_id
     except ValueError as e:
         raise e
     except Exception as e:
         logging.error(f"Unexpected error in create_bitcoin_order for user {user_id}: {e}", exc_info=True)
         raise ValueError("Внутренняя ошибка сервера. Попробуйте позже.")
 
-async def cancel_bitcoin_order(order_id: int, user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND user_id=$2 AND status='active'", order_id, user_id)
+async def cancel_bitcoin_order(order_id: int, user_id: Optional[int] = None) -> bool:
+    """Отменяет активную заявку и возвращает блокировку. user_id=None – отмена админом."""
+    async with exchange.lock:
+        if exchange.stale:
+            await exchange.load()
+        async with db_transaction() as conn:
+            order = await conn.fetchrow(
+                "SELECT * FROM bitcoin_orders WHERE id=$1 AND ($2::bigint IS NULL OR user_id=$2) AND status='active' FOR UPDATE",
+                order_id, user_id
+            )
             if not order:
                 return False
-            total_locked = float(order['total_locked'])
+            total_locked = order_row(order)['total_locked']
             if order['type'] == 'sell':
-                await update_user_bitcoin(user_id, total_locked, conn=conn)
+                await update_user_bitcoin(order['user_id'], total_locked, conn=conn)
             else:
-                await update_user_balance(user_id, total_locked, conn=conn)
-            await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE id=$1", order_id)
-            return True
-
-async def match_orders(conn):
-    while True:
-        buy = await conn.fetchrow("""
-            SELECT id, user_id, price, amount, total_locked
-            FROM bitcoin_orders
-            WHERE type='buy' AND status='active'
-            ORDER BY price DESC, created_at ASC
-            LIMIT 1
-        """)
-        sell = await conn.fetchrow("""
-            SELECT id, user_id, price, amount, total_locked
-            FROM bitcoin_orders
-            WHERE type='sell' AND status='active'
-            ORDER BY price ASC, created_at ASC
-            LIMIT 1
-        """)
-        if not buy or not sell or buy['price'] < sell['price']:
-            break
-
-        buy_amount = float(buy['amount'])
-        buy_total_locked = float(buy['total_locked'])
-        sell_amount = float(sell['amount'])
-        sell_total_locked = float(sell['total_locked'])
-        trade_price = sell['price']
-
-        trade_amount = min(buy_amount, sell_amount)
-        total_cost = trade_amount * trade_price
-
-        buyer_id = buy['user_id']
-        seller_id = sell['user_id']
-
-        await update_user_balance(seller_id, total_cost, conn=conn)
-        await update_user_bitcoin(buyer_id, trade_amount, conn=conn)
-
-        new_buy_amount = buy_amount - trade_amount
-        new_sell_amount = sell_amount - trade_amount
-        new_buy_locked = buy_total_locked - total_cost
-        new_sell_locked = sell_total_locked - trade_amount
-
-        if new_buy_amount <= 0.0001:
-            await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", buy['id'])
-        else:
-            await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_buy_amount, new_buy_locked, buy['id'])
-
-        if new_sell_amount <= 0.0001:
-            await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", sell['id'])
-        else:
-            await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_sell_amount, new_sell_locked, sell['id'])
-
-        await conn.execute(
-            "INSERT INTO bitcoin_trades (buy_order_id, sell_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5, $6)",
-            buy['id'], sell['id'], trade_amount, trade_price, buyer_id, seller_id
-        )
+                await update_user_balance(order['user_id'], total_locked, conn=conn)
+            await archive_bitcoin_orders(conn, [order_id], 'cancelled')
+        exchange.remove(order_id)
+        return True
 
 # ==================== КОНЕЦ ЧАСТИ 1 ====================
 # ==================== ЧАСТЬ 2: СОСТОЯНИЯ FSM И КЛАВИАТУРЫ ====================
@@ -2701,10 +4398,11 @@ def bitcoin_exchange_keyboard():
     return ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="📈 Купить BTC"), KeyboardButton(text="📉 Продать BTC")],
         [KeyboardButton(text="📋 Мои заявки"), KeyboardButton(text="📊 Стакан заявок")],
+        [KeyboardButton(text="📜 История заявок")],
         [KeyboardButton(text="◀️ Назад")]
     ], resize_keyboard=True)
 
-def order_book_keyboard(book: Dict[str, List[Dict]]):
+def order_book_keyboard(book: Dict[str, Any]):
     kb = []
     if book['asks']:
         kb.append([InlineKeyboardButton(text="📉 Продажа (ASK) - лучшие цены", callback_data="noop")])
@@ -2726,6 +4424,11 @@ def order_book_keyboard(book: Dict[str, List[Dict]]):
     else:
         kb.append([InlineKeyboardButton(text="Нет активных покупок", callback_data="noop")])
     
+    kb.append([
+        InlineKeyboardButton(text="⚡ Купить по рынку", callback_data="buy_from_market"),
+        InlineKeyboardButton(text="⚡ Продать по рынку", callback_data="sell_to_market"),
+    ])
+    kb.append([InlineKeyboardButton(text="🔄 Обновить", callback_data=f"book_refresh_{book['version']}")])
     kb.append([InlineKeyboardButton(text="« Назад", callback_data="exchange_back")])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
@@ -2787,7 +4490,7 @@ def business_buy_keyboard(business_types: List[dict]):
     kb = []
     for bt in business_types:
         kb.append([InlineKeyboardButton(
-            text=f"{bt['emoji']} {bt['name']} – {bt['base_price_btc']} BTC",
+            text=f"{bt['emoji']} {bt['name']} – {bt['base_price_btc']:.2f} BTC",
             callback_data=f"buy_biz_{bt['id']}"
         )])
     kb.append([InlineKeyboardButton(text="◀️ Отмена", callback_data="buy_biz_cancel")])
@@ -3170,13 +4873,100 @@ async def send_with_media(chat_id: int, text: str, media_key: str = None, **kwar
         file_id = await get_media_file_id(media_key)
         if file_id:
             try:
-                await bot.send_photo(chat_id, file_id, caption=text, **kwargs)
+                await outbound.send(chat_id, 'send_photo', file_id, caption=text, **kwargs)
                 return
             except Exception as e:
                 logging.error(f"Ошибка отправки фото с ключом {media_key}: {e}", exc_info=True)
                 # fallback на текстовое сообщение
     await safe_send_message(chat_id, text, **kwargs)
 
+# ==================== МАРШРУТИЗАЦИЯ КНОПОК И CALLBACK ====================
+class Router:
+    """Таблица маршрутов: точный текст кнопки -> хендлер, префиксное дерево для callback_data.
+
+    Вместо сотни lambda-фильтров, которые aiogram перебирает по очереди, в диспетчере
+    регистрируется по одному хендлеру на сообщения и callback-и, а нужный хендлер
+    находится одним поиском в словаре или проходом по дереву (самый длинный префикс).
+    """
+    def __init__(self):
+        self.text_routes = {}
+        self.callback_exact = {}
+        self.callback_trie = {}
+        self.specs = {}
+
+    def text(self, text: str):
+        def decorator(handler):
+            # как и в aiogram, при повторной регистрации срабатывает первый хендлер
+            self.text_routes.setdefault(text, handler)
+            return handler
+        return decorator
+
+    def callback(self, prefix: str = None, exact: Union[str, List[str]] = None, exclude: Tuple[str, ...] = ()):
+        def decorator(handler):
+            if exact is not None:
+                for value in ([exact] if isinstance(exact, str) else exact):
+                    self.callback_exact.setdefault(value, handler)
+            if prefix is not None:
+                node = self._trie_node(prefix)
+                if node.get(None) is None:
+                    node[None] = handler
+                for excluded in exclude:
+                    # None в узле закрывает ветку, пока под неё не зарегистрируют свой хендлер
+                    self._trie_node(excluded).setdefault(None, None)
+            return handler
+        return decorator
+
+    def _trie_node(self, prefix: str) -> dict:
+        node = self.callback_trie
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        return node
+
+    def match_text(self, text: Optional[str]):
+        if text is None:
+            return None
+        return self.text_routes.get(text)
+
+    def match_callback(self, data: Optional[str]):
+        if data is None:
+            return None
+        handler = self.callback_exact.get(data)
+        if handler is not None:
+            return handler
+        node = self.callback_trie
+        for ch in data:
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                handler = node[None]
+        return handler
+
+    def message_filter(self, message: types.Message):
+        handler = self.match_text(message.text)
+        return {'routed_handler': handler} if handler else False
+
+    def callback_filter(self, callback: types.CallbackQuery):
+        handler = self.match_callback(callback.data)
+        return {'routed_handler': handler} if handler else False
+
+    async def call(self, handler, obj, data: dict):
+        spec = self.specs.get(handler)
+        if spec is None:
+            spec = set(inspect.signature(handler).parameters)
+            self.specs[handler] = spec
+        return await handler(obj, **{k: v for k, v in data.items() if k in spec})
+
+router = Router()
+
+@dp.message_handler(router.message_filter)
+async def routed_message_handler(message: types.Message, **kwargs):
+    await router.call(kwargs.pop('routed_handler'), message, kwargs)
+
+@dp.callback_query_handler(router.callback_filter)
+async def routed_callback_handler(callback: types.CallbackQuery, **kwargs):
+    await router.call(kwargs.pop('routed_handler'), callback, kwargs)
+
 # ==================== ГЛОБАЛЬНЫЙ ОБРАБОТЧИК /cancel ====================
 @dp.message_handler(commands=['cancel'], state='*')
 async def cmd_cancel(message: types.Message, state: FSMContext):
@@ -3319,17 +5109,17 @@ async def cmd_start(message: types.Message):
         try:
             referrer_id = int(args[3:])
             if referrer_id != user_id:
-                async with db_pool.acquire() as conn:
+                async with db_conn() as conn:
                     referrer_exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", referrer_id)
                     if referrer_exists and not await is_banned(referrer_id):
                         existing = await conn.fetchval("SELECT 1 FROM referrals WHERE referred_id=$1", user_id)
                         if not existing:
                             await conn.execute(
                                 "INSERT INTO referrals (referrer_id, referred_id, referred_date, reward_given, clicks) VALUES ($1, $2, $3, $4, 1) ON CONFLICT (referred_id) DO NOTHING",
-                                referrer_id, user_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), False
+                                referrer_id, user_id, db_now(), False
                             )
                             await conn.execute("UPDATE referrals SET clicks = clicks + 1 WHERE referred_id=$1", user_id)
-                            await safe_send_message(referrer_id, f"🔗 Новый пользователь {message.from_user.first_name} зарегистрировался по вашей ссылке! Награда будет выдана после того, как он совершит {await get_setting('referral_required_thefts')} успешных ограблений.")
+                            await safe_send_message(referrer_id, f"🔗 Новый пользователь {message.from_user.first_name} зарегистрировался по вашей ссылке! Награда будет выдана после того, как он совершит {(await get_settings_snapshot()).referral_required_thefts} успешных ограблений.")
         except:
             pass
 
@@ -3337,6 +5127,8 @@ async def cmd_start(message: types.Message):
     created, bonus = await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     if created:
         await message.answer(f"🎁 Вам начислен стартовый бонус: {bonus} баксов!")
+    else:
+        await mark_user_reachable(user_id)
 
     # Отправляем приветственную картинку из медиа
     welcome_text = "Добро пожаловать в Malboro GAME!"
@@ -3362,7 +5154,7 @@ async def cmd_start(message: types.Message):
     )
 
 @dp.message_handler(commands=['help'])
-async def cmd_help_private(message: types.Message):
+async def cmd_help_private(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         # в группе отправляем краткую справку
         await message.reply("Для списка команд в личных сообщениях используйте /help в ЛС.\n"
@@ -3374,9 +5166,9 @@ async def cmd_help_private(message: types.Message):
                            "/mlb_help – помощь в группе")
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -3403,14 +5195,14 @@ async def cmd_help_private(message: types.Message):
     await message.answer(text)
 
 # ==================== ПРОВЕРКА ПОДПИСКИ (ИНЛАЙН) ====================
-@dp.callback_query_handler(lambda c: c.data == "check_sub")
-async def check_subscription_callback(callback: types.CallbackQuery):
+@router.callback(exact="check_sub")
+async def check_subscription_callback(callback: types.CallbackQuery, user_ctx: UserContext = None):
     user_id = callback.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(callback.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
-    await ensure_user_exists(user_id, callback.from_user.username, callback.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
+    ok, not_subscribed = await check_subscription(user_id, force=True)
     if ok:
         await callback.message.delete()
         is_admin_user = await is_admin(user_id)
@@ -3422,45 +5214,47 @@ async def check_subscription_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Ты ещё не подписался на все каналы!", show_alert=True)
         await callback.message.edit_reply_markup(reply_markup=subscription_inline(not_subscribed))
 
-@dp.callback_query_handler(lambda c: c.data == "no_link")
+@dp.chat_member_handler()
+async def channel_member_update(update: types.ChatMemberUpdated):
+    # Telegram присылает chat_member только там, где бот – администратор
+    channels = await get_channels()
+    channel_ids = set()
+    for chat_id, _, _ in channels:
+        try:
+            channel_ids.add(int(chat_id))
+        except (TypeError, ValueError):
+            pass
+    if update.chat.id not in channel_ids:
+        return
+    new_member = update.new_chat_member
+    set_channel_membership(new_member.user.id, update.chat.id, new_member.status not in ['left', 'kicked'])
+
+@router.callback(exact="no_link")
 async def no_link_callback(callback: types.CallbackQuery):
     await callback.answer("Ссылка отсутствует. Подпишись вручную.", show_alert=True)
 
 # ==================== ПРОФИЛЬ ====================
-@dp.message_handler(lambda message: message.text == "👤 Профиль")
-async def profile_handler(message: types.Message):
+@router.text("👤 Профиль")
+async def profile_handler(message: types.Message, user_ctx: UserContext = None):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
 
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT balance, reputation, total_spent, negative_balance, joined_date, "
-                "theft_attempts, theft_success, theft_failed, theft_protected, "
-                "casino_wins, casino_losses, dice_wins, dice_losses, guess_wins, guess_losses, "
-                "slots_wins, slots_losses, roulette_wins, roulette_losses, "
-                "COALESCE(multiplayer_wins, 0) as multiplayer_wins, "
-                "COALESCE(multiplayer_losses, 0) as multiplayer_losses, "
-                "exp, level, strength, agility, defense, "
-                "COALESCE(smuggle_success, 0) as smuggle_success, "
-                "COALESCE(smuggle_fail, 0) as smuggle_fail, "
-                "bitcoin_balance, authority_balance "
-                "FROM users WHERE user_id=$1",
-                user_id
-            )
+        row = counters.merge(user_ctx.row) if user_ctx.row else None
         if row:
-            balance = float(row['balance'] or 0)
+            balance = Cents(row['balance'] or 0)
             rep = row['reputation'] or 0
-            spent = float(row['total_spent'] or 0)
-            neg = float(row['negative_balance'] or 0)
+            spent = Cents(row['total_spent'] or 0)
+            neg = Cents(row['negative_balance'] or 0)
             joined = row['joined_date']
             attempts = row['theft_attempts'] or 0
             success = row['theft_success'] or 0
@@ -3485,16 +5279,15 @@ async def profile_handler(message: types.Message):
             defense = row['defense'] or 1
             smuggle_success = row['smuggle_success'] or 0
             smuggle_fail = row['smuggle_fail'] or 0
-            bitcoin = float(row['bitcoin_balance']) if row['bitcoin_balance'] is not None else 0.0
+            bitcoin = BtcUnits(row['bitcoin_balance'] or 0)
             authority = row['authority_balance'] or 0
 
             neg_text = f" (долг: {neg:.2f})" if neg > 0 else ""
-            level_mult = await get_setting_int("level_multiplier")
+            level_mult = cfg.level_multiplier
             exp_needed = level * level_mult
             bar = progress_bar(exp, exp_needed, 10)
 
-            total_authority_chat = await get_total_user_authority(user_id)
-            total_fights, total_damage = await get_total_user_fights(user_id)
+            total_authority_chat, total_fights, total_damage = await get_total_user_chat_stats(user_id)
 
             joined_str = joined if joined else 'неизвестно'
 
@@ -3527,24 +5320,25 @@ async def profile_handler(message: types.Message):
         text = "❌ Ошибка загрузки профиля. Подробности в логах."
 
     # Отправляем с картинкой, если есть медиа с ключом 'profile'
-    await send_with_media(user_id, text, media_key='profile', reply_markup=main_menu_keyboard(await is_admin(user_id)))
+    await send_with_media(user_id, text, media_key='profile', reply_markup=main_menu_keyboard(user_ctx.is_admin))
 
 # ==================== УРОВЕНЬ ====================
-@dp.message_handler(lambda message: message.text == "📊 Уровень")
-async def level_handler(message: types.Message):
+@router.text("📊 Уровень")
+async def level_handler(message: types.Message, user_ctx: UserContext = None):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    level = await get_user_level(user_id)
-    exp = await get_user_exp(user_id)
-    level_mult = await get_setting_int("level_multiplier")
+    level = user_ctx.level
+    exp = user_ctx.exp
+    level_mult = cfg.level_multiplier
     exp_needed = level * level_mult
     bar = progress_bar(exp, exp_needed, 10)
     level_names = {
@@ -3570,37 +5364,34 @@ async def level_handler(message: types.Message):
         f"За повышение уровня ты получаешь баксы, репутацию и очки статов!\n"
         f"Следующая награда: +{next_coins:.2f} баксов, +{next_rep} репутации."
     )
-    await message.answer(text, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+    await message.answer(text, reply_markup=main_menu_keyboard(user_ctx.is_admin))
 
 async def get_level_reward_coins(level: int) -> float:
-    async with db_pool.acquire() as conn:
-        val = await conn.fetchval("SELECT coins FROM level_rewards WHERE level=$1", level)
-        return float(val) if val else 0.0
+    return level_rewards_between(level, level)[0]
 
 async def get_level_reward_rep(level: int) -> int:
-    async with db_pool.acquire() as conn:
-        val = await conn.fetchval("SELECT reputation FROM level_rewards WHERE level=$1", level)
-        return val if val else 0
+    return level_rewards_between(level, level)[1]
 
 # ==================== РЕПУТАЦИЯ ====================
-@dp.message_handler(lambda message: message.text == "⭐️ Репутация")
-async def reputation_handler(message: types.Message):
+@router.text("⭐️ Репутация")
+async def reputation_handler(message: types.Message, user_ctx: UserContext = None):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    rep = await get_user_reputation(user_id)
-    theft_bonus = float(await get_setting_float("reputation_theft_bonus")) * rep
-    defense_bonus = float(await get_setting_float("reputation_defense_bonus")) * rep
-    smuggle_bonus = float(await get_setting_float("reputation_smuggle_bonus")) * rep
-    smuggle_success_bonus = float(await get_setting_float("reputation_smuggle_success_bonus")) * rep
-    max_bonus = await get_setting_float("reputation_max_bonus_percent")
+    rep = user_ctx.reputation
+    theft_bonus = float(cfg.reputation_theft_bonus) * rep
+    defense_bonus = float(cfg.reputation_defense_bonus) * rep
+    smuggle_bonus = float(cfg.reputation_smuggle_bonus) * rep
+    smuggle_success_bonus = float(cfg.reputation_smuggle_success_bonus) * rep
+    max_bonus = cfg.reputation_max_bonus_percent
     
     theft_bonus = min(theft_bonus, max_bonus)
     defense_bonus = min(defense_bonus, max_bonus)
@@ -3614,58 +5405,55 @@ async def reputation_handler(message: types.Message):
         f"📦 Бонус к добыче BTC: +{smuggle_bonus:.1f} BTC\n"
         f"🚤 Бонус к успеху контрабанды: +{smuggle_success_bonus:.1f}%\n\n"
         f"Зарабатывай репутацию в играх и за выполнение заданий!",
-        reply_markup=main_menu_keyboard(await is_admin(user_id))
+        reply_markup=main_menu_keyboard(user_ctx.is_admin)
     )
 
 # ==================== ЕЖЕДНЕВНЫЙ БОНУС ====================
-@dp.message_handler(lambda message: message.text == "🎁 Бонус")
-async def bonus_handler(message: types.Message):
+@router.text("🎁 Бонус")
+async def bonus_handler(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
 
-    async with db_pool.acquire() as conn:
-        last_bonus_str = await conn.fetchval("SELECT last_bonus FROM users WHERE user_id=$1", user_id)
+    async with db_conn() as conn:
+        last_bonus = await conn.fetchval("SELECT last_bonus FROM users WHERE user_id=$1", user_id)
 
-        now = datetime.now()
-        if last_bonus_str:
-            try:
-                last_bonus = datetime.strptime(last_bonus_str, "%Y-%m-%d %H:%M:%S")
-                if last_bonus.date() == now.date():
-                    next_bonus = last_bonus + timedelta(days=1)
-                    time_left = next_bonus - now
-                    hours, remainder = divmod(time_left.seconds, 3600)
-                    minutes, _ = divmod(remainder, 60)
-                    await message.answer(f"⏳ Бонус уже получен сегодня. Следующий через {hours} ч {minutes} мин.")
-                    return
-            except:
-                pass
+        now = db_now()
+        if last_bonus and last_bonus.date() == now.date():
+            next_bonus = last_bonus + timedelta(days=1)
+            time_left = next_bonus - now
+            hours, remainder = divmod(time_left.seconds, 3600)
+            minutes, _ = divmod(remainder, 60)
+            await message.answer(f"⏳ Бонус уже получен сегодня. Следующий через {hours} ч {minutes} мин.")
+            return
 
         bonus = random.randint(10, 50)
         phrase = get_random_phrase(BONUS_PHRASES, bonus=bonus)
 
-        await conn.execute(
-            "UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id=$3",
-            bonus, now.strftime("%Y-%m-%d %H:%M:%S"), user_id
+        balance = await conn.fetchval(
+            "WITH u AS (UPDATE users SET last_bonus = $2 WHERE user_id=$3) "
+            "UPDATE user_wallet SET balance = balance + $1 WHERE user_id=$3 RETURNING balance",
+            Cents.from_major(bonus), now, user_id
         )
-    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+        ledger.record(user_id, 'balance', Cents.from_major(bonus), balance, 'daily_bonus')
+    await message.answer(phrase, reply_markup=main_menu_keyboard(user_ctx.is_admin))
 
 # ==================== ТОП ИГРОКОВ ====================
-@dp.message_handler(lambda message: message.text == "🏆 Топ игроков")
-async def leaderboard_menu(message: types.Message):
+@router.text("🏆 Топ игроков")
+async def leaderboard_menu(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -3694,14 +5482,12 @@ async def show_top(message: types.Message, order_field: str, title: str):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
-            if order_field == 'bitcoin_balance':
-                order_expr = "bitcoin_balance"
-            else:
-                order_expr = order_field
+        async with db_conn() as conn:
+            table = user_column_table(order_field)
             total = await conn.fetchval(f"SELECT COUNT(*) FROM users")
             rows = await conn.fetch(
-                f"SELECT first_name, {order_expr} as value FROM users ORDER BY value DESC LIMIT $1 OFFSET $2",
+                f"SELECT u.first_name, t.{order_field} AS value FROM {table} t "
+                f"JOIN users u ON u.user_id = t.user_id ORDER BY value DESC LIMIT $1 OFFSET $2",
                 ITEMS_PER_PAGE, offset
             )
         if not rows:
@@ -3710,10 +5496,8 @@ async def show_top(message: types.Message, order_field: str, title: str):
         text = f"{title} (страница {page}):\n\n"
         for idx, row in enumerate(rows, start=offset+1):
             val = row['value']
-            if order_field == 'bitcoin_balance':
-                val = f"{float(val):.4f}"
-            elif order_field in ['balance', 'total_spent']:
-                val = f"{float(val):.2f}"
+            if order_field in MONEY_COLUMNS:
+                val = str(MONEY_COLUMNS[order_field](val))
             text += f"{idx}. {row['first_name']} – {val}\n"
         kb = []
         nav_buttons = []
@@ -3731,43 +5515,43 @@ async def show_top(message: types.Message, order_field: str, title: str):
         logging.error(f"Top error: {e}", exc_info=True)
         await message.answer("❌ Ошибка загрузки топа.")
 
-@dp.message_handler(lambda message: message.text == "💰 Самые богатые")
+@router.text("💰 Самые богатые")
 async def top_rich_handler(message: types.Message):
     await show_top(message, "balance", "💰 Самые богатые")
 
-@dp.message_handler(lambda message: message.text == "💸 Транжиры")
+@router.text("💸 Транжиры")
 async def top_spenders_handler(message: types.Message):
     await show_top(message, "total_spent", "💸 Транжиры")
 
-@dp.message_handler(lambda message: message.text == "🔫 Крадуны")
+@router.text("🔫 Крадуны")
 async def top_thieves_handler(message: types.Message):
     await show_top(message, "theft_success", "🔫 Крадуны")
 
-@dp.message_handler(lambda message: message.text == "⭐️ По репутации")
+@router.text("⭐️ По репутации")
 async def top_reputation_handler(message: types.Message):
     await show_top(message, "reputation", "⭐️ По репутации")
 
-@dp.message_handler(lambda message: message.text == "₿ По биткоинам")
+@router.text("₿ По биткоинам")
 async def top_bitcoin_handler(message: types.Message):
     await show_top(message, "bitcoin_balance", "₿ По биткоинам")
 
-@dp.message_handler(lambda message: message.text == "📈 По уровню")
+@router.text("📈 По уровню")
 async def top_level_handler(message: types.Message):
     await show_top(message, "level", "📈 По уровню")
 
-@dp.message_handler(lambda message: message.text == "💪 По силе")
+@router.text("💪 По силе")
 async def top_strength_handler(message: types.Message):
     await show_top(message, "strength", "💪 По силе")
 
-@dp.message_handler(lambda message: message.text == "🏃 По ловкости")
+@router.text("🏃 По ловкости")
 async def top_agility_handler(message: types.Message):
     await show_top(message, "agility", "🏃 По ловкости")
 
-@dp.message_handler(lambda message: message.text == "🛡 По защите")
+@router.text("🛡 По защите")
 async def top_defense_handler(message: types.Message):
     await show_top(message, "defense", "🛡 По защите")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("top:"))
+@router.callback(prefix="top:")
 async def top_page_callback(callback: types.CallbackQuery):
     parts = callback.data.split(":")
     field = parts[1]
@@ -3788,20 +5572,21 @@ async def top_page_callback(callback: types.CallbackQuery):
     await callback.answer()
 
 # ==================== КАЗИНО И ИГРЫ ====================
-@dp.message_handler(lambda message: message.text == "🎰 Казино")
-async def casino_menu(message: types.Message):
+@router.text("🎰 Казино")
+async def casino_menu(message: types.Message, user_ctx: UserContext = None):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    min_level = await get_setting_int("min_level_casino")
-    level = await get_user_level(user_id)
+    min_level = cfg.min_level_casino
+    level = user_ctx.level
     if level < min_level:
         await message.answer(f"❌ Для доступа к казино нужен {min_level} уровень. Твой уровень: {level}")
         return
@@ -3809,12 +5594,13 @@ async def casino_menu(message: types.Message):
     await send_with_media(user_id, "Выбери игру:", media_key='casino', reply_markup=casino_menu_keyboard())
 
 # ----- Казино (простое) с анимацией -----
-@dp.message_handler(lambda message: message.text == "🎰 Играть в казино")
+@router.text("🎰 Играть в казино")
 async def casino_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    min_level = await get_setting_int("min_level_casino")
+    min_level = cfg.min_level_casino
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -3823,7 +5609,7 @@ async def casino_start(message: types.Message):
     await CasinoBet.amount.set()
 
 async def save_last_bet(user_id: int, game: str, amount: float, bet_data: dict = None):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("""
             INSERT INTO user_last_bets (user_id, game, bet_amount, bet_data, updated_at)
             VALUES ($1, $2, $3, $4, NOW())
@@ -3835,6 +5621,7 @@ async def save_last_bet(user_id: int, game: str, amount: float, bet_data: dict =
 
 @dp.message_handler(state=CasinoBet.amount)
 async def casino_bet(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await casino_menu(message)
@@ -3855,9 +5642,9 @@ async def casino_bet(message: types.Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("casino_min_bet")
-    max_bet = await get_setting_float("casino_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = cfg.casino_min_bet
+    max_bet = cfg.casino_max_bet
+    max_input = cfg.max_input_number
     if amount < min_bet or amount > max_bet:
         await message.answer(f"❌ Ставка должна быть от {min_bet:.2f} до {max_bet:.2f}.")
         return
@@ -3868,8 +5655,8 @@ async def casino_bet(message: types.Message, state: FSMContext):
         await message.answer("❌ Недостаточно баксов.")
         return
 
-    win_chance = await get_setting_float("casino_win_chance")
-    multiplier = await get_setting_float("casino_multiplier")
+    win_chance = cfg.casino_win_chance
+    multiplier = cfg.casino_multiplier
 
     anim = await message.answer("🎰 Крутим барабан...")
     await asyncio.sleep(1)
@@ -3878,25 +5665,25 @@ async def casino_bet(message: types.Message, state: FSMContext):
 
     win = random.random() * 100 <= win_chance
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'casino', win, conn=conn)
+        update_user_game_stats(user_id, 'casino', win)
 
         if win:
             profit = amount * (multiplier - 1)
             await update_user_balance(user_id, amount * multiplier, conn=conn)
-            exp = await get_setting_int("exp_per_casino_win")
-            btc_reward = await get_setting_int("bitcoin_per_casino_win")
+            exp = cfg.exp_per_casino_win
+            btc_reward = cfg.bitcoin_per_casino_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
                 btc_text = f" и {btc_reward} BTC"
             else:
                 btc_text = ""
             phrase = get_random_phrase(CASINO_WIN_PHRASES, win=amount*multiplier, profit=profit)
-            if amount * multiplier >= BIG_WIN_THRESHOLD and await get_setting("chat_notify_big_win") == "1":
+            if amount * multiplier >= BIG_WIN_THRESHOLD and cfg.chat_notify_big_win:
                 await notify_chats(f"🔥 {message.from_user.first_name} сорвал куш в казино: +{amount * multiplier:.2f} баксов!{btc_text}")
         else:
-            exp = await get_setting_int("exp_per_casino_lose")
+            exp = cfg.exp_per_casino_lose
             phrase = get_random_phrase(CASINO_LOSE_PHRASES, loss=amount)
         await add_exp(user_id, exp, conn=conn)
 
@@ -3907,12 +5694,13 @@ async def casino_bet(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Кости -----
-@dp.message_handler(lambda message: message.text == "🎲 Кости")
+@router.text("🎲 Кости")
 async def dice_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    min_level = await get_setting_int("min_level_dice")
+    min_level = cfg.min_level_dice
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -3922,6 +5710,7 @@ async def dice_start(message: types.Message):
 
 @dp.message_handler(state=DiceBet.amount)
 async def dice_bet(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await casino_menu(message)
@@ -3943,8 +5732,8 @@ async def dice_bet(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
     min_bet = 1.0
-    max_bet = await get_setting_float("casino_max_bet")  # используем общий максимум казино
-    max_input = await get_setting_float("max_input_number")
+    max_bet = cfg.casino_max_bet  # используем общий максимум казино
+    max_input = cfg.max_input_number
     if amount < min_bet:
         await message.answer(f"❌ Минимальная ставка {min_bet:.2f} бакса.")
         return
@@ -3961,23 +5750,23 @@ async def dice_bet(message: types.Message, state: FSMContext):
     dice1 = random.randint(1, 6)
     dice2 = random.randint(1, 6)
     total = dice1 + dice2
-    threshold = await get_setting_int("dice_win_threshold")
+    threshold = cfg.dice_win_threshold
     win = total > threshold
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'dice', win, conn=conn)
+        update_user_game_stats(user_id, 'dice', win)
         if win:
-            multiplier = await get_setting_float("dice_multiplier")
+            multiplier = cfg.dice_multiplier
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
-            exp = await get_setting_int("exp_per_dice_win")
-            btc_reward = await get_setting_int("bitcoin_per_dice_win")
+            exp = cfg.exp_per_dice_win
+            btc_reward = cfg.bitcoin_per_dice_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(DICE_WIN_PHRASES, dice1=dice1, dice2=dice2, total=total, profit=profit)
         else:
-            exp = await get_setting_int("exp_per_dice_lose")
+            exp = cfg.exp_per_dice_lose
             phrase = get_random_phrase(DICE_LOSE_PHRASES, dice1=dice1, dice2=dice2, total=total, loss=amount)
         await add_exp(user_id, exp, conn=conn)
 
@@ -3988,12 +5777,13 @@ async def dice_bet(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Угадай число -----
-@dp.message_handler(lambda message: message.text == "🔢 Угадай число")
+@router.text("🔢 Угадай число")
 async def guess_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    min_level = await get_setting_int("min_level_guess")
+    min_level = cfg.min_level_guess
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -4003,6 +5793,7 @@ async def guess_start(message: types.Message):
 
 @dp.message_handler(state=GuessBet.amount)
 async def guess_bet(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await casino_menu(message)
@@ -4024,8 +5815,8 @@ async def guess_bet(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
     min_bet = 1.0
-    max_bet = await get_setting_float("casino_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    max_bet = cfg.casino_max_bet
+    max_input = cfg.max_input_number
     if amount < min_bet:
         await message.answer(f"❌ Минимальная ставка {min_bet:.2f}.")
         return
@@ -4045,6 +5836,7 @@ async def guess_bet(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=GuessBet.number)
 async def guess_number(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await casino_menu(message)
@@ -4063,23 +5855,23 @@ async def guess_number(message: types.Message, state: FSMContext):
     secret = random.randint(1, 5)
     win = (guess == secret)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'guess', win, conn=conn)
+        update_user_game_stats(user_id, 'guess', win)
         if win:
-            multiplier = await get_setting_float("guess_multiplier")
-            rep_reward = await get_setting_int("guess_reputation")
+            multiplier = cfg.guess_multiplier
+            rep_reward = cfg.guess_reputation
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
             await update_user_reputation(user_id, rep_reward)
-            exp = await get_setting_int("exp_per_guess_win")
-            btc_reward = await get_setting_int("bitcoin_per_guess_win")
+            exp = cfg.exp_per_guess_win
+            btc_reward = cfg.bitcoin_per_guess_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(GUESS_WIN_PHRASES, secret=secret, profit=profit, rep=rep_reward)
             bet_data = {'number': guess}
         else:
-            exp = await get_setting_int("exp_per_guess_lose")
+            exp = cfg.exp_per_guess_lose
             phrase = get_random_phrase(GUESS_LOSE_PHRASES, secret=secret, loss=amount)
             bet_data = {'number': guess}
         await add_exp(user_id, exp, conn=conn)
@@ -4091,12 +5883,13 @@ async def guess_number(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Слоты -----
-@dp.message_handler(lambda message: message.text == "🍒 Слоты")
+@router.text("🍒 Слоты")
 async def slots_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    min_level = await get_setting_int("min_level_slots")
+    min_level = cfg.min_level_slots
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -4106,6 +5899,7 @@ async def slots_start(message: types.Message):
 
 @dp.message_handler(state=SlotsBet.amount)
 async def slots_bet(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await casino_menu(message)
@@ -4126,9 +5920,9 @@ async def slots_bet(message: types.Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("slots_min_bet")
-    max_bet = await get_setting_float("slots_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = cfg.slots_min_bet
+    max_bet = cfg.slots_max_bet
+    max_input = cfg.max_input_number
     if amount < min_bet or amount > max_bet:
         await message.answer(f"❌ Ставка должна быть от {min_bet:.2f} до {max_bet:.2f}.")
         return
@@ -4153,19 +5947,19 @@ async def slots_bet(message: types.Message, state: FSMContext):
     symbols, multiplier, win = await slots_spin()
     result_str = format_slots_result(symbols)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'slots', win, conn=conn)
+        update_user_game_stats(user_id, 'slots', win)
         if win:
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
-            exp = await get_setting_int("exp_per_slots_win")
-            btc_reward = await get_setting_int("bitcoin_per_slots_win")
+            exp = cfg.exp_per_slots_win
+            btc_reward = cfg.bitcoin_per_slots_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(SLOTS_WIN_PHRASES, combo=result_str, multiplier=multiplier, profit=profit)
         else:
-            exp = await get_setting_int("exp_per_slots_lose")
+            exp = cfg.exp_per_slots_lose
             phrase = get_random_phrase(SLOTS_LOSE_PHRASES, combo=result_str, loss=amount)
         await add_exp(user_id, exp, conn=conn)
 
@@ -4176,12 +5970,13 @@ async def slots_bet(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Рулетка -----
-@dp.message_handler(lambda message: message.text == "🎡 Рулетка")
+@router.text("🎡 Рулетка")
 async def roulette_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    min_level = await get_setting_int("min_level_roulette")
+    min_level = cfg.min_level_roulette
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -4191,6 +5986,7 @@ async def roulette_start(message: types.Message):
 
 @dp.message_handler(state=RouletteBet.amount)
 async def roulette_bet_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await casino_menu(message)
@@ -4211,9 +6007,9 @@ async def roulette_bet_amount(message: types.Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("roulette_min_bet")
-    max_bet = await get_setting_float("roulette_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = cfg.roulette_min_bet
+    max_bet = cfg.roulette_max_bet
+    max_input = cfg.max_input_number
     if amount < min_bet or amount > max_bet:
         await message.answer(f"❌ Ставка должна быть от {min_bet:.2f} до {max_bet:.2f}.")
         return
@@ -4262,6 +6058,7 @@ async def roulette_bet_number(message: types.Message, state: FSMContext):
     await process_roulette_bet(message, state)
 
 async def process_roulette_bet(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     data = await state.get_data()
     amount = data['amount']
     bet_type = data['bet_type']
@@ -4279,26 +6076,26 @@ async def process_roulette_bet(message: types.Message, state: FSMContext):
 
     number, color, win = await roulette_spin(bet_type, bet_number)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'roulette', win, conn=conn)
+        update_user_game_stats(user_id, 'roulette', win)
         if win:
             if bet_type == 'number':
-                multiplier = await get_setting_float("roulette_number_multiplier")
+                multiplier = cfg.roulette_number_multiplier
             elif bet_type == 'green':
-                multiplier = await get_setting_float("roulette_green_multiplier")
+                multiplier = cfg.roulette_green_multiplier
             else:
-                multiplier = await get_setting_float("roulette_color_multiplier")
+                multiplier = cfg.roulette_color_multiplier
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
-            exp = await get_setting_int("exp_per_roulette_win")
-            btc_reward = await get_setting_int("bitcoin_per_roulette_win")
+            exp = cfg.exp_per_roulette_win
+            btc_reward = cfg.bitcoin_per_roulette_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(ROULETTE_WIN_PHRASES, number=number, color=color, profit=profit)
             bet_data = {'bet_type': bet_type, 'number': bet_number}
         else:
-            exp = await get_setting_int("exp_per_roulette_lose")
+            exp = cfg.exp_per_roulette_lose
             phrase = get_random_phrase(ROULETTE_LOSE_PHRASES, number=number, color=color, loss=amount)
             bet_data = {'bet_type': bet_type, 'number': bet_number}
         await add_exp(user_id, exp, conn=conn)
@@ -4310,7 +6107,7 @@ async def process_roulette_bet(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Обработчик повтора ставки (с сохранением данных) -----
-@dp.callback_query_handler(lambda c: c.data.startswith("repeat_"))
+@router.callback(prefix="repeat_")
 async def repeat_bet_callback(callback: types.CallbackQuery, state: FSMContext):
     game = callback.data.split("_")[1]
     user_id = callback.from_user.id
@@ -4321,7 +6118,7 @@ async def repeat_bet_callback(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer(f"⏳ Подожди ещё {remaining} сек.", show_alert=True)
         return
     
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         last = await conn.fetchrow(
             "SELECT bet_amount, bet_data FROM user_last_bets WHERE user_id=$1 AND game=$2",
             user_id, game
@@ -4364,8 +6161,9 @@ async def repeat_bet_callback(callback: types.CallbackQuery, state: FSMContext):
 
 # Вспомогательные функции для повтора
 async def process_casino_repeat(user_id: int, amount: float, message: types.Message):
-    win_chance = await get_setting_float("casino_win_chance")
-    multiplier = await get_setting_float("casino_multiplier")
+    cfg = await get_settings_snapshot()
+    win_chance = cfg.casino_win_chance
+    multiplier = cfg.casino_multiplier
     
     anim = await message.answer("🎰 Повторяем...")
     await asyncio.sleep(1)
@@ -4374,19 +6172,19 @@ async def process_casino_repeat(user_id: int, amount: float, message: types.Mess
     
     win = random.random() * 100 <= win_chance
     
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'casino', win, conn=conn)
+        update_user_game_stats(user_id, 'casino', win)
         if win:
             profit = amount * (multiplier - 1)
             await update_user_balance(user_id, amount * multiplier, conn=conn)
-            exp = await get_setting_int("exp_per_casino_win")
-            btc_reward = await get_setting_int("bitcoin_per_casino_win")
+            exp = cfg.exp_per_casino_win
+            btc_reward = cfg.bitcoin_per_casino_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(CASINO_WIN_PHRASES, win=amount*multiplier, profit=profit)
         else:
-            exp = await get_setting_int("exp_per_casino_lose")
+            exp = cfg.exp_per_casino_lose
             phrase = get_random_phrase(CASINO_LOSE_PHRASES, loss=amount)
         await add_exp(user_id, exp, conn=conn)
     
@@ -4394,26 +6192,27 @@ async def process_casino_repeat(user_id: int, amount: float, message: types.Mess
     await anim.edit_text(phrase, reply_markup=repeat_bet_keyboard('casino'))
 
 async def process_dice_repeat(user_id: int, amount: float, message: types.Message):
+    cfg = await get_settings_snapshot()
     dice1 = random.randint(1, 6)
     dice2 = random.randint(1, 6)
     total = dice1 + dice2
-    threshold = await get_setting_int("dice_win_threshold")
+    threshold = cfg.dice_win_threshold
     win = total > threshold
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'dice', win, conn=conn)
+        update_user_game_stats(user_id, 'dice', win)
         if win:
-            multiplier = await get_setting_float("dice_multiplier")
+            multiplier = cfg.dice_multiplier
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
-            exp = await get_setting_int("exp_per_dice_win")
-            btc_reward = await get_setting_int("bitcoin_per_dice_win")
+            exp = cfg.exp_per_dice_win
+            btc_reward = cfg.bitcoin_per_dice_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(DICE_WIN_PHRASES, dice1=dice1, dice2=dice2, total=total, profit=profit)
         else:
-            exp = await get_setting_int("exp_per_dice_lose")
+            exp = cfg.exp_per_dice_lose
             phrase = get_random_phrase(DICE_LOSE_PHRASES, dice1=dice1, dice2=dice2, total=total, loss=amount)
         await add_exp(user_id, exp, conn=conn)
 
@@ -4421,29 +6220,30 @@ async def process_dice_repeat(user_id: int, amount: float, message: types.Messag
     await message.answer(phrase, reply_markup=repeat_bet_keyboard('dice'))
 
 async def process_guess_repeat(user_id: int, amount: float, number: int, message: types.Message):
+    cfg = await get_settings_snapshot()
     if number is None:
         await message.answer("❌ Нет сохранённого числа для повтора.")
         return
     secret = random.randint(1, 5)
     win = (number == secret)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'guess', win, conn=conn)
+        update_user_game_stats(user_id, 'guess', win)
         if win:
-            multiplier = await get_setting_float("guess_multiplier")
-            rep_reward = await get_setting_int("guess_reputation")
+            multiplier = cfg.guess_multiplier
+            rep_reward = cfg.guess_reputation
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
             await update_user_reputation(user_id, rep_reward)
-            exp = await get_setting_int("exp_per_guess_win")
-            btc_reward = await get_setting_int("bitcoin_per_guess_win")
+            exp = cfg.exp_per_guess_win
+            btc_reward = cfg.bitcoin_per_guess_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(GUESS_WIN_PHRASES, secret=secret, profit=profit, rep=rep_reward)
             bet_data = {'number': number}
         else:
-            exp = await get_setting_int("exp_per_guess_lose")
+            exp = cfg.exp_per_guess_lose
             phrase = get_random_phrase(GUESS_LOSE_PHRASES, secret=secret, loss=amount)
             bet_data = {'number': number}
         await add_exp(user_id, exp, conn=conn)
@@ -4452,22 +6252,23 @@ async def process_guess_repeat(user_id: int, amount: float, number: int, message
     await message.answer(phrase, reply_markup=repeat_bet_keyboard('guess'))
 
 async def process_slots_repeat(user_id: int, amount: float, message: types.Message):
+    cfg = await get_settings_snapshot()
     symbols, multiplier, win = await slots_spin()
     result_str = format_slots_result(symbols)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'slots', win, conn=conn)
+        update_user_game_stats(user_id, 'slots', win)
         if win:
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
-            exp = await get_setting_int("exp_per_slots_win")
-            btc_reward = await get_setting_int("bitcoin_per_slots_win")
+            exp = cfg.exp_per_slots_win
+            btc_reward = cfg.bitcoin_per_slots_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(SLOTS_WIN_PHRASES, combo=result_str, multiplier=multiplier, profit=profit)
         else:
-            exp = await get_setting_int("exp_per_slots_lose")
+            exp = cfg.exp_per_slots_lose
             phrase = get_random_phrase(SLOTS_LOSE_PHRASES, combo=result_str, loss=amount)
         await add_exp(user_id, exp, conn=conn)
 
@@ -4475,30 +6276,31 @@ async def process_slots_repeat(user_id: int, amount: float, message: types.Messa
     await message.answer(phrase, reply_markup=repeat_bet_keyboard('slots'))
 
 async def process_roulette_repeat(user_id: int, amount: float, bet_type: str, number: int, message: types.Message):
+    cfg = await get_settings_snapshot()
     if bet_type is None:
         await message.answer("❌ Нет сохранённых параметров для повтора.")
         return
     num, color, win = await roulette_spin(bet_type, number)
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await update_user_balance(user_id, -amount, conn=conn)
-        await update_user_game_stats(user_id, 'roulette', win, conn=conn)
+        update_user_game_stats(user_id, 'roulette', win)
         if win:
             if bet_type == 'number':
-                multiplier = await get_setting_float("roulette_number_multiplier")
+                multiplier = cfg.roulette_number_multiplier
             elif bet_type == 'green':
-                multiplier = await get_setting_float("roulette_green_multiplier")
+                multiplier = cfg.roulette_green_multiplier
             else:
-                multiplier = await get_setting_float("roulette_color_multiplier")
+                multiplier = cfg.roulette_color_multiplier
             profit = amount * multiplier
             await update_user_balance(user_id, profit, conn=conn)
-            exp = await get_setting_int("exp_per_roulette_win")
-            btc_reward = await get_setting_int("bitcoin_per_roulette_win")
+            exp = cfg.exp_per_roulette_win
+            btc_reward = cfg.bitcoin_per_roulette_win
             if btc_reward > 0:
                 await update_user_bitcoin(user_id, float(btc_reward), conn=conn)
             phrase = get_random_phrase(ROULETTE_WIN_PHRASES, number=num, color=color, profit=profit)
         else:
-            exp = await get_setting_int("exp_per_roulette_lose")
+            exp = cfg.exp_per_roulette_lose
             phrase = get_random_phrase(ROULETTE_LOSE_PHRASES, number=num, color=color, loss=amount)
         await add_exp(user_id, exp, conn=conn)
 
@@ -4510,14 +6312,14 @@ async def process_roulette_repeat(user_id: int, amount: float, bet_type: str, nu
 # ==================== ЧАСТЬ 4: МАГАЗИН, ПРОМОКОДЫ, ОГРАБЛЕНИЕ, РЕФЕРАЛЫ, АУКЦИОН ====================
 
 # ==================== МАГАЗИН ПОДАРКОВ ====================
-@dp.message_handler(lambda message: message.text == "🛒 Магазин подарков")
-async def shop_handler(message: types.Message):
+@router.text("🛒 Магазин подарков")
+async def shop_handler(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -4531,7 +6333,7 @@ async def shop_handler(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM shop_items")
             rows = await conn.fetch(
                 "SELECT id, name, description, price, stock, photo_file_id FROM shop_items ORDER BY id LIMIT $1 OFFSET $2",
@@ -4564,28 +6366,29 @@ async def shop_handler(message: types.Message):
         logging.error(f"Shop error: {e}", exc_info=True)
         await message.answer("❌ Ошибка загрузки магазина.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("shop_page_"))
+@router.callback(prefix="shop_page_")
 async def shop_page_callback(callback: types.CallbackQuery):
     page = int(callback.data.split("_")[2])
     callback.message.text = f"🛒 Магазин подарков {page}"
     await shop_handler(callback.message)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("buy_"))
-async def buy_callback(callback: types.CallbackQuery):
+@router.callback(prefix="buy_")
+async def buy_callback(callback: types.CallbackQuery, user_ctx: UserContext = None):
+    cfg = await get_settings_snapshot()
     await callback.answer()  # обязательно!
     user_id = callback.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(callback.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         await callback.message.answer("⛔ Вы заблокированы.")
         return
-    await ensure_user_exists(user_id, callback.from_user.username, callback.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await callback.message.edit_text("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
     item_id = int(callback.data.split("_")[1])
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             row = await conn.fetchrow("SELECT name, price, stock FROM shop_items WHERE id=$1", item_id)
             if not row:
                 await callback.message.answer("Товар не найден")
@@ -4598,12 +6401,12 @@ async def buy_callback(callback: types.CallbackQuery):
             if balance < price:
                 await callback.message.answer("Не хватает баксов!")
                 return
-            async with conn.transaction():
+            async with db_transaction():
                 await update_user_balance(user_id, -price, conn=conn)
                 await update_user_total_spent(user_id, price)
                 await conn.execute(
                     "INSERT INTO purchases (user_id, item_id, purchase_date) VALUES ($1, $2, $3)",
-                    user_id, item_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    user_id, item_id, db_now()
                 )
                 if stock != -1:
                     await conn.execute("UPDATE shop_items SET stock = stock - 1 WHERE id=$1", item_id)
@@ -4611,7 +6414,7 @@ async def buy_callback(callback: types.CallbackQuery):
         phrase = get_random_phrase(PURCHASE_PHRASES)
         await callback.message.answer(f"✅ Ты купил {name}! {phrase}")
 
-        if await get_setting("chat_notify_big_purchase") == "1" and price >= BIG_PURCHASE_THRESHOLD:
+        if cfg.chat_notify_big_purchase and price >= BIG_PURCHASE_THRESHOLD:
             user = callback.from_user
             chat_phrase = get_random_phrase(CHAT_PURCHASE_PHRASES, name=user.first_name, item=name, price=price)
             await notify_chats(chat_phrase)
@@ -4625,7 +6428,7 @@ async def buy_callback(callback: types.CallbackQuery):
 
 async def notify_admins_about_purchase(user: types.User, item_name: str, price: float):
     admins = SUPER_ADMINS.copy()
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT user_id FROM admins")
         for row in rows:
             admins.append(row['user_id'])
@@ -4636,14 +6439,14 @@ async def notify_admins_about_purchase(user: types.User, item_name: str, price:
         )
 
 # ==================== МОИ ПОКУПКИ ====================
-@dp.message_handler(lambda message: message.text == "💰 Мои покупки")
-async def my_purchases(message: types.Message):
+@router.text("💰 Мои покупки")
+async def my_purchases(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -4657,7 +6460,7 @@ async def my_purchases(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM purchases WHERE user_id=$1", user_id)
             rows = await conn.fetch(
                 "SELECT p.id, s.name, p.purchase_date, p.status, p.admin_comment FROM purchases p "
@@ -4665,7 +6468,7 @@ async def my_purchases(message: types.Message):
                 user_id, ITEMS_PER_PAGE, offset
             )
         if not rows:
-            await message.answer("У тебя пока нет покупок.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
+            await message.answer("У тебя пока нет покупок.", reply_markup=main_menu_keyboard(user_ctx.is_admin))
             return
         text = f"📦 Твои покупки (страница {page}):\n\n"
         for row in rows:
@@ -4686,12 +6489,12 @@ async def my_purchases(message: types.Message):
         if kb:
             await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
         else:
-            await message.answer(text, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+            await message.answer(text, reply_markup=main_menu_keyboard(user_ctx.is_admin))
     except Exception as e:
         logging.error(f"My purchases error: {e}", exc_info=True)
         await message.answer("❌ Ошибка загрузки покупок.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("mypurchases_page_"))
+@router.callback(prefix="mypurchases_page_")
 async def mypurchases_page_callback(callback: types.CallbackQuery):
     page = int(callback.data.split("_")[2])
     callback.message.text = f"💰 Мои покупки {page}"
@@ -4699,14 +6502,14 @@ async def mypurchases_page_callback(callback: types.CallbackQuery):
     await callback.answer()
 
 # ==================== ПРОМОКОД ====================
-@dp.message_handler(lambda message: message.text == "🎟 Промокод")
-async def promo_handler(message: types.Message):
+@router.text("🎟 Промокод")
+async def promo_handler(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -4731,7 +6534,7 @@ async def promo_activate(message: types.Message, state: FSMContext):
         await state.finish()
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             already_used = await conn.fetchval(
                 "SELECT 1 FROM promo_activations WHERE user_id=$1 AND promo_code=$2",
                 user_id, code
@@ -4752,12 +6555,12 @@ async def promo_activate(message: types.Message, state: FSMContext):
                 await message.answer("❌ Промокод уже использован максимальное количество раз.")
                 await state.finish()
                 return
-            async with conn.transaction():
+            async with db_transaction():
                 await update_user_balance(user_id, reward, conn=conn)
                 await conn.execute("UPDATE promocodes SET used_count = used_count + 1 WHERE code=$1", code)
                 await conn.execute(
                     "INSERT INTO promo_activations (user_id, promo_code, activated_at) VALUES ($1, $2, $3)",
-                    user_id, code, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    user_id, code, db_now()
                 )
         await message.answer(
             f"✅ Промокод активирован! Ты получил {reward:.2f} баксов.",
@@ -4770,137 +6573,146 @@ async def promo_activate(message: types.Message, state: FSMContext):
 
 # ==================== ОГРАБЛЕНИЕ ====================
 async def get_theft_success_chance(attacker_id: int) -> float:
-    base = await get_setting_float("theft_success_chance")
+    cfg = await get_settings_snapshot()
+    base = cfg.theft_success_chance
     rep = await get_user_reputation(attacker_id)
-    bonus = float(await get_setting_float("reputation_theft_bonus")) * rep
-    max_bonus = await get_setting_float("reputation_max_bonus_percent")
+    bonus = float(cfg.reputation_theft_bonus) * rep
+    max_bonus = cfg.reputation_max_bonus_percent
     bonus = min(bonus, max_bonus)
     return base + bonus
 
 async def get_defense_chance(victim_id: int) -> float:
-    base = await get_setting_float("theft_defense_chance")
+    cfg = await get_settings_snapshot()
+    base = cfg.theft_defense_chance
     rep = await get_user_reputation(victim_id)
-    bonus = float(await get_setting_float("reputation_defense_bonus")) * rep
-    max_bonus = await get_setting_float("reputation_max_bonus_percent")
+    bonus = float(cfg.reputation_defense_bonus) * rep
+    max_bonus = cfg.reputation_max_bonus_percent
     bonus = min(bonus, max_bonus)
     return base + bonus
 
 async def perform_theft(message: types.Message, robber_id: int, victim_id: int, cost: float = 0):
+    cfg = await get_settings_snapshot()
     success_chance = await get_theft_success_chance(robber_id)
     defense_chance = await get_defense_chance(victim_id)
-    defense_penalty = await get_setting_int("theft_defense_penalty")
-    min_amount = await get_setting_float("min_theft_amount")
-    max_amount = await get_setting_float("max_theft_amount")
-    bitcoin_reward = await get_setting_int("bitcoin_per_theft")
+    defense_penalty = cfg.theft_defense_penalty
+    min_amount = cfg.min_theft_amount
+    max_amount = cfg.max_theft_amount
+    bitcoin_reward = cfg.bitcoin_per_theft
 
     try:
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                robber_balance = await get_user_balance(robber_id)
-                if robber_balance is None:
-                    await message.answer("❌ Ошибка: ваш профиль не найден.")
-                    return
-                if robber_balance < cost:
-                    await message.answer(get_random_phrase(THEFT_NO_MONEY_PHRASES), reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-                    return
-
-                victim_row = await conn.fetchrow("SELECT balance, username, first_name FROM users WHERE user_id=$1", victim_id)
-                if not victim_row:
-                    await message.answer("❌ Цель не найдена в базе.")
-                    return
-                victim_balance = float(victim_row['balance'])
-                victim_username = victim_row['username']
-                victim_first = victim_row['first_name']
-                victim_name = victim_first if victim_first else str(victim_id)
-
-                if cost > 0:
-                    await update_user_balance(robber_id, -cost, conn=conn)
-                    robber_balance -= cost
-
-                defense_triggered = random.random() * 100 <= defense_chance
-                if defense_triggered:
-                    penalty = min(defense_penalty, robber_balance)
-                    if penalty > 0:
-                        await update_user_balance(robber_id, -penalty, conn=conn)
-                        await update_user_balance(victim_id, penalty, conn=conn)
-                    await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                    await conn.execute("UPDATE users SET theft_protected = theft_protected + 1 WHERE user_id=$1", victim_id)
-                    await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), robber_id)
-
-                    exp_defense = await get_setting_int("exp_per_theft_defense")
-                    await add_exp(victim_id, exp_defense, conn=conn)
-                    exp_fail = await get_setting_int("exp_per_theft_fail")
-                    await add_exp(robber_id, exp_fail, conn=conn)
+        async with db_transaction() as conn:
+            robber_balance = await get_user_balance(robber_id)
+            if robber_balance is None:
+                outbox_send(message.chat.id, "❌ Ошибка: ваш профиль не найден.")
+                return
+            if robber_balance < cost:
+                outbox_send(message.chat.id, get_random_phrase(THEFT_NO_MONEY_PHRASES), reply_markup=main_menu_keyboard(await is_admin(robber_id)))
+                return
 
-                    robber_phrase = get_random_phrase(THEFT_DEFENSE_PHRASES, target=victim_name, penalty=penalty)
-                    victim_phrase = get_random_phrase(THEFT_VICTIM_DEFENSE_PHRASES, attacker=message.from_user.first_name, penalty=penalty)
-                    await message.answer(robber_phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-                    await safe_send_message(victim_id, victim_phrase)
-                    return
+            victim_row = await conn.fetchrow(
+                "SELECT w.balance, u.username, u.first_name FROM users u "
+                "JOIN user_wallet w ON w.user_id = u.user_id WHERE u.user_id=$1", victim_id
+            )
+            if not victim_row:
+                outbox_send(message.chat.id, "❌ Цель не найдена в базе.")
+                return
+            victim_balance = Cents(victim_row['balance']).major
+            victim_username = victim_row['username']
+            victim_first = victim_row['first_name']
+            victim_name = victim_first if victim_first else str(victim_id)
+
+            if cost > 0:
+                await update_user_balance(robber_id, -cost, conn=conn, reason='theft_cost')
+                robber_balance -= cost
+
+            defense_triggered = random.random() * 100 <= defense_chance
+            if defense_triggered:
+                penalty = min(defense_penalty, robber_balance)
+                if penalty > 0:
+                    await wallet_transfer(robber_id, victim_id, penalty, conn=conn, reason='theft_defense')
+                counters.add(robber_id, 'theft_attempts')
+                counters.add(robber_id, 'theft_failed')
+                counters.add(victim_id, 'theft_protected')
+                await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", db_now(), robber_id)
+
+                exp_defense = cfg.exp_per_theft_defense
+                await add_exp(victim_id, exp_defense, conn=conn)
+                exp_fail = cfg.exp_per_theft_fail
+                await add_exp(robber_id, exp_fail, conn=conn)
+
+                robber_phrase = get_random_phrase(THEFT_DEFENSE_PHRASES, target=victim_name, penalty=penalty)
+                victim_phrase = get_random_phrase(THEFT_VICTIM_DEFENSE_PHRASES, attacker=message.from_user.first_name, penalty=penalty)
+                outbox_send(message.chat.id, robber_phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
+                outbox_send(victim_id, victim_phrase)
+                return
 
-                success = random.random() * 100 <= success_chance
-                if success and victim_balance > 0:
-                    if victim_balance < min_amount:
-                        steal_amount = 0
-                    else:
-                        max_possible = min(max_amount, victim_balance)
-                        steal_amount = round(random.uniform(min_amount, max_possible), 2)
-
-                    if steal_amount > 0:
-                        await update_user_balance(victim_id, -steal_amount, conn=conn)
-                        await update_user_balance(robber_id, steal_amount, conn=conn)
-                        if bitcoin_reward > 0:
-                            await update_user_bitcoin(robber_id, float(bitcoin_reward), conn=conn)
-                        await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_success = theft_success + 1 WHERE user_id=$1", robber_id)
-
-                        exp_success = await get_setting_int("exp_per_theft_success")
-                        await add_exp(robber_id, exp_success, conn=conn)
-
-                        required_thefts = await get_setting_int("referral_required_thefts")
-                        new_success = await conn.fetchval("SELECT theft_success FROM users WHERE user_id=$1", robber_id)
-                        if new_success == required_thefts:
-                            ref = await conn.fetchrow("SELECT referrer_id FROM referrals WHERE referred_id=$1 AND reward_given=FALSE", robber_id)
-                            if ref:
-                                referrer_id = ref['referrer_id']
-                                bonus_coins = await get_setting_float("referral_bonus")
-                                bonus_rep = await get_setting_int("referral_reputation")
-                                await update_user_balance(referrer_id, bonus_coins, conn=conn)
-                                await update_user_reputation(referrer_id, bonus_rep)
-                                await conn.execute("UPDATE referrals SET reward_given=TRUE WHERE referred_id=$1", robber_id)
-                                await conn.execute("UPDATE referrals SET active=TRUE WHERE referred_id=$1", robber_id)
-                                await safe_send_message(referrer_id, f"🎉 Ваш реферал совершил {required_thefts} успешных ограблений! Вы получили {bonus_coins:.2f} баксов и {bonus_rep} репутации.")
-
-                        btc_text = f" и {bitcoin_reward} BTC" if bitcoin_reward > 0 else ""
-                        phrase = get_random_phrase(THEFT_SUCCESS_PHRASES, amount=steal_amount, target=victim_name)
-                        await message.answer(f"{phrase}{btc_text}", reply_markup=main_menu_keyboard(await is_admin(robber_id)))
-                        await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount:.2f} баксов.")
-                    else:
-                        await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                        exp_fail = await get_setting_int("exp_per_theft_fail")
-                        await add_exp(robber_id, exp_fail, conn=conn)
-                        phrase = get_random_phrase(THEFT_FAIL_PHRASES, target=victim_name)
-                        await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
+            success = random.random() * 100 <= success_chance
+            if success and victim_balance > 0:
+                if victim_balance < min_amount:
+                    steal_amount = 0
+                else:
+                    max_possible = min(max_amount, victim_balance)
+                    steal_amount = round(random.uniform(min_amount, max_possible), 2)
+
+                if steal_amount > 0:
+                    await wallet_transfer(victim_id, robber_id, steal_amount, conn=conn, reason='theft')
+                    if bitcoin_reward > 0:
+                        await update_user_bitcoin(robber_id, float(bitcoin_reward), conn=conn, reason='theft')
+                    counters.add(robber_id, 'theft_attempts')
+                    counters.add(robber_id, 'theft_success')
+
+                    exp_success = cfg.exp_per_theft_success
+                    await add_exp(robber_id, exp_success, conn=conn)
+
+                    required_thefts = cfg.referral_required_thefts
+                    # +1 – эта кража, её приращение попадёт в буфер после коммита
+                    new_success = (await conn.fetchval("SELECT theft_success FROM user_game_stats WHERE user_id=$1", robber_id)
+                                   + counters.get(robber_id, 'theft_success') + 1)
+                    if new_success == required_thefts:
+                        ref = await conn.fetchrow("SELECT referrer_id FROM referrals WHERE referred_id=$1 AND reward_given=FALSE", robber_id)
+                        if ref:
+                            referrer_id = ref['referrer_id']
+                            bonus_coins = cfg.referral_bonus
+                            bonus_rep = cfg.referral_reputation
+                            await update_user_balance(referrer_id, bonus_coins, conn=conn)
+                            await update_user_reputation(referrer_id, bonus_rep)
+                            await conn.execute("UPDATE referrals SET reward_given=TRUE WHERE referred_id=$1", robber_id)
+                            await conn.execute("UPDATE referrals SET active=TRUE WHERE referred_id=$1", robber_id)
+                            outbox_send(referrer_id, f"🎉 Ваш реферал совершил {required_thefts} успешных ограблений! Вы получили {bonus_coins:.2f} баксов и {bonus_rep} репутации.")
+
+                    btc_text = f" и {bitcoin_reward} BTC" if bitcoin_reward > 0 else ""
+                    phrase = get_random_phrase(THEFT_SUCCESS_PHRASES, amount=steal_amount, target=victim_name)
+                    outbox_send(message.chat.id, f"{phrase}{btc_text}", reply_markup=main_menu_keyboard(await is_admin(robber_id)))
+                    outbox_send(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount:.2f} баксов.")
                 else:
-                    await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                    exp_fail = await get_setting_int("exp_per_theft_fail")
+                    counters.add(robber_id, 'theft_attempts')
+                    counters.add(robber_id, 'theft_failed')
+                    exp_fail = cfg.exp_per_theft_fail
                     await add_exp(robber_id, exp_fail, conn=conn)
                     phrase = get_random_phrase(THEFT_FAIL_PHRASES, target=victim_name)
-                    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
+                    outbox_send(message.chat.id, phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
+            else:
+                counters.add(robber_id, 'theft_attempts')
+                counters.add(robber_id, 'theft_failed')
+                exp_fail = cfg.exp_per_theft_fail
+                await add_exp(robber_id, exp_fail, conn=conn)
+                phrase = get_random_phrase(THEFT_FAIL_PHRASES, target=victim_name)
+                outbox_send(message.chat.id, phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
 
-                await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now().strftime("%Y-%m-%d %H:%M:%S"), robber_id)
+            await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", db_now(), robber_id)
 
     except Exception as e:
         logging.error(f"Theft error: {e}", exc_info=True)
         await message.answer("❌ Ошибка при ограблении.")
 
-@dp.message_handler(lambda message: message.text == "🔫 Ограбить")
-async def theft_menu(message: types.Message):
+@router.text("🔫 Ограбить")
+async def theft_menu(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -4908,56 +6720,51 @@ async def theft_menu(message: types.Message):
     phrase = get_random_phrase(THEFT_CHOICE_PHRASES)
     await send_with_media(user_id, phrase, media_key='theft', reply_markup=theft_choice_keyboard())
 
-@dp.message_handler(lambda message: message.text == "🎲 Случайная цель")
+@router.text("🎲 Случайная цель")
 async def theft_random(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    cooldown_minutes = await get_setting_int("theft_cooldown_minutes")
-    async with db_pool.acquire() as conn:
-        last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
-        if last_time_str:
-            try:
-                last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-                diff = datetime.now() - last_time
-                if diff < timedelta(minutes=cooldown_minutes):
-                    remaining = cooldown_minutes - int(diff.total_seconds() // 60)
-                    phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
-                    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
-                    return
-            except:
-                pass
+    cooldown_minutes = cfg.theft_cooldown_minutes
+    async with db_conn() as conn:
+        last_time = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
+        if last_time:
+            diff = datetime.now() - last_time
+            if diff < timedelta(minutes=cooldown_minutes):
+                remaining = cooldown_minutes - int(diff.total_seconds() // 60)
+                phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
+                await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+                return
     target_id = await get_random_user(user_id)
     if not target_id:
         await message.answer("😕 В игре пока нет других игроков.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
         return
-    cost = await get_setting_float("random_attack_cost")
+    cost = cfg.random_attack_cost
     await perform_theft(message, user_id, target_id, cost)
 
-@dp.message_handler(lambda message: message.text == "👤 Выбрать пользователя")
+@router.text("👤 Выбрать пользователя")
 async def theft_choose_user(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    cooldown_minutes = await get_setting_int("theft_cooldown_minutes")
-    async with db_pool.acquire() as conn:
-        last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
-        if last_time_str:
-            try:
-                last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-                diff = datetime.now() - last_time
-                if diff < timedelta(minutes=cooldown_minutes):
-                    remaining = cooldown_minutes - int(diff.total_seconds() // 60)
-                    phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
-                    await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
-                    return
-            except:
-                pass
+    cooldown_minutes = cfg.theft_cooldown_minutes
+    async with db_conn() as conn:
+        last_time = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
+        if last_time:
+            diff = datetime.now() - last_time
+            if diff < timedelta(minutes=cooldown_minutes):
+                remaining = cooldown_minutes - int(diff.total_seconds() // 60)
+                phrase = get_random_phrase(THEFT_COOLDOWN_PHRASES, minutes=remaining)
+                await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
+                return
     await message.answer("Введи @username или ID того, кого хочешь ограбить:", reply_markup=back_keyboard())
     await TheftTarget.target.set()
 
 @dp.message_handler(state=TheftTarget.target)
 async def theft_target_entered(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         await state.finish()
         return
@@ -4984,23 +6791,24 @@ async def theft_target_entered(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    cost = await get_setting_float("targeted_attack_cost")
+    cost = cfg.targeted_attack_cost
     await perform_theft(message, robber_id, target_id, cost)
     await state.finish()
 
 # ==================== РЕФЕРАЛЬНАЯ ССЫЛКА ====================
-@dp.message_handler(lambda message: message.text == "🔗 Рефералка")
+@router.text("🔗 Рефералка")
 async def referral_link(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
     bot_username = (await bot.me).username
     link = f"https://t.me/{bot_username}?start=ref{user_id}"
-    bonus_coins = await get_setting_float("referral_bonus")
-    bonus_rep = await get_setting_int("referral_reputation")
-    required_thefts = await get_setting_int("referral_required_thefts")
+    bonus_coins = cfg.referral_bonus
+    bonus_rep = cfg.referral_reputation
+    required_thefts = cfg.referral_required_thefts
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         clicks = await conn.fetchval("SELECT SUM(clicks) FROM referrals WHERE referrer_id=$1", user_id) or 0
         active = await conn.fetchval("SELECT COUNT(*) FROM referrals WHERE referrer_id=$1 AND active=TRUE", user_id) or 0
         earned = active * bonus_coins
@@ -5016,14 +6824,14 @@ async def referral_link(message: types.Message):
     await send_with_media(user_id, text, media_key='referral', reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== ЗАДАНИЯ (ОБЪЕДИНЕННЫЙ ХЕНДЛЕР С ПРОВЕРКОЙ ПРАВ) ====================
-@dp.message_handler(lambda message: message.text == "📋 Задания")
-async def tasks_unified_handler(message: types.Message):
+@router.text("📋 Задания")
+async def tasks_unified_handler(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -5035,7 +6843,7 @@ async def tasks_unified_handler(message: types.Message):
         await user_tasks_menu(message)
 
 async def user_tasks_menu(message: types.Message):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT id, name, description, reward_coins, reward_reputation, max_completions, completed_count FROM tasks WHERE active=TRUE")
     if not rows:
         await message.answer("📋 Пока нет доступных заданий.", reply_markup=main_menu_keyboard(await is_admin(message.from_user.id)))
@@ -5049,12 +6857,12 @@ async def user_tasks_menu(message: types.Message):
         kb.append([InlineKeyboardButton(text=f"Выполнить {row['name']}", callback_data=f"task_{row['id']}")])
     await send_with_media(message.chat.id, text, media_key='tasks', reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
-@dp.callback_query_handler(lambda c: c.data.startswith("task_"))
+@router.callback(prefix="task_")
 async def take_task(callback: types.CallbackQuery):
     task_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         existing = await conn.fetchval("SELECT 1 FROM user_tasks WHERE user_id=$1 AND task_id=$2", user_id, task_id)
         if existing:
             await callback.answer("Ты уже выполнял это задание!", show_alert=True)
@@ -5081,13 +6889,13 @@ async def take_task(callback: types.CallbackQuery):
                 await callback.answer("❌ Не удалось проверить подписку. Возможно, бот не админ канала.", show_alert=True)
                 return
 
-            async with conn.transaction():
+            async with db_transaction():
                 await update_user_balance(user_id, float(task['reward_coins']), conn=conn)
                 await update_user_reputation(user_id, task['reward_reputation'])
-                expires_at = (datetime.now() + timedelta(days=task['required_days'])).strftime("%Y-%m-%d %H:%M:%S") if task['required_days'] > 0 else None
+                expires_at = (db_now() + timedelta(days=task['required_days'])) if task['required_days'] > 0 else None
                 await conn.execute(
                     "INSERT INTO user_tasks (user_id, task_id, completed_at, expires_at, status) VALUES ($1, $2, $3, $4, $5)",
-                    user_id, task_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), expires_at, 'completed'
+                    user_id, task_id, db_now(), expires_at, 'completed'
                 )
                 await conn.execute("UPDATE tasks SET completed_count = completed_count + 1 WHERE id=$1", task_id)
 
@@ -5097,14 +6905,14 @@ async def take_task(callback: types.CallbackQuery):
             await callback.answer("Этот тип заданий пока не поддерживается.", show_alert=True)
 
 # ==================== АУКЦИОН (ОБЪЕДИНЕННЫЙ ХЕНДЛЕР С ПРОВЕРКОЙ ПРАВ) ====================
-@dp.message_handler(lambda message: message.text == "🏷 Аукцион")
-async def auction_unified_handler(message: types.Message):
+@router.text("🏷 Аукцион")
+async def auction_unified_handler(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -5117,7 +6925,7 @@ async def auction_unified_handler(message: types.Message):
 
 async def list_auctions(message: types.Message, page: int = 1):
     offset = (page - 1) * ITEMS_PER_PAGE
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         total = await conn.fetchval("SELECT COUNT(*) FROM auctions WHERE status='active'")
         rows = await conn.fetch(
             "SELECT id, item_name, current_price, end_time, target_price FROM auctions WHERE status='active' ORDER BY created_at DESC LIMIT $1 OFFSET $2",
@@ -5142,16 +6950,16 @@ async def list_auctions(message: types.Message, page: int = 1):
     kb = auction_list_keyboard(rows, page, total_pages)
     await send_with_media(message.chat.id, text, media_key='auction', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("auction_page_"))
+@router.callback(prefix="auction_page_")
 async def auction_page_callback(callback: types.CallbackQuery):
     page = int(callback.data.split("_")[2])
     await list_auctions(callback.message, page)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("auction_view_"))
+@router.callback(prefix="auction_view_")
 async def auction_view(callback: types.CallbackQuery):
     auction_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         auction = await conn.fetchrow("SELECT * FROM auctions WHERE id=$1 AND status='active'", auction_id)
         if not auction:
             await callback.answer("Аукцион не найден или завершён.", show_alert=True)
@@ -5185,7 +6993,7 @@ async def auction_view(callback: types.CallbackQuery):
         await callback.message.edit_text(text, reply_markup=auction_detail_keyboard(auction_id))
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("auction_bid_"))
+@router.callback(prefix="auction_bid_")
 async def auction_bid_start(callback: types.CallbackQuery, state: FSMContext):
     auction_id = int(callback.data.split("_")[2])
     await state.update_data(auction_id=auction_id)
@@ -5195,6 +7003,7 @@ async def auction_bid_start(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message_handler(state=AuctionBid.amount)
 async def auction_bid_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await auction_unified_handler(message)
@@ -5210,10 +7019,10 @@ async def auction_bid_amount(message: types.Message, state: FSMContext):
     data = await state.get_data()
     auction_id = data['auction_id']
     user_id = message.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_transaction() as conn:
         auction = await conn.fetchrow("SELECT * FROM auctions WHERE id=$1 AND status='active'", auction_id)
         if not auction:
-            await message.answer("❌ Аукцион не найден или завершён.")
+            outbox_send(message.chat.id, "❌ Аукцион не найден или завершён.")
             await state.finish()
             return
 
@@ -5222,22 +7031,22 @@ async def auction_bid_amount(message: types.Message, state: FSMContext):
             auction_id
         )
         if current_leader == user_id:
-            await message.answer("❌ Ты уже являешься лидером этого аукциона. Нельзя повышать свою ставку.")
+            outbox_send(message.chat.id, "❌ Ты уже являешься лидером этого аукциона. Нельзя повышать свою ставку.")
             await state.finish()
             return
 
-        min_step = await get_setting_int("auction_min_bid_step")
+        min_step = cfg.auction_min_bid_step
         min_bid = float(auction['current_price']) + min_step
         if amount < min_bid:
-            await message.answer(f"❌ Ставка должна быть не меньше {min_bid:.2f} (текущая цена + минимальный шаг).")
+            outbox_send(message.chat.id, f"❌ Ставка должна быть не меньше {min_bid:.2f} (текущая цена + минимальный шаг).")
             return
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if amount > max_input:
-            await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
+            outbox_send(message.chat.id, f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
         balance = await get_user_balance(user_id)
         if balance < amount:
-            await message.answer("❌ Недостаточно баксов.")
+            outbox_send(message.chat.id, "❌ Недостаточно баксов.")
             return
         await update_user_balance(user_id, -amount, conn=conn)
         await conn.execute(
@@ -5250,14 +7059,14 @@ async def auction_bid_amount(message: types.Message, state: FSMContext):
         )
         if auction['target_price'] and amount >= float(auction['target_price']):
             await conn.execute("UPDATE auctions SET status='ended', winner_id=$1 WHERE id=$2", user_id, auction_id)
-            await safe_send_message(user_id, f"🎉 Поздравляем! Ты выиграл аукцион «{auction['item_name']}» с ценой {amount:.2f} баксов. Админ скоро свяжется для передачи товара.")
-            await safe_send_message(auction['created_by'], f"🏁 Аукцион «{auction['item_name']}» завершён по достижению целевой цены. Победитель: {message.from_user.first_name} (ID: {user_id}) с суммой {amount:.2f} баксов.")
-            await message.answer("✅ Аукцион завершён! Ты победитель.")
+            outbox_send(user_id, f"🎉 Поздравляем! Ты выиграл аукцион «{auction['item_name']}» с ценой {amount:.2f} баксов. Админ скоро свяжется для передачи товара.")
+            outbox_send(auction['created_by'], f"🏁 Аукцион «{auction['item_name']}» завершён по достижению целевой цены. Победитель: {message.from_user.first_name} (ID: {user_id}) с суммой {amount:.2f} баксов.")
+            outbox_send(message.chat.id, "✅ Аукцион завершён! Ты победитель.")
         else:
-            await message.answer(f"✅ Ставка принята! Ты теперь лидер с ценой {amount:.2f} баксов.")
+            outbox_send(message.chat.id, f"✅ Ставка принята! Ты теперь лидер с ценой {amount:.2f} баксов.")
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data == "auction_list")
+@router.callback(exact="auction_list")
 async def auction_list_back(callback: types.CallbackQuery):
     await list_auctions(callback.message)
     await callback.answer()
@@ -5267,22 +7076,20 @@ async def auction_list_back(callback: types.CallbackQuery):
 
 # ==================== БИЗНЕСЫ ====================
 
-@dp.message_handler(lambda message: message.text == "🏪 Мои бизнесы")
-async def my_businesses(message: types.Message):
+@router.text("🏪 Мои бизнесы")
+async def my_businesses(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
 
-    async with db_pool.acquire() as conn:
-        await update_business_income(user_id, conn)
-        businesses = await get_user_businesses(user_id)
+    businesses = await get_user_businesses(user_id)
 
     if not businesses:
         kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -5294,11 +7101,11 @@ async def my_businesses(message: types.Message):
     kb = business_main_keyboard(businesses)
     await send_with_media(user_id, "🏪 Твои бизнесы:", media_key='business', reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data == "buy_business_menu")
+@router.callback(exact="buy_business_menu")
 async def buy_business_menu(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     all_types = await get_business_type_list(only_available=True)
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         owned = await conn.fetch("SELECT business_type_id FROM user_businesses WHERE user_id=$1", user_id)
         owned_ids = [r['business_type_id'] for r in owned]
     available = [bt for bt in all_types if bt['id'] not in owned_ids]
@@ -5309,7 +7116,7 @@ async def buy_business_menu(callback: types.CallbackQuery):
     await callback.message.edit_text("Выбери бизнес для покупки:", reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("buy_biz_"))
+@router.callback(prefix="buy_biz_")
 async def buy_business_choose(callback: types.CallbackQuery, state: FSMContext):
     if callback.data == "buy_biz_cancel":
         await callback.message.delete()
@@ -5329,8 +7136,8 @@ async def buy_business_choose(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("У тебя уже есть такой бизнес!", show_alert=True)
         return
     price = biz_type['base_price_btc']
-    btc_balance = await get_user_bitcoin(user_id)
-    if btc_balance < price - 0.0001:
+    btc_balance = BtcUnits.from_major(await get_user_bitcoin(user_id))
+    if btc_balance < price:
         await callback.answer(f"Недостаточно биткоинов. Нужно {price:.2f} BTC, у тебя {btc_balance:.4f}.", show_alert=True)
         return
     await state.update_data(biz_type_id=biz_type_id, price=price, biz_name=biz_type['name'], biz_emoji=biz_type['emoji'])
@@ -5351,8 +7158,8 @@ async def buy_business_confirm(message: types.Message, state: FSMContext):
         biz_name = data['biz_name']
         user_id = message.from_user.id
         try:
-            async with db_pool.acquire() as conn:
-                async with conn.transaction():
+            async with db_conn() as conn:
+                async with db_transaction():
                     # 1. Проверяем, не куплен ли уже
                     existing = await conn.fetchval(
                         "SELECT 1 FROM user_businesses WHERE user_id=$1 AND business_type_id=$2",
@@ -5371,19 +7178,19 @@ async def buy_business_confirm(message: types.Message, state: FSMContext):
                         return
 
                     # 3. Проверяем баланс ещё раз
-                    btc = await get_user_bitcoin(user_id)
-                    if btc < price - 0.0001:
+                    btc = BtcUnits.from_major(await get_user_bitcoin(user_id))
+                    if btc < price:
                         await message.answer("❌ Недостаточно биткоинов.")
                         await state.finish()
                         return
 
                     # 4. Списываем BTC
-                    await update_user_bitcoin(user_id, -price, conn=conn)
+                    await update_user_bitcoin(user_id, BtcUnits(-price), conn=conn)
 
                     # 5. Создаём запись бизнеса
                     await conn.execute(
                         "INSERT INTO user_businesses (user_id, business_type_id, level, last_collection, accumulated) VALUES ($1, $2, $3, $4, $5)",
-                        user_id, biz_type_id, 1, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0
+                        user_id, biz_type_id, 1, db_now(), 0
                     )
 
             phrase = get_random_phrase(BUSINESS_BUY_PHRASES, name=biz_name)
@@ -5395,18 +7202,17 @@ async def buy_business_confirm(message: types.Message, state: FSMContext):
     else:
         await message.answer("Введи 'да' или 'нет'.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("biz_view_"))
+@router.callback(prefix="biz_view_")
 async def business_view(callback: types.CallbackQuery):
     biz_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        await update_business_income(user_id, conn)
-        biz = await conn.fetchrow("""
-            SELECT ub.*, bt.name, bt.emoji, bt.base_price_btc, bt.base_income_cents, bt.max_level
+    async with db_conn() as conn:
+        biz = await conn.fetchrow(f"""
+            SELECT {BUSINESS_COLUMNS_SQL.format(now='$3')}
             FROM user_businesses ub
             JOIN business_types bt ON ub.business_type_id = bt.id
             WHERE ub.id = $1 AND ub.user_id = $2
-        """, biz_id, user_id)
+        """, biz_id, user_id, datetime.now())
         if not biz:
             await callback.answer("Бизнес не найден", show_alert=True)
             return
@@ -5429,7 +7235,7 @@ async def business_view(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=business_actions_keyboard(biz_id))
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("biz_collect_"))
+@router.callback(prefix="biz_collect_")
 async def business_collect(callback: types.CallbackQuery):
     biz_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
@@ -5440,7 +7246,7 @@ async def business_collect(callback: types.CallbackQuery):
         await callback.answer(f"❌ {result}", show_alert=True)
     await business_view(callback)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("biz_upgrade_"))
+@router.callback(prefix="biz_upgrade_")
 async def business_upgrade(callback: types.CallbackQuery, state: FSMContext):
     biz_id = int(callback.data.split("_")[2])
     await state.update_data(biz_id=biz_id)
@@ -5465,26 +7271,26 @@ async def upgrade_confirm(message: types.Message, state: FSMContext):
     else:
         await message.answer("Введи 'да' или 'нет'.")
 
-@dp.callback_query_handler(lambda c: c.data == "biz_back")
+@router.callback(exact="biz_back")
 async def business_back(callback: types.CallbackQuery):
     await my_businesses(callback.message)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "biz_back_to_main")
+@router.callback(exact="biz_back_to_main")
 async def business_back_to_main(callback: types.CallbackQuery):
     await my_businesses(callback.message)
     await callback.answer()
 
 # ==================== РОЗЫГРЫШИ (ОБЪЕДИНЕННЫЙ ХЕНДЛЕР С ПРОВЕРКОЙ ПРАВ) ====================
 
-@dp.message_handler(lambda message: message.text == "🎁 Розыгрыши")
-async def giveaways_unified_handler(message: types.Message):
+@router.text("🎁 Розыгрыши")
+async def giveaways_unified_handler(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
@@ -5498,7 +7304,7 @@ async def giveaways_unified_handler(message: types.Message):
 async def user_giveaways_menu(message: types.Message):
     await send_with_media(message.chat.id, "🎁 Розыгрыши:", media_key='giveaway', reply_markup=giveaways_user_keyboard())
 
-@dp.message_handler(lambda message: message.text == "📋 Активные розыгрыши")
+@router.text("📋 Активные розыгрыши")
 async def active_giveaways_user(message: types.Message):
     if message.chat.type != 'private':
         return
@@ -5513,7 +7319,7 @@ async def active_giveaways_user(message: types.Message):
     except:
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         total = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='active'")
         rows = await conn.fetch(
             "SELECT id, prize, description, end_date FROM giveaways WHERE status='active' ORDER BY end_date LIMIT $1 OFFSET $2",
@@ -5531,11 +7337,11 @@ async def active_giveaways_user(message: types.Message):
     kb = active_giveaways_keyboard(rows, page, total_pages)
     await message.answer(text, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("active_gw_") and not c.data.startswith("active_gw_page_"))
+@router.callback(prefix="active_gw_", exclude=("active_gw_page_",))
 async def active_giveaway_detail(callback: types.CallbackQuery):
     gw_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         gw = await conn.fetchrow("SELECT * FROM giveaways WHERE id=$1 AND status='active'", gw_id)
         if not gw:
             await callback.answer("Розыгрыш не найден или уже завершён.", show_alert=True)
@@ -5555,11 +7361,11 @@ async def active_giveaway_detail(callback: types.CallbackQuery):
         await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("join_giveaway_"))
+@router.callback(prefix="join_giveaway_")
 async def join_giveaway(callback: types.CallbackQuery):
     gw_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         status = await conn.fetchval("SELECT status FROM giveaways WHERE id=$1", gw_id)
         if status != 'active':
             await callback.answer("Розыгрыш уже завершён.", show_alert=True)
@@ -5572,21 +7378,21 @@ async def join_giveaway(callback: types.CallbackQuery):
     await callback.answer("✅ Ты участвуешь в розыгрыше!", show_alert=True)
     await active_giveaway_detail(callback)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("leave_giveaway_"))
+@router.callback(prefix="leave_giveaway_")
 async def leave_giveaway(callback: types.CallbackQuery):
     gw_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM participants WHERE user_id=$1 AND giveaway_id=$2", user_id, gw_id)
     await callback.answer("❌ Ты отказался от участия.", show_alert=True)
     await active_giveaway_detail(callback)
 
-@dp.callback_query_handler(lambda c: c.data == "active_gw_back")
+@router.callback(exact="active_gw_back")
 async def active_gw_back(callback: types.CallbackQuery):
     await active_giveaways_user(callback.message)
     await callback.answer()
 
-@dp.message_handler(lambda message: message.text == "🏁 Завершённые розыгрыши")
+@router.text("🏁 Завершённые розыгрыши")
 async def completed_giveaways_user(message: types.Message):
     if message.chat.type != 'private':
         return
@@ -5601,7 +7407,7 @@ async def completed_giveaways_user(message: types.Message):
     except:
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         total = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='completed'")
         rows = await conn.fetch(
             "SELECT id, prize, description, end_date, winners_list FROM giveaways WHERE status='completed' ORDER BY end_date DESC LIMIT $1 OFFSET $2",
@@ -5619,10 +7425,10 @@ async def completed_giveaways_user(message: types.Message):
     kb = completed_giveaways_keyboard(rows, page, total_pages)
     await message.answer(text, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("completed_gw_") and not c.data.startswith("completed_gw_page_"))
+@router.callback(prefix="completed_gw_", exclude=("completed_gw_page_",))
 async def completed_giveaway_detail(callback: types.CallbackQuery):
     gw_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         gw = await conn.fetchrow("SELECT * FROM giveaways WHERE id=$1 AND status='completed'", gw_id)
         if not gw:
             await callback.answer("Розыгрыш не найден.", show_alert=True)
@@ -5644,41 +7450,36 @@ async def completed_giveaway_detail(callback: types.CallbackQuery):
         await callback.message.edit_text(text)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("completed_gw_page_"))
+@router.callback(prefix="completed_gw_page_")
 async def completed_gw_page_callback(callback: types.CallbackQuery):
     page = int(callback.data.split("_")[3])
     callback.message.text = f"🏁 Завершённые розыгрыши {page}"
     await completed_giveaways_user(callback.message)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "completed_gw_back")
+@router.callback(exact="completed_gw_back")
 async def completed_gw_back(callback: types.CallbackQuery):
     await completed_giveaways_user(callback.message)
     await callback.answer()
 
 # ==================== БИТКОИН-БИРЖА (ПОЛНОЦЕННЫЙ СТАКАН) ====================
 
-@dp.message_handler(lambda message: message.text == "💼 Биткоин-биржа")
-async def bitcoin_exchange_menu(message: types.Message):
+@router.text("💼 Биткоин-биржа")
+async def bitcoin_exchange_menu(message: types.Message, user_ctx: UserContext = None):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    await send_with_media(user_id, "💼 Биткоин-биржа: продавай и покупай BTC за баксы.", media_key='exchange', reply_markup=bitcoin_exchange_keyboard())
+    await send_with_media(user_id, f"💼 Биткоин-биржа: продавай и покупай BTC за баксы.\n\n{ticker_text()}", media_key='exchange', reply_markup=bitcoin_exchange_keyboard())
 
 # ----- Просмотр стакана заявок -----
-@dp.message_handler(lambda message: message.text == "📊 Стакан заявок")
-async def exchange_order_book(message: types.Message):
-    if message.chat.type != 'private':
-        return
-    user_id = message.from_user.id
-    book = await get_order_book()
+def order_book_text(book: Dict[str, Any]) -> str:
     text = "📊 <b>Биржевой стакан</b>\n\n"
     text += "📉 <b>Продажа (ASK)</b>:\n"
     if book['asks']:
@@ -5693,31 +7494,38 @@ async def exchange_order_book(message: types.Message):
     else:
         text += "Нет активных заявок на покупку.\n"
     text += "\nВыбери действие ниже:"
-    await message.answer(text, reply_markup=order_book_keyboard(book))
+    return text
 
-@dp.callback_query_handler(lambda c: c.data.startswith("buy_from_"))
-async def buy_from_price(callback: types.CallbackQuery, state: FSMContext):
-    price = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        orders = await conn.fetch(
-            "SELECT * FROM bitcoin_orders WHERE type='sell' AND status='active' AND price=$1 ORDER BY created_at ASC",
-            price
-        )
-    if not orders:
-        await callback.answer("Заявок по этой цене больше нет.", show_alert=True)
+@router.text("📊 Стакан заявок")
+async def exchange_order_book(message: types.Message):
+    if message.chat.type != 'private':
         return
-    orders_list = []
-    total_available = 0.0
-    for o in orders:
-        d = dict(o)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders_list.append(d)
-        total_available += d['amount']
-    await state.update_data(price=price, orders=orders_list, total_available=total_available)
+    book = get_order_book()
+    await message.answer(order_book_text(book), reply_markup=order_book_keyboard(book))
+
+@router.callback(prefix="book_refresh_")
+async def exchange_order_book_refresh(callback: types.CallbackQuery):
+    version = int(callback.data.split("_")[2])
+    book = get_order_book()
+    if book['version'] == version:
+        await callback.answer("Стакан не изменился.")
+        return
+    await callback.message.edit_text(order_book_text(book), reply_markup=order_book_keyboard(book))
+    await callback.answer()
+
+@router.callback(prefix="buy_from_")
+async def buy_from_price(callback: types.CallbackQuery, state: FSMContext):
+    arg = callback.data.split("_")[2]
+    price = None if arg == 'market' else int(arg)
+    total_available = exchange.available('sell', price)
+    if total_available <= 0:
+        await callback.answer("Заявок на продажу по такой цене больше нет.", show_alert=True)
+        return
+    await state.update_data(price=price, total_available=total_available)
+    limit = "по рынку" if price is None else f"по цене до {price} $/BTC"
     await callback.message.answer(
-        f"📉 Продажа по цене {price} $/BTC. Доступно всего: {total_available:.4f} BTC.\n"
+        f"📉 Покупка {limit}. Доступно всего: {total_available:.4f} BTC.\n"
+        f"Заявка пройдёт по всем подходящим уровням, неисполненный остаток вернётся.\n"
         f"Введи количество BTC, которое хочешь купить (можно дробное):",
         reply_markup=back_keyboard()
     )
@@ -5731,83 +7539,46 @@ async def buy_from_price_amount(message: types.Message, state: FSMContext):
         await bitcoin_exchange_menu(message)
         return
     try:
-        amount = float(message.text)
+        amount = BtcUnits.from_major(float(message.text))
         if amount <= 0:
             raise ValueError
-        amount = round(amount, 4)
     except:
         await message.answer("❌ Введи положительное число.")
         return
     data = await state.get_data()
     price = data['price']
-    orders = data['orders']
     total_available = data['total_available']
-    if amount > total_available + 0.0001:
+    if amount > total_available:
         await message.answer(f"❌ Недостаточно BTC для покупки. Доступно {total_available:.4f} BTC.")
         return
     user_id = message.from_user.id
-    total_cost = amount * price
-    balance = await get_user_balance(user_id)
-    if balance < total_cost:
-        await message.answer(f"❌ Недостаточно баксов. Нужно {total_cost:.2f}.")
+    try:
+        _, fills = await place_bitcoin_order(user_id, 'buy', amount, price, rest=False)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        await state.finish()
         return
-    max_input = await get_setting_float("max_input_number")
-    if total_cost > max_input:
-        await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
+    except Exception as e:
+        logging.error(f"Buy from book error: {e}", exc_info=True)
+        await message.answer("❌ Ошибка при покупке.")
+        await state.finish()
         return
-    remaining = amount
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            for order in orders:
-                if remaining <= 0.0001:
-                    break
-                order_id = order['id']
-                seller_id = order['user_id']
-                order_amount = order['amount']
-                take = min(remaining, order_amount)
-                current = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active'", order_id)
-                if not current or float(current['amount']) < take - 0.0001:
-                    continue
-                await update_user_balance(user_id, -take * price, conn=conn)
-                await update_user_bitcoin(user_id, take, conn=conn)
-                await update_user_balance(seller_id, take * price, conn=conn)
-                new_amount = float(current['amount']) - take
-                new_locked = float(current['total_locked']) - take
-                if new_amount <= 0.0001:
-                    await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", order_id)
-                else:
-                    await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_amount, new_locked, order_id)
-                await conn.execute(
-                    "INSERT INTO bitcoin_trades (sell_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5)",
-                    order_id, take, price, user_id, seller_id
-                )
-                remaining -= take
-    await message.answer(f"✅ Ты купил {amount:.4f} BTC за {total_cost:.2f} баксов.", reply_markup=bitcoin_exchange_keyboard())
+    await message.answer(fill_report_text('buy', amount, fills), reply_markup=bitcoin_exchange_keyboard())
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("sell_to_"))
+@router.callback(prefix="sell_to_")
 async def sell_to_price(callback: types.CallbackQuery, state: FSMContext):
-    price = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        orders = await conn.fetch(
-            "SELECT * FROM bitcoin_orders WHERE type='buy' AND status='active' AND price=$1 ORDER BY created_at ASC",
-            price
-        )
-    if not orders:
-        await callback.answer("Заявок по этой цене больше нет.", show_alert=True)
-        return
-    orders_list = []
-    total_available = 0.0
-    for o in orders:
-        d = dict(o)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders_list.append(d)
-        total_available += d['amount']
-    await state.update_data(price=price, orders=orders_list, total_available=total_available)
+    arg = callback.data.split("_")[2]
+    price = None if arg == 'market' else int(arg)
+    total_available = exchange.available('buy', price)
+    if total_available <= 0:
+        await callback.answer("Заявок на покупку по такой цене больше нет.", show_alert=True)
+        return
+    await state.update_data(price=price, total_available=total_available)
+    limit = "по рынку" if price is None else f"по цене от {price} $/BTC"
     await callback.message.answer(
-        f"📈 Покупка по цене {price} $/BTC. Требуется всего: {total_available:.4f} BTC.\n"
+        f"📈 Продажа {limit}. Спрос всего: {total_available:.4f} BTC.\n"
+        f"Заявка пройдёт по всем подходящим уровням, неисполненный остаток вернётся.\n"
         f"Введи количество BTC, которое хочешь продать (можно дробное):",
         reply_markup=back_keyboard()
     )
@@ -5821,18 +7592,16 @@ async def sell_to_price_amount(message: types.Message, state: FSMContext):
         await bitcoin_exchange_menu(message)
         return
     try:
-        amount = float(message.text)
+        amount = BtcUnits.from_major(float(message.text))
         if amount <= 0:
             raise ValueError
-        amount = round(amount, 4)
     except:
         await message.answer("❌ Введи положительное число.")
         return
     data = await state.get_data()
     price = data['price']
-    orders = data['orders']
     total_available = data['total_available']
-    if amount > total_available + 0.0001:
+    if amount > total_available:
         await message.answer(f"❌ Спрос меньше. Максимум можно продать {total_available:.4f} BTC.")
         return
     user_id = message.from_user.id
@@ -5840,49 +7609,29 @@ async def sell_to_price_amount(message: types.Message, state: FSMContext):
     if btc_balance < amount:
         await message.answer(f"❌ Недостаточно BTC. У тебя {btc_balance:.4f} BTC.")
         return
-    total_profit = amount * price
-    max_input = await get_setting_float("max_input_number")
-    if total_profit > max_input:
-        await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
+    try:
+        _, fills = await place_bitcoin_order(user_id, 'sell', amount, price, rest=False)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        await state.finish()
+        return
+    except Exception as e:
+        logging.error(f"Sell to book error: {e}", exc_info=True)
+        await message.answer("❌ Ошибка при продаже.")
+        await state.finish()
         return
-    remaining = amount
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            for order in orders:
-                if remaining <= 0.0001:
-                    break
-                order_id = order['id']
-                buyer_id = order['user_id']
-                order_amount = order['amount']
-                take = min(remaining, order_amount)
-                current = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active'", order_id)
-                if not current or float(current['amount']) < take - 0.0001:
-                    continue
-                await update_user_balance(user_id, take * price, conn=conn)
-                await update_user_bitcoin(user_id, -take, conn=conn)
-                await update_user_bitcoin(buyer_id, take, conn=conn)
-                new_amount = float(current['amount']) - take
-                new_locked = float(current['total_locked']) - take * price
-                if new_amount <= 0.0001:
-                    await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", order_id)
-                else:
-                    await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_amount, new_locked, order_id)
-                await conn.execute(
-                    "INSERT INTO bitcoin_trades (buy_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5)",
-                    order_id, take, price, buyer_id, user_id
-                )
-                remaining -= take
-    await message.answer(f"✅ Ты продал {amount:.4f} BTC за {total_profit:.2f} баксов.", reply_markup=bitcoin_exchange_keyboard())
+    await message.answer(fill_report_text('sell', amount, fills), reply_markup=bitcoin_exchange_keyboard())
     await state.finish()
 
 # ----- Создание заявки на продажу -----
-@dp.message_handler(lambda message: message.text == "📉 Продать BTC")
+@router.text("📉 Продать BTC")
 async def sell_bitcoin_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
     btc_balance = await get_user_bitcoin(user_id)
-    min_amount = await get_setting_float("exchange_min_amount_btc")
+    min_amount = cfg.exchange_min_amount_btc
     await message.answer(
         f"У тебя {btc_balance:.4f} BTC.\n"
         f"Минимальная сумма заявки: {min_amount} BTC.\n"
@@ -5893,25 +7642,25 @@ async def sell_bitcoin_start(message: types.Message):
 
 @dp.message_handler(state=SellBitcoin.amount)
 async def sell_bitcoin_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await bitcoin_exchange_menu(message)
         return
     try:
-        amount = float(message.text)
+        amount = BtcUnits.from_major(float(message.text))
         if amount <= 0:
             raise ValueError
-        amount = round(amount, 4)
-    except ValueError:
+    except (ValueError, OverflowError):
         await message.answer("❌ Введи положительное число (можно дробное).")
         return
     user_id = message.from_user.id
-    btc_balance = await get_user_bitcoin(user_id)
-    if btc_balance < amount - 0.0001:
+    btc_balance = BtcUnits.from_major(await get_user_bitcoin(user_id))
+    if btc_balance < amount:
         await message.answer(f"❌ Недостаточно BTC. У тебя {btc_balance:.4f} BTC.")
         return
-    min_amount = await get_setting_float("exchange_min_amount_btc")
-    if amount < min_amount:
+    min_amount = cfg.exchange_min_amount_btc
+    if amount < BtcUnits.from_major(min_amount):
         await message.answer(f"❌ Минимальное количество для продажи: {min_amount} BTC.")
         return
     await state.update_data(amount=amount)
@@ -5920,6 +7669,7 @@ async def sell_bitcoin_amount(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=SellBitcoin.price)
 async def sell_bitcoin_price(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await bitcoin_exchange_menu(message)
@@ -5931,8 +7681,8 @@ async def sell_bitcoin_price(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введи целое положительное число.")
         return
-    min_price = await get_setting_int("exchange_min_price")
-    max_price = await get_setting_int("exchange_max_price")
+    min_price = cfg.exchange_min_price
+    max_price = cfg.exchange_max_price
     if price < min_price:
         await message.answer(f"❌ Цена не может быть меньше {min_price}.")
         return
@@ -5957,11 +7707,12 @@ async def sell_bitcoin_price(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Создание заявки на покупку -----
-@dp.message_handler(lambda message: message.text == "📈 Купить BTC")
+@router.text("📈 Купить BTC")
 async def buy_bitcoin_start(message: types.Message):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
-    min_amount = await get_setting_float("exchange_min_amount_btc")
+    min_amount = cfg.exchange_min_amount_btc
     await message.answer(
         f"Минимальная сумма заявки: {min_amount} BTC.\n"
         f"Введи количество BTC, которое хочешь купить (можно дробное, например 0.5):",
@@ -5971,20 +7722,20 @@ async def buy_bitcoin_start(message: types.Message):
 
 @dp.message_handler(state=BuyBitcoin.amount)
 async def buy_bitcoin_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await bitcoin_exchange_menu(message)
         return
     try:
-        amount = float(message.text)
+        amount = BtcUnits.from_major(float(message.text))
         if amount <= 0:
             raise ValueError
-        amount = round(amount, 4)
-    except ValueError:
+    except (ValueError, OverflowError):
         await message.answer("❌ Введи положительное число (можно дробное).")
         return
-    min_amount = await get_setting_float("exchange_min_amount_btc")
-    if amount < min_amount:
+    min_amount = cfg.exchange_min_amount_btc
+    if amount < BtcUnits.from_major(min_amount):
         await message.answer(f"❌ Минимальное количество для покупки: {min_amount} BTC.")
         return
     await state.update_data(amount=amount)
@@ -5993,6 +7744,7 @@ async def buy_bitcoin_amount(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=BuyBitcoin.price)
 async def buy_bitcoin_price(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await bitcoin_exchange_menu(message)
@@ -6004,8 +7756,8 @@ async def buy_bitcoin_price(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введи целое положительное число.")
         return
-    min_price = await get_setting_int("exchange_min_price")
-    max_price = await get_setting_int("exchange_max_price")
+    min_price = cfg.exchange_min_price
+    max_price = cfg.exchange_max_price
     if price < min_price:
         await message.answer(f"❌ Цена не может быть меньше {min_price}.")
         return
@@ -6030,12 +7782,12 @@ async def buy_bitcoin_price(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ----- Просмотр моих заявок -----
-@dp.message_handler(lambda message: message.text == "📋 Мои заявки")
+@router.text("📋 Мои заявки")
 async def my_orders(message: types.Message):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch(
             "SELECT * FROM bitcoin_orders WHERE user_id=$1 AND status='active' ORDER BY created_at DESC",
             user_id
@@ -6043,12 +7795,7 @@ async def my_orders(message: types.Message):
     if not rows:
         await message.answer("У тебя нет активных заявок.", reply_markup=bitcoin_exchange_keyboard())
         return
-    orders = []
-    for r in rows:
-        d = dict(r)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders.append(d)
+    orders = [order_row(r) for r in rows]
     page = 1
     total_pages = (len(orders) + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
     start = (page - 1) * ITEMS_PER_PAGE
@@ -6057,22 +7804,21 @@ async def my_orders(message: types.Message):
     kb = my_orders_keyboard(page_orders, page, total_pages)
     await message.answer("Твои активные заявки:", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("myorder_"))
+@router.callback(prefix="myorder_")
 async def my_order_detail(callback: types.CallbackQuery):
     order_id = int(callback.data.split("_")[1])
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1", order_id)
     if not order or order['status'] != 'active':
         await callback.answer("Заявка не найдена или уже не активна.", show_alert=True)
         return
-    amount = float(order['amount'])
-    total_locked = float(order['total_locked'])
+    amount = order_row(order)['amount']
     text = (
         f"📄 Заявка #{order['id']}\n"
         f"Тип: {'📈 Покупка' if order['type']=='buy' else '📉 Продажа'}\n"
         f"Количество: {amount:.4f} BTC\n"
         f"Цена: {order['price']} $/BTC\n"
-        f"Всего: {amount * order['price']:.2f} $\n"
+        f"Всего: {trade_cost(amount, order['price']):.2f} $\n"
         f"Создана: {order['created_at'].strftime('%Y-%m-%d %H:%M')}"
     )
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -6082,7 +7828,7 @@ async def my_order_detail(callback: types.CallbackQuery):
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cancel_order_"))
+@router.callback(prefix="cancel_order_")
 async def cancel_order_callback(callback: types.CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
@@ -6093,19 +7839,59 @@ async def cancel_order_callback(callback: types.CallbackQuery, state: FSMContext
         await callback.answer("❌ Не удалось отменить заявку.", show_alert=True)
     await my_orders(callback.message)
 
-@dp.callback_query_handler(lambda c: c.data == "my_orders_back")
+# ----- История заявок (из архива, keyset-пагинация) -----
+async def order_history_page(user_id: int, before_id: Optional[int] = None) -> Tuple[str, InlineKeyboardMarkup]:
+    async with db_conn() as conn:
+        rows = await conn.fetch(
+            "SELECT id, type, amount, price, status, closed_at FROM bitcoin_orders_history "
+            "WHERE user_id=$1 AND ($2::int IS NULL OR id < $2) ORDER BY id DESC LIMIT $3",
+            user_id, before_id, ITEMS_PER_PAGE + 1
+        )
+    has_more = len(rows) > ITEMS_PER_PAGE
+    rows = rows[:ITEMS_PER_PAGE]
+    if not rows:
+        text = "📜 История заявок пуста."
+    else:
+        text = "📜 <b>История заявок</b>\n\n"
+        for r in rows:
+            status = "✅ исполнена" if r['status'] == 'completed' else f"❌ отменена (остаток {float(r['amount']):.4f} BTC)"
+            text += (
+                f"#{r['id']} {'📈' if r['type'] == 'buy' else '📉'} @ {r['price']} $ – {status}, "
+                f"{r['closed_at'].strftime('%Y-%m-%d %H:%M')}\n"
+            )
+    kb = []
+    if has_more:
+        kb.append([InlineKeyboardButton("➡️ Раньше", callback_data=f"ordhist_{rows[-1]['id']}")])
+    kb.append([InlineKeyboardButton("« Назад", callback_data="exchange_back")])
+    return text, InlineKeyboardMarkup(inline_keyboard=kb)
+
+@router.text("📜 История заявок")
+async def my_orders_history(message: types.Message):
+    if message.chat.type != 'private':
+        return
+    text, kb = await order_history_page(message.from_user.id)
+    await message.answer(text, reply_markup=kb)
+
+@router.callback(prefix="ordhist_")
+async def my_orders_history_page(callback: types.CallbackQuery):
+    before_id = int(callback.data.split("_")[1])
+    text, kb = await order_history_page(callback.from_user.id, before_id)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+@router.callback(exact="my_orders_back")
 async def my_orders_back(callback: types.CallbackQuery):
     await my_orders(callback.message)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("myorders_page_"))
+@router.callback(prefix="myorders_page_")
 async def myorders_page_callback(callback: types.CallbackQuery):
     page = int(callback.data.split("_")[2])
     callback.message.text = f"📋 Мои заявки {page}"
     await my_orders(callback.message)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data == "exchange_back")
+@router.callback(exact="exchange_back")
 async def exchange_back(callback: types.CallbackQuery):
     await bitcoin_exchange_menu(callback.message)
     await callback.answer()
@@ -6116,18 +7902,18 @@ async def exchange_back(callback: types.CallbackQuery):
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ МУЛЬТИПЛЕЕРА ====================
 
 async def get_multiplayer_game(game_id: str) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         row = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         return dict(row) if row else None
 
 async def get_game_players(game_id: str) -> List[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT * FROM game_players WHERE game_id=$1 ORDER BY joined_at", game_id)
         return [dict(r) for r in rows]
 
 async def add_player_to_game(game_id: str, user_id: int, username: str):
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
+    async with db_conn() as conn:
+        async with db_transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 AND status='waiting' FOR UPDATE", game_id)
             if not game:
                 raise ValueError("Игра не найдена или уже началась")
@@ -6136,19 +7922,19 @@ async def add_player_to_game(game_id: str, user_id: int, username: str):
                 raise ValueError("Комната уже полная")
             await conn.execute(
                 "INSERT INTO game_players (game_id, user_id, username, cards, value, stopped, joined_at) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                game_id, user_id, username, '', 0, False, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                game_id, user_id, username, '', 0, False, db_now()
             )
 
 async def remove_player_from_game(game_id: str, user_id: int):
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM game_players WHERE game_id=$1 AND user_id=$2", game_id, user_id)
         remaining = await conn.fetchval("SELECT COUNT(*) FROM game_players WHERE game_id=$1", game_id)
         if remaining == 0:
             await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
 
 async def start_game(game_id: str):
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
+    async with db_conn() as conn:
+        async with db_transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 AND status='waiting' FOR UPDATE", game_id)
             if not game:
                 raise ValueError("Игра не найдена или уже началась")
@@ -6156,12 +7942,14 @@ async def start_game(game_id: str):
             if len(players) < 2:
                 raise ValueError("Недостаточно игроков")
             
-            bet_amount = float(game['bet_amount'])
+            bet_amount = Cents.from_major(game['bet_amount'])
             for player in players:
-                balance = await get_user_balance(player['user_id'])
-                if balance < bet_amount - 0.01:
+                balance = await conn.fetchval(
+                    "SELECT balance FROM user_wallet WHERE user_id=$1 FOR UPDATE", player['user_id']
+                )
+                if Cents(balance or 0) < bet_amount:
                     raise ValueError(f"У игрока {player['username']} недостаточно баксов")
-                await update_user_balance(player['user_id'], -bet_amount, conn=conn)
+                await update_user_balance(player['user_id'], Cents(-bet_amount), conn=conn)
             
             deck = create_deck()
             deck_str = ','.join(deck)
@@ -6179,7 +7967,7 @@ async def start_game(game_id: str):
             return game_id
 
 async def get_current_player(game_id: str) -> Optional[dict]:
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         if not game or game['status'] != 'playing':
             return None
@@ -6192,8 +7980,8 @@ async def get_current_player(game_id: str) -> Optional[dict]:
         return dict(players[idx])
 
 async def next_player(game_id: str) -> Optional[int]:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
+    async with db_conn() as conn:
+        async with db_transaction():
             game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 FOR UPDATE", game_id)
             if not game:
                 return -1
@@ -6216,72 +8004,73 @@ async def next_player(game_id: str) -> Optional[int]:
             return -1
 
 async def finish_game(game_id: str):
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
-            if not game or game['status'] != 'playing':
-                return
-            players = await conn.fetch("SELECT * FROM game_players WHERE game_id=$1", game_id)
-            if not players:
-                await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
-                return
-            best_value = -1
-            winner_id = None
-            for p in players:
-                val = p['value']
-                if val <= 21 and val > best_value:
-                    best_value = val
-                    winner_id = p['user_id']
-            bet_amount = float(game['bet_amount'])
-            pot = bet_amount * len(players)
-            if winner_id:
-                await update_user_balance(winner_id, pot, conn=conn)
-                await update_user_game_stats(winner_id, 'multiplayer', win=True, conn=conn)
-                for p in players:
-                    if p['user_id'] != winner_id:
-                        await update_user_game_stats(p['user_id'], 'multiplayer', win=False, conn=conn)
-                exp_win = await get_setting_int("exp_per_game_win")
-                exp_lose = await get_setting_int("exp_per_game_lose")
-                await add_exp(winner_id, exp_win, conn=conn)
-                for p in players:
-                    if p['user_id'] != winner_id:
-                        await add_exp(p['user_id'], exp_lose, conn=conn)
-                for p in players:
-                    if p['user_id'] == winner_id:
-                        await safe_send_message(p['user_id'], f"🎉 Ты выиграл в игре 21! Твой выигрыш: {pot:.2f} баксов.")
-                    else:
-                        await safe_send_message(p['user_id'], f"😢 Ты проиграл в игре 21. Твоя ставка {bet_amount:.2f} баксов потеряна.")
-            else:
-                for p in players:
-                    await update_user_balance(p['user_id'], bet_amount, conn=conn)
-                    await update_user_game_stats(p['user_id'], 'multiplayer', win=False, conn=conn)
-                    await add_exp(p['user_id'], await get_setting_int("exp_per_game_lose"), conn=conn)
-                    await safe_send_message(p['user_id'], f"🤝 В игре 21 ничья. Твоя ставка {bet_amount:.2f} баксов возвращена.")
+    cfg = await get_settings_snapshot()
+    async with db_transaction() as conn:
+        game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
+        if not game or game['status'] != 'playing':
+            return
+        players = await conn.fetch("SELECT * FROM game_players WHERE game_id=$1", game_id)
+        if not players:
             await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
-            await conn.execute("DELETE FROM game_players WHERE game_id=$1", game_id)
+            return
+        best_value = -1
+        winner_id = None
+        for p in players:
+            val = p['value']
+            if val <= 21 and val > best_value:
+                best_value = val
+                winner_id = p['user_id']
+        bet_amount = float(game['bet_amount'])
+        pot = bet_amount * len(players)
+        if winner_id:
+            await update_user_balance(winner_id, pot, conn=conn)
+            update_user_game_stats(winner_id, 'multiplayer', win=True)
+            for p in players:
+                if p['user_id'] != winner_id:
+                    update_user_game_stats(p['user_id'], 'multiplayer', win=False)
+            exp_win = cfg.exp_per_game_win
+            exp_lose = cfg.exp_per_game_lose
+            await add_exp(winner_id, exp_win, conn=conn)
+            for p in players:
+                if p['user_id'] != winner_id:
+                    await add_exp(p['user_id'], exp_lose, conn=conn)
+            for p in players:
+                if p['user_id'] == winner_id:
+                    outbox_send(p['user_id'], f"🎉 Ты выиграл в игре 21! Твой выигрыш: {pot:.2f} баксов.")
+                else:
+                    outbox_send(p['user_id'], f"😢 Ты проиграл в игре 21. Твоя ставка {bet_amount:.2f} баксов потеряна.")
+        else:
+            for p in players:
+                await update_user_balance(p['user_id'], bet_amount, conn=conn)
+                update_user_game_stats(p['user_id'], 'multiplayer', win=False)
+                await add_exp(p['user_id'], cfg.exp_per_game_lose, conn=conn)
+                outbox_send(p['user_id'], f"🤝 В игре 21 ничья. Твоя ставка {bet_amount:.2f} баксов возвращена.")
+        await conn.execute("DELETE FROM multiplayer_games WHERE game_id=$1", game_id)
+        await conn.execute("DELETE FROM game_players WHERE game_id=$1", game_id)
 
 # ==================== ХЕНДЛЕРЫ МУЛЬТИПЛЕЕРА ====================
 
-@dp.message_handler(lambda message: message.text == "👥 Мультиплеер 21")
-async def multiplayer_menu(message: types.Message):
+@router.text("👥 Мультиплеер 21")
+async def multiplayer_menu(message: types.Message, user_ctx: UserContext = None):
+    cfg = await get_settings_snapshot()
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    if await is_banned(user_id) and not await is_admin(user_id):
+    user_ctx = user_ctx or await load_user_context(message.from_user)
+    if user_ctx.is_banned and not user_ctx.is_admin:
         return
-    await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
     ok, not_subscribed = await check_subscription(user_id)
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    min_level = await get_setting_int("min_level_multiplayer")
-    level = await get_user_level(user_id)
+    min_level = cfg.min_level_multiplayer
+    level = user_ctx.level
     if level < min_level:
         await message.answer(f"❌ Для игры в мультиплеер нужен {min_level} уровень. Твой уровень: {level}")
         return
     await send_with_media(user_id, "🎮 Мультиплеер 21 (очко)", media_key='multiplayer', reply_markup=multiplayer_lobby_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Создать комнату")
+@router.text("➕ Создать комнату")
 async def create_room_start(message: types.Message):
     if message.chat.type != 'private':
         return
@@ -6307,6 +8096,7 @@ async def create_room_max_players(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=MultiplayerGame.create_bet)
 async def create_room_bet(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await multiplayer_menu(message)
@@ -6319,9 +8109,9 @@ async def create_room_bet(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введи положительное число с точностью до сотых.")
         return
-    min_bet = await get_setting_float("multiplayer_min_bet")
-    max_bet = await get_setting_float("multiplayer_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = cfg.multiplayer_min_bet
+    max_bet = cfg.multiplayer_max_bet
+    max_input = cfg.max_input_number
     if bet < min_bet or bet > max_bet:
         await message.answer(f"❌ Ставка должна быть от {min_bet:.2f} до {max_bet:.2f}.")
         return
@@ -6336,14 +8126,14 @@ async def create_room_bet(message: types.Message, state: FSMContext):
     data = await state.get_data()
     max_players = data['max_players']
     game_id = generate_game_id()
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute(
             "INSERT INTO multiplayer_games (game_id, host_id, max_players, bet_amount, status, created_at) VALUES ($1, $2, $3, $4, $5, $6)",
-            game_id, user_id, max_players, bet, 'waiting', datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            game_id, user_id, max_players, bet, 'waiting', db_now()
         )
         await conn.execute(
             "INSERT INTO game_players (game_id, user_id, username, cards, value, stopped, joined_at) VALUES ($1, $2, $3, $4, $5, $6, $7)",
-            game_id, user_id, message.from_user.username or "Player", '', 0, False, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            game_id, user_id, message.from_user.username or "Player", '', 0, False, db_now()
         )
     await state.finish()
     text = (
@@ -6358,7 +8148,7 @@ async def create_room_bet(message: types.Message, state: FSMContext):
     ])
     await send_with_media(user_id, text, media_key='multiplayer', reply_markup=kb)
 
-@dp.message_handler(lambda message: message.text == "🔍 Найти комнату")
+@router.text("🔍 Найти комнату")
 async def join_room_by_code(message: types.Message):
     if message.chat.type != 'private':
         return
@@ -6399,11 +8189,11 @@ async def join_room_code(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка при присоединении.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список комнат")
+@router.text("📋 Список комнат")
 async def list_rooms(message: types.Message):
     if message.chat.type != 'private':
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT * FROM multiplayer_games WHERE status='waiting' ORDER BY created_at DESC LIMIT 10")
     if not rows:
         await message.answer("Нет открытых комнат.")
@@ -6414,12 +8204,12 @@ async def list_rooms(message: types.Message):
         text += f"🆔 {row['game_id']} | Ставка: {float(row['bet_amount']):.2f} | Игроков: {len(players)}/{row['max_players']}\n"
     await message.answer(text, reply_markup=multiplayer_lobby_keyboard())
 
-@dp.callback_query_handler(lambda c: c.data.startswith("close_room_"))
+@router.callback(prefix="close_room_")
 async def close_room_callback(callback: types.CallbackQuery):
     await callback.answer()
     game_id = callback.data.split("_")[2]
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         if not game or game['host_id'] != user_id:
             await callback.message.answer("❌ Только создатель может закрыть комнату.")
@@ -6428,7 +8218,7 @@ async def close_room_callback(callback: types.CallbackQuery):
         await conn.execute("DELETE FROM game_players WHERE game_id=$1", game_id)
     await callback.message.edit_text("❌ Комната закрыта.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("start_game_"))
+@router.callback(prefix="start_game_")
 async def start_game_callback(callback: types.CallbackQuery):
     await callback.answer()
     game_id = callback.data.split("_")[2]
@@ -6475,15 +8265,15 @@ async def show_current_turn(game_id: str, message: types.Message = None, user_id
     text += f"\n💰 Твоя ставка: {float(game['bet_amount']):.2f} баксов"
     kb = room_action_keyboard(can_double=not current_player['doubled'])
     if user_id:
-        await bot.send_message(user_id, text, reply_markup=kb)
+        await outbound.send(user_id, 'send_message', text, reply_markup=kb)
     else:
         await message.answer(text, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data in ["room_hit", "room_stand", "room_double", "room_surrender", "room_chat"])
+@router.callback(exact=["room_hit", "room_stand", "room_double", "room_surrender", "room_chat"])
 async def room_action_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         game_row = await conn.fetchrow("""
             SELECT g.* FROM multiplayer_games g
             JOIN game_players p ON g.game_id = p.game_id
@@ -6500,8 +8290,8 @@ async def room_action_callback(callback: types.CallbackQuery, state: FSMContext)
         return
     
     if action == "hit":
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
+        async with db_conn() as conn:
+            async with db_transaction():
                 game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1 FOR UPDATE", game_id)
                 deck = game['deck'].split(',')
                 if not deck:
@@ -6524,14 +8314,14 @@ async def room_action_callback(callback: types.CallbackQuery, state: FSMContext)
         await show_current_turn(game_id, user_id=user_id)
         
     elif action == "stand":
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("UPDATE game_players SET stopped=TRUE WHERE game_id=$1 AND user_id=$2", game_id, user_id)
             await next_player(game_id)
         await show_current_turn(game_id, user_id=user_id)
         
     elif action == "double":
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
+        async with db_conn() as conn:
+            async with db_transaction():
                 player = await conn.fetchrow("SELECT * FROM game_players WHERE game_id=$1 AND user_id=$2 FOR UPDATE", game_id, user_id)
                 if player['doubled']:
                     await callback.message.answer("❌ Ты уже удваивал ставку.")
@@ -6562,7 +8352,7 @@ async def room_action_callback(callback: types.CallbackQuery, state: FSMContext)
         await show_current_turn(game_id, user_id=user_id)
         
     elif action == "surrender":
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("UPDATE game_players SET surrendered=TRUE WHERE game_id=$1 AND user_id=$2", game_id, user_id)
             await next_player(game_id)
         await show_current_turn(game_id, user_id=user_id)
@@ -6588,12 +8378,12 @@ async def room_chat_message(message: types.Message, state: FSMContext):
     await state.finish()
     await show_current_turn(game_id, user_id=message.from_user.id)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("leave_room_"))
+@router.callback(prefix="leave_room_")
 async def leave_room_callback(callback: types.CallbackQuery):
     await callback.answer()
     game_id = callback.data.split("_")[2]
     user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         game = await conn.fetchrow("SELECT * FROM multiplayer_games WHERE game_id=$1", game_id)
         if game and game['status'] == 'waiting':
             await remove_player_from_game(game_id, user_id)
@@ -6617,6 +8407,7 @@ async def is_group_admin(chat_id: int, user_id: int) -> bool:
 # ----- /fight – атака на банду -----
 @dp.message_handler(commands=['fight'], chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
 async def fight_command(message: types.Message):
+    cfg = await get_settings_snapshot()
     chat_id = message.chat.id
     user_id = message.from_user.id
 
@@ -6660,7 +8451,7 @@ async def fight_command(message: types.Message):
             await update_user_balance(user_id, -loss)
         authority = 0
         await log_fight(chat_id, user_id, loss, 0, 'counter')
-        await add_exp(user_id, await get_setting_int("exp_per_fight"))
+        await add_exp(user_id, cfg.exp_per_fight)
         await set_fight_cooldown(chat_id, user_id)
         await auto_delete_reply(message, phrase.format(damage=loss))
         return
@@ -6670,13 +8461,13 @@ async def fight_command(message: types.Message):
     # Успешная атака
     await update_user_balance(user_id, authority)  # авторитет в баксах? или в отдельной валюте? по логике авторитет добавляется к authority_balance
     await update_user_authority(user_id, authority)
-    bitcoin_reward = await get_setting_int("fight_bitcoin_reward")
+    bitcoin_reward = cfg.fight_bitcoin_reward
     if bitcoin_reward > 0:
         await update_user_bitcoin(user_id, float(bitcoin_reward))
 
     await add_chat_authority(chat_id, user_id, authority, damage)
     await log_fight(chat_id, user_id, damage, authority, 'hit')
-    await add_exp(user_id, await get_setting_int("exp_per_fight"))
+    await add_exp(user_id, cfg.exp_per_fight)
     await set_fight_cooldown(chat_id, user_id)
 
     await auto_delete_reply(message, phrase.format(damage=damage, authority=authority))
@@ -6684,6 +8475,7 @@ async def fight_command(message: types.Message):
 # ----- /smuggle – контрабанда (в группе) -----
 @dp.message_handler(commands=['smuggle'], chat_type=[types.ChatType.GROUP, types.ChatType.SUPERGROUP])
 async def smuggle_group_command(message: types.Message):
+    cfg = await get_settings_snapshot()
     chat_id = message.chat.id
     user_id = message.from_user.id
 
@@ -6705,7 +8497,7 @@ async def smuggle_group_command(message: types.Message):
         return
 
     # Проверяем, нет ли уже активного рейса
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         active = await conn.fetchval(
             "SELECT 1 FROM smuggle_runs WHERE user_id=$1 AND status='in_progress'",
             user_id
@@ -6714,20 +8506,21 @@ async def smuggle_group_command(message: types.Message):
             await auto_delete_reply(message, "❌ У тебя уже есть активный рейс. Дождись его завершения.")
             return
 
-    min_dur = await get_setting_int("smuggle_min_duration")
-    max_dur = await get_setting_int("smuggle_max_duration")
+    min_dur = cfg.smuggle_min_duration
+    max_dur = cfg.smuggle_max_duration
     duration = random.randint(min_dur, max_dur)
-    start_time = datetime.now()
+    start_time = db_now()
     end_time = start_time + timedelta(minutes=duration)
 
     cargo = random.choice(SMUGGLE_CARGO)
     end_time_str = end_time.strftime("%H:%M %d.%m")
 
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO smuggle_runs (user_id, chat_id, start_time, end_time, status, notified) VALUES ($1, $2, $3, $4, $5, $6)",
-            user_id, chat_id, start_time.strftime("%Y-%m-%d %H:%M:%S"), end_time.strftime("%Y-%m-%d %H:%M:%S"), 'in_progress', False
+    async with db_conn() as conn:
+        run_id = await conn.fetchval(
+            "INSERT INTO smuggle_runs (user_id, chat_id, start_time, end_time, status, notified) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id",
+            user_id, chat_id, start_time, end_time, 'in_progress', False
         )
+    deadlines.schedule('smuggle', run_id, end_time)
 
     phrase = get_random_phrase(SMUGGLE_START_PHRASES, cargo=cargo, end_time=end_time_str)
     await auto_delete_reply(message, phrase)
@@ -6751,7 +8544,7 @@ async def chat_top_command(message: types.Message):
 
     offset = (page - 1) * ITEMS_PER_PAGE
 
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         if order == 'authority':
             total = await conn.fetchval("SELECT COUNT(*) FROM chat_authority WHERE chat_id=$1", chat_id)
             rows = await conn.fetch(
@@ -6799,7 +8592,7 @@ async def chat_top_command(message: types.Message):
     kb = chat_top_navigation(order, page, has_prev, has_next)
     await auto_delete_reply(message, text, reply_markup=kb, delete_seconds=60)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("chat_top_page_"))
+@router.callback(prefix="chat_top_page_")
 async def chat_top_page_callback(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     order = parts[3]
@@ -6809,7 +8602,7 @@ async def chat_top_page_callback(callback: types.CallbackQuery):
     await chat_top_command(callback.message)
     await callback.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("chat_top_"))
+@router.callback(prefix="chat_top_")
 async def chat_top_switch_callback(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     order = parts[2]
@@ -6857,7 +8650,7 @@ async def activate_chat_command(message: types.Message):
     kb = confirm_chat_inline(chat_id)
 
     admins = SUPER_ADMINS.copy()
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT user_id FROM admins")
         for r in rows:
             admins.append(r['user_id'])
@@ -6869,14 +8662,14 @@ async def activate_chat_command(message: types.Message):
 
 # ==================== ОБРАБОТЧИКИ ДЛЯ ПОДТВЕРЖДЕНИЯ ЧАТОВ ====================
 
-@dp.callback_query_handler(lambda c: c.data.startswith("confirm_chat_"))
+@router.callback(prefix="confirm_chat_")
 async def confirm_chat_callback(callback: types.CallbackQuery):
     await callback.answer()
     if not await is_admin(callback.from_user.id):
         await callback.message.answer("❌ Недостаточно прав.")
         return
     chat_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         req = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1 AND status='pending'", chat_id)
         if not req:
             await callback.message.edit_text("❌ Запрос уже обработан.")
@@ -6886,14 +8679,14 @@ async def confirm_chat_callback(callback: types.CallbackQuery):
         await safe_send_message(req['requested_by'], f"✅ Ваш чат «{req['title']}» активирован!")
     await callback.message.edit_text(f"✅ Чат {chat_id} подтверждён.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("reject_chat_"))
+@router.callback(prefix="reject_chat_")
 async def reject_chat_callback(callback: types.CallbackQuery):
     await callback.answer()
     if not await is_admin(callback.from_user.id):
         await callback.message.answer("❌ Недостаточно прав.")
         return
     chat_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         req = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1 AND status='pending'", chat_id)
         if not req:
             await callback.message.edit_text("❌ Запрос уже обработан.")
@@ -6910,7 +8703,7 @@ async def check_admin_permissions(user_id: int, permission: str) -> bool:
     return await has_permission(user_id, permission)
 
 # ==================== ГЛАВНОЕ МЕНЮ АДМИНКИ ====================
-@dp.message_handler(lambda message: message.text == "⚙️ Админ панель")
+@router.text("⚙️ Админ панель")
 async def admin_panel(message: types.Message):
     if message.chat.type != 'private':
         return
@@ -6920,7 +8713,7 @@ async def admin_panel(message: types.Message):
     permissions = await get_admin_permissions(message.from_user.id)
     await send_with_media(message.chat.id, "Панель администратора:", media_key='admin', reply_markup=admin_main_keyboard(permissions))
 
-@dp.message_handler(lambda message: message.text == "◀️ Назад в админку")
+@router.text("◀️ Назад в админку")
 async def back_to_admin(message: types.Message):
     if message.chat.type != 'private':
         return
@@ -6930,14 +8723,14 @@ async def back_to_admin(message: types.Message):
     await send_with_media(message.chat.id, "Панель администратора:", media_key='admin', reply_markup=admin_main_keyboard(permissions))
 
 # ==================== УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ====================
-@dp.message_handler(lambda message: message.text == "👥 Пользователи")
+@router.text("👥 Пользователи")
 async def admin_users_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление пользователями:", media_key='admin_users', reply_markup=admin_users_keyboard())
 
-@dp.message_handler(lambda message: message.text == "💰 Начислить баксы")
+@router.text("💰 Начислить баксы")
 async def add_balance_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -6962,6 +8755,7 @@ async def add_balance_user(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=AddBalance.amount)
 async def add_balance_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_users_menu(message)
@@ -6971,7 +8765,7 @@ async def add_balance_amount(message: types.Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
@@ -6989,7 +8783,7 @@ async def add_balance_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "💸 Списать баксы")
+@router.text("💸 Списать баксы")
 async def remove_balance_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7014,6 +8808,7 @@ async def remove_balance_user(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=RemoveBalance.amount)
 async def remove_balance_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_users_menu(message)
@@ -7023,7 +8818,7 @@ async def remove_balance_amount(message: types.Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
@@ -7041,7 +8836,7 @@ async def remove_balance_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "⭐️ Начислить репутацию")
+@router.text("⭐️ Начислить репутацию")
 async def add_reputation_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7086,7 +8881,7 @@ async def add_reputation_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "🔻 Снять репутацию")
+@router.text("🔻 Снять репутацию")
 async def remove_reputation_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7131,7 +8926,7 @@ async def remove_reputation_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📈 Начислить опыт")
+@router.text("📈 Начислить опыт")
 async def add_exp_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7175,7 +8970,7 @@ async def add_exp_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "🔝 Установить уровень")
+@router.text("🔝 Установить уровень")
 async def set_level_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7214,8 +9009,8 @@ async def set_level_value(message: types.Message, state: FSMContext):
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("UPDATE users SET level=$1 WHERE user_id=$2", level, uid)
+        async with db_conn() as conn:
+            await conn.execute("UPDATE user_progress SET level=$1 WHERE user_id=$2", level, uid)
         await message.answer(f"✅ Пользователю {uid} установлен уровень {level}.")
         await safe_send_message(uid, f"🔝 Ваш уровень изменён на {level} администратором.")
     except Exception as e:
@@ -7223,7 +9018,7 @@ async def set_level_value(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "₿ Начислить биткоины")
+@router.text("₿ Начислить биткоины")
 async def add_bitcoin_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7248,6 +9043,7 @@ async def add_bitcoin_user(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=AddBitcoin.amount)
 async def add_bitcoin_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_users_menu(message)
@@ -7257,7 +9053,7 @@ async def add_bitcoin_amount(message: types.Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 4)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
             return
@@ -7275,7 +9071,7 @@ async def add_bitcoin_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "₿ Списать биткоины")
+@router.text("₿ Списать биткоины")
 async def remove_bitcoin_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7300,6 +9096,7 @@ async def remove_bitcoin_user(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=RemoveBitcoin.amount)
 async def remove_bitcoin_amount(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_users_menu(message)
@@ -7309,7 +9106,7 @@ async def remove_bitcoin_amount(message: types.Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 4)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
             return
@@ -7327,7 +9124,7 @@ async def remove_bitcoin_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "⚔️ Начислить авторитет")
+@router.text("⚔️ Начислить авторитет")
 async def add_authority_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7374,7 +9171,7 @@ async def add_authority_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "⚔️ Списать авторитет")
+@router.text("⚔️ Списать авторитет")
 async def remove_authority_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7421,7 +9218,7 @@ async def remove_authority_amount(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "👥 Найти пользователя")
+@router.text("👥 Найти пользователя")
 async def find_user_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7440,11 +9237,12 @@ async def find_user_result(message: types.Message, state: FSMContext):
     if not user_data:
         await message.answer("❌ Пользователь не найден.")
         return
+    user_data = counters.merge(user_data)
     uid = user_data['user_id']
     name = user_data['first_name']
-    bal = float(user_data['balance'])
+    bal = Cents(user_data['balance'] or 0)
     rep = user_data['reputation']
-    spent = float(user_data['total_spent'])
+    spent = Cents(user_data['total_spent'] or 0)
     joined = user_data['joined_date']
     attempts = user_data['theft_attempts']
     success = user_data['theft_success']
@@ -7455,7 +9253,7 @@ async def find_user_result(message: types.Message, state: FSMContext):
     strength = user_data['strength']
     agility = user_data['agility']
     defense = user_data['defense']
-    bitcoin = float(user_data['bitcoin_balance']) if user_data['bitcoin_balance'] is not None else 0.0
+    bitcoin = BtcUnits(user_data['bitcoin_balance'] or 0)
     authority = user_data['authority_balance'] or 0
     smuggle_success = user_data.get('smuggle_success', 0)
     smuggle_fail = user_data.get('smuggle_fail', 0)
@@ -7479,7 +9277,7 @@ async def find_user_result(message: types.Message, state: FSMContext):
     await message.answer(text)
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📊 Экспорт пользователей")
+@router.text("📊 Экспорт пользователей")
 async def export_users(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         return
@@ -7497,14 +9295,14 @@ async def export_users(message: types.Message):
         await message.answer("❌ Ошибка при экспорте.")
 
 # ==================== УПРАВЛЕНИЕ МАГАЗИНОМ ====================
-@dp.message_handler(lambda message: message.text == "🛒 Магазин")
+@router.text("🛒 Магазин")
 async def admin_shop_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление магазином:", media_key='admin_shop', reply_markup=admin_shop_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить товар")
+@router.text("➕ Добавить товар")
 async def add_shop_item_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -7533,6 +9331,7 @@ async def add_shop_item_description(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=AddShopItem.price)
 async def add_shop_item_price(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_shop_menu(message)
@@ -7542,7 +9341,7 @@ async def add_shop_item_price(message: types.Message, state: FSMContext):
         if price <= 0:
             raise ValueError
         price = round(price, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if price > max_input:
             await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
             return
@@ -7584,7 +9383,7 @@ async def add_shop_item_photo(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO shop_items (name, description, price, stock, photo_file_id) VALUES ($1, $2, $3, $4, $5)",
                 data['name'], data['description'], data['price'], data['stock'], photo_file_id
@@ -7595,12 +9394,12 @@ async def add_shop_item_photo(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка при добавлении товара.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "➖ Удалить товар")
+@router.text("➖ Удалить товар")
 async def remove_shop_item_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             items = await conn.fetch("SELECT id, name FROM shop_items ORDER BY id")
         if not items:
             await message.answer("В магазине нет товаров.")
@@ -7625,7 +9424,7 @@ async def remove_shop_item(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи число.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("DELETE FROM shop_items WHERE id=$1", item_id)
         await message.answer("✅ Товар удалён, если существовал.", reply_markup=admin_shop_keyboard())
     except Exception as e:
@@ -7633,7 +9432,7 @@ async def remove_shop_item(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "✏️ Редактировать товар")
+@router.text("✏️ Редактировать товар")
 async def edit_shop_item_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -7671,6 +9470,7 @@ async def edit_shop_item_value(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=EditShopItem.value)
 async def edit_shop_item_final(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_shop_menu(message)
@@ -7682,7 +9482,7 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
             if value <= 0:
                 raise ValueError
             value = round(value, 2)
-            max_input = await get_setting_float("max_input_number")
+            max_input = cfg.max_input_number
             if value > max_input:
                 await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
                 return
@@ -7694,7 +9494,7 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
     item_id = data['item_id']
     field = data['field']
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(f"UPDATE shop_items SET {field}=$1 WHERE id=$2", value, item_id)
         await message.answer("✅ Товар обновлён.", reply_markup=admin_shop_keyboard())
     except Exception as e:
@@ -7702,7 +9502,7 @@ async def edit_shop_item_final(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список товаров")
+@router.text("📋 Список товаров")
 async def list_shop_items(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -7715,7 +9515,7 @@ async def list_shop_items(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM shop_items")
             items = await conn.fetch(
                 "SELECT id, name, description, price, stock, photo_file_id FROM shop_items ORDER BY id LIMIT $1 OFFSET $2",
@@ -7743,19 +9543,19 @@ async def list_shop_items(message: types.Message):
         logging.error(f"List shop items error: {e}", exc_info=True)
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("shopitems_page_"))
+@router.callback(prefix="shopitems_page_")
 async def shopitems_page_callback(callback: types.CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     callback.message.text = f"📋 Список товаров {page}"
     await list_shop_items(callback.message)
 
-@dp.message_handler(lambda message: message.text == "🛍️ Список покупок")
+@router.text("🛍️ Список покупок")
 async def admin_purchases(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             rows = await conn.fetch(
                 "SELECT p.id, u.user_id, u.username, s.name, p.purchase_date, p.status FROM purchases p "
                 "JOIN users u ON p.user_id = u.user_id JOIN shop_items s ON p.item_id = s.id "
@@ -7772,7 +9572,7 @@ async def admin_purchases(message: types.Message):
         logging.error(f"Admin purchases error: {e}", exc_info=True)
         await message.answer("❌ Ошибка загрузки покупок.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("purchase_done_"))
+@router.callback(prefix="purchase_done_")
 async def purchase_done(callback: types.CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_shop"):
@@ -7780,7 +9580,7 @@ async def purchase_done(callback: types.CallbackQuery):
         return
     purchase_id = int(callback.data.split("_")[2])
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("UPDATE purchases SET status='completed' WHERE id=$1", purchase_id)
             user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
             if user_id:
@@ -7790,7 +9590,7 @@ async def purchase_done(callback: types.CallbackQuery):
         logging.error(f"Purchase done error: {e}", exc_info=True)
         await callback.message.answer("Ошибка")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("purchase_reject_"))
+@router.callback(prefix="purchase_reject_")
 async def purchase_reject(callback: types.CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_shop"):
@@ -7798,7 +9598,7 @@ async def purchase_reject(callback: types.CallbackQuery):
         return
     purchase_id = int(callback.data.split("_")[2])
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("UPDATE purchases SET status='rejected' WHERE id=$1", purchase_id)
             user_id = await conn.fetchval("SELECT user_id FROM purchases WHERE id=$1", purchase_id)
             if user_id:
@@ -7809,14 +9609,14 @@ async def purchase_reject(callback: types.CallbackQuery):
         await callback.message.answer("Ошибка")
 
 # ==================== УПРАВЛЕНИЕ КАНАЛАМИ ====================
-@dp.message_handler(lambda message: message.text == "📢 Каналы")
+@router.text("📢 Каналы")
 async def admin_channel_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление каналами:", media_key='admin_channels', reply_markup=admin_channel_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить канал")
+@router.text("➕ Добавить канал")
 async def add_channel_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         return
@@ -7852,11 +9652,12 @@ async def add_channel_link(message: types.Message, state: FSMContext):
     link = None if message.text.lower() == 'нет' else message.text.strip()
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO channels (chat_id, title, invite_link) VALUES ($1, $2, $3)",
                 data['chat_id'], data['title'], link
             )
+        await invalidate_channels_cache(data['chat_id'])
         await message.answer("✅ Канал добавлен!", reply_markup=admin_channel_keyboard())
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Канал с таким chat_id уже существует.")
@@ -7865,7 +9666,7 @@ async def add_channel_link(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "➖ Удалить канал")
+@router.text("➖ Удалить канал")
 async def remove_channel_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         return
@@ -7880,15 +9681,16 @@ async def remove_channel(message: types.Message, state: FSMContext):
         return
     chat_id = message.text.strip()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("DELETE FROM channels WHERE chat_id=$1", chat_id)
+        await invalidate_channels_cache(chat_id)
         await message.answer("✅ Канал удалён, если существовал.", reply_markup=admin_channel_keyboard())
     except Exception as e:
         logging.error(f"Remove channel error: {e}", exc_info=True)
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список каналов")
+@router.text("📋 Список каналов")
 async def list_channels(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         return
@@ -7902,14 +9704,14 @@ async def list_channels(message: types.Message):
     await message.answer(text, reply_markup=admin_channel_keyboard())
 
 # ==================== УПРАВЛЕНИЕ ПРОМОКОДАМИ ====================
-@dp.message_handler(lambda message: message.text == "🎫 Промокоды")
+@router.text("🎫 Промокоды")
 async def admin_promo_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_promocodes"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление промокодами:", media_key='admin_promo', reply_markup=admin_promo_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Создать промокод")
+@router.text("➕ Создать промокод")
 async def create_promo_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_promocodes"):
         return
@@ -7929,6 +9731,7 @@ async def create_promo_code(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=CreatePromocode.reward)
 async def create_promo_reward(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_promo_menu(message)
@@ -7938,7 +9741,7 @@ async def create_promo_reward(message: types.Message, state: FSMContext):
         if reward <= 0:
             raise ValueError
         reward = round(reward, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if reward > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
@@ -7964,10 +9767,10 @@ async def create_promo_max_uses(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO promocodes (code, reward, max_uses, created_at) VALUES ($1, $2, $3, $4)",
-                data['code'], data['reward'], max_uses, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                data['code'], data['reward'], max_uses, db_now()
             )
         await message.answer("✅ Промокод создан!", reply_markup=admin_promo_keyboard())
     except asyncpg.UniqueViolationError:
@@ -7977,7 +9780,7 @@ async def create_promo_max_uses(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список промокодов")
+@router.text("📋 Список промокодов")
 async def list_promos(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_promocodes"):
         return
@@ -7990,7 +9793,7 @@ async def list_promos(message: types.Message):
         pass
     offset = (page - 1) * ITEMS_PER_PAGE
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             total = await conn.fetchval("SELECT COUNT(*) FROM promocodes")
             rows = await conn.fetch(
                 "SELECT code, reward, max_uses, used_count FROM promocodes LIMIT $1 OFFSET $2",
@@ -8018,7 +9821,7 @@ async def list_promos(message: types.Message):
         logging.error(f"List promos error: {e}", exc_info=True)
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("promos_page_"))
+@router.callback(prefix="promos_page_")
 async def promos_page_callback(callback: types.CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
@@ -8026,14 +9829,14 @@ async def promos_page_callback(callback: types.CallbackQuery):
     await list_promos(callback.message)
 
 # ==================== УПРАВЛЕНИЕ ЗАДАНИЯМИ (АДМИНСКАЯ ЧАСТЬ) ====================
-@dp.message_handler(lambda message: message.text == "📋 Задания")
+@router.text("📋 Задания")
 async def admin_tasks_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_tasks"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление заданиями:", media_key='admin_tasks', reply_markup=admin_tasks_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Создать задание")
+@router.text("➕ Создать задание")
 async def create_task_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_tasks"):
         return
@@ -8086,6 +9889,7 @@ async def create_task_target(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=CreateTask.reward_coins)
 async def create_task_reward_coins(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_tasks_menu(message)
@@ -8095,7 +9899,7 @@ async def create_task_reward_coins(message: types.Message, state: FSMContext):
         if coins <= 0:
             raise ValueError
         coins = round(coins, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if coins > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
@@ -8172,10 +9976,10 @@ async def create_task_max_completions(message: types.Message, state: FSMContext)
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO tasks (name, description, task_type, target_id, reward_coins, reward_reputation, required_days, penalty_days, max_completions, created_by, created_at, active) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)",
-                data['name'], data['description'], data['task_type'], data['target_id'], data['reward_coins'], data['reward_reputation'], data['required_days'], data['penalty_days'], max_comp, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), True
+                data['name'], data['description'], data['task_type'], data['target_id'], data['reward_coins'], data['reward_reputation'], data['required_days'], data['penalty_days'], max_comp, message.from_user.id, db_now(), True
             )
         await message.answer("✅ Задание создано!", reply_markup=admin_tasks_keyboard())
     except Exception as e:
@@ -8183,11 +9987,11 @@ async def create_task_max_completions(message: types.Message, state: FSMContext)
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список заданий")
+@router.text("📋 Список заданий")
 async def list_tasks_admin(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_tasks"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT id, name, description, reward_coins, reward_reputation, active FROM tasks ORDER BY id")
     if not rows:
         await message.answer("Нет созданных заданий.")
@@ -8198,7 +10002,7 @@ async def list_tasks_admin(message: types.Message):
         text += f"{status} ID {row['id']}: {row['name']}\n{row['description']}\nНаграда: {float(row['reward_coins']):.2f} баксов, {row['reward_reputation']} репутации\n\n"
     await message.answer(text, reply_markup=admin_tasks_keyboard())
 
-@dp.message_handler(lambda message: message.text == "❌ Удалить задание")
+@router.text("❌ Удалить задание")
 async def delete_task_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_tasks"):
         return
@@ -8217,7 +10021,7 @@ async def delete_task_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Введи число.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("DELETE FROM tasks WHERE id=$1", task_id)
             await conn.execute("DELETE FROM user_tasks WHERE task_id=$1", task_id)
         await message.answer("✅ Задание удалено, если существовало.", reply_markup=admin_tasks_keyboard())
@@ -8227,14 +10031,14 @@ async def delete_task_finish(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ==================== УПРАВЛЕНИЕ БЛОКИРОВКАМИ ====================
-@dp.message_handler(lambda message: message.text == "🔨 Блокировки")
+@router.text("🔨 Блокировки")
 async def admin_ban_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bans"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление блокировками:", media_key='admin_ban', reply_markup=admin_ban_keyboard())
 
-@dp.message_handler(lambda message: message.text == "🔨 Заблокировать пользователя")
+@router.text("🔨 Заблокировать пользователя")
 async def block_user_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bans"):
         return
@@ -8270,11 +10074,12 @@ async def block_user_reason(message: types.Message, state: FSMContext):
     data = await state.get_data()
     uid = data['user_id']
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO banned_users (user_id, banned_by, banned_date, reason) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO NOTHING",
-                uid, message.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), reason
+                uid, message.from_user.id, db_now(), reason
             )
+        await notify_access_changed()
         await message.answer(f"✅ Пользователь {uid} заблокирован.")
         await safe_send_message(uid, f"⛔ Вы заблокированы в боте. Причина: {reason if reason else 'не указана'}")
     except Exception as e:
@@ -8282,7 +10087,7 @@ async def block_user_reason(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "🔓 Разблокировать пользователя")
+@router.text("🔓 Разблокировать пользователя")
 async def unblock_user_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bans"):
         return
@@ -8301,8 +10106,9 @@ async def unblock_user_finish(message: types.Message, state: FSMContext):
         return
     uid = user_data['user_id']
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("DELETE FROM banned_users WHERE user_id=$1", uid)
+        await notify_access_changed()
         await message.answer(f"✅ Пользователь {uid} разблокирован.")
         await safe_send_message(uid, "🔓 Вы разблокированы в боте.")
     except Exception as e:
@@ -8310,11 +10116,11 @@ async def unblock_user_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список заблокированных")
+@router.text("📋 Список заблокированных")
 async def list_banned(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bans"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT user_id, banned_date, reason FROM banned_users ORDER BY banned_date DESC")
     if not rows:
         await message.answer("Нет заблокированных пользователей.")
@@ -8325,14 +10131,14 @@ async def list_banned(message: types.Message):
     await message.answer(text)
 
 # ==================== УПРАВЛЕНИЕ АДМИНАМИ ====================
-@dp.message_handler(lambda message: message.text == "➕ Админы")
+@router.text("➕ Админы")
 async def admin_admins_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление админами:", media_key='admin_admins', reply_markup=admin_admins_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить админа")
+@router.text("➕ Добавить админа")
 async def add_admin_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -8378,11 +10184,12 @@ async def add_admin_done(callback: types.CallbackQuery, state: FSMContext):
     uid = data['user_id']
     perms = data.get('selected_perms', [])
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO admins (user_id, added_by, added_date, permissions) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO UPDATE SET permissions=$4",
-                uid, callback.from_user.id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), json.dumps(perms)
+                uid, callback.from_user.id, db_now(), json.dumps(perms)
             )
+        await notify_access_changed()
         await callback.message.edit_text(f"✅ Пользователь {uid} теперь младший админ с правами: {', '.join(perms) if perms else 'нет прав'}.")
         await safe_send_message(uid, f"🔔 Вам назначены права администратора!\nВаши права: {', '.join(perms) if perms else 'нет прав'}.\nПожалуйста, нажмите /start для обновления меню.")
     except Exception as e:
@@ -8390,7 +10197,7 @@ async def add_admin_done(callback: types.CallbackQuery, state: FSMContext):
         await callback.message.edit_text("❌ Ошибка при добавлении админа.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "✏️ Редактировать права админа")
+@router.text("✏️ Редактировать права админа")
 async def edit_admin_permissions_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -8450,7 +10257,7 @@ async def edit_admin_save(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(f"✅ Права пользователя {uid} обновлены: {', '.join(selected)}")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "➖ Удалить админа")
+@router.text("➖ Удалить админа")
 async def remove_admin_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -8473,8 +10280,9 @@ async def remove_admin_finish(message: types.Message, state: FSMContext):
         await state.finish()
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("DELETE FROM admins WHERE user_id=$1", uid)
+        await notify_access_changed()
         await message.answer(f"✅ Пользователь {uid} больше не админ, если был им.")
         await safe_send_message(uid, "🔔 Ваши права администратора были отозваны.")
     except Exception as e:
@@ -8482,11 +10290,11 @@ async def remove_admin_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список админов")
+@router.text("📋 Список админов")
 async def list_admins(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT user_id, added_date, permissions FROM admins ORDER BY added_date")
     if not rows:
         await message.answer("Нет младших админов.")
@@ -8499,14 +10307,14 @@ async def list_admins(message: types.Message):
     await message.answer(text)
 
 # ==================== УПРАВЛЕНИЕ ЧАТАМИ ====================
-@dp.message_handler(lambda message: message.text == "🤖 Чаты")
+@router.text("🤖 Чаты")
 async def admin_chats_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление чатами:", media_key='admin_chats', reply_markup=admin_chats_keyboard())
 
-@dp.message_handler(lambda message: message.text == "📋 Список запросов на подтверждение")
+@router.text("📋 Список запросов на подтверждение")
 async def list_pending_requests(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -8519,7 +10327,7 @@ async def list_pending_requests(message: types.Message):
         text += f"• {req['title']} (ID: {req['chat_id']})\n  Запросил: {req['requested_by']} ({req['request_date']})\n"
     await message.answer(text)
 
-@dp.message_handler(lambda message: message.text == "✅ Подтвердить чат")
+@router.text("✅ Подтвердить чат")
 async def confirm_chat_manual(message: types.Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -8527,7 +10335,7 @@ async def confirm_chat_manual(message: types.Message, state: FSMContext):
     await ManageChats.chat_id.set()
     await state.update_data(action="confirm")
 
-@dp.message_handler(lambda message: message.text == "❌ Отклонить запрос")
+@router.text("❌ Отклонить запрос")
 async def reject_chat_manual(message: types.Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -8535,7 +10343,7 @@ async def reject_chat_manual(message: types.Message, state: FSMContext):
     await ManageChats.chat_id.set()
     await state.update_data(action="reject")
 
-@dp.message_handler(lambda message: message.text == "🗑 Удалить чат из подтверждённых")
+@router.text("🗑 Удалить чат из подтверждённых")
 async def remove_confirmed_chat_start(message: types.Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -8543,7 +10351,7 @@ async def remove_confirmed_chat_start(message: types.Message, state: FSMContext)
     await ManageChats.chat_id.set()
     await state.update_data(action="remove")
 
-@dp.message_handler(lambda message: message.text == "📋 Список подтверждённых чатов")
+@router.text("📋 Список подтверждённых чатов")
 async def list_confirmed_chats(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -8569,7 +10377,7 @@ async def process_chat_id(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     action = data.get('action')
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         if action == "confirm":
             request = await conn.fetchrow("SELECT * FROM chat_confirmation_requests WHERE chat_id=$1", chat_id)
             if request:
@@ -8599,18 +10407,18 @@ async def process_chat_id(message: types.Message, state: FSMContext):
     await state.finish()
 
 # ==================== УПРАВЛЕНИЕ БОССАМИ ====================
-@dp.message_handler(lambda message: message.text == "👾 Боссы")
+@router.text("👾 Боссы")
 async def admin_boss_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bosses"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление боссами:", media_key='admin_boss', reply_markup=admin_boss_keyboard())
 
-@dp.message_handler(lambda message: message.text == "📋 Активные боссы")
+@router.text("📋 Активные боссы")
 async def list_active_bosses(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bosses"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT * FROM bosses WHERE status='active' ORDER BY spawned_at")
     if not rows:
         await message.answer("Нет активных боссов.")
@@ -8622,14 +10430,14 @@ async def list_active_bosses(message: types.Message):
         kb.add(InlineKeyboardButton(f"❌ Удалить босса ID {row['id']}", callback_data=f"delete_boss_{row['id']}"))
     await message.answer(text, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("delete_boss_"))
+@router.callback(prefix="delete_boss_")
 async def delete_boss_callback(callback: types.CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_bosses"):
         await callback.message.answer("❌ Недостаточно прав")
         return
     boss_id = int(callback.data.split("_")[2])
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         boss = await conn.fetchrow("SELECT * FROM bosses WHERE id=$1", boss_id)
         if not boss:
             await callback.message.answer("❌ Босс не найден")
@@ -8639,7 +10447,7 @@ async def delete_boss_callback(callback: types.CallbackQuery):
     await callback.message.answer(f"✅ Босс {boss['name']} полностью удалён")
     await callback.message.delete()
 
-@dp.message_handler(lambda message: message.text == "⚔️ Создать босса вручную")
+@router.text("⚔️ Создать босса вручную")
 async def manual_spawn_boss_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bosses"):
         return
@@ -8704,7 +10512,7 @@ async def manual_spawn_boss_image(message: types.Message, state: FSMContext):
     await message.answer(f"✅ Босс {level} уровня создан в чате {chat_id}.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "❌ Удалить босса (по ID)")
+@router.text("❌ Удалить босса (по ID)")
 async def delete_boss_by_id_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_bosses"):
         return
@@ -8735,7 +10543,7 @@ async def delete_boss_by_id_final(message: types.Message, state: FSMContext):
     if message.text.lower() == 'да':
         data = await state.get_data()
         boss_id = data['boss_id']
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             boss = await conn.fetchrow("SELECT * FROM bosses WHERE id=$1", boss_id)
             if not boss:
                 await message.answer("❌ Босс с таким ID не найден.")
@@ -8750,14 +10558,14 @@ async def delete_boss_by_id_final(message: types.Message, state: FSMContext):
         await message.answer("Введи 'да' или 'нет'.")
 
 # ==================== УПРАВЛЕНИЕ АУКЦИОНАМИ (админские функции) ====================
-@dp.message_handler(lambda message: message.text == "🏷 Аукцион")
+@router.text("🏷 Аукцион")
 async def admin_auction_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_auctions"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление аукционами:", media_key='admin_auction', reply_markup=admin_auction_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Создать аукцион")
+@router.text("➕ Создать аукцион")
 async def create_auction_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_auctions"):
         return
@@ -8786,6 +10594,7 @@ async def create_auction_description(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=CreateAuction.start_price)
 async def create_auction_start_price(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_auction_menu(message)
@@ -8795,7 +10604,7 @@ async def create_auction_start_price(message: types.Message, state: FSMContext):
         if price <= 0:
             raise ValueError
         price = round(price, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if price > max_input:
             await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
             return
@@ -8829,6 +10638,7 @@ async def create_auction_end_time(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=CreateAuction.target_price)
 async def create_auction_target_price(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_auction_menu(message)
@@ -8841,7 +10651,7 @@ async def create_auction_target_price(message: types.Message, state: FSMContext)
             if target_price <= 0:
                 raise ValueError
             target_price = round(target_price, 2)
-            max_input = await get_setting_float("max_input_number")
+            max_input = cfg.max_input_number
             if target_price > max_input:
                 await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
                 return
@@ -8868,22 +10678,24 @@ async def create_auction_photo(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO auctions (item_name, description, start_price, current_price, end_time, target_price, created_by, photo_file_id) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+        async with db_conn() as conn:
+            auction_id = await conn.fetchval(
+                "INSERT INTO auctions (item_name, description, start_price, current_price, end_time, target_price, created_by, photo_file_id) VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id",
                 data['item_name'], data['description'], data['start_price'], data['start_price'], data['end_time'], data['target_price'], message.from_user.id, photo_file_id
             )
+        if data['end_time']:
+            deadlines.schedule('auction', auction_id, data['end_time'])
         await message.answer("✅ Аукцион создан!", reply_markup=admin_auction_keyboard())
     except Exception as e:
         logging.error(f"Create auction error: {e}", exc_info=True)
         await message.answer("❌ Ошибка при создании аукциона.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Активные аукционы")
+@router.text("📋 Активные аукционы")
 async def list_active_auctions(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_auctions"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT * FROM auctions WHERE status='active' ORDER BY created_at")
     if not rows:
         await message.answer("Нет активных аукционов.")
@@ -8893,7 +10705,7 @@ async def list_active_auctions(message: types.Message):
         text += f"ID {row['id']}: {row['item_name']} | Текущая цена: {float(row['current_price']):.2f} | Создатель: {row['created_by']}\n"
     await message.answer(text)
 
-@dp.message_handler(lambda message: message.text == "❌ Отменить аукцион")
+@router.text("❌ Отменить аукцион")
 async def cancel_auction_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_auctions"):
         return
@@ -8911,25 +10723,26 @@ async def cancel_auction_finish(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         exists = await conn.fetchval("SELECT 1 FROM auctions WHERE id=$1", auction_id)
         if not exists:
             await message.answer("❌ Аукцион с таким ID не найден.")
             await state.finish()
             return
         await conn.execute("UPDATE auctions SET status='cancelled' WHERE id=$1", auction_id)
+    deadlines.cancel('auction', auction_id)
     await message.answer(f"✅ Аукцион {auction_id} отменён.")
     await state.finish()
 
 # ==================== УПРАВЛЕНИЕ РЕКЛАМОЙ ====================
-@dp.message_handler(lambda message: message.text == "📢 Реклама")
+@router.text("📢 Реклама")
 async def admin_ad_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_ads"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление рекламой:", media_key='admin_ad', reply_markup=admin_ad_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Создать рекламу")
+@router.text("➕ Создать рекламу")
 async def create_ad_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_ads"):
         return
@@ -8975,22 +10788,24 @@ async def create_ad_target(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO ads (text, interval_minutes, target, last_sent, enabled) VALUES ($1, $2, $3, $4, $5)",
-                data['text'], data['interval'], target, datetime.now(), True
+        now = datetime.now()
+        async with db_conn() as conn:
+            ad_id = await conn.fetchval(
+                "INSERT INTO ads (text, interval_minutes, target, last_sent, enabled) VALUES ($1, $2, $3, $4, $5) RETURNING id",
+                data['text'], data['interval'], target, now, True
             )
+        deadlines.schedule('ad', ad_id, now + timedelta(minutes=data['interval']))
         await message.answer("✅ Рекламное объявление создано!", reply_markup=admin_ad_keyboard())
     except Exception as e:
         logging.error(f"Create ad error: {e}", exc_info=True)
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список рекламы")
+@router.text("📋 Список рекламы")
 async def list_ads(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_ads"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT id, text, interval_minutes, enabled FROM ads ORDER BY id")
     if not rows:
         await message.answer("Нет рекламных объявлений.")
@@ -9001,7 +10816,7 @@ async def list_ads(message: types.Message):
         text += f"{status} ID {row['id']}: {row['text'][:50]}... (интервал {row['interval_minutes']} мин)\n"
     await message.answer(text)
 
-@dp.message_handler(lambda message: message.text == "✏️ Редактировать рекламу")
+@router.text("✏️ Редактировать рекламу")
 async def edit_ad_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_ads"):
         return
@@ -9019,7 +10834,7 @@ async def edit_ad_id(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         ad = await conn.fetchrow("SELECT * FROM ads WHERE id=$1", ad_id)
         if not ad:
             await message.answer("❌ Реклама не найдена.")
@@ -9073,15 +10888,17 @@ async def edit_ad_value(message: types.Message, state: FSMContext):
         val = message.text
 
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(f"UPDATE ads SET {field}=$1 WHERE id=$2", val, ad_id)
+        # обработчик сам сверит last_sent с новым интервалом и перенесёт таймер
+        deadlines.schedule('ad', ad_id, datetime.now())
         await message.answer("✅ Реклама обновлена.", reply_markup=admin_ad_keyboard())
     except Exception as e:
         logging.error(f"Edit ad error: {e}", exc_info=True)
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "❌ Удалить рекламу")
+@router.text("❌ Удалить рекламу")
 async def delete_ad_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_ads"):
         return
@@ -9099,20 +10916,21 @@ async def delete_ad_finish(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         await conn.execute("DELETE FROM ads WHERE id=$1", ad_id)
+    deadlines.cancel('ad', ad_id)
     await message.answer("✅ Реклама удалена, если существовала.", reply_markup=admin_ad_keyboard())
     await state.finish()
 
 # ==================== УПРАВЛЕНИЕ БИРЖЕЙ ====================
-@dp.message_handler(lambda message: message.text == "💼 Биржа")
+@router.text("💼 Биржа")
 async def admin_exchange_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление биткоин-биржей:", media_key='admin_exchange', reply_markup=admin_exchange_keyboard())
 
-@dp.message_handler(lambda message: message.text == "📋 Активные заявки")
+@router.text("📋 Активные заявки")
 async def admin_list_orders(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         return
@@ -9125,7 +10943,7 @@ async def admin_list_orders(message: types.Message):
         text += f"ID {o['id']}: {'📈' if o['type']=='buy' else '📉'} {o['amount']:.4f} BTC @ {o['price']} $ (пользователь {o['user_id']})\n"
     await message.answer(text, reply_markup=admin_exchange_keyboard())
 
-@dp.message_handler(lambda message: message.text == "❌ Удалить заявку (по ID)")
+@router.text("❌ Удалить заявку (по ID)")
 async def admin_remove_order_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         return
@@ -9143,45 +10961,36 @@ async def admin_remove_order_finish(message: types.Message, state: FSMContext):
     except:
         await message.answer("❌ Введи число.")
         return
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active'", order_id)
-            if not order:
-                await message.answer("❌ Заявка не найдена или уже не активна.")
-                await state.finish()
-                return
-            total_locked = float(order['total_locked'])
-            if order['type'] == 'sell':
-                await update_user_bitcoin(order['user_id'], total_locked, conn=conn)
-            else:
-                await update_user_balance(order['user_id'], total_locked, conn=conn)
-            await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE id=$1", order_id)
+    if not await cancel_bitcoin_order(order_id):
+        await message.answer("❌ Заявка не найдена или уже не активна.")
+        await state.finish()
+        return
     await message.answer(f"✅ Заявка {order_id} отменена, средства возвращены пользователю.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📊 История сделок")
+@router.text("📊 История сделок")
 async def admin_trade_history(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT * FROM bitcoin_trades ORDER BY traded_at DESC LIMIT 50")
     if not rows:
         await message.answer("Нет сделок.")
         return
-    text = "📊 Последние сделки:\n\n"
+    text = f"{ticker_text()}\n\n📊 Последние сделки:\n\n"
     for r in rows:
         text += f"ID {r['id']}: {float(r['amount']):.4f} BTC @ {r['price']} $ (покупатель {r['buyer_id']}, продавец {r['seller_id']}) в {r['traded_at'].strftime('%Y-%m-%d %H:%M')}\n"
     await message.answer(text, reply_markup=admin_exchange_keyboard())
 
 # ==================== УПРАВЛЕНИЕ БИЗНЕСАМИ ====================
-@dp.message_handler(lambda message: message.text == "🏪 Бизнесы")
+@router.text("🏪 Бизнесы")
 async def admin_business_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление бизнесами:", media_key='admin_business', reply_markup=admin_business_keyboard())
 
-@dp.message_handler(lambda message: message.text == "📋 Список бизнесов")
+@router.text("📋 Список бизнесов")
 async def admin_list_businesses(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9198,7 +11007,7 @@ async def admin_list_businesses(message: types.Message):
         text += f"  Макс. уровень: {bt['max_level']}\n\n"
     await message.answer(text, reply_markup=admin_business_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить бизнес")
+@router.text("➕ Добавить бизнес")
 async def add_business_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9227,6 +11036,7 @@ async def add_business_emoji(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=AddBusiness.price)
 async def add_business_price(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_business_menu(message)
@@ -9236,7 +11046,7 @@ async def add_business_price(message: types.Message, state: FSMContext):
         if price <= 0:
             raise ValueError
         price = round(price, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = cfg.max_input_number
         if price > max_input:
             await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
             return
@@ -9289,7 +11099,7 @@ async def add_business_max_level(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO business_types (name, emoji, base_price_btc, base_income_cents, description, max_level, available) VALUES ($1, $2, $3, $4, $5, $6, $7)",
                 data['name'], data['emoji'], data['price'], data['income'], data['description'], max_level, True
@@ -9302,7 +11112,7 @@ async def add_business_max_level(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка при добавлении бизнеса.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "✏️ Редактировать бизнес")
+@router.text("✏️ Редактировать бизнес")
 async def edit_business_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9354,6 +11164,7 @@ async def edit_business_field(message: types.Message, state: FSMContext):
 
 @dp.message_handler(state=EditBusiness.value)
 async def edit_business_value(message: types.Message, state: FSMContext):
+    cfg = await get_settings_snapshot()
     if message.text == "◀️ Назад":
         await state.finish()
         await admin_business_menu(message)
@@ -9370,7 +11181,7 @@ async def edit_business_value(message: types.Message, state: FSMContext):
             if val <= 0:
                 raise ValueError
             val = round(val, 2)
-            max_input = await get_setting_float("max_input_number")
+            max_input = cfg.max_input_number
             if val > max_input:
                 await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
                 return
@@ -9389,7 +11200,7 @@ async def edit_business_value(message: types.Message, state: FSMContext):
         val = message.text
 
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             column_map = {
                 'name': 'name',
                 'emoji': 'emoji',
@@ -9407,7 +11218,7 @@ async def edit_business_value(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка при обновлении.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "🔄 Переключить доступность")
+@router.text("🔄 Переключить доступность")
 async def toggle_business_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9447,7 +11258,7 @@ async def toggle_business_finish(message: types.Message, state: FSMContext):
         bid = data['business_id']
         new_status = data['new_status']
         try:
-            async with db_pool.acquire() as conn:
+            async with db_conn() as conn:
                 await conn.execute("UPDATE business_types SET available=$1 WHERE id=$2", new_status, bid)
             await message.answer(f"✅ Доступность бизнеса изменена на {'✅ доступен' if new_status else '❌ недоступен'}.", reply_markup=admin_business_keyboard())
         except Exception as e:
@@ -9458,14 +11269,14 @@ async def toggle_business_finish(message: types.Message, state: FSMContext):
         await message.answer("Введи 'да' или 'нет'.")
 
 # ==================== УПРАВЛЕНИЕ МЕДИА ====================
-@dp.message_handler(lambda message: message.text == "🖼 Медиа")
+@router.text("🖼 Медиа")
 async def admin_media_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление медиафайлами:", media_key='admin_media', reply_markup=admin_media_keyboard())
 
-@dp.message_handler(lambda message: message.text == "➕ Добавить медиа")
+@router.text("➕ Добавить медиа")
 async def add_media_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
@@ -9502,7 +11313,7 @@ async def add_media_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
     key = data['key']
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute(
                 "INSERT INTO media (key, file_id, description) VALUES ($1, $2, $3) ON CONFLICT (key) DO UPDATE SET file_id=$2",
                 key, file_id, f"Медиа для {key}"
@@ -9514,7 +11325,7 @@ async def add_media_file(message: types.Message, state: FSMContext):
     await state.finish()
     await admin_media_menu(message)
 
-@dp.message_handler(lambda message: message.text == "➖ Удалить медиа")
+@router.text("➖ Удалить медиа")
 async def remove_media_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
@@ -9529,7 +11340,7 @@ async def remove_media_finish(message: types.Message, state: FSMContext):
         return
     key = message.text.strip()
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             await conn.execute("DELETE FROM media WHERE key=$1", key)
         await message.answer(f"✅ Медиа с ключом '{key}' удалено, если существовало.")
     except Exception as e:
@@ -9537,11 +11348,11 @@ async def remove_media_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.finish()
 
-@dp.message_handler(lambda message: message.text == "📋 Список медиа")
+@router.text("📋 Список медиа")
 async def list_media(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
-    async with db_pool.acquire() as conn:
+    async with db_conn() as conn:
         rows = await conn.fetch("SELECT key, description FROM media ORDER BY key")
     if not rows:
         await message.answer("Нет сохранённых медиа.")
@@ -9553,7 +11364,7 @@ async def list_media(message: types.Message):
 
 # ==================== НАСТРОЙКИ ИГРЫ ====================
 
-@dp.message_handler(lambda message: message.text == "⚙️ Настройки")
+@router.text("⚙️ Настройки")
 async def settings_menu(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "edit_settings"):
         await message.answer("❌ Недостаточно прав.")
@@ -9579,14 +11390,14 @@ async def settings_category_handler(message: types.Message):
     kb = settings_param_keyboard(kb_params, category)
     await message.answer(text, reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("settings_back_"))
+@router.callback(prefix="settings_back_")
 async def settings_back_callback(callback: types.CallbackQuery):
     await callback.answer()
     category = callback.data.split("_", 2)[2]
     await callback.message.delete()
     await settings_menu(callback.message)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit_"))
+@router.callback(prefix="edit_")
 async def edit_setting_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "edit_settings"):
@@ -9619,6 +11430,9 @@ async def edit_setting_value(message: types.Message, state: FSMContext):
     try:
         await set_setting(key, new_value)
         await message.answer(f"✅ Настройка <b>{key}</b> обновлена!\nНовое значение: <code>{new_value}</code>")
+    except ValueError as e:
+        await message.answer(f"❌ Неверное значение: {e}. Настройка не изменена.")
+        return
     except Exception as e:
         logging.error(f"Error setting {key}: {e}", exc_info=True)
         await message.answer("❌ Ошибка при сохранении настройки.")
@@ -9627,23 +11441,23 @@ async def edit_setting_value(message: types.Message, state: FSMContext):
     await settings_menu(message)
 
 # ==================== СТАТИСТИКА ====================
-@dp.message_handler(lambda message: message.text == "📊 Статистика")
+@router.text("📊 Статистика")
 async def stats_handler(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "view_stats"):
         await message.answer("❌ Недостаточно прав.")
         return
     try:
-        async with db_pool.acquire() as conn:
+        async with db_conn() as conn:
             users = await conn.fetchval("SELECT COUNT(*) FROM users")
-            total_balance = await conn.fetchval("SELECT SUM(balance) FROM users") or 0.0
-            total_reputation = await conn.fetchval("SELECT SUM(reputation) FROM users") or 0
-            total_spent = await conn.fetchval("SELECT SUM(total_spent) FROM users") or 0.0
-            total_bitcoin = await conn.fetchval("SELECT SUM(bitcoin_balance) FROM users") or 0.0
+            total_balance = Cents(await conn.fetchval("SELECT COALESCE(SUM(balance), 0)::bigint FROM user_wallet"))
+            total_reputation = await conn.fetchval("SELECT SUM(reputation) FROM user_progress") or 0
+            total_spent = Cents(await conn.fetchval("SELECT COALESCE(SUM(total_spent), 0)::bigint FROM user_wallet"))
+            total_bitcoin = BtcUnits(await conn.fetchval("SELECT COALESCE(SUM(bitcoin_balance), 0)::bigint FROM user_wallet"))
             active_giveaways = await conn.fetchval("SELECT COUNT(*) FROM giveaways WHERE status='active'") or 0
             shop_items = await conn.fetchval("SELECT COUNT(*) FROM shop_items") or 0
             purchases_pending = await conn.fetchval("SELECT COUNT(*) FROM purchases WHERE status='pending'") or 0
-            total_thefts = await conn.fetchval("SELECT SUM(theft_attempts) FROM users") or 0
-            total_thefts_success = await conn.fetchval("SELECT SUM(theft_success) FROM users") or 0
+            total_thefts = await conn.fetchval("SELECT SUM(theft_attempts) FROM user_game_stats") or 0
+            total_thefts_success = await conn.fetchval("SELECT SUM(theft_success) FROM user_game_stats") or 0
             promos = await conn.fetchval("SELECT COUNT(*) FROM promocodes") or 0
             banned = await conn.fetchval("SELECT COUNT(*) FROM banned_users") or 0
             total_bosses = await conn.fetchval("SELECT COUNT(*) FROM bosses") or 0
@@ -9654,10 +11468,10 @@ async def stats_handler(message: types.Message):
         text = (
             f"📊 <b>Статистика:</b>\n"
             f"👥 Пользователей: {users}\n"
-            f"💰 Всего баксов: {float(total_balance):.2f}\n"
-            f"₿ Всего биткоинов: {float(total_bitcoin):.4f}\n"
+            f"💰 Всего баксов: {total_balance}\n"
+            f"₿ Всего биткоинов: {total_bitcoin}\n"
             f"⭐️ Всего репутации: {total_reputation}\n"
-            f"💸 Всего потрачено: {float(total_spent):.2f}\n"
+            f"💸 Всего потрачено: {total_spent}\n"
             f"🎁 Активных розыгрышей: {active_giveaways}\n"
             f"🛒 Товаров в магазине: {shop_items}\n"
             f"🛍️ Ожидающих покупок: {purchases_pending}\n"
@@ -9676,7 +11490,7 @@ async def stats_handler(message: types.Message):
         await message.answer("❌ Ошибка получения статистики.")
 
 # ==================== РАССЫЛКА ====================
-@dp.message_handler(lambda message: message.text == "📢 Рассылка")
+@router.text("📢 Рассылка")
 async def broadcast_start(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "broadcast"):
         await message.answer("❌ Недостаточно прав.")
@@ -9715,62 +11529,114 @@ async def broadcast_media(message: types.Message, state: FSMContext):
     await state.finish()
 
     status_msg = await message.answer("⏳ Рассылка начата... Это может занять некоторое время.")
+    async with db_conn() as conn:
+        job_id = await conn.fetchval(
+            "INSERT INTO broadcast_jobs (created_by, created_at, content, status, status_chat_id, status_message_id) "
+            "VALUES ($1, $2, $3, 'running', $4, $5) RETURNING id",
+            message.from_user.id, db_now(), json.dumps(content),
+            status_msg.chat.id, status_msg.message_id
+        )
+    asyncio.create_task(run_broadcast_job(job_id))
+
+# ----- Задания рассылки -----
+# Получатели перебираются курсором по users.user_id, после каждой страницы позиция сохраняется
+# в broadcast_jobs. После перезапуска задание продолжается с последней сохранённой позиции
+# (получатели недосланной страницы могут получить сообщение повторно).
+BROADCAST_RECIPIENTS_SQL = (
+    "FROM users u WHERE NOT u.bot_blocked "
+    "AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)"
+)
 
-    async with db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        users = [r['user_id'] for r in users]
-
-    sent = 0
-    failed = 0
-    total = len(users)
+def broadcast_status_text(job) -> str:
+    return (f"⏳ Прогресс: {job['sent'] + job['failed'] + job['blocked']}/{job['total']}\n"
+            f"✅ Отправлено: {job['sent']}\n❌ Ошибок: {job['failed']}\n🚫 Заблокировали бота: {job['blocked']}")
 
-    for i, uid in enumerate(users):
-        if await is_banned(uid):
-            continue
-        try:
-            if content['type'] == 'text':
-                await bot.send_message(uid, content['text'])
-            elif content['type'] == 'photo':
-                await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'video':
-                await bot.send_video(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'document':
-                await bot.send_document(uid, content['file_id'], caption=content['caption'])
-            sent += 1
-        except (BotBlocked, UserDeactivated, ChatNotFound):
-            failed += 1
-        except RetryAfter as e:
-            logging.warning(f"Flood limit, waiting {e.timeout} seconds")
-            await asyncio.sleep(e.timeout)
-            try:
-                if content['type'] == 'text':
-                    await bot.send_message(uid, content['text'])
-                else:
-                    if content['type'] == 'photo':
-                        await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'video':
-                        await bot.send_video(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'document':
-                        await bot.send_document(uid, content['file_id'], caption=content['caption'])
-                sent += 1
-            except:
-                failed += 1
-        except Exception as e:
-            failed += 1
-            logging.warning(f"Failed to send to {uid}: {e}")
+async def edit_broadcast_status(job, text: str):
+    if not job['status_chat_id']:
+        return
+    try:
+        await bot.edit_message_text(text, job['status_chat_id'], job['status_message_id'])
+    except Exception:
+        pass
 
-        if (i + 1) % 10 == 0:
-            try:
-                await status_msg.edit_text(f"⏳ Прогресс: {i+1}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
-            except:
-                pass
+def submit_broadcast_message(uid: int, content: dict):
+    if content['type'] == 'text':
+        return outbound.submit(uid, 'send_message', content['text'], priority=PRIORITY_BULK, wait=True)
+    return outbound.submit(uid, f"send_{content['type']}", content['file_id'],
+                           caption=content['caption'], priority=PRIORITY_BULK, wait=True)
 
-        await asyncio.sleep(0.05)
+async def run_broadcast_job(job_id: int):
+    try:
+        async with db_conn() as conn:
+            job = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id=$1", job_id)
+            if not job or job['status'] != 'running':
+                return
+            if not job['total']:
+                total = await conn.fetchval(f"SELECT COUNT(*) {BROADCAST_RECIPIENTS_SQL}")
+                job = await conn.fetchrow("UPDATE broadcast_jobs SET total=$1 WHERE id=$2 RETURNING *", total, job_id)
+        content = json.loads(job['content'])
+        last_edit = time.monotonic()
+
+        while True:
+            async with db_conn() as conn:
+                page = await conn.fetch(
+                    f"SELECT u.user_id {BROADCAST_RECIPIENTS_SQL} AND u.user_id > $1 ORDER BY u.user_id LIMIT $2",
+                    job['last_user_id'], BROADCAST_PAGE_SIZE
+                )
+            if not page:
+                break
+            uids = [r['user_id'] for r in page]
+            # страница уходит в планировщик целиком, темп отправки держат его лимиты
+            results = await asyncio.gather(*[submit_broadcast_message(uid, content) for uid in uids],
+                                           return_exceptions=True)
+            sent = failed = 0
+            blocked = []
+            for uid, result in zip(uids, results):
+                if not isinstance(result, Exception):
+                    sent += 1
+                elif isinstance(result, (BotBlocked, UserDeactivated, ChatNotFound)):
+                    blocked.append(uid)
+                else:
+                    failed += 1
+                    logging.warning(f"Broadcast {job_id}: failed to send to {uid}: {result}")
+
+            async with db_transaction() as conn:
+                if blocked:
+                    await conn.execute("UPDATE users SET bot_blocked=TRUE WHERE user_id = ANY($1::bigint[])", blocked)
+                job = await conn.fetchrow(
+                    "UPDATE broadcast_jobs SET last_user_id=$1, sent=sent+$2, failed=failed+$3, blocked=blocked+$4 "
+                    "WHERE id=$5 RETURNING *",
+                    uids[-1], sent, failed, len(blocked), job_id
+                )
+            if job['status'] != 'running':
+                return
+            if time.monotonic() - last_edit >= BROADCAST_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                await edit_broadcast_status(job, broadcast_status_text(job))
+
+        async with db_conn() as conn:
+            job = await conn.fetchrow(
+                "UPDATE broadcast_jobs SET status='done', finished_at=$1 WHERE id=$2 RETURNING *",
+                db_now(), job_id
+            )
+        await edit_broadcast_status(job, (
+            f"✅ Рассылка завершена!\n📊 Отправлено: {job['sent']}\n❌ Ошибок: {job['failed']}\n"
+            f"🚫 Заблокировали бота: {job['blocked']}\n👥 Всего: {job['total']}"
+        ))
+        logging.info(f"Broadcast {job_id} finished: sent {job['sent']}, failed {job['failed']}, blocked {job['blocked']}")
+    except Exception as e:
+        logging.error(f"Error in broadcast job {job_id}: {e}", exc_info=True)
 
-    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {total}")
+async def resume_broadcast_jobs():
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")
+    for row in rows:
+        logging.info(f"Resuming broadcast job {row['id']}")
+        asyncio.create_task(run_broadcast_job(row['id']))
 
 # ==================== ОЧИСТКА СТАРЫХ ЗАПИСЕЙ ====================
-@dp.message_handler(lambda message: message.text == "🧹 Очистка")
+@router.text("🧹 Очистка")
 async def cleanup_old_data(message: types.Message):
     if not await check_admin_permissions(message.from_user.id, "cleanup"):
         return
@@ -9789,325 +11655,463 @@ async def admin_giveaway_menu(message: types.Message):
 # ==================== КОНЕЦ ЧАСТИ 8 ====================
 # ==================== ЧАСТЬ 9: ФОНОВЫЕ ЗАДАЧИ И ЗАПУСК БОТА ====================
 
-# ==================== ФОНОВАЯ ЗАДАЧА: ОБРАБОТКА КОНТРАБАНДНЫХ РЕЙСОВ ====================
-async def process_smuggle_runs():
-    while True:
-        try:
-            await asyncio.sleep(30)
-            now = datetime.now()
-            async with db_pool.acquire() as conn:
-                runs = await conn.fetch("""
-                    SELECT * FROM smuggle_runs
-                    WHERE status = 'in_progress' AND end_time::timestamp <= $1 AND notified = FALSE
-                """, now)
-
-                for run in runs:
-                    try:
-                        user_id = run['user_id']
-                        chat_id = run['chat_id']
-
-                        rep = await get_user_reputation(user_id)
-
-                        success_chance = await get_setting_float("smuggle_success_chance")
-                        caught_chance = await get_setting_float("smuggle_caught_chance")
-                        lost_chance = await get_setting_float("smuggle_lost_chance")
-
-                        rep_success_bonus = float(await get_setting_float("reputation_smuggle_success_bonus")) * rep
-                        max_bonus = await get_setting_float("reputation_max_bonus_percent")
-                        rep_success_bonus = min(rep_success_bonus, max_bonus)
-                        
-                        total_success_chance = min(success_chance + rep_success_bonus, 100)
-                        remaining = 100 - total_success_chance
-                        if remaining < 0:
-                            remaining = 0
-                        
-                        total_base_catch_lost = caught_chance + lost_chance
-                        if total_base_catch_lost > 0:
-                            adjusted_caught = int(remaining * caught_chance / total_base_catch_lost)
-                            adjusted_lost = remaining - adjusted_caught
-                        else:
-                            adjusted_caught = 0
-                            adjusted_lost = 0
-
-                        rand = random.randint(1, 100)
-                        result_text = ""
-                        status = ""
-                        amount = 0.0
-                        penalty = 0
-
-                        if rand <= total_success_chance:
-                            base_amount = await get_setting_float("smuggle_base_amount")
-                            rep_bonus = float(await get_setting_float("reputation_smuggle_bonus")) * rep
-                            amount = base_amount + rep_bonus
-                            await update_user_bitcoin(user_id, amount, conn=conn)
-                            await conn.execute(
-                                "UPDATE users SET smuggle_success = smuggle_success + 1 WHERE user_id = $1",
-                                user_id
-                            )
-                            result_text = get_random_phrase(SMUGGLE_SUCCESS_PHRASES, amount=amount)
-                            status = 'completed'
-                            penalty = 0
-                        elif rand <= total_success_chance + adjusted_caught:
-                            penalty = await get_setting_int("smuggle_fail_penalty_minutes")
-                            await conn.execute(
-                                "UPDATE users SET smuggle_fail = smuggle_fail + 1 WHERE user_id = $1",
-                                user_id
-                            )
-                            result_text = get_random_phrase(SMUGGLE_CAUGHT_PHRASES)
-                            status = 'failed'
-                        else:
-                            await conn.execute(
-                                "UPDATE users SET smuggle_fail = smuggle_fail + 1 WHERE user_id = $1",
-                                user_id
-                            )
-                            result_text = get_random_phrase(SMUGGLE_LOST_PHRASES)
-                            status = 'failed'
-                            penalty = 0
-
-                        await conn.execute(
-                            "UPDATE smuggle_runs SET status = $1, notified = TRUE, result = $2, smuggle_amount = $3 WHERE id = $4",
-                            status, result_text, amount, run['id']
-                        )
-
-                        if chat_id:
-                            try:
-                                user = await conn.fetchrow("SELECT first_name FROM users WHERE user_id=$1", user_id)
-                                name = user['first_name'] if user else f"ID {user_id}"
-                                file_id = await get_media_file_id('smuggle_result')
-                                if file_id:
-                                    await bot.send_photo(chat_id, file_id, caption=f"{result_text}\n(для {name})")
-                                else:
-                                    await bot.send_message(chat_id, f"{result_text}\n(для {name})")
-                            except:
-                                await safe_send_message(user_id, result_text)
-                        else:
-                            await safe_send_message(user_id, result_text)
-
-                        await set_smuggle_cooldown(user_id, penalty)
-
-                        exp = await get_setting_int("exp_per_smuggle")
-                        await add_exp(user_id, exp, conn=conn)
-                    except Exception as e:
-                        logging.error(f"Error processing smuggle run {run['id']}: {e}", exc_info=True)
+# ==================== ПЛАНИРОВЩИК ДЕДЛАЙНОВ ====================
+BOSS_SPAWN_INTERVAL = 1800  # секунд между попытками спавна босса
+
+DEADLINE_RETRY_BASE = 5       # секунд до первой повторной попытки после ошибки обработчика
+DEADLINE_RETRY_MAX = 300
 
+class DeadlineScheduler:
+    """Таймеры на min-heap вместо периодического опроса таблиц.
+
+    Для каждого вида событий регистрируется обработчик (получает список сработавших ключей)
+    и загрузчик, который при старте возвращает пары (ключ, срок) из БД. Новые строки
+    ставят таймер сами через schedule(). Пока ничего не наступило, цикл просто спит
+    до ближайшего срока и в БД не ходит. Обработчики сами перепроверяют строку в БД,
+    поэтому устаревший таймер безопасен. Если обработчик упал, его ключи ставятся
+    повторно с нарастающей паузой – как раньше их подобрал бы следующий опрос.
+    """
+    def __init__(self):
+        self.heap = []      # (срок, seq, вид, ключ)
+        self.timers = {}    # (вид, ключ) -> seq актуального таймера
+        self.failures = {}  # (вид, ключ) -> число неудачных попыток подряд
+        self.handlers = {}
+        self.loaders = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def register(self, kind: str, handler, loader=None):
+        self.handlers[kind] = handler
+        if loader is not None:
+            self.loaders[kind] = loader
+
+    def schedule(self, kind: str, key, when):
+        """Ставит (или переносит) таймер. when – datetime или unix-время."""
+        deadline = when.timestamp() if isinstance(when, datetime) else float(when)
+        seq = next(self.counter)
+        self.timers[(kind, key)] = seq
+        heapq.heappush(self.heap, (deadline, seq, kind, key))
+        if self.heap[0][1] == seq:
+            self.wakeup.set()
+
+    def cancel(self, kind: str, key):
+        self.timers.pop((kind, key), None)
+
+    async def rebuild(self):
+        self.heap.clear()
+        self.timers.clear()
+        self.failures.clear()
+        for kind, loader in self.loaders.items():
+            entries = await loader()
+            for key, when in entries:
+                self.schedule(kind, key, when)
+            logging.info(f"Deadline scheduler: {len(entries)} timers of kind '{kind}'")
+
+    async def run(self):
+        while True:
+            try:
+                now = time.time()
+                due = defaultdict(list)
+                while self.heap and self.heap[0][0] <= now:
+                    _, seq, kind, key = heapq.heappop(self.heap)
+                    if self.timers.get((kind, key)) != seq:
+                        continue  # таймер перенесён или отменён
+                    del self.timers[(kind, key)]
+                    due[kind].append(key)
+                for kind, keys in due.items():
+                    asyncio.create_task(self._fire(kind, keys))
+                timeout = self.heap[0][0] - time.time() if self.heap else None
+                self.wakeup.clear()
+                if timeout is None or timeout > 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except Exception as e:
+                logging.error(f"Error in deadline scheduler: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    def retry(self, kind: str, key):
+        """Повторный таймер после неудачи: пауза удваивается до DEADLINE_RETRY_MAX."""
+        if (kind, key) in self.timers:
+            return  # таймер уже переставили
+        attempt = self.failures.get((kind, key), 0) + 1
+        self.failures[(kind, key)] = attempt
+        delay = min(DEADLINE_RETRY_BASE * 2 ** (attempt - 1), DEADLINE_RETRY_MAX)
+        self.schedule(kind, key, time.time() + delay)
+
+    async def _fire(self, kind: str, keys: list):
+        attempts = {key: self.failures.get((kind, key)) for key in keys}
+        try:
+            await self.handlers[kind](keys)
         except Exception as e:
-            logging.error(f"Error in process_smuggle_runs main loop: {e}", exc_info=True)
-            await asyncio.sleep(60)
+            logging.error(f"Error in deadline handler '{kind}' for {keys}: {e}", exc_info=True)
+            for key in keys:
+                self.retry(kind, key)
+        else:
+            for key in keys:
+                # обработчик сам вызвал retry() для упавшего элемента – счётчик попыток не сбрасываем
+                if self.failures.get((kind, key)) == attempts[key]:
+                    self.failures.pop((kind, key), None)
+
+deadlines = DeadlineScheduler()
+
+# ==================== ТАЙМЕР: ЗАВЕРШЕНИЕ КОНТРАБАНДНЫХ РЕЙСОВ ====================
+async def load_smuggle_deadlines():
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT id, end_time FROM smuggle_runs WHERE status = 'in_progress' AND notified = FALSE")
+    return [(r['id'], r['end_time']) for r in rows]
+
+def roll_smuggle_outcome(rep: int, cfg: SettingsSnapshot) -> str:
+    """Бросок исхода рейса: 'success', 'caught' или 'lost'."""
+    rep_success_bonus = min(cfg.reputation_smuggle_success_bonus * rep, cfg.reputation_max_bonus_percent)
+    total_success_chance = min(cfg.smuggle_success_chance + rep_success_bonus, 100)
+    remaining = max(100 - total_success_chance, 0)
+    total_base_catch_lost = cfg.smuggle_caught_chance + cfg.smuggle_lost_chance
+    if total_base_catch_lost > 0:
+        adjusted_caught = int(remaining * cfg.smuggle_caught_chance / total_base_catch_lost)
+    else:
+        adjusted_caught = 0
 
-# ==================== ФОНОВАЯ ЗАДАЧА: ПРОВЕРКА АУКЦИОНОВ ====================
-async def check_auctions():
-    while True:
+    rand = random.randint(1, 100)
+    if rand <= total_success_chance:
+        return 'success'
+    elif rand <= total_success_chance + adjusted_caught:
+        return 'caught'
+    return 'lost'
+
+async def send_smuggle_result(user_id: int, chat_id: Optional[int], name: str, text: str, file_id: Optional[str]):
+    if chat_id:
         try:
-            await asyncio.sleep(60)
-            now = datetime.now()
-            async with db_pool.acquire() as conn:
-                expired = await conn.fetch("""
-                    SELECT * FROM auctions
-                    WHERE status = 'active' AND end_time IS NOT NULL AND end_time <= $1
-                """, now)
-
-                for auction in expired:
-                    try:
-                        auction_id = auction['id']
-                        winner_bid = await conn.fetchrow("""
-                            SELECT user_id, bid_amount FROM auction_bids
-                            WHERE auction_id = $1
-                            ORDER BY bid_amount DESC, bid_time ASC
-                            LIMIT 1
-                        """, auction_id)
-
-                        if winner_bid:
-                            winner_id = winner_bid['user_id']
-                            final_price = float(winner_bid['bid_amount'])
-                            await conn.execute(
-                                "UPDATE auctions SET status = 'ended', winner_id = $1, current_price = $2 WHERE id = $3",
-                                winner_id, final_price, auction_id
-                            )
-                            await safe_send_message(
-                                winner_id,
-                                f"🎉 Поздравляем! Вы выиграли аукцион «{auction['item_name']}» с ценой {final_price:.2f} баксов. Админ скоро свяжется."
-                            )
-                            await safe_send_message(
-                                auction['created_by'],
-                                f"🏁 Аукцион «{auction['item_name']}» завершён. Победитель: {winner_id}, цена: {final_price:.2f}."
-                            )
-                        else:
-                            await conn.execute(
-                                "UPDATE auctions SET status = 'ended', winner_id = NULL WHERE id = $1",
-                                auction_id
-                            )
-                            await safe_send_message(
-                                auction['created_by'],
-                                f"🏁 Аукцион «{auction['item_name']}» завершён без ставок."
-                            )
-                    except Exception as e:
-                        logging.error(f"Error processing auction {auction['id']}: {e}", exc_info=True)
+            if file_id:
+                await outbound.send(chat_id, 'send_photo', file_id, caption=f"{text}\n(для {name})", priority=PRIORITY_NOTIFY)
+            else:
+                await outbound.send(chat_id, 'send_message', f"{text}\n(для {name})", priority=PRIORITY_NOTIFY)
+            return
+        except Exception:
+            pass
+    await safe_send_message(user_id, text, priority=PRIORITY_NOTIFY)
 
-        except Exception as e:
-            logging.error(f"Error in check_auctions: {e}", exc_info=True)
-            await asyncio.sleep(60)
+async def process_smuggle_runs(run_ids: list):
+    """Расчёт всех наступивших рейсов пачкой: один SELECT, исходы в Python, запись через unnest."""
+    now = datetime.now()
+    cfg = await get_settings_snapshot()
+
+    notifications = []
+    async with db_transaction() as conn:
+        runs = await conn.fetch("""
+            SELECT r.id, r.user_id, r.chat_id, COALESCE(p.reputation, 0) AS reputation, u.first_name
+            FROM smuggle_runs r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            LEFT JOIN user_progress p ON p.user_id = r.user_id
+            WHERE r.id = ANY($1::int[]) AND r.status = 'in_progress' AND r.end_time <= $2 AND r.notified = FALSE
+            FOR UPDATE OF r SKIP LOCKED
+        """, run_ids, now)
+        missing = set(run_ids) - {run['id'] for run in runs}
+        if missing:
+            # не вернулись: ещё не наступили по часам БД или заняты другой транзакцией –
+            # без нового таймера такие рейсы висели бы до перезапуска
+            pending = await conn.fetch(
+                "SELECT id, end_time FROM smuggle_runs WHERE id = ANY($1::int[]) "
+                "AND status = 'in_progress' AND notified = FALSE",
+                list(missing)
+            )
+            for row in pending:
+                if row['end_time'] > now:
+                    deadlines.schedule('smuggle', row['id'], row['end_time'])
+                else:
+                    deadlines.retry('smuggle', row['id'])
+        if not runs:
+            return
 
-# ==================== ФОНОВАЯ ЗАДАЧА: СПАВН БОССОВ ====================
-async def boss_spawn_scheduler():
-    while True:
+        run_rows = ([], [], [], [])          # id, status, result, amount
+        user_deltas = {}                     # user_id -> [btc, success, fail, cooldown_until]
+        for run in runs:
+            user_id = run['user_id']
+            rep = run['reputation']
+            outcome = roll_smuggle_outcome(rep, cfg)
+            amount = 0.0
+            penalty = 0
+            if outcome == 'success':
+                amount = cfg.smuggle_base_amount + cfg.reputation_smuggle_bonus * rep
+                result_text = get_random_phrase(SMUGGLE_SUCCESS_PHRASES, amount=amount)
+            elif outcome == 'caught':
+                penalty = cfg.smuggle_fail_penalty_minutes
+                result_text = get_random_phrase(SMUGGLE_CAUGHT_PHRASES)
+            else:
+                result_text = get_random_phrase(SMUGGLE_LOST_PHRASES)
+
+            run_rows[0].append(run['id'])
+            run_rows[1].append('completed' if outcome == 'success' else 'failed')
+            run_rows[2].append(result_text)
+            run_rows[3].append(amount)
+            delta = user_deltas.setdefault(user_id, [0.0, 0, 0, now])
+            delta[0] += amount
+            delta[1 if outcome == 'success' else 2] += 1
+            delta[3] = max(delta[3], now + timedelta(minutes=cfg.smuggle_cooldown_minutes + penalty))
+            name = run['first_name'] or f"ID {user_id}"
+            notifications.append((user_id, run['chat_id'], name, result_text))
+
+        await conn.execute("""
+            UPDATE smuggle_runs r
+            SET status = v.status, notified = TRUE, result = v.result, smuggle_amount = v.amount
+            FROM unnest($1::int[], $2::text[], $3::text[], $4::numeric[]) AS v(id, status, result, amount)
+            WHERE r.id = v.id
+        """, *run_rows)
+        user_ids = list(user_deltas)
+        rows = await conn.fetch("""
+            UPDATE user_wallet u
+            SET bitcoin_balance = u.bitcoin_balance + v.btc
+            FROM unnest($1::bigint[], $2::bigint[]) AS v(user_id, btc)
+            WHERE u.user_id = v.user_id
+            RETURNING u.user_id, u.bitcoin_balance
+        """, user_ids, [BtcUnits.from_major(user_deltas[u][0]) for u in user_ids])
+        for r in rows:
+            if user_deltas[r['user_id']][0]:
+                ledger.record(r['user_id'], 'bitcoin', BtcUnits.from_major(user_deltas[r['user_id']][0]),
+                              r['bitcoin_balance'], 'smuggle')
+        for user_id in user_ids:
+            if user_deltas[user_id][1]:
+                counters.add(user_id, 'smuggle_success', user_deltas[user_id][1])
+            if user_deltas[user_id][2]:
+                counters.add(user_id, 'smuggle_fail', user_deltas[user_id][2])
+        await conn.execute("""
+            INSERT INTO smuggle_cooldowns (user_id, cooldown_until)
+            SELECT * FROM unnest($1::bigint[], $2::timestamp[])
+            ON CONFLICT (user_id) DO UPDATE SET cooldown_until = EXCLUDED.cooldown_until
+        """, user_ids, [user_deltas[u][3] for u in user_ids])
+        # опыт начисляем по-прежнему через add_exp: там повышение уровня и награды
+        for user_id in user_ids:
+            await add_exp(user_id, cfg.exp_per_smuggle * (user_deltas[user_id][1] + user_deltas[user_id][2]), conn=conn)
+
+    logging.info(f"Smuggle settlement: {len(runs)} runs for {len(user_ids)} users")
+    file_id = await get_media_file_id('smuggle_result')
+    await asyncio.gather(*[send_smuggle_result(*n, file_id) for n in notifications], return_exceptions=True)
+
+deadlines.register('smuggle', process_smuggle_runs, load_smuggle_deadlines)
+
+# ==================== ТАЙМЕР: ЗАВЕРШЕНИЕ АУКЦИОНОВ ====================
+async def load_auction_deadlines():
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT id, end_time FROM auctions WHERE status = 'active' AND end_time IS NOT NULL")
+    return [(r['id'], r['end_time']) for r in rows]
+
+async def check_auctions(auction_ids: list):
+    now = datetime.now()
+    async with db_conn() as conn:
+        expired = await conn.fetch("""
+            SELECT * FROM auctions
+            WHERE id = ANY($1::int[]) AND status = 'active' AND end_time IS NOT NULL AND end_time <= $2
+        """, auction_ids, now)
+
+    for auction in expired:
         try:
-            await asyncio.sleep(1800)  # проверка раз в 30 минут
-            spawn_chance = await get_setting_int("boss_spawn_chance")
-            if random.randint(1, 100) > spawn_chance:
-                continue
+            async with db_transaction() as conn:
+                auction_id = auction['id']
+                winner_bid = await conn.fetchrow("""
+                    SELECT user_id, bid_amount FROM auction_bids
+                    WHERE auction_id = $1
+                    ORDER BY bid_amount DESC, bid_time ASC
+                    LIMIT 1
+                """, auction_id)
+
+                if winner_bid:
+                    winner_id = winner_bid['user_id']
+                    final_price = float(winner_bid['bid_amount'])
+                    await conn.execute(
+                        "UPDATE auctions SET status = 'ended', winner_id = $1, current_price = $2 WHERE id = $3",
+                        winner_id, final_price, auction_id
+                    )
+                    outbox_send(
+                        winner_id,
+                        f"🎉 Поздравляем! Вы выиграли аукцион «{auction['item_name']}» с ценой {final_price:.2f} баксов. Админ скоро свяжется."
+                    )
+                    outbox_send(
+                        auction['created_by'],
+                        f"🏁 Аукцион «{auction['item_name']}» завершён. Победитель: {winner_id}, цена: {final_price:.2f}."
+                    )
+                else:
+                    await conn.execute(
+                        "UPDATE auctions SET status = 'ended', winner_id = NULL WHERE id = $1",
+                        auction_id
+                    )
+                    outbox_send(
+                        auction['created_by'],
+                        f"🏁 Аукцион «{auction['item_name']}» завершён без ставок."
+                    )
+        except Exception as e:
+            logging.error(f"Error processing auction {auction['id']}: {e}", exc_info=True)
+            deadlines.retry('auction', auction['id'])
+
+deadlines.register('auction', check_auctions, load_auction_deadlines)
+
+# ==================== ТАЙМЕР: СПАВН БОССОВ ====================
+async def load_boss_deadlines():
+    return [('spawn', time.time() + BOSS_SPAWN_INTERVAL)]
+
+async def boss_spawn_scheduler(keys: list):
+    try:
+        await try_spawn_random_boss()
+    finally:
+        deadlines.schedule('boss', 'spawn', time.time() + BOSS_SPAWN_INTERVAL)
+
+async def try_spawn_random_boss():
+    cfg = await get_settings_snapshot()
+    spawn_chance = cfg.boss_spawn_chance
+    if random.randint(1, 100) > spawn_chance:
+        return
+
+    async with db_conn() as conn:
+        chat_row = await conn.fetchrow("""
+            SELECT chat_id FROM confirmed_chats 
+            WHERE boss_spawn_count < (SELECT value::int FROM settings WHERE key='boss_max_per_day')
+            ORDER BY RANDOM() LIMIT 1
+        """)
+        if not chat_row:
+            return
+        chat_id = chat_row['chat_id']
+
+    max_per_day = cfg.boss_max_per_day
+    today = date.today().isoformat()
+
+    async with db_conn() as conn2:
+        chat_data = await conn2.fetchrow(
+            "SELECT boss_last_spawn, boss_spawn_count FROM confirmed_chats WHERE chat_id = $1",
+            chat_id
+        )
+        if chat_data:
+            last_spawn = chat_data['boss_last_spawn']
+            spawn_count = chat_data['boss_spawn_count']
+
+            if last_spawn:
+                if last_spawn.date() == date.today():
+                    if spawn_count >= max_per_day:
+                        return
+                else:
+                    await conn2.execute(
+                        "UPDATE confirmed_chats SET boss_spawn_count = 0 WHERE chat_id = $1",
+                        chat_id
+                    )
+
+        existing = await conn2.fetchval(
+            "SELECT 1 FROM bosses WHERE chat_id = $1 AND status = 'active'",
+            chat_id
+        )
+        if existing:
+            return
+
+    image_file_id = await get_media_file_id('boss_default')
+    level = random.randint(1, 5)
+    await spawn_boss(chat_id, level=level, image_file_id=image_file_id)
+
+deadlines.register('boss', boss_spawn_scheduler, load_boss_deadlines)
+
+# ==================== ТАЙМЕР: РАССЫЛКА РЕКЛАМЫ ====================
+async def load_ad_deadlines():
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT id, last_sent, interval_minutes FROM ads WHERE enabled = TRUE")
+    now = datetime.now()
+    return [(r['id'], r['last_sent'] + timedelta(minutes=r['interval_minutes']) if r['last_sent'] else now)
+            for r in rows]
 
-            async with db_pool.acquire() as conn:
-                chat_row = await conn.fetchrow("""
-                    SELECT chat_id FROM confirmed_chats 
-                    WHERE boss_spawn_count < (SELECT value::int FROM settings WHERE key='boss_max_per_day')
-                    ORDER BY RANDOM() LIMIT 1
-                """)
-                if not chat_row:
+async def ad_sender(ad_ids: list):
+    now = datetime.now()
+    async with db_conn() as conn:
+        ads = await conn.fetch("SELECT * FROM ads WHERE id = ANY($1::int[]) AND enabled = TRUE", ad_ids)
+        for ad in ads:
+            try:
+                interval = timedelta(minutes=ad['interval_minutes'])
+                if ad['last_sent'] and ad['last_sent'] + interval > now:
+                    # интервал изменили – переносим таймер
+                    deadlines.schedule('ad', ad['id'], ad['last_sent'] + interval)
                     continue
-                chat_id = chat_row['chat_id']
 
-            max_per_day = await get_setting_int("boss_max_per_day")
-            today = date.today().isoformat()
-            
-            async with db_pool.acquire() as conn2:
-                chat_data = await conn2.fetchrow(
-                    "SELECT boss_last_spawn, boss_spawn_count FROM confirmed_chats WHERE chat_id = $1",
-                    chat_id
-                )
-                if chat_data:
-                    last_spawn_str = chat_data['boss_last_spawn']
-                    spawn_count = chat_data['boss_spawn_count']
-                    
-                    if last_spawn_str:
-                        try:
-                            last_spawn_date = datetime.strptime(last_spawn_str, "%Y-%m-%d %H:%M:%S").date()
-                            if last_spawn_date == date.today():
-                                if spawn_count >= max_per_day:
-                                    continue
-                            else:
-                                await conn2.execute(
-                                    "UPDATE confirmed_chats SET boss_spawn_count = 0 WHERE chat_id = $1",
-                                    chat_id
-                                )
-                        except:
-                            pass
-
-                existing = await conn2.fetchval(
-                    "SELECT 1 FROM bosses WHERE chat_id = $1 AND status = 'active'",
-                    chat_id
+                target = ad['target']
+                recipients = []
+
+                if target in ('chats', 'all'):
+                    confirmed = await get_confirmed_chats()
+                    for chat_id in confirmed.keys():
+                        recipients.append(('chat', chat_id))
+                if target in ('private', 'all'):
+                    async with db_conn() as conn2:
+                        users = await conn2.fetch("SELECT user_id FROM users")
+                        for u in users:
+                            recipients.append(('user', u['user_id']))
+
+                # отправку и паузы между сообщениями берёт на себя планировщик
+                sent_count = 0
+                for typ, dest in recipients:
+                    outbound.submit(dest, 'send_message', ad['text'], priority=PRIORITY_BULK)
+                    sent_count += 1
+
+                await conn.execute(
+                    "UPDATE ads SET last_sent = $1 WHERE id = $2",
+                    now, ad['id']
                 )
-                if existing:
-                    continue
+                logging.info(f"Ad {ad['id']} queued for {sent_count} recipients")
+                deadlines.schedule('ad', ad['id'], now + interval)
+            except Exception as e:
+                logging.error(f"Error processing ad {ad['id']}: {e}", exc_info=True)
+                deadlines.retry('ad', ad['id'])
 
-            image_file_id = await get_media_file_id('boss_default')
-            level = random.randint(1, 5)
-            await spawn_boss(chat_id, level=level, image_file_id=image_file_id)
+deadlines.register('ad', ad_sender, load_ad_deadlines)
 
-        except Exception as e:
-            logging.error(f"Error in boss_spawn_scheduler: {e}", exc_info=True)
-            await asyncio.sleep(60)
+# ==================== ТАЙМЕР: ЗАВЕРШЕНИЕ РОЗЫГРЫШЕЙ ====================
+async def load_giveaway_deadlines():
+    async with db_conn() as conn:
+        rows = await conn.fetch("SELECT id, end_date FROM giveaways WHERE status = 'active' AND end_date IS NOT NULL")
+    return [(r['id'], r['end_date']) for r in rows]
 
-# ==================== ФОНОВАЯ ЗАДАЧА: РАССЫЛКА РЕКЛАМЫ ====================
-async def ad_sender():
-    while True:
-        try:
-            await asyncio.sleep(300)  # проверка раз в 5 минут
-            now = datetime.now()
-            async with db_pool.acquire() as conn:
-                ads = await conn.fetch("SELECT * FROM ads WHERE enabled = TRUE")
-                for ad in ads:
-                    try:
-                        last_sent = ad['last_sent']
-                        interval = ad['interval_minutes']
-                        if last_sent:
-                            try:
-                                if isinstance(last_sent, str):
-                                    last = datetime.strptime(last_sent, "%Y-%m-%d %H:%M:%S.%f")
-                                else:
-                                    last = last_sent
-                                if (now - last).total_seconds() < interval * 60:
-                                    continue
-                            except:
-                                pass
-
-                        target = ad['target']
-                        recipients = []
-
-                        if target in ('chats', 'all'):
-                            confirmed = await get_confirmed_chats()
-                            for chat_id in confirmed.keys():
-                                recipients.append(('chat', chat_id))
-                        if target in ('private', 'all'):
-                            async with db_pool.acquire() as conn2:
-                                users = await conn2.fetch("SELECT user_id FROM users")
-                                for u in users:
-                                    recipients.append(('user', u['user_id']))
-
-                        sent_count = 0
-                        for typ, dest in recipients:
-                            try:
-                                if typ == 'chat':
-                                    await bot.send_message(dest, ad['text'])
-                                else:
-                                    await safe_send_message(dest, ad['text'])
-                                sent_count += 1
-                            except:
-                                pass
-                            await asyncio.sleep(0.05)
-
-                        await conn.execute(
-                            "UPDATE ads SET last_sent = $1 WHERE id = $2",
-                            now, ad['id']
-                        )
-                        logging.info(f"Ad {ad['id']} sent to {sent_count} recipients")
-                    except Exception as e:
-                        logging.error(f"Error processing ad {ad['id']}: {e}", exc_info=True)
+async def check_giveaways(giveaway_ids: list):
+    cfg = await get_settings_snapshot()
+    now = datetime.now()
+    async with db_conn() as conn:
+        expired = await conn.fetch("""
+            SELECT * FROM giveaways
+            WHERE id = ANY($1::int[]) AND status = 'active' AND end_date <= $2
+        """, giveaway_ids, now)
 
-        except Exception as e:
-            logging.error(f"Error in ad_sender: {e}", exc_info=True)
-            await asyncio.sleep(60)
+        for gw in expired:
+            try:
+                gw_id = gw['id']
+                winners_count = gw['winners_count'] or 1
+                participants = await conn.fetch("SELECT user_id FROM participants WHERE giveaway_id=$1", gw_id)
+                participant_ids = [p['user_id'] for p in participants]
+
+                winners = []
+                if not participant_ids:
+                    winners_list = "нет участников"
+                elif len(participant_ids) <= winners_count:
+                    winners = participant_ids
+                    winners_list = ", ".join(str(uid) for uid in winners)
+                else:
+                    winners = random.sample(participant_ids, winners_count)
+                    winners_list = ", ".join(str(uid) for uid in winners)
+
+                await conn.execute(
+                    "UPDATE giveaways SET status='completed', winners_list=$1 WHERE id=$2",
+                    winners_list, gw_id
+                )
+
+                for uid in winners:
+                    await safe_send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{gw_id}: {gw['prize']}!")
+                if cfg.chat_notify_giveaway:
+                    await notify_chats(f"🏁 Розыгрыш #{gw_id} завершён! Победители: {winners_list}")
+            except Exception as e:
+                logging.error(f"Error processing giveaway {gw['id']}: {e}", exc_info=True)
+                deadlines.retry('giveaway', gw['id'])
+
+deadlines.register('giveaway', check_giveaways, load_giveaway_deadlines)
 
-# ==================== ФОНОВАЯ ЗАДАЧА: ЗАВЕРШЕНИЕ РОЗЫГРЫШЕЙ ====================
-async def check_giveaways():
+# ==================== ФОНОВАЯ ЗАДАЧА: ОБНОВЛЕНИЕ НАСТРОЕК ====================
+async def settings_refresher():
     while True:
         try:
-            await asyncio.sleep(60)  # проверка раз в минуту
-            now = datetime.now()
-            async with db_pool.acquire() as conn:
-                expired = await conn.fetch("""
-                    SELECT * FROM giveaways
-                    WHERE status = 'active' AND end_date <= $1
-                """, now.strftime("%Y-%m-%d %H:%M:%S"))
-
-                for gw in expired:
-                    try:
-                        gw_id = gw['id']
-                        winners_count = gw['winners_count'] or 1
-                        participants = await conn.fetch("SELECT user_id FROM participants WHERE giveaway_id=$1", gw_id)
-                        participant_ids = [p['user_id'] for p in participants]
-
-                        if not participant_ids:
-                            winners_list = "нет участников"
-                        elif len(participant_ids) <= winners_count:
-                            winners = participant_ids
-                            winners_list = ", ".join(str(uid) for uid in winners)
-                        else:
-                            winners = random.sample(participant_ids, winners_count)
-                            winners_list = ", ".join(str(uid) for uid in winners)
-
-                        await conn.execute(
-                            "UPDATE giveaways SET status='completed', winners_list=$1 WHERE id=$2",
-                            winners_list, gw_id
-                        )
-
-                        for uid in winners:
-                            await safe_send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{gw_id}: {gw['prize']}!")
-                        if await get_setting("chat_notify_giveaway") == "1":
-                            await notify_chats(f"🏁 Розыгрыш #{gw_id} завершён! Победители: {winners_list}")
-                    except Exception as e:
-                        logging.error(f"Error processing giveaway {gw['id']}: {e}", exc_info=True)
+            await asyncio.sleep(60)
+            await reload_settings()
         except Exception as e:
-            logging.error(f"Error in check_giveaways main loop: {e}", exc_info=True)
+            logging.error(f"Error in settings_refresher: {e}", exc_info=True)
             await asyncio.sleep(60)
 
 # ==================== ПЕРИОДИЧЕСКАЯ ОЧИСТКА СТАРЫХ ЗАПИСЕЙ ====================
@@ -10120,27 +12124,21 @@ async def periodic_cleanup():
             logging.error(f"Error in periodic_cleanup: {e}", exc_info=True)
             await asyncio.sleep(3600)
 
-# ==================== ФОНОВАЯ ЗАДАЧА: АВТОМАТИЧЕСКОЕ НАЧИСЛЕНИЕ ДОХОДА БИЗНЕСОВ ====================
-async def update_all_businesses_income():
+# ==================== ФОНОВАЯ ЗАДАЧА: ПРОСЛУШИВАНИЕ ИЗМЕНЕНИЙ ДОСТУПА ====================
+async def access_registry_listener():
+    global access_listener_conn
     while True:
-        await asyncio.sleep(3600)  # раз в час
         try:
-            async with db_pool.acquire() as conn:
-                businesses = await conn.fetch("""
-                    SELECT ub.*, bt.base_income_cents 
-                    FROM user_businesses ub
-                    JOIN business_types bt ON ub.business_type_id = bt.id
-                """)
-                for biz in businesses:
-                    income_per_hour = biz['base_income_cents'] * biz['level']
-                    new_accum = biz['accumulated'] + income_per_hour
-                    await conn.execute(
-                        "UPDATE user_businesses SET accumulated = $1 WHERE id = $2",
-                        new_accum, biz['id']
-                    )
-                logging.info("Автоматическое начисление дохода по бизнесам выполнено.")
+            if access_listener_conn is None or access_listener_conn.is_closed():
+                access_listener_conn = await asyncpg.connect(DATABASE_URL)
+                await access_listener_conn.add_listener(ACCESS_NOTIFY_CHANNEL, on_access_notify)
+                # пока соединения не было, уведомления могли потеряться
+                await reload_access_registry()
+            await asyncio.sleep(30)
         except Exception as e:
-            logging.error(f"Ошибка в update_all_businesses_income: {e}", exc_info=True)
+            logging.error(f"Error in access_registry_listener: {e}", exc_info=True)
+            access_listener_conn = None
+            await asyncio.sleep(30)
 
 # ==================== ЗАПУСК БОТА ====================
 async def on_startup(dp):
@@ -10165,23 +12163,42 @@ async def on_startup(dp):
     logging.info("Бот запущен!")
 
 async def on_shutdown(dp):
+    await outbound.drain()
+    await counters.flush()
+    await ledger.flush()
+    if access_listener_conn is not None and not access_listener_conn.is_closed():
+        await access_listener_conn.close()
     await db_pool.close()
     logging.info("Бот остановлен, соединения закрыты.")
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(create_db_pool())
+    with startup_step("подключение к БД"):
+        loop.run_until_complete(create_db_pool())
     loop.run_until_complete(init_db())
-
-    loop.create_task(process_smuggle_runs())
-    loop.create_task(check_auctions())
-    loop.create_task(boss_spawn_scheduler())
-    loop.create_task(ad_sender())
+    with startup_step("доступ и настройки"):
+        loop.run_until_complete(reload_access_registry())
+        loop.run_until_complete(reload_settings())
+        loop.run_until_complete(reload_level_rewards())
+    with startup_step("таймеры"):
+        loop.run_until_complete(deadlines.rebuild())
+    with startup_step("стакан биржи"):
+        loop.run_until_complete(exchange.load())
+        loop.run_until_complete(ticker.load())
+    log_startup_report()
+
+    loop.create_task(deadlines.run())
     loop.create_task(periodic_cleanup())
-    loop.create_task(update_all_businesses_income())
-    loop.create_task(check_giveaways())
-
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
+    loop.create_task(access_registry_listener())
+    loop.create_task(settings_refresher())
+    loop.create_task(outbound.run())
+    loop.create_task(counters.run())
+    loop.create_task(ledger.run())
+    loop.create_task(resume_broadcast_jobs())
+
+    # chat_member не входит в набор обновлений по умолчанию – без него индекс подписок не наполняется
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown,
+                           allowed_updates=types.AllowedUpdates.all())
 
 # ==================== КОНЕЦ ЧАСТИ 9 ====================
 # ==================== КОНЕЦ ПОЛНОГО КОДА ====================
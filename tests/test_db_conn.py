@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import pytest
+
+import main
+
+
+class FakeConnection:
+    def __init__(self, number: int):
+        self.number = number
+        self.depth = 0
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+
+
+class FakePool:
+    """Пул asyncpg в миниатюре: acquire() ждёт, пока не освободится одно из max_size соединений."""
+    def __init__(self, max_size: int = 1):
+        self.max_size = max_size
+        self.slots = asyncio.Semaphore(max_size)
+        self.in_use = 0
+        self.acquired = 0
+
+    def get_size(self):
+        return self.in_use
+
+    def get_max_size(self):
+        return self.max_size
+
+    def get_idle_size(self):
+        return 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.slots:
+            self.in_use += 1
+            self.acquired += 1
+            try:
+                yield FakeConnection(self.acquired)
+            finally:
+                self.in_use -= 1
+
+
+def run(coro_factory, timeout: float = 1.0):
+    """Один слот пула: если вложенный вызов попросит второе соединение, тест упадёт по таймауту."""
+    async def runner():
+        pool = FakePool(max_size=1)
+        main.db_pool = pool
+        try:
+            return await asyncio.wait_for(coro_factory(pool), timeout)
+        finally:
+            main.db_pool = None
+    return asyncio.run(runner())
+
+
+def test_nested_db_conn_reuses_connection():
+    async def scenario(pool):
+        async with main.db_conn() as outer:
+            async with main.db_conn() as inner:
+                async with main.db_conn() as innermost:
+                    assert inner is outer and innermost is outer
+        return pool.acquired
+    assert run(scenario) == 1
+
+
+def test_transaction_inside_db_conn_and_helpers_inside_transaction():
+    async def scenario(pool):
+        async with main.db_conn() as conn:
+            async with main.db_transaction() as tx:
+                assert tx is conn and conn.depth == 1
+                async with main.db_transaction() as nested:
+                    assert nested is conn and conn.depth == 2
+                async with main.db_conn() as helper:
+                    assert helper is conn
+        return pool.acquired
+    assert run(scenario) == 1
+
+
+def test_after_commit_waits_for_outer_transaction():
+    done = []
+
+    async def scenario(pool):
+        async with main.db_transaction():
+            async with main.db_transaction():
+                main.after_commit(lambda: done.append("nested"))
+            assert done == []
+        assert done == ["nested"]
+    run(scenario)
+
+
+def test_rollback_drops_deferred_actions():
+    done = []
+
+    async def scenario(pool):
+        with pytest.raises(RuntimeError):
+            async with main.db_transaction():
+                main.after_commit(lambda: done.append("x"))
+                raise RuntimeError
+        assert done == []
+        # соединение вернулось в пул
+        async with main.db_conn():
+            pass
+    run(scenario)
+
+
+def test_child_task_waits_for_its_own_connection():
+    async def scenario(pool):
+        order = []
+
+        async def child():
+            async with main.db_conn() as conn:
+                order.append(("child", conn.number))
+
+        async with main.db_conn() as conn:
+            # контекст копируется в задачу, но соединение родителя ей не отдаётся
+            task = asyncio.create_task(child())
+            await asyncio.sleep(0.05)
+            assert not task.done()
+            order.append(("parent", conn.number))
+        await task
+        return order
+    assert run(scenario) == [("parent", 1), ("child", 2)]
+
+
+def test_exhausted_pool_is_logged(caplog):
+    async def scenario(pool):
+        release = asyncio.Event()
+
+        async def holder():
+            async with main.db_conn():
+                await release.wait()
+
+        async def waiter():
+            async with main.db_conn() as conn:
+                return conn.number
+
+        held = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        with caplog.at_level(logging.WARNING):
+            waiting = asyncio.create_task(waiter())
+            await asyncio.sleep(0.01)
+            assert not waiting.done()
+            release.set()
+            await held
+            assert await waiting == 2
+    run(scenario)
+    assert any("Пул соединений исчерпан" in r.getMessage() for r in caplog.records)
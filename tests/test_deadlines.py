@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import main
+
+
+def test_failed_handler_keys_are_retried(monkeypatch):
+    monkeypatch.setattr(main, "DEADLINE_RETRY_BASE", 0.01)
+    calls = []
+
+    async def handler(keys):
+        calls.append(list(keys))
+        if len(calls) == 1:
+            raise RuntimeError("db down")
+
+    async def scenario():
+        scheduler = main.DeadlineScheduler()
+        scheduler.register("run", handler)
+        scheduler.schedule("run", 7, time.time())
+        runner = asyncio.create_task(scheduler.run())
+        try:
+            for _ in range(100):
+                if len(calls) >= 2:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            runner.cancel()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert calls[:2] == [[7], [7]]
+    assert scheduler.failures == {}
+
+
+def test_retry_backoff_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(main, "DEADLINE_RETRY_BASE", 5)
+    monkeypatch.setattr(main, "DEADLINE_RETRY_MAX", 30)
+
+    async def scenario():
+        scheduler = main.DeadlineScheduler()
+        delays = []
+        for _ in range(5):
+            before = time.time()
+            scheduler.retry("run", 1)
+            seq = scheduler.timers[("run", 1)]
+            deadline = next(d for d, s, _, _ in scheduler.heap if s == seq)
+            delays.append(round(deadline - before))
+            scheduler.cancel("run", 1)
+        return delays
+
+    assert asyncio.run(scenario()) == [5, 10, 20, 30, 30]
+
+
+def test_item_retried_by_handler_keeps_its_attempt_count(monkeypatch):
+    monkeypatch.setattr(main, "DEADLINE_RETRY_BASE", 0.01)
+    calls = []
+
+    async def scenario():
+        scheduler = main.DeadlineScheduler()
+
+        async def handler(keys):
+            # как check_auctions: ошибка по элементу ловится внутри обработчика
+            calls.append(list(keys))
+            for key in keys:
+                scheduler.retry("run", key)
+
+        scheduler.register("run", handler)
+        scheduler.schedule("run", 3, time.time())
+        runner = asyncio.create_task(scheduler.run())
+        try:
+            for _ in range(100):
+                if len(calls) >= 3:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            runner.cancel()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert calls[:3] == [[3], [3], [3]]
+    assert scheduler.failures[("run", 3)] >= 3
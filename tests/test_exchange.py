@@ -0,0 +1,191 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import main
+from main import BookOrder, BtcUnits, Cents, MatchingEngine
+
+
+def btc(value):
+    return BtcUnits.from_major(value)
+
+
+def usd(value):
+    return Cents.from_major(value)
+
+
+def make_engine():
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 100, 'buy', 50, btc(2), usd(100)))
+    return engine
+
+
+def test_cancelled_commit_resyncs_book(monkeypatch):
+    engine = make_engine()
+    loads = []
+
+    async def fake_load():
+        # состояние из БД: встречная заявка не исполнялась
+        loads.append(True)
+        fresh = make_engine()
+        engine.orders, engine.levels, engine.heaps, engine.depth = fresh.orders, fresh.levels, fresh.heaps, fresh.depth
+        engine.stale = False
+
+    @asynccontextmanager
+    async def fake_transaction():
+        yield object()
+
+    async def no_op(*args, **kwargs):
+        return None
+
+    async def cancelled_persist(*args, **kwargs):
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(engine, "load", fake_load)
+    monkeypatch.setattr(main, "exchange", engine)
+    monkeypatch.setattr(main, "settings_snapshot", main.SettingsSnapshot.from_raw({}))
+    monkeypatch.setattr(main, "db_transaction", fake_transaction)
+    monkeypatch.setattr(main, "update_user_bitcoin", no_op)
+    monkeypatch.setattr(main, "persist_fills", cancelled_persist)
+
+    async def scenario():
+        with pytest.raises(asyncio.CancelledError):
+            await main.place_bitcoin_order(200, 'sell', 1.0, 50, rest=False)
+
+    asyncio.run(scenario())
+    assert loads == [True]
+    assert engine.orders[1].amount == btc(2)
+    assert not engine.stale
+
+
+def test_price_time_priority():
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 10, 'sell', 52, btc(1), btc(1)))
+    engine.add(BookOrder(2, 11, 'sell', 50, btc(1), btc(1)))
+    engine.add(BookOrder(3, 12, 'sell', 50, btc(1), btc(1)))
+
+    taker = BookOrder(None, 20, 'buy', 52, btc(2.5), usd(130))
+    fills = engine.match(taker)
+
+    # сначала лучшая цена, внутри уровня – кто раньше пришёл
+    assert [(maker.id, take, price) for maker, take, price in fills] == [
+        (2, btc(1), 50), (3, btc(1), 50), (1, btc(0.5), 52)]
+    assert taker.amount == 0
+    assert taker.total_locked == usd(130 - 50 - 50 - 26)
+    assert list(engine.orders) == [1]
+    assert engine.best_price('sell') == 52
+
+
+def test_partial_fill_keeps_taker_and_maker_remainders():
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 10, 'buy', 50, btc(3), usd(150)))
+
+    taker = BookOrder(None, 20, 'sell', 49, btc(1.25), btc(1.25))
+    fills = engine.match(taker)
+
+    assert [(maker.id, take, price) for maker, take, price in fills] == [(1, btc(1.25), 50)]
+    maker = engine.orders[1]
+    assert maker.amount == btc(1.75)
+    assert maker.total_locked == usd(150 - 1.25 * 50)
+    assert isinstance(maker.amount, BtcUnits) and isinstance(maker.total_locked, Cents)
+    assert taker.amount == 0 and taker.total_locked == 0
+
+    # лимит не пускает дальше лучшей цены
+    taker = BookOrder(None, 21, 'sell', 51, btc(1), btc(1))
+    assert engine.match(taker) == []
+    assert taker.amount == btc(1)
+
+
+def test_fractional_fills_add_up_to_exactly_zero():
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 10, 'sell', 50, btc(0.1), btc(0.1)))
+    engine.add(BookOrder(2, 11, 'sell', 50, btc(0.2), btc(0.2)))
+
+    taker = BookOrder(None, 20, 'buy', 50, btc(0.3), main.trade_cost(btc(0.3), 50))
+    engine.match(taker)
+
+    # в float 0.3 - 0.1 - 0.2 не ноль; в BtcUnits заявка исполнена ровно
+    assert taker.amount == 0 and taker.total_locked == 0
+    assert not engine.orders and engine.depth_snapshot()['asks'] == []
+
+
+def test_trade_costs_never_exceed_the_lock():
+    engine = MatchingEngine()
+    for i, price in enumerate((33, 37, 41), start=1):
+        engine.add(BookOrder(i, 10 + i, 'sell', price, BtcUnits(3), BtcUnits(3)))
+
+    taker = BookOrder(None, 20, 'buy', 41, BtcUnits(9), main.trade_cost(BtcUnits(9), 41))
+    fills = engine.match(taker)
+
+    paid = sum(main.trade_cost(take, price) for _, take, price in fills)
+    assert paid + taker.total_locked == main.trade_cost(BtcUnits(9), 41)
+    assert taker.total_locked >= 0
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.fetches = []
+
+    async def execute(self, query, *args):
+        return None
+
+    async def fetch(self, query, *args):
+        self.fetches.append((query, args))
+        return []
+
+
+def test_buy_filled_below_limit_refunds_the_difference(monkeypatch):
+    monkeypatch.setattr(main, "db_now", lambda: main.datetime(2024, 1, 1))
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 300, 'sell', 40, btc(1), btc(1)))
+
+    taker = BookOrder(None, 100, 'buy', 50, btc(1), usd(50))
+    fills = engine.match(taker)
+    conn = RecordingConnection()
+    asyncio.run(main.persist_fills(conn, taker, fills, release_taker=True))
+
+    balance_update = next(args for query, args in conn.fetches if 'SET balance' in query)
+    # продавец получает 40, покупателю возвращается 10 из заблокированных 50
+    assert dict(zip(*balance_update)) == {300: usd(40), 100: usd(10)}
+    btc_update = next(args for query, args in conn.fetches if 'SET bitcoin_balance' in query)
+    assert dict(zip(*btc_update)) == {100: btc(1)}
+    assert taker.total_locked == 0
+
+
+def test_quote_and_available_respect_the_limit():
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 10, 'sell', 50, btc(1), btc(1)))
+    engine.add(BookOrder(2, 11, 'sell', 55, btc(2), btc(2)))
+    engine.add(BookOrder(3, 12, 'sell', 60, btc(1), btc(1)))
+
+    assert engine.available('sell') == btc(4)
+    assert engine.available('sell', 55) == btc(3)
+    assert engine.quote('sell', btc(2)) == (btc(2), usd(50 + 55))
+    assert engine.quote('sell', btc(10), 55) == (btc(3), usd(50 + 2 * 55))
+    # quote ничего не меняет в стакане
+    assert engine.available('sell') == btc(4)
+
+
+def test_depth_snapshot_follows_version():
+    engine = MatchingEngine()
+    engine.add(BookOrder(1, 10, 'buy', 48, btc(1), usd(48)))
+    engine.add(BookOrder(2, 11, 'buy', 48, btc(0.5), usd(24)))
+    engine.add(BookOrder(3, 12, 'sell', 52, btc(2), btc(2)))
+
+    snapshot = engine.depth_snapshot()
+    assert snapshot['bids'] == [{'price': 48, 'total_amount': btc(1.5), 'count': 2}]
+    assert snapshot['asks'] == [{'price': 52, 'total_amount': btc(2), 'count': 1}]
+    assert engine.depth_snapshot() is snapshot  # стакан не менялся – тот же снимок
+
+    engine.remove(1)
+    changed = engine.depth_snapshot()
+    assert changed is not snapshot and changed['version'] > snapshot['version']
+    assert changed['bids'] == [{'price': 48, 'total_amount': btc(0.5), 'count': 1}]
+
+
+def test_fill_report_in_major_units():
+    fills = [(None, btc(0.5), 40), (None, btc(0.25), 44)]
+    text = main.fill_report_text('buy', btc(1), fills)
+    assert "0.7500 BTC за 31.00 баксов" in text
+    assert "Не исполнено: 0.2500 BTC" in text
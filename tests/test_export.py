@@ -0,0 +1,40 @@
+import asyncio
+import csv
+import io
+from contextlib import asynccontextmanager
+
+import main
+
+
+class RowsConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, query, *args):
+        return self.rows
+
+
+def test_users_export_includes_unflushed_counters(monkeypatch):
+    row = {'user_id': 7, 'balance': 12345, 'casino_wins': 3, 'dice_losses': 0}
+
+    @asynccontextmanager
+    async def fake_db_conn():
+        yield RowsConnection([row])
+
+    async def failing_flush():
+        raise RuntimeError("db down")
+
+    buffer = main.CounterBuffer()
+    buffer._add(7, 'casino_wins', 2)
+    buffer._add(7, 'dice_losses', 1)
+    monkeypatch.setattr(buffer, "flush", failing_flush)
+    monkeypatch.setattr(main, "counters", buffer)
+    monkeypatch.setattr(main, "db_conn", fake_db_conn)
+
+    data = asyncio.run(main.export_users_to_csv()).decode('utf-8')
+    header, values = list(csv.reader(io.StringIO(data)))
+    exported = dict(zip(header, values))
+
+    assert exported['casino_wins'] == '5'
+    assert exported['dice_losses'] == '1'
+    assert exported['balance'] == '123.45'
@@ -0,0 +1,34 @@
+import random
+
+from main import levels_gained_for
+
+
+def levels_gained_by_loop(level, exp, level_mult):
+    """Прежний расчёт: уровень за уровнем."""
+    gained = 0
+    while exp >= level * level_mult:
+        exp -= level * level_mult
+        level += 1
+        gained += 1
+    return gained, exp
+
+
+def test_closed_form_matches_loop_on_random_inputs():
+    rng = random.Random(22)
+    for _ in range(5000):
+        level = rng.randint(1, 300)
+        level_mult = rng.randint(1, 500)
+        exp = rng.randint(0, level_mult * 20000)
+        assert levels_gained_for(level, exp, level_mult) == levels_gained_by_loop(level, exp, level_mult), \
+            (level, exp, level_mult)
+
+
+def test_exact_level_boundaries():
+    for level in (1, 2, 7, 50):
+        for level_mult in (1, 3, 100):
+            cost = level * level_mult
+            assert levels_gained_for(level, cost - 1, level_mult) == (0, cost - 1)
+            assert levels_gained_for(level, cost, level_mult) == (1, 0)
+            two = cost + (level + 1) * level_mult
+            assert levels_gained_for(level, two, level_mult) == (2, 0)
+            assert levels_gained_for(level, two - 1, level_mult) == (1, two - 1 - cost)
@@ -0,0 +1,17 @@
+from collections import OrderedDict
+
+import main
+
+
+def test_membership_cache_evicts_oldest_first(monkeypatch):
+    monkeypatch.setattr(main, "membership_cache", OrderedDict())
+    monkeypatch.setattr(main, "MEMBERSHIP_CACHE_MAX", 3)
+
+    for user_id in (1, 2, 3):
+        main.set_channel_membership(user_id, -100, True)
+    main.set_channel_membership(1, -100, False)   # обновлённая запись становится самой свежей
+    main.set_channel_membership(4, -100, True)
+
+    # живые записи тоже вытесняются: размер не растёт выше предела
+    assert list(main.membership_cache) == [(3, -100), (1, -100), (4, -100)]
+    assert main.membership_cache[(1, -100)][0] is False
@@ -0,0 +1,60 @@
+import main
+from main import Router, router
+
+
+async def h_buy(callback): pass
+async def h_buy_biz(callback): pass
+async def h_buy_menu(callback): pass
+async def h_detail(callback): pass
+async def h_back(callback): pass
+async def h_first(message): pass
+async def h_second(message): pass
+
+
+def test_exact_text_first_registration_wins():
+    r = Router()
+    r.text("💰 Баланс")(h_first)
+    r.text("💰 Баланс")(h_second)
+    assert r.match_text("💰 Баланс") is h_first
+    assert r.match_text("Баланс") is None
+    assert r.match_text(None) is None
+
+
+def test_longest_prefix_does_not_depend_on_registration_order():
+    r = Router()
+    r.callback(prefix="buy_")(h_buy)
+    r.callback(exact="buy_business_menu")(h_buy_menu)
+    r.callback(prefix="buy_biz_")(h_buy_biz)
+    assert r.match_callback("buy_7") is h_buy
+    assert r.match_callback("buy_biz_3") is h_buy_biz
+    assert r.match_callback("buy_business_menu") is h_buy_menu
+    assert r.match_callback("buy_business_other") is h_buy
+    assert r.match_callback("sell_1") is None
+
+
+def test_exclude_closes_branch_until_registered():
+    r = Router()
+    r.callback(prefix="active_gw_", exclude=("active_gw_page_",))(h_detail)
+    r.callback(exact="active_gw_back")(h_back)
+    assert r.match_callback("active_gw_5") is h_detail
+    assert r.match_callback("active_gw_back") is h_back
+    assert r.match_callback("active_gw_page_2") is None
+    r.callback(prefix="active_gw_page_")(h_buy)
+    assert r.match_callback("active_gw_page_2") is h_buy
+
+
+def test_previously_shadowed_callbacks_reach_their_handlers():
+    # с lambda-фильтрами их перехватывали зарегистрированные раньше buy_ и active_gw_
+    assert router.match_callback("buy_biz_2") is main.buy_business_choose
+    assert router.match_callback("buy_business_menu") is main.buy_business_menu
+    assert router.match_callback("buy_from_150") is main.buy_from_price
+    assert router.match_callback("buy_from_market") is main.buy_from_price
+    assert router.match_callback("active_gw_back") is main.active_gw_back
+
+
+def test_unshadowed_callbacks_keep_their_handlers():
+    assert router.match_callback("buy_12") is main.buy_callback
+    assert router.match_callback("active_gw_4") is main.active_giveaway_detail
+    assert router.match_callback("sell_to_120") is main.sell_to_price
+    assert router.match_callback("completed_gw_3") is main.completed_giveaway_detail
+    assert router.match_callback("completed_gw_page_2") is main.completed_gw_page_callback
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+import main
+from main import SettingsSnapshot
+
+
+def test_unparseable_values_fall_back_to_zero():
+    snapshot = SettingsSnapshot.from_raw({
+        'level_multiplier': 'inf', 'global_cooldown_seconds': '1e400',
+        'casino_min_bet': 'abc', 'dice_win_threshold': '7.0',
+    })
+    assert snapshot.level_multiplier == 0
+    assert snapshot.global_cooldown_seconds == 0
+    assert snapshot.casino_min_bet == 0.0
+    assert snapshot.dice_win_threshold == 7
+
+
+def test_defaults_and_raw_lookup():
+    snapshot = SettingsSnapshot.from_raw({})
+    assert snapshot.level_multiplier == int(main.DEFAULT_SETTINGS['level_multiplier'])
+    assert snapshot.chat_notify_big_win is True
+    assert snapshot.get('exchange_commission_side') == 'seller'
+    assert snapshot.replace('level_multiplier', '50').level_multiplier == 50
+
+
+@pytest.mark.parametrize("key, value", [
+    ('level_multiplier', 'inf'), ('level_multiplier', '1.5'), ('level_multiplier', 'x'),
+    ('casino_win_chance', 'nan'), ('chat_notify_big_win', 'yes'),
+])
+def test_set_setting_rejects_before_writing(key, value):
+    with pytest.raises(ValueError):
+        asyncio.run(main.set_setting(key, value))   # db_pool не нужен – до UPDATE не доходит
+
+
+@pytest.mark.parametrize("key, value", [
+    ('level_multiplier', '120'), ('casino_win_chance', '37.5'),
+    ('chat_notify_big_win', '0'), ('exchange_commission_side', 'buyer'),
+])
+def test_valid_values_pass(key, value):
+    main.validate_setting(key, value)
@@ -0,0 +1,44 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import main
+
+
+class RaceConnection:
+    """Первый запрос проигрывает гонку вставки: ни RETURNING, ни снимок SELECT строки не дают."""
+
+    def __init__(self, row):
+        self.row = row
+        self.queries = []
+
+    async def fetchrow(self, query, *args):
+        self.queries.append(query)
+        return None if len(self.queries) == 1 else self.row
+
+
+def test_concurrent_first_insert_rereads_user(monkeypatch):
+    row = {'user_id': 42, 'created': False, 'bot_blocked': False}
+    conn = RaceConnection(row)
+
+    @asynccontextmanager
+    async def fake_db_conn():
+        yield conn
+
+    async def no(*args):
+        return False
+
+    monkeypatch.setattr(main, "settings_snapshot", main.SettingsSnapshot.from_raw({}))
+    monkeypatch.setattr(main, "db_conn", fake_db_conn)
+    monkeypatch.setattr(main, "is_banned", no)
+    monkeypatch.setattr(main, "is_admin", no)
+
+    user = SimpleNamespace(id=42, username="u", first_name="U")
+    ctx = asyncio.run(main.load_user_context(user))
+
+    assert ctx.user_id == 42
+    assert ctx.created is False and ctx.bonus == 0
+    assert len(conn.queries) == 2
+    assert "users_full" in conn.queries[1] and "INSERT" not in conn.queries[1]
+    for query in conn.queries:
+        assert "SELECT *" not in query